@@ -0,0 +1,14 @@
+"""Benchmarks of the MDT hot paths, using `airspeed velocity <https://asv.readthedocs.io>`_.
+
+The benchmarks run on synthetic phantoms (see :func:`mdt.simulations.create_phantom`) using the CPU OpenCL devices,
+such that they can be run on any machine without a GPU or network access. Most benchmarks are parameterized on the
+number of voxels, such that regressions in the number of voxels per second can be tracked across releases.
+
+To run the benchmarks against the current checkout, use::
+
+    $ asv run --python=same --quick
+
+or to compare two releases::
+
+    $ asv continuous v1.2.0 HEAD
+"""
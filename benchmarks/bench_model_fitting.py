@@ -0,0 +1,77 @@
+"""Benchmarks of the model fitting, sampling and bootstrapping on synthetic phantoms."""
+import timeit
+import mdt
+from benchmarks.common import TemporaryDirectoryBenchmark, get_phantom, get_cpu_device_indices
+
+__author__ = 'Robbert Harms'
+__date__ = '2020-05-22'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert@xkls.nl'
+__licence__ = 'LGPL v3'
+
+
+class FitModel(TemporaryDirectoryBenchmark):
+    """Fit a single model, without the cascaded initializations, on phantoms of increasing size."""
+    params = (['BallStick_r1', 'Tensor', 'NODDI', 'CHARMED_r1'], [100, 1000, 10000])
+    param_names = ['model', 'nmr_voxels']
+    timeout = 1800
+    number = 1
+    repeat = 3
+
+    def setup(self, model_name, nmr_voxels):
+        super().setup()
+        self.input_data = get_phantom(model_name, nmr_voxels)[0]
+
+    def _fit(self, model_name):
+        mdt.fit_model(model_name, self.input_data, self.get_tmp_path('output'),
+                      recalculate=True, use_cascaded_inits=False,
+                      cl_device_ind=get_cpu_device_indices(), tmp_results_dir=self.get_tmp_path('tmp'))
+
+    def time_fit_model(self, model_name, nmr_voxels):
+        self._fit(model_name)
+
+    def track_voxels_per_second(self, model_name, nmr_voxels):
+        start_time = timeit.default_timer()
+        self._fit(model_name)
+        return nmr_voxels / (timeit.default_timer() - start_time)
+    track_voxels_per_second.unit = 'voxels/s'
+
+
+class SampleModel(TemporaryDirectoryBenchmark):
+    """Sample a model using the Adaptive Metropolis-Within-Gibbs sampler."""
+    params = (['BallStick_r1', 'NODDI'], [100, 1000])
+    param_names = ['model', 'nmr_voxels']
+    timeout = 1800
+    number = 1
+    repeat = 3
+
+    def setup(self, model_name, nmr_voxels):
+        super().setup()
+        self.input_data = get_phantom(model_name, nmr_voxels)[0]
+
+    def time_sample_model(self, model_name, nmr_voxels):
+        mdt.sample_model(model_name, self.input_data, self.get_tmp_path('output'),
+                         nmr_samples=500, burnin=0, thinning=1, method='AMWG', recalculate=True,
+                         cl_device_ind=get_cpu_device_indices(), tmp_results_dir=self.get_tmp_path('tmp'))
+
+
+class BootstrapModel(TemporaryDirectoryBenchmark):
+    """Bootstrap a model starting from the optimization results."""
+    params = (['BallStick_r1', 'Tensor'], ['wild', 'residual'], [100, 1000])
+    param_names = ['model', 'bootstrap_method', 'nmr_voxels']
+    timeout = 1800
+    number = 1
+    repeat = 3
+
+    def setup(self, model_name, bootstrap_method, nmr_voxels):
+        super().setup()
+        self.input_data = get_phantom(model_name, nmr_voxels)[0]
+        self.optimization_results = mdt.fit_model(
+            model_name, self.input_data, self.get_tmp_path('output'), use_cascaded_inits=False,
+            cl_device_ind=get_cpu_device_indices(), tmp_results_dir=self.get_tmp_path('tmp'))
+
+    def time_bootstrap_model(self, model_name, bootstrap_method, nmr_voxels):
+        mdt.bootstrap_model(model_name, self.input_data, self.optimization_results, self.get_tmp_path('output'),
+                            bootstrap_method=bootstrap_method, nmr_samples=100, recalculate=True,
+                            keep_samples=False, cl_device_ind=get_cpu_device_indices(),
+                            tmp_results_dir=self.get_tmp_path('tmp'))
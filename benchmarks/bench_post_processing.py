@@ -0,0 +1,25 @@
+"""Benchmarks of the post-processing routines."""
+from mdt.lib.post_processing import DKIMeasures
+from benchmarks.common import get_phantom, cpu_context
+
+__author__ = 'Robbert Harms'
+__date__ = '2020-05-22'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert@xkls.nl'
+__licence__ = 'LGPL v3'
+
+
+class DKIMeasuresExtraMaps:
+    """Compute the mean, axial and radial kurtosis from Kurtosis model parameters."""
+    params = [1000, 10000, 100000]
+    param_names = ['nmr_voxels']
+    timeout = 600
+
+    def setup(self, nmr_voxels):
+        ground_truth = get_phantom('Kurtosis', nmr_voxels)[1]
+        self.parameters = {key.split('.')[-1]: value for key, value in ground_truth.items()
+                           if key.startswith('KurtosisTensor.')}
+
+    def time_extra_optimization_maps(self, nmr_voxels):
+        with cpu_context():
+            DKIMeasures.extra_optimization_maps(self.parameters)
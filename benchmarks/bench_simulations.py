@@ -0,0 +1,56 @@
+"""Benchmarks of the signal simulation, comparing the OpenCL and the NumPy backends."""
+from mdt.lib.numpy_backend import compare_backends
+from mdt.simulations import simulate_signals
+from benchmarks.common import get_phantom, get_protocol, cpu_context
+
+__author__ = 'Robbert Harms'
+__date__ = '2020-05-22'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert@xkls.nl'
+__licence__ = 'LGPL v3'
+
+
+class SimulateSignals:
+    """Simulate the signals of the ground truth parameters of a phantom, using either backend."""
+    params = (['BallStick_r1', 'Tensor'], ['opencl', 'numpy'], [100, 10000])
+    param_names = ['model', 'backend', 'nmr_voxels']
+    timeout = 600
+
+    def setup(self, model_name, backend, nmr_voxels):
+        self.protocol = get_protocol(model_name)
+        self.parameters = get_phantom(model_name, nmr_voxels)[1]
+
+    def time_simulate_signals(self, model_name, backend, nmr_voxels):
+        with cpu_context():
+            simulate_signals(model_name, self.protocol, self.parameters, backend=backend)
+
+
+class CompareBackends:
+    """Compare the backends using :func:`~mdt.lib.numpy_backend.compare_backends`.
+
+    The speedup is tracked against the first OpenCL run, which includes the kernel compilation, and against the
+    subsequent OpenCL runs.
+    """
+    params = (['BallStick_r1', 'Tensor'], [100, 10000])
+    param_names = ['model', 'nmr_voxels']
+    timeout = 600
+    number = 1
+    repeat = 1
+
+    def setup(self, model_name, nmr_voxels):
+        protocol = get_protocol(model_name)
+        parameters = get_phantom(model_name, nmr_voxels)[1]
+        with cpu_context():
+            self.comparison = compare_backends(model_name, protocol, parameters)
+
+    def track_numpy_speedup(self, model_name, nmr_voxels):
+        return self.comparison['opencl_first_run'] / self.comparison['numpy']
+    track_numpy_speedup.unit = 'times'
+
+    def track_numpy_speedup_compiled(self, model_name, nmr_voxels):
+        return self.comparison['opencl'] / self.comparison['numpy']
+    track_numpy_speedup_compiled.unit = 'times'
+
+    def track_max_relative_difference(self, model_name, nmr_voxels):
+        return self.comparison['max_relative_difference']
+    track_max_relative_difference.unit = 'relative'
@@ -0,0 +1,78 @@
+"""Benchmarks of the conversions between volumes and ROIs and of writing the (intermediate) results."""
+import numpy as np
+from mdt.lib.nifti import write_all_as_nifti
+from mdt.lib.processing.processing_strategies import SimpleModelProcessor
+from mdt.utils import create_roi, restore_volumes
+from benchmarks.common import TemporaryDirectoryBenchmark
+
+__author__ = 'Robbert Harms'
+__date__ = '2020-05-22'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert@xkls.nl'
+__licence__ = 'LGPL v3'
+
+
+def _get_mask(shape, fraction=0.5, seed=0):
+    """Get a random mask with the given fraction of the voxels set."""
+    return np.random.RandomState(seed).rand(*shape) < fraction
+
+
+def _get_roi_maps(nmr_maps, nmr_voxels, seed=0):
+    """Get a dictionary with random ROI maps, the last map has a fourth dimension."""
+    random_state = np.random.RandomState(seed)
+    maps = {'map_{}'.format(ind): random_state.rand(nmr_voxels).astype(np.float32) for ind in range(nmr_maps - 1)}
+    maps['covariances'] = random_state.rand(nmr_voxels, 10).astype(np.float32)
+    return maps
+
+
+class RoiConversions:
+    """Convert many maps between volumes and ROIs, as done in the post-processing and result writing."""
+    params = ([(32, 32, 16), (96, 96, 64)], [1, 50])
+    param_names = ['volume_shape', 'nmr_maps']
+
+    def setup(self, volume_shape, nmr_maps):
+        self.mask = _get_mask(volume_shape)
+        self.roi_maps = _get_roi_maps(nmr_maps, int(np.count_nonzero(self.mask)))
+        self.volumes = restore_volumes(self.roi_maps, self.mask)
+
+    def time_create_roi(self, volume_shape, nmr_maps):
+        # create_roi converts the maps of a dictionary on access, iterating over the items forces the conversion
+        dict(create_roi(self.volumes, self.mask).items())
+
+    def time_restore_volumes(self, volume_shape, nmr_maps):
+        restore_volumes(self.roi_maps, self.mask)
+
+
+class WriteNifti(TemporaryDirectoryBenchmark):
+    """Write result volumes as (gzipped) nifti files."""
+    params = ([(32, 32, 16), (96, 96, 64)], [False, True])
+    param_names = ['volume_shape', 'gzip']
+    number = 1
+
+    def setup(self, volume_shape, gzip):
+        super().setup()
+        mask = _get_mask(volume_shape)
+        self.volumes = restore_volumes(_get_roi_maps(20, int(np.count_nonzero(mask))), mask)
+
+    def time_write_all_as_nifti(self, volume_shape, gzip):
+        write_all_as_nifti(self.volumes, self.get_tmp_path('output'), gzip=gzip)
+
+
+class WriteVolumes(TemporaryDirectoryBenchmark):
+    """Write the results of all the chunks of a fit to the temporary storage of a model processor."""
+    params = ([(32, 32, 16), (96, 96, 64)], [1000, 10000])
+    param_names = ['volume_shape', 'chunk_size']
+    number = 1
+
+    def setup(self, volume_shape, chunk_size):
+        super().setup()
+        mask = _get_mask(volume_shape)
+        self.nmr_voxels = int(np.count_nonzero(mask))
+        self.roi_maps = _get_roi_maps(20, self.nmr_voxels)
+        self.processor = SimpleModelProcessor(mask, None, self.get_tmp_path('output'), self.get_tmp_path('tmp'), True)
+
+    def time_write_volumes(self, volume_shape, chunk_size):
+        for start in range(0, self.nmr_voxels, chunk_size):
+            roi_indices = np.arange(start, min(start + chunk_size, self.nmr_voxels))
+            self.processor._write_volumes({k: v[roi_indices] for k, v in self.roi_maps.items()},
+                                          roi_indices, self.get_tmp_path('tmp'))
@@ -0,0 +1,101 @@
+"""Shared functionality for the benchmarks."""
+import os
+import shutil
+import tempfile
+from pkg_resources import resource_filename
+import mot.configuration
+import mdt
+from mdt.simulations import create_phantom
+
+__author__ = 'Robbert Harms'
+__date__ = '2020-05-22'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert@xkls.nl'
+__licence__ = 'LGPL v3'
+
+
+_protocols = {
+    'b1k_b2k': 'data/mdt_example_data/b1k_b2k/b1k_b2k.prtcl',
+    'multishell_b6k_max': 'data/mdt_example_data/multishell_b6k_max/multishell_b6k_max.prtcl'
+}
+
+_model_protocols = {
+    'BallStick_r1': 'b1k_b2k',
+    'Tensor': 'b1k_b2k',
+    'NODDI': 'b1k_b2k',
+    'Kurtosis': 'multishell_b6k_max',
+    'CHARMED_r1': 'multishell_b6k_max'
+}
+
+
+def get_protocol(model_name):
+    """Get the protocol of the example data suitable for the given model.
+
+    Args:
+        model_name (str): the name of one of the benchmarked models
+
+    Returns:
+        mdt.protocols.Protocol: the protocol of the example data
+    """
+    return mdt.load_protocol(resource_filename('mdt', _protocols[_model_protocols[model_name]]))
+
+
+def get_phantom(model_name, nmr_voxels, seed=0):
+    """Create a reproducible synthetic phantom for the given model.
+
+    Args:
+        model_name (str): the name of the model to simulate
+        nmr_voxels (int): the number of voxels in the phantom
+        seed (int): the seed of the random number generation
+
+    Returns:
+        tuple: the input data and the ground truth parameters, see :func:`mdt.simulations.create_phantom`.
+    """
+    with cpu_context():
+        return create_phantom(model_name, get_protocol(model_name), nmr_voxels, seed=seed)
+
+
+def get_cpu_devices():
+    """Get the CPU OpenCL devices the benchmarks run on.
+
+    Returns:
+        list of mot.lib.cl_environments.CLEnvironment: the CPU devices
+    """
+    devices = mdt.get_cl_devices(device_type='CPU')
+    if not devices:
+        raise NotImplementedError('The benchmarks require an OpenCL CPU device.')
+    return devices
+
+
+def get_cpu_device_indices():
+    """Get the indices of the CPU OpenCL devices, for the ``cl_device_ind`` argument of the MDT functions.
+
+    Returns:
+        list of int: the indices of the CPU devices in the list of :func:`mdt.get_cl_devices`.
+    """
+    all_devices = mdt.get_cl_devices()
+    return [all_devices.index(device) for device in get_cpu_devices()]
+
+
+def cpu_context():
+    """Get a context manager running all the OpenCL computations within it on the CPU devices, in single precision.
+
+    Returns:
+        contextmanager: the MOT configuration context
+    """
+    return mot.configuration.config_context(mot.configuration.RuntimeConfigurationAction(
+        cl_environments=get_cpu_devices(), double_precision=False))
+
+
+class TemporaryDirectoryBenchmark:
+    """Base class for benchmarks writing output, this creates a new temporary directory for every benchmark."""
+
+    def setup(self, *args):
+        self.tmp_dir = tempfile.mkdtemp(prefix='mdt_benchmark_')
+
+    def teardown(self, *args):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def get_tmp_path(self, *path):
+        """Get a path within the temporary directory of this benchmark."""
+        return os.path.join(self.tmp_dir, *path)
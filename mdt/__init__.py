@@ -22,7 +22,7 @@ from mdt.component_templates.compartment_models import CompartmentTemplate, Weig
 from mdt.component_templates.composite_models import CompositeModelTemplate
 from mdt.component_templates.library_functions import LibraryFunctionTemplate
 
-from mdt.lib.processing.model_fitting import get_batch_fitting_function
+from mdt.lib.processing.model_fitting import get_batch_fitting_function, run_batch_fitting
 from mdt.utils import estimate_noise_std, get_cl_devices, create_blank_mask, create_index_matrix, \
     volume_index_to_roi_index, roi_index_to_volume_index, load_brain_mask, init_user_settings, restore_volumes, \
     apply_mask, create_roi, volume_merge, protocol_merge, create_median_otsu_brain_mask, create_brain_mask, \
@@ -30,16 +30,17 @@ from mdt.utils import estimate_noise_std, get_cl_devices, create_blank_mask, cre
     get_slice_in_dimension, per_model_logging_context, \
     get_temporary_results_dir, get_example_data, SimpleInitializationData, InitializationData, load_volume_maps, \
     covariance_to_correlation, check_user_components, unzip_nifti, zip_nifti, combine_dict_to_array, \
-    compute_noddi_dti
+    compute_noddi_dti, MaskIndex, get_mask_index
 from mdt.lib.input_data import load_input_data
 from mdt.lib.sorting import sort_orientations, create_4d_sort_matrix, sort_volumes_per_voxel
-from mdt.simulations import create_signal_estimates, simulate_signals, add_rician_noise
+from mdt.simulations import create_signal_estimates, simulate_signals, add_rician_noise, create_phantom
 from mdt.lib.batch_utils import run_function_on_batch_fit_output, batch_apply, \
     batch_profile_factory, get_subject_selection
 from mdt.protocols import load_bvec_bval, load_protocol, auto_load_protocol, write_protocol, write_bvec_bval, \
     create_protocol
 from mdt.configuration import config_context, get_processing_strategy, get_config_option, set_config_option
 from mdt.lib.exceptions import InsufficientProtocolError
+from mdt.lib.profiling import profiling_context
 from mdt.lib.nifti import write_nifti, get_all_nifti_data
 from mdt.lib.components import get_model, get_batch_profile, get_component, get_template
 
@@ -52,7 +53,7 @@ __email__ = "robbert@xkls.nl"
 
 
 def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=None,
-                           method=None, optimizer_options=None, double_precision=False):
+                           method=None, optimizer_options=None, double_precision=False, results_cache=None):
     """Get better optimization starting points for the given model.
 
     Since initialization can make quite a difference in optimization results, this function can generate
@@ -77,7 +78,7 @@ def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=
         input_data (:class:`~mdt.lib.input_data.MRIInputData`): the input data object containing all
             the info needed for model fitting of intermediate models.
         output_folder (string): The path to the folder where to place the output, we will make a subdir with the
-            model name in it.
+            model name in it. If None, the intermediate models are fitted in memory.
         cl_device_ind (int or list): the index of the CL device to use. The index is from the list from the function
             utils.get_cl_devices(). This can also be a list of device indices.
         method (str): The optimization method to use, one of:
@@ -89,6 +90,9 @@ def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=
             If not given, defaults to 'Powell'.
         optimizer_options (dict): extra options passed to the optimization routines.
         double_precision (boolean): if we would like to do the calculations in double precision
+        results_cache (mdt.lib.processing.model_fitting.CascadeResultsCache): optional in-memory cache with the
+            results of intermediate models. If given, intermediate models are only fitted if their results are not
+            yet in this cache.
 
     Returns:
         dict: a dictionary with initialization points for the selected model
@@ -96,7 +100,7 @@ def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=
     from mdt.lib.processing.model_fitting import get_optimization_inits
     return get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=cl_device_ind,
                                   method=method, optimizer_options=optimizer_options,
-                                  double_precision=double_precision)
+                                  double_precision=double_precision, results_cache=results_cache)
 
 
 def fit_model(model, input_data, output_folder,
@@ -104,7 +108,7 @@ def fit_model(model, input_data, output_folder,
               cl_device_ind=None, cl_load_balancer=None,
               double_precision=False, tmp_results_dir=True,
               initialization_data=None, use_cascaded_inits=True,
-              post_processing=None):
+              post_processing=None, results_cache=None, profile=False):
     """Run the optimizer on the given model.
 
     Args:
@@ -113,7 +117,8 @@ def fit_model(model, input_data, output_folder,
         input_data (:class:`~mdt.lib.input_data.MRIInputData`): the input data object containing all
             the info needed for the model fitting.
         output_folder (string): The path to the folder where to place the output, we will make a subdir with the
-            model name in it.
+            model name in it. If None, the model (and any intermediate model of the cascade) is fitted in memory
+            and no files are written. In that case the ``recalculate`` and ``tmp_results_dir`` arguments are ignored.
         method (str): The optimization method to use, one of:
             - 'Levenberg-Marquardt'
             - 'Nelder-Mead'
@@ -154,6 +159,13 @@ def fit_model(model, input_data, output_folder,
             For valid elements, please see the configuration file settings for ``optimization``
             under ``post_processing``. Valid input for this parameter is for example: {'covariance': False}
             to disable automatic calculation of the covariance from the Hessian.
+        results_cache (mdt.lib.processing.model_fitting.CascadeResultsCache): optional in-memory cache for the
+            results of the models fitted on this input data. If given, the fit results are stored in this cache and
+            the cascaded initializations use the cached results of the intermediate models, if available. When
+            fitting in memory, a new cache is used for the cascade if none is given.
+        profile (boolean): if set, we record the processing time and peak memory of every processing stage and write
+            a summary and a Chrome trace file to the model output folder. See :mod:`mdt.lib.profiling`.
+            When fitting in memory, the summary is logged instead.
 
     Returns:
         dict: The result maps for the given composite model or the last model in the cascade.
@@ -184,35 +196,47 @@ def fit_model(model, input_data, output_folder,
     if post_processing:
         model_instance.update_active_post_processing('optimization', post_processing)
 
-    if use_cascaded_inits:
-        initialization_data['inits'] = initialization_data.get('inits', {})
-        inits = get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=cl_device_ind,
-                                       method=method, optimizer_options=optimizer_options,
-                                       double_precision=double_precision)
-        inits.update(initialization_data['inits'])
-        initialization_data['inits'] = inits
-        logger.info('Preparing {0} with the cascaded initializations.'.format(model_name))
+    output_path = None if output_folder is None else os.path.join(output_folder, model_name)
 
-    initialization_data = SimpleInitializationData(**initialization_data)
-    initialization_data.apply_to_model(model_instance, input_data)
+    with profiling_context(output_path, enabled=profile):
+        if use_cascaded_inits:
+            if output_path is None and results_cache is None:
+                from mdt.lib.processing.model_fitting import CascadeResultsCache
+                results_cache = CascadeResultsCache()
 
-    if method is None:
-        method, optimizer_options = get_optimizer_for_model(model_name)
+            initialization_data['inits'] = initialization_data.get('inits', {})
+            inits = get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=cl_device_ind,
+                                           method=method, optimizer_options=optimizer_options,
+                                           double_precision=double_precision, results_cache=results_cache)
+            inits.update(initialization_data['inits'])
+            initialization_data['inits'] = inits
+            logger.info('Preparing {0} with the cascaded initializations.'.format(model_name))
 
-    with mot.configuration.config_context(CLRuntimeAction(cl_runtime_info)):
-        from mdt.lib.processing.model_fitting import fit_composite_model
-        fit_composite_model(model_instance, input_data, output_folder, method,
-                            get_temporary_results_dir(tmp_results_dir), recalculate=recalculate,
-                            optimizer_options=optimizer_options)
+        initialization_data = SimpleInitializationData(**initialization_data)
+        initialization_data.apply_to_model(model_instance, input_data)
+
+        if method is None:
+            method, optimizer_options = get_optimizer_for_model(model_name)
+
+        with mot.configuration.config_context(CLRuntimeAction(cl_runtime_info)):
+            from mdt.lib.processing.model_fitting import fit_composite_model
+            roi_results = fit_composite_model(model_instance, input_data, output_folder, method,
+                                              get_temporary_results_dir(tmp_results_dir), recalculate=recalculate,
+                                              optimizer_options=optimizer_options)
 
-    return get_all_nifti_data(os.path.join(output_folder, model_name))
+    if results_cache is not None:
+        results_cache.set_results(model_name, roi_results)
+
+    if output_path is None:
+        return restore_volumes(roi_results, input_data.mask)
+    return get_all_nifti_data(output_path)
 
 
 def sample_model(model, input_data, output_folder, nmr_samples=None, burnin=None, thinning=None,
                  method=None, recalculate=False, cl_device_ind=None, cl_load_balancer=None, double_precision=False,
                  store_samples=True, sample_items_to_save=None, tmp_results_dir=True,
                  initialization_data=None, post_processing=None, post_sampling_cb=None,
-                 sampler_options=None):
+                 sampler_options=None, streaming_block_size=None, checkpoint_interval=None, profile=False):
     """Sample a composite model using Markov Chain Monte Carlo sampling.
 
     Args:
@@ -276,6 +300,16 @@ def sample_model(model, input_data, output_folder, nmr_samples=None, burnin=None
                 dictionary with as keys dir-/file-names and as values maps to be stored in the results directory.
         sampler_options (dict): specific options for the MCMC routine. These will be provided to the sampling routine
             as additional keyword arguments to the constructor.
+        streaming_block_size (int): if set, we sample in streaming mode. The chains are generated in blocks of this
+            many samples and the post-sampling statistics are updated after every block, such that the memory use
+            is independent of the chain length. The stored samples are written to disk per block. If not given,
+            we use the value from the configuration.
+        checkpoint_interval (int): if set, we checkpoint the state of the samplers every this many samples. When
+            the sampling is interrupted, running this function again with ``recalculate=False`` continues the chains
+            of the interrupted batch of voxels from the last checkpoint. Checkpoints written using another version of
+            MOT are not used. If not given, we use the value from the configuration.
+        profile (boolean): if set, we record the processing time and peak memory of every processing stage and write
+            a summary and a Chrome trace file to the samples output folder. See :mod:`mdt.lib.profiling`.
 
     Returns:
         dict: if store_samples is True then we return the samples per parameter as a numpy memmap. If store_samples
@@ -297,6 +331,10 @@ def sample_model(model, input_data, output_folder, nmr_samples=None, burnin=None
         burnin = settings['burnin']
     if thinning is None:
         thinning = settings['thinning']
+    if streaming_block_size is None:
+        streaming_block_size = settings['streaming_block_size']
+    if checkpoint_interval is None:
+        checkpoint_interval = settings['checkpoint_interval']
 
     if isinstance(model, str):
         model_instance = get_model(model)()
@@ -309,7 +347,8 @@ def sample_model(model, input_data, output_folder, nmr_samples=None, burnin=None
     if post_processing:
         model_instance.update_active_post_processing('sampling', post_processing)
 
-    with mot.configuration.config_context(CLRuntimeAction(cl_runtime_info)):
+    with mot.configuration.config_context(CLRuntimeAction(cl_runtime_info)), \
+            profiling_context(os.path.join(output_folder, model_instance.name, 'samples'), enabled=profile):
         from mdt.lib.processing.model_sampling import sample_composite_model
         return sample_composite_model(model_instance, input_data, output_folder, nmr_samples, thinning, burnin,
                                       get_temporary_results_dir(tmp_results_dir),
@@ -317,7 +356,9 @@ def sample_model(model, input_data, output_folder, nmr_samples=None, burnin=None
                                       store_samples=store_samples,
                                       sample_items_to_save=sample_items_to_save,
                                       post_sampling_cb=post_sampling_cb,
-                                      sampler_options=sampler_options)
+                                      sampler_options=sampler_options,
+                                      streaming_block_size=streaming_block_size,
+                                      checkpoint_interval=checkpoint_interval)
 
 
 def compute_fim(model, input_data, optimization_results, output_folder=None, cl_device_ind=None, cl_load_balancer=None,
@@ -415,7 +456,7 @@ def compute_fim(model, input_data, optimization_results, output_folder=None, cl_
 def bootstrap_model(model, input_data, optimization_results, output_folder, bootstrap_method=None,
                     bootstrap_options=None, nmr_samples=None, optimization_method=None, optimizer_options=None,
                     recalculate=False, cl_device_ind=None, double_precision=False, keep_samples=True,
-                    tmp_results_dir=True, initialization_data=None):
+                    tmp_results_dir=True, initialization_data=None, profile=False):
     """Resample the model using residual bootstrapping.
 
     This is typically used to construct confidence intervals on the optimized parameters.
@@ -463,6 +504,9 @@ def bootstrap_model(model, input_data, optimization_results, output_folder, boot
                     'inits': {...}
                 }
 
+        profile (boolean): if set, we record the processing time and peak memory of every processing stage and write
+            a summary and a Chrome trace file to the bootstrap output folder. See :mod:`mdt.lib.profiling`.
+
     Returns:
         dict: if keep_samples is True we return the samples per parameter as a numpy memmap.
             If store_samples is False we return None
@@ -496,7 +540,8 @@ def bootstrap_model(model, input_data, optimization_results, output_folder, boot
     if optimization_method is None:
         optimization_method, optimizer_options = get_optimizer_for_model(model_name)
 
-    with mot.configuration.config_context(cl_context_action):
+    profile_dir = os.path.join(output_folder, model_name, '{}_bootstrap'.format(bootstrap_method))
+    with mot.configuration.config_context(cl_context_action), profiling_context(profile_dir, enabled=profile):
         from mdt.lib.processing.model_bootstrapping import compute_bootstrap
         return compute_bootstrap(model_instance, input_data, optimization_results,
                                  output_folder, bootstrap_method, optimization_method, nmr_samples,
@@ -511,7 +556,7 @@ def batch_fit(data_folder, models_to_fit, output_folder=None, batch_profile=None
               subjects_selection=None, recalculate=False,
               cl_device_ind=None, dry_run=False,
               double_precision=False, tmp_results_dir=True,
-              use_gradient_deviations=False):
+              use_gradient_deviations=False, nmr_concurrent_subjects=1, prefetch=True, profile=False):
     """Run all the available and applicable models on the data in the given folder.
 
     The idea is that a single folder is enough to fit_model the computations. One can optionally give it the
@@ -538,6 +583,12 @@ def batch_fit(data_folder, models_to_fit, output_folder=None, batch_profile=None
         tmp_results_dir (str, True or None): The temporary dir for the calculations. Set to a string to use
                 that path directly, set to True to use the config value, set to None to disable.
         use_gradient_deviations (boolean): if you want to use the gradient deviations if present
+        nmr_concurrent_subjects (int): the number of subjects to fit concurrently. If larger than one, the subjects
+            are distributed over this many worker processes, with the CL devices distributed over the workers.
+        prefetch (boolean): if we load the data of the next subject while fitting the current subject. This is only
+            used if we fit one subject at the time.
+        profile (boolean): if set, we write a profile of the processing stages to the output folder of every model,
+            see :mod:`mdt.lib.profiling`.
     Returns:
         The list of subjects we will calculate / have calculated.
     """
@@ -571,12 +622,11 @@ def batch_fit(data_folder, models_to_fit, output_folder=None, batch_profile=None
         logger.info('Subjects found: {0}'.format(list(subject.subject_id for subject in subjects)))
         return
 
-    batch_fit_func = get_batch_fitting_function(
-        len(subjects), models_to_fit, output_folder, recalculate=recalculate,
-        cl_device_ind=cl_device_ind, double_precision=double_precision,
-        tmp_results_dir=tmp_results_dir, use_gradient_deviations=use_gradient_deviations)
-
-    return batch_apply(data_folder, batch_fit_func, batch_profile=batch_profile, subjects_selection=subjects_selection)
+    return run_batch_fitting(subjects, models_to_fit, output_folder,
+                             nmr_concurrent_subjects=nmr_concurrent_subjects, prefetch=prefetch,
+                             recalculate=recalculate, cl_device_ind=cl_device_ind, double_precision=double_precision,
+                             tmp_results_dir=tmp_results_dir, use_gradient_deviations=use_gradient_deviations,
+                             profile=profile)
 
 
 def view_maps(data, config=None, figure_options=None,
@@ -753,7 +803,9 @@ def write_volume_maps(maps, directory, header=None, overwrite_volumes=True, gzip
         gzip (boolean): if we want to write the results gzipped
     """
     from mdt.lib.nifti import write_all_as_nifti
-    write_all_as_nifti(maps, directory, nifti_header=header, overwrite_volumes=overwrite_volumes, gzip=gzip)
+    from mdt.configuration import get_nifti_writer_options
+    write_all_as_nifti(maps, directory, nifti_header=header, overwrite_volumes=overwrite_volumes, gzip=gzip,
+                       **get_nifti_writer_options())
 
 
 def get_models_list():
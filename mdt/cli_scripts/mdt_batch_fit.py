@@ -98,10 +98,24 @@ class BatchFit(BasicShellApplication):
                             help="Shows what it will do without the dry run argument.")
         parser.set_defaults(dry_run=False)
 
+        parser.add_argument('--nmr-concurrent-subjects', dest='nmr_concurrent_subjects', type=int, default=1,
+                            help="The number of subjects to fit concurrently, each in its own process. "
+                                 "The CL devices are distributed over these processes. Defaults to 1.")
+
+        parser.add_argument('--prefetch', dest='prefetch', action='store_true',
+                            help="Load the data of the next subject while fitting the current one. (default)")
+        parser.add_argument('--no-prefetch', dest='prefetch', action='store_false',
+                            help="Do not load the data of the next subject in the background.")
+        parser.set_defaults(prefetch=True)
+
         parser.add_argument('--tmp-results-dir', dest='tmp_results_dir', default='True', type=str,
                             help='The directory for the temporary results. The default ("True") uses the config file '
                                  'setting. Set to the literal "None" to disable.').completer = FilesCompleter()
 
+        parser.add_argument('--profile', dest='profile', action='store_true',
+                            help='Write the processing time and peak memory per processing stage to '
+                                 'profile_summary.json and profile_trace.json in the model output folder.')
+
         return parser
 
     def run(self, args, extra_args):
@@ -130,7 +144,10 @@ class BatchFit(BasicShellApplication):
                       double_precision=args.double_precision,
                       dry_run=args.dry_run,
                       tmp_results_dir=tmp_results_dir,
-                      use_gradient_deviations=args.use_gradient_deviations)
+                      use_gradient_deviations=args.use_gradient_deviations,
+                      nmr_concurrent_subjects=args.nmr_concurrent_subjects,
+                      prefetch=args.prefetch,
+                      profile=args.profile)
 
 
 def get_doc_arg_parser():
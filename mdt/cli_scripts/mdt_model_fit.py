@@ -111,6 +111,10 @@ class ModelFit(BasicShellApplication):
         parser.add_argument('--extra-protocol', dest='extra_protocol', type=str, nargs='+',
                             help='Additional protocol values, provide as <key>=<value> pairs')
 
+        parser.add_argument('--profile', dest='profile', action='store_true',
+                            help='Write the processing time and peak memory per processing stage to '
+                                 'profile_summary.json and profile_trace.json in the model output folder.')
+
         return parser
 
     def run(self, args, extra_args):
@@ -152,7 +156,8 @@ class ModelFit(BasicShellApplication):
                           cl_device_ind=args.cl_device_ind,
                           double_precision=args.double_precision,
                           tmp_results_dir=tmp_results_dir,
-                          use_cascaded_inits=args.use_cascaded_inits)
+                          use_cascaded_inits=args.use_cascaded_inits,
+                          profile=args.profile)
 
         if args.config_context:
             with mdt.config_context(args.config_context):
@@ -19,6 +19,7 @@ using :py:func:`config_context`. Example:
         mdt.fit_model(...)
 """
 import os
+import sys
 import re
 from copy import deepcopy
 
@@ -57,6 +58,18 @@ def get_config_option(option_name):
         return config[option_name[-1]]
 
 
+def get_config_dict():
+    """Get a copy of the complete current configuration.
+
+    This can for example be used to transfer the current configuration to a subprocess,
+    see :class:`SetConfigDict`.
+
+    Returns:
+        dict: a deep copy of the current configuration
+    """
+    return deepcopy(_config)
+
+
 def set_config_option(option_name, value):
     """Set the current configuration option for the given option name.
 
@@ -258,6 +271,18 @@ class OutputFormatLoader(ConfigSectionLoader):
             if 'gzip' in options:
                 _config_insert(['output_format', item, 'gzip'], bool(options['gzip']))
 
+        if 'compression_level' in value:
+            _config_insert(['output_format', 'compression_level'], int(value['compression_level']))
+
+        if 'nmr_threads' in value:
+            _config_insert(['output_format', 'nmr_threads'], value['nmr_threads'])
+
+        if 'multithreaded_gzip' in value:
+            _config_insert(['output_format', 'multithreaded_gzip'], bool(value['multithreaded_gzip']))
+
+        if 'results_container' in value:
+            _config_insert(['output_format', 'results_container'], bool(value['results_container']))
+
 
 class LoggingLoader(ConfigSectionLoader):
     """Loader for the top level key logging. """
@@ -298,6 +323,8 @@ class SampleSettingsLoader(ConfigSectionLoader):
         settings['nmr_samples'] = settings.get('nmr_samples', 10000)
         settings['burnin'] = settings.get('burnin', 0)
         settings['thinning'] = settings.get('thinning', 1)
+        settings['streaming_block_size'] = settings.get('streaming_block_size', None)
+        settings['checkpoint_interval'] = settings.get('checkpoint_interval', None)
         _config_insert(['sampling', 'general', 'settings'], settings)
 
 
@@ -318,6 +345,15 @@ class TmpResultsDirSectionLoader(ConfigSectionLoader):
         _config_insert(['tmp_results_dir'], value)
 
 
+class RamTmpStorageLoader(ConfigSectionLoader):
+    """Load the settings for placing the temporary results in a RAM filesystem."""
+
+    def load(self, value):
+        for item in ['enabled', 'path', 'memory_budget']:
+            if item in value:
+                _config_insert(['ram_tmp_storage', item], value[item])
+
+
 class ActivePostProcessingLoader(ConfigSectionLoader):
     """Load the default settings for the post sample calculations."""
 
@@ -334,6 +370,9 @@ class ActivePostProcessingLoader(ConfigSectionLoader):
         optimization = value.get('optimization', {})
         optimization['uncertainties'] = optimization.get('uncertainties', True)
         optimization['store_covariances'] = optimization.get('store_covariances', True)
+        optimization['uncertainties_method'] = optimization.get('uncertainties_method', 'hessian')
+        optimization['uncertainties_nmr_steps'] = optimization.get('uncertainties_nmr_steps', 5)
+        optimization['covariances_storage'] = optimization.get('covariances_storage', 'maps')
         optimization['ll_and_ic'] = optimization.get('ll_and_ic', True)
 
         _config_insert(['active_post_processing', 'optimization'], optimization)
@@ -357,6 +396,23 @@ class RuntimeSettingsLoader(ConfigSectionLoader):
         config_dict['runtime_settings'].update(updates)
 
 
+class KernelCacheLoader(ConfigSectionLoader):
+    """Load the kernel cache settings and enable or disable the kernel cache accordingly."""
+
+    def load(self, value):
+        for item in ['enabled', 'max_size', 'cache_dir']:
+            if item in value:
+                _config_insert(['kernel_cache', item], value[item])
+
+        settings = _config['kernel_cache']
+        if settings.get('enabled', False):
+            from mdt.lib.kernel_cache import enable_kernel_cache
+            enable_kernel_cache(settings.get('cache_dir') or os.path.join(get_config_dir(), 'kernel_cache'),
+                                max_size=settings.get('max_size', 500))
+        elif 'mdt.lib.kernel_cache' in sys.modules:
+            sys.modules['mdt.lib.kernel_cache'].disable_kernel_cache()
+
+
 def get_section_loader(section):
     """Get the section loader to use for the given top level section.
 
@@ -384,12 +440,18 @@ def get_section_loader(section):
     if section == 'tmp_results_dir':
         return TmpResultsDirSectionLoader()
 
+    if section == 'ram_tmp_storage':
+        return RamTmpStorageLoader()
+
     if section == 'runtime_settings':
         return RuntimeSettingsLoader()
 
     if section == 'active_post_processing':
         return ActivePostProcessingLoader()
 
+    if section == 'kernel_cache':
+        return KernelCacheLoader()
+
     raise ValueError('Could not find a suitable configuration loader for the section {}.'.format(section))
 
 
@@ -411,6 +473,31 @@ def gzip_sampling_results():
     return _config['output_format']['sampling']['gzip']
 
 
+def get_nifti_writer_options():
+    """Get the options for writing the nifti result volumes.
+
+    Returns:
+        dict: with the keyword arguments ``compression_level``, ``nmr_threads`` and ``multithreaded_gzip`` for
+            the function :func:`mdt.lib.nifti.write_all_as_nifti`.
+    """
+    nmr_threads = _config['output_format'].get('nmr_threads', 1)
+    if nmr_threads is None:
+        nmr_threads = os.cpu_count() or 1
+
+    return {'compression_level': _config['output_format'].get('compression_level', 1),
+            'nmr_threads': nmr_threads,
+            'multithreaded_gzip': _config['output_format'].get('multithreaded_gzip', False)}
+
+
+def use_results_container():
+    """Check if we should write the results in a single results container instead of as separate nifti files.
+
+    Returns:
+        boolean: True if the results should be written to a results container, False otherwise.
+    """
+    return _config['output_format'].get('results_container', False)
+
+
 def get_tmp_results_dir():
     """Get the default tmp results directory.
 
@@ -423,6 +510,19 @@ def get_tmp_results_dir():
     return _config['tmp_results_dir']
 
 
+def get_ram_tmp_storage_settings():
+    """Get the settings for placing the temporary results in a RAM filesystem, see :mod:`mdt.lib.tmp_storage`.
+
+    Returns:
+        dict: with the keys ``enabled``, ``path`` (the directory in the RAM filesystem) and ``memory_budget``
+            (the maximum size in MB of all temporary results in the RAM filesystem, None for half its size).
+    """
+    settings = _config.get('ram_tmp_storage', {})
+    return {'enabled': settings.get('enabled', False),
+            'path': settings.get('path') or '/dev/shm/mdt',
+            'memory_budget': settings.get('memory_budget')}
+
+
 def get_active_post_processing():
     """Get the overview of active post processing switches.
 
@@ -442,13 +542,21 @@ def get_processing_strategy(processing_type, *args, **kwargs):
         *args: passed to the constructor of the loaded processing strategy.
         **kwargs: passed to the constructor of the loaded processing strategy.
 
+    The configuration of a processing type can contain the key ``name`` with the class name of the processing
+    strategy to use, defaults to ``VoxelRange``. All other options are passed to the constructor of that class.
+
     Returns:
         ModelProcessingStrategy: the processing strategy to use for this model
     """
-    from mdt.lib.processing.processing_strategies import VoxelRange
-    options = _config['processing_strategies'].get(processing_type, {}) or {}
+    from mdt.lib.processing import processing_strategies
+    options = dict(_config['processing_strategies'].get(processing_type, {}) or {})
     options.update(kwargs)
-    return VoxelRange(*args, **options)
+    strategy_name = options.pop('name', None) or 'VoxelRange'
+
+    strategy_class = getattr(processing_strategies, strategy_name, None)
+    if strategy_class is None:
+        raise ValueError('Could not find the processing strategy with name {}.'.format(strategy_name))
+    return strategy_class(*args, **options)
 
 
 def get_logging_configuration_dict():
@@ -637,6 +745,22 @@ class YamlStringAction(SimpleConfigAction):
         load_from_yaml(self._yaml_str)
 
 
+class SetConfigDict(SimpleConfigAction):
+
+    def __init__(self, config_dict):
+        """Replace the complete configuration with the given configuration dictionary.
+
+        Args:
+            config_dict (dict): a complete configuration, as for example returned by :func:`get_config_dict`.
+        """
+        super().__init__()
+        self._config_dict = config_dict
+
+    def _apply(self):
+        global _config
+        _config = deepcopy(self._config_dict)
+
+
 class SetGeneralSampler(SimpleConfigAction):
 
     def __init__(self, sampler_name, settings=None):
@@ -2,6 +2,7 @@ import logging
 import numbers
 import numpy as np
 from mdt.lib.exceptions import NoiseStdEstimationNotPossible
+from mdt.lib.nifti import nifti_filepath_resolution
 from mdt.utils import is_scalar, create_roi, estimate_noise_std, load_nifti, restore_volumes, load_protocol, load_brain_mask
 from mot.lib.utils import all_elements_equal, get_single_value
 
@@ -82,12 +83,28 @@ class MRIInputData:
     def observations(self):
         """Return the observations stored in this input data container.
 
+        This loads the observations of all voxels in memory, use :meth:`get_observations_subset` to load the
+        observations of only some of the voxels.
+
         Returns:
             ndarray: The list of observed instances per volumes. Should be a (n, d) matrix of type float with for
                 n voxels and d volumes the measured signal.
         """
         raise NotImplementedError()
 
+    def get_observations_subset(self, roi_indices):
+        """Get the observations of only the given voxels.
+
+        Implementations can override this to read the observations on demand, instead of loading all observations.
+
+        Args:
+            roi_indices (ndarray): the indices of the voxels (in the ROI) for which we want the observations
+
+        Returns:
+            ndarray: a (n, d) matrix with for the n requested voxels the d observations
+        """
+        return self.observations[roi_indices]
+
     @property
     def noise_std(self):
         """The noise standard deviation we will use during model evaluation.
@@ -210,7 +227,8 @@ class SimpleMRIInputData(MRIInputData):
 
         Args:
             protocol (Protocol): The protocol object used as input data to the model
-            signal4d (ndarray): The DWI data (4d matrix)
+            signal4d (ndarray or MemoryMappedVolume): The DWI data (4d matrix). If a memory mapped volume is given,
+                the observations are read on demand from disk.
             mask (ndarray): The mask used to create the observations list
             nifti_header (nifti header): The header of the nifti file to use for writing the results.
             extra_protocol (Dict[str, val]): additional protocol items. Here one may additionally specify values to be
@@ -248,6 +266,7 @@ class SimpleMRIInputData(MRIInputData):
         self._mask = mask
         self._protocol = protocol
         self._observation_list = None
+        self._voxel_coordinates = None
         self._extra_protocol = self._preload_extra_protocol_items(extra_protocol)
         self._noise_std = noise_std
 
@@ -364,6 +383,8 @@ class SimpleMRIInputData(MRIInputData):
 
     @property
     def nmr_voxels(self):
+        if self._observation_list is None and isinstance(self._signal4d, MemoryMappedVolume):
+            return int(np.count_nonzero(self._mask))
         return self.observations.shape[0]
 
     @property
@@ -374,6 +395,13 @@ class SimpleMRIInputData(MRIInputData):
     def signal4d(self):
         return self._signal4d
 
+    def get_observations_subset(self, roi_indices):
+        if self._observation_list is None and isinstance(self._signal4d, MemoryMappedVolume):
+            if self._voxel_coordinates is None:
+                self._voxel_coordinates = np.argwhere(self._mask)
+            return self._signal4d.get_voxels(self._voxel_coordinates[roi_indices])
+        return self.observations[roi_indices]
+
     @property
     def nifti_header(self):
         return self._nifti_header
@@ -743,8 +771,96 @@ class ROIMRIInputData(MRIInputData):
         return return_items
 
 
+class MemoryMappedVolume:
+
+    def __init__(self, filename, volume_indices=None):
+        """A 4d volume which reads its data on demand from an uncompressed nifti file.
+
+        Indexing this volume with a 3d boolean mask only reads the voxels in the mask, and selecting volumes using
+        ``volume[..., indices]`` returns a new memory mapped volume. All other operations load the full volume
+        in memory.
+
+        Args:
+            filename (str): the filename of an uncompressed (.nii) nifti file
+            volume_indices (list of int): if given, the indices of the volumes in the nifti file we use
+
+        Raises:
+            ValueError: if the nifti file does not contain a 4d volume
+        """
+        self._filename = filename
+        self._volume_indices = volume_indices
+        nifti = load_nifti(filename)
+        self._header = nifti.header
+        self._slope, self._inter = nifti.dataobj.slope, nifti.dataobj.inter
+        self._data = np.memmap(filename, dtype=nifti.dataobj.dtype, mode='r', offset=nifti.dataobj.offset,
+                               shape=nifti.dataobj.shape, order='F')
+
+        if self._data.ndim != 4:
+            raise ValueError('The volume "{}" is not a 4d volume.'.format(filename))
+
+    @property
+    def header(self):
+        return self._header
+
+    @property
+    def shape(self):
+        if self._volume_indices is None:
+            return self._data.shape
+        return self._data.shape[:3] + (len(self._volume_indices),)
+
+    @property
+    def ndim(self):
+        return 4
+
+    def get_voxels(self, voxel_coordinates):
+        """Read the data of the given voxels from disk.
+
+        Since the volumes are stored one after another, this only reads the selected volumes from disk.
+
+        Args:
+            voxel_coordinates (ndarray): a (n, 3) matrix with the coordinates of the voxels we want to read
+
+        Returns:
+            ndarray: a (n, d) matrix with for the n voxels the d volumes
+        """
+        voxel_coordinates = np.asarray(voxel_coordinates)
+        if self._volume_indices is None:
+            voxels = self._data[voxel_coordinates[:, 0], voxel_coordinates[:, 1], voxel_coordinates[:, 2]]
+        else:
+            voxels = np.stack([self._data[voxel_coordinates[:, 0], voxel_coordinates[:, 1], voxel_coordinates[:, 2],
+                                          volume_index] for volume_index in self._volume_indices], axis=1)
+        return self._apply_scaling(voxels)
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple) and len(item) == 2 and item[0] is Ellipsis and not is_scalar(item[1]):
+            volume_indices = np.arange(self._data.shape[3])
+            if self._volume_indices is not None:
+                volume_indices = volume_indices[self._volume_indices]
+            return MemoryMappedVolume(self._filename, volume_indices=volume_indices[item[1]].tolist())
+
+        if isinstance(item, np.ndarray) and item.dtype == np.bool_ and item.shape == self.shape[:3]:
+            return self.get_voxels(np.argwhere(item))
+
+        return np.asarray(self)[item]
+
+    def __array__(self, dtype=None):
+        data = self._data
+        if self._volume_indices is not None:
+            data = data[..., self._volume_indices]
+        return np.asarray(self._apply_scaling(data), dtype=dtype)
+
+    def __reduce__(self):
+        return MemoryMappedVolume, (self._filename, self._volume_indices)
+
+    def _apply_scaling(self, data):
+        """Apply the nifti data scaling to the data read from disk, this also copies the data out of the memory map."""
+        if self._slope == 1 and self._inter == 0:
+            return np.array(data)
+        return data * self._slope + self._inter
+
+
 def load_input_data(volume_info, protocol, mask, extra_protocol=None, gradient_deviations=None,
-                    noise_std=None, volume_weights=None):
+                    noise_std=None, volume_weights=None, memory_map=False):
     """Load and create the input data object for diffusion MRI modeling.
 
     Args:
@@ -784,13 +900,23 @@ def load_input_data(volume_info, protocol, mask, extra_protocol=None, gradient_d
             a weight in [0, 1]. If set, these weights are used during model fitting to weigh the objective function
             values per observation.
 
+        memory_map (boolean): if set and the volume is an uncompressed (.nii) nifti file, we memory map the volume
+            instead of loading it. The observations are then read from disk in chunks, as they are needed. This
+            lowers the memory usage for very large datasets.
+
     Returns:
         SimpleMRIInputData: the input data object containing all the info needed for diffusion MRI model fitting
     """
     protocol = load_protocol(protocol)
     mask = load_brain_mask(mask)
 
-    if isinstance(volume_info, str):
+    if isinstance(volume_info, str) and memory_map and nifti_filepath_resolution(volume_info).endswith('.nii'):
+        signal4d = MemoryMappedVolume(nifti_filepath_resolution(volume_info))
+        img_header = signal4d.header
+    elif isinstance(volume_info, str):
+        if memory_map:
+            logging.getLogger(__name__).info('Can not memory map the compressed volume "{}", '
+                                             'loading the volume in memory instead.'.format(volume_info))
         info = load_nifti(volume_info)
         signal4d = info.get_data()
         img_header = info.header
@@ -0,0 +1,219 @@
+"""On-disk cache for the compiled OpenCL kernels.
+
+The CL code of the composite models is regenerated and recompiled on every model fit. Since the generated source code
+is deterministic, we can store the compiled program binaries on disk and reuse them in later runs and other processes.
+
+The cache is keyed by a hash of the kernel source, the device and the compile flags. The total size of the cache is
+bounded, if the cache grows too large, the least recently used kernels are removed.
+
+The cache hooks into the program compilation of MOT and is enabled or disabled using the ``kernel_cache`` section of
+the MDT configuration.
+"""
+import hashlib
+import logging
+import os
+import pyopencl as cl
+import mot.lib.cl_function
+
+__author__ = 'Robbert Harms'
+__date__ = "2018-11-02"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert@xkls.nl"
+
+
+_original_cl_module = mot.lib.cl_function.cl
+
+
+class KernelCache:
+
+    def __init__(self, cache_dir, max_size=500):
+        """Store and load compiled OpenCL programs on disk.
+
+        Args:
+            cache_dir (str): the directory in which to store the compiled programs
+            max_size (float): the maximum size of the cache directory, in MB
+        """
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    def get_program(self, context, kernel_source, options=''):
+        """Get a compiled program for the given source, either from the cache or by compiling the source.
+
+        Args:
+            context (pyopencl.Context): the context for which we want to build the program
+            kernel_source (str): the source of the kernel
+            options (str): the compile flags
+
+        Returns:
+            pyopencl.Program: the compiled program
+        """
+        key = self.get_key(context, kernel_source, options)
+        cache_file = os.path.join(self._cache_dir, key + '.bin')
+
+        if os.path.isfile(cache_file):
+            program = self._load_program(context, cache_file, options)
+            if program is not None:
+                self._logger.debug('Kernel cache hit for kernel {}.'.format(key))
+                return program
+
+        self._logger.debug('Kernel cache miss for kernel {}, compiling the kernel.'.format(key))
+        program = _original_cl_module.Program(context, kernel_source).build(options)
+        self._store_program(program, cache_file)
+        return program
+
+    def get_key(self, context, kernel_source, options=''):
+        """Get the cache key for the given kernel.
+
+        Args:
+            context (pyopencl.Context): the context for which we build the program
+            kernel_source (str): the source of the kernel
+            options (str): the compile flags
+
+        Returns:
+            str: the hexadecimal hash of the kernel source, the devices and the compile flags
+        """
+        hash_func = hashlib.sha256()
+        hash_func.update(kernel_source.encode('utf8'))
+        hash_func.update(str(options).encode('utf8'))
+        hash_func.update(str(cl.VERSION).encode('utf8'))
+        for device in context.devices:
+            hash_func.update('{} {} {} {}'.format(device.platform.name, device.name,
+                                                  device.version, device.driver_version).encode('utf8'))
+        return hash_func.hexdigest()
+
+    def clear(self):
+        """Remove all the compiled kernels from the cache."""
+        for fname in self._get_cache_files():
+            os.remove(fname)
+
+    def _load_program(self, context, cache_file, options):
+        """Load a program from the given cache file.
+
+        Returns:
+            pyopencl.Program: the loaded program, or None if the cached binary could not be used.
+        """
+        try:
+            with open(cache_file, 'rb') as f:
+                binary = f.read()
+            program = _original_cl_module.Program(context, context.devices, [binary] * len(context.devices))
+            program = program.build(options)
+            os.utime(cache_file)
+            return program
+        except (IOError, cl.Error) as exc:
+            self._logger.debug('Could not load cached kernel from {}: {}'.format(cache_file, exc))
+            try:
+                os.remove(cache_file)
+            except OSError:
+                pass
+            return None
+
+    def _store_program(self, program, cache_file):
+        """Store the binary of the given program in the cache and evict old kernels if the cache is too large."""
+        binaries = program.get_info(cl.program_info.BINARIES)
+        if len(set(binaries)) != 1 or not binaries[0]:
+            return
+
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+            with open(tmp_file, 'wb') as f:
+                f.write(binaries[0])
+            os.replace(tmp_file, cache_file)
+        except IOError as exc:
+            self._logger.debug('Could not store the compiled kernel in the cache: {}'.format(exc))
+            return
+
+        self._evict()
+
+    def _evict(self):
+        """Remove the least recently used kernels until the cache is within the maximum size."""
+        cache_files = []
+        for fname in self._get_cache_files():
+            try:
+                stat = os.stat(fname)
+                cache_files.append((stat.st_mtime, stat.st_size, fname))
+            except OSError:
+                pass
+
+        total_size = sum(el[1] for el in cache_files)
+        for _, size, fname in sorted(cache_files):
+            if total_size <= self._max_size * 1024 ** 2:
+                break
+            try:
+                os.remove(fname)
+                total_size -= size
+            except OSError:
+                pass
+
+    def _get_cache_files(self):
+        if not os.path.isdir(self._cache_dir):
+            return []
+        return [os.path.join(self._cache_dir, fname) for fname in os.listdir(self._cache_dir)
+                if fname.endswith('.bin')]
+
+
+class _ProgramCachingCLModule:
+
+    def __init__(self, kernel_cache):
+        """Stand-in for the pyopencl module in MOT, which builds the programs using the kernel cache.
+
+        Args:
+            kernel_cache (KernelCache): the kernel cache to use
+        """
+        self._kernel_cache = kernel_cache
+
+    def Program(self, context, *args):
+        if len(args) == 1 and isinstance(args[0], str):
+            return _CachedProgramBuilder(self._kernel_cache, context, args[0])
+        return _original_cl_module.Program(context, *args)
+
+    def __getattr__(self, item):
+        return getattr(_original_cl_module, item)
+
+
+class _CachedProgramBuilder:
+
+    def __init__(self, kernel_cache, context, kernel_source):
+        """Mimics the construction of a pyopencl Program from source, but builds the program using the cache."""
+        self._kernel_cache = kernel_cache
+        self._context = context
+        self._kernel_source = kernel_source
+
+    def build(self, options=''):
+        return self._kernel_cache.get_program(self._context, self._kernel_source, options)
+
+
+def enable_kernel_cache(cache_dir, max_size=500):
+    """Enable the on-disk kernel cache for all programs compiled by MOT.
+
+    Args:
+        cache_dir (str): the directory in which to store the compiled programs
+        max_size (float): the maximum size of the cache directory, in MB
+
+    Returns:
+        KernelCache: the enabled kernel cache
+    """
+    kernel_cache = KernelCache(cache_dir, max_size=max_size)
+    mot.lib.cl_function.cl = _ProgramCachingCLModule(kernel_cache)
+    return kernel_cache
+
+
+def disable_kernel_cache():
+    """Disable the on-disk kernel cache, MOT will compile all programs from source."""
+    mot.lib.cl_function.cl = _original_cl_module
+
+
+def get_kernel_cache():
+    """Get the currently enabled kernel cache.
+
+    Returns:
+        KernelCache: the current kernel cache, or None if the kernel cache is disabled.
+    """
+    if isinstance(mot.lib.cl_function.cl, _ProgramCachingCLModule):
+        return mot.lib.cl_function.cl._kernel_cache
+    return None
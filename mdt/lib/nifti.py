@@ -1,8 +1,13 @@
+import collections
 import glob
 import gzip
+import io
 import os
 import copy
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import nibabel as nib
+from nibabel.fileholders import FileHolder
 import numpy as np
 import shutil
 
@@ -75,18 +80,29 @@ def get_all_nifti_data(directory, map_names=None, deferred=True):
         deferred (boolean): if True we return an deferred loading dictionary instead of a dictionary with the values
             loaded as arrays.
 
+    If the maps of this directory are (also) stored in a results container (see :mod:`mdt.lib.results_container`),
+    we load those maps from the container as well. Nifti files take precedence over the maps in the container.
+
     Returns:
         dict: A dictionary with the volumes. The keys of the dictionary are the filenames
             without the extension of the .nii(.gz) files in the given directory.
     """
-    proxies = load_all_niftis(directory, map_names=map_names)
+    from mdt.lib.results_container import find_results_container
+
+    proxies = {}
+    container, prefix = find_results_container(directory)
+    if container is not None:
+        proxies.update(container.get_volume_proxies(prefix=prefix, map_names=map_names))
+
+    proxies.update(load_all_niftis(directory, map_names=map_names))
     if deferred:
         return DeferredActionDict(lambda _, item: item.get_data(), proxies)
     else:
         return {k: v.get_data() for k, v in proxies.items()}
 
 
-def write_nifti(data, output_fname, header=None, affine=None, use_data_dtype=True, **kwargs):
+def write_nifti(data, output_fname, header=None, affine=None, use_data_dtype=True, compression_level=1,
+                nmr_compression_threads=1, **kwargs):
     """Write data to a nifti file.
 
     This will write the output directory if it does not exist yet.
@@ -100,6 +116,10 @@ def write_nifti(data, output_fname, header=None, affine=None, use_data_dtype=Tru
         affine (ndarray): the affine transformation matrix
         use_data_dtype (boolean): if we want to use the dtype from the data instead of that from the header
             when saving the nifti.
+        compression_level (int): the gzip compression level for .nii.gz files, from 1 (fastest) to 9 (smallest)
+        nmr_compression_threads (int): the number of threads used to gzip .nii.gz files. If larger than one,
+            the data is compressed in independent blocks, which results in a multi-member gzip file.
+            In both cases the data is compressed while it is written, without first copying it to a single buffer.
         **kwargs: other arguments to Nifti2Image from NiBabel
     """
     if header is None:
@@ -118,18 +138,29 @@ def write_nifti(data, output_fname, header=None, affine=None, use_data_dtype=Tru
     if not (output_fname.endswith('.nii.gz') or output_fname.endswith('.nii')):
         output_fname += '.nii.gz'
 
-    if not os.path.exists(os.path.dirname(output_fname)):
-        os.makedirs(os.path.dirname(output_fname))
+    os.makedirs(os.path.dirname(output_fname), exist_ok=True)
 
     if isinstance(header, nib.nifti2.Nifti2Header):
         format = nib.Nifti2Image
     else:
         format = nib.Nifti1Image
 
-    format(data, affine, header=header, **kwargs).to_filename(output_fname)
+    image = format(data, affine, header=header, **kwargs)
+
+    if output_fname.endswith('.nii.gz'):
+        if nmr_compression_threads > 1:
+            fileobj = _ParallelGzipFile(output_fname, compression_level=compression_level,
+                                        nmr_threads=nmr_compression_threads)
+        else:
+            fileobj = gzip.GzipFile(output_fname, 'wb', compresslevel=compression_level)
+        with fileobj:
+            image.to_file_map({'image': FileHolder(fileobj=fileobj)})
+    else:
+        image.to_filename(output_fname)
 
 
-def write_all_as_nifti(volumes, directory, nifti_header=None, overwrite_volumes=True, gzip=True):
+def write_all_as_nifti(volumes, directory, nifti_header=None, overwrite_volumes=True, gzip=True,
+                       compression_level=1, nmr_threads=1, multithreaded_gzip=False):
     """Write a number of volume maps to the specific directory.
 
     Args:
@@ -139,8 +170,12 @@ def write_all_as_nifti(volumes, directory, nifti_header=None, overwrite_volumes=
         nifti_header: the nifti header to use for each of the volumes.
         overwrite_volumes (boolean): defaults to True, if we want to overwrite the volumes if they exists
         gzip (boolean): if True we write the files as .nii.gz, if False we write the files as .nii
+        compression_level (int): the gzip compression level, from 1 (fastest) to 9 (smallest files)
+        nmr_threads (int): the number of threads to use for writing the volumes
+        multithreaded_gzip (boolean): if set, we write the volumes one by one, compressing each volume using all
+            the threads. If not set, we write multiple volumes at the same time, each compressed by a single thread.
     """
-    for key, volume in volumes.items():
+    def write_volume(key):
         extension = '.nii'
         if gzip:
             extension += '.gz'
@@ -149,11 +184,94 @@ def write_all_as_nifti(volumes, directory, nifti_header=None, overwrite_volumes=
         full_filename = os.path.abspath(os.path.join(directory, filename))
 
         if os.path.exists(full_filename):
-            if overwrite_volumes:
-                os.remove(full_filename)
-                write_nifti(volume, full_filename, header=nifti_header)
-        else:
-            write_nifti(volume, full_filename, header=nifti_header)
+            if not overwrite_volumes:
+                return
+            os.remove(full_filename)
+
+        write_nifti(volumes[key], full_filename, header=nifti_header, compression_level=compression_level,
+                    nmr_compression_threads=(nmr_threads if multithreaded_gzip else 1))
+
+    if nmr_threads > 1 and not multithreaded_gzip:
+        with ThreadPoolExecutor(max_workers=nmr_threads) as executor:
+            list(executor.map(write_volume, volumes.keys()))
+    else:
+        for key in volumes.keys():
+            write_volume(key)
+
+
+class _ParallelGzipFile(io.RawIOBase):
+
+    def __init__(self, output_fname, compression_level=1, nmr_threads=1, block_size=2 ** 22):
+        """A write only file object which gzips the written data using multiple threads.
+
+        The data is split in blocks which are compressed independently and written as separate gzip members. Such
+        multi-member files are valid gzip files, readable by all gzip readers. The written data is compressed while it
+        is being written, such that at most a few blocks per thread are kept in memory.
+
+        Args:
+            output_fname (str): the filename to write to
+            compression_level (int): the gzip compression level
+            nmr_threads (int): the number of threads to use for compressing the data
+            block_size (int): the size of the independently compressed blocks, in bytes
+        """
+        super().__init__()
+        self._file = open(output_fname, 'wb')
+        self._compress = partial(gzip.compress, compresslevel=compression_level)
+        self._max_pending = 2 * nmr_threads
+        self._block_size = block_size
+        self._executor = ThreadPoolExecutor(max_workers=nmr_threads)
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+        self._position = 0
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        nmr_bytes_written = len(data)
+        self._position += nmr_bytes_written
+
+        if self._buffer:
+            nmr_bytes = min(len(data), self._block_size - len(self._buffer))
+            self._buffer += data[:nmr_bytes]
+            data = data[nmr_bytes:]
+            if len(self._buffer) == self._block_size:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+
+        while len(data) >= self._block_size:
+            self._submit(data[:self._block_size] if data.readonly else bytes(data[:self._block_size]))
+            data = data[self._block_size:]
+        self._buffer += data
+        return nmr_bytes_written
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence != io.SEEK_SET or offset != self._position:
+            raise IOError('Can not seek in a file opened for parallel gzip writing.')
+        return self._position
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer or not self._position:
+                self._submit(bytes(self._buffer))
+            while self._pending:
+                self._file.write(self._pending.popleft().result())
+        finally:
+            self._executor.shutdown()
+            self._file.close()
+            super().close()
+
+    def _submit(self, block):
+        """Compress the given block in the background, while writing the compressed blocks that are done."""
+        self._pending.append(self._executor.submit(self._compress, block))
+        while len(self._pending) > self._max_pending or (self._pending and self._pending[0].done()):
+            self._file.write(self._pending.popleft().result())
 
 
 def nifti_filepath_resolution(file_path):
@@ -301,6 +419,9 @@ def nifti_info_decorate_array(array, nifti_info=None):
         def nifti_info(self):
             return self._nifti_info
 
+        def __reduce__(self):
+            return nifti_info_decorate_array, (np.asarray(self), self._nifti_info)
+
         def __array_finalize__(self, obj):
             if obj is None:
                 return
@@ -0,0 +1,302 @@
+"""Evaluate composite models on the CPU using NumPy, without OpenCL.
+
+All model evaluations in MDT normally run in the OpenCL kernels generated by the composite models. For small
+problems, like simulating signals, compiling and dispatching these kernels often takes longer
+than the evaluation itself. This module evaluates the signal of composite models using vectorized NumPy
+implementations of the compartments.
+
+This backend is only used for simulating signals, see :func:`mdt.simulations.simulate_signals`. Model fitting and
+sampling always evaluate the objective function in the OpenCL kernels.
+
+Only models of which all compartments have a NumPy implementation can be evaluated by this backend. Implementations
+for the compartments ``S0``, ``Weight``, ``Ball``, ``Stick``, ``Zeppelin`` and ``Tensor`` are provided, additional
+implementations can be added using :func:`register_compartment_function`.
+"""
+import re
+import timeit
+import numpy as np
+from mdt.model_building.parameters import ProtocolParameter, FreeParameter
+from mdt.utils import spherical_to_cartesian, tensor_spherical_to_cartesian
+
+__author__ = 'Robbert Harms'
+__date__ = '2020-03-02'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert@xkls.nl'
+__licence__ = 'LGPL v3'
+
+
+_compartment_functions = {}
+
+
+def register_compartment_function(compartment_name, function):
+    """Register the NumPy implementation of a compartment.
+
+    The implementation receives the parameters of the compartment as keyword arguments, by their parameter names. The
+    free parameters are given as (n, 1) arrays for n voxels, the protocol parameters as (1, m) arrays for m
+    observations, or as (n, m) arrays if they differ per voxel. The gradient directions ``g`` are given as a (1, m, 3)
+    or (n, m, 3) array. The function should return the compartment signal as an array broadcastable to (n, m).
+
+    Args:
+        compartment_name (str): the name of the compartment, for example ``Stick``
+        function (Callable): the vectorized implementation of the compartment
+    """
+    _compartment_functions[compartment_name] = function
+
+
+def has_compartment_function(compartment_name):
+    """Check if there is a NumPy implementation for the given compartment.
+
+    Args:
+        compartment_name (str): the name of the compartment, for example ``Stick``
+
+    Returns:
+        boolean: if there is a NumPy implementation for this compartment
+    """
+    return compartment_name in _compartment_functions
+
+
+def _s0(s0):
+    return s0
+
+
+def _weight(w):
+    return w
+
+
+def _ball(b, d):
+    return np.exp(-d * b)
+
+
+def _stick(g, b, d, theta, phi):
+    direction = spherical_to_cartesian(theta[:, 0], phi[:, 0])
+    return np.exp(-b * d * np.sum(g * direction[:, None, :], axis=-1) ** 2)
+
+
+def _zeppelin(g, b, d, dperp0, theta, phi):
+    direction = spherical_to_cartesian(theta[:, 0], phi[:, 0])
+    return np.exp(-b * (((d - dperp0) * np.sum(g * direction[:, None, :], axis=-1) ** 2) + dperp0))
+
+
+def _tensor(g, b, d, dperp0, dperp1, theta, phi, psi):
+    vec0, vec1, vec2 = tensor_spherical_to_cartesian(theta[:, 0], phi[:, 0], psi[:, 0])
+    adc = (d * np.sum(g * vec0[:, None, :], axis=-1) ** 2
+           + dperp0 * np.sum(g * vec1[:, None, :], axis=-1) ** 2
+           + dperp1 * np.sum(g * vec2[:, None, :], axis=-1) ** 2)
+    return np.exp(-b * adc)
+
+
+register_compartment_function('S0', _s0)
+register_compartment_function('Weight', _weight)
+register_compartment_function('Ball', _ball)
+register_compartment_function('Stick', _stick)
+register_compartment_function('Zeppelin', _zeppelin)
+register_compartment_function('Tensor', _tensor)
+
+
+class NumpyModelEvaluator:
+
+    def __init__(self, model):
+        """Evaluate a composite model using NumPy.
+
+        The model should have its input data set. Every evaluation is done for all the voxels in the input data,
+        the parameters should therefore be given for all these voxels.
+
+        Args:
+            model (mdt.models.composite.DMRICompositeModel): the model to evaluate
+
+        Raises:
+            ValueError: if the model can not be evaluated using NumPy
+        """
+        problems = get_numpy_backend_problems(model)
+        if problems:
+            raise ValueError('The model "{}" can not be evaluated using the NumPy backend: {}'.format(
+                model.name, ' '.join(problems)))
+
+        self._model = model
+        self._functions_info = model._model_functions_info
+        self._input_data = model.get_input_data()
+        self._estimable_parameters = ['{}.{}'.format(m.name, p.name)
+                                      for m, p in self._functions_info.get_estimable_parameters_list()]
+        self._protocol_values = {p.name: self._prepare_protocol_value(p.name, model._get_protocol_value(p))
+                                 for p in self._functions_info.get_unique_protocol_parameters()}
+
+    def get_signals(self, parameters):
+        """Evaluate the model signal for the given parameters.
+
+        Args:
+            parameters (ndarray): a (n, p) matrix with for n voxels the p free parameters of the model
+
+        Returns:
+            ndarray: a (n, m) matrix with the model signal for each of the m observations
+        """
+        parameter_values = self._get_parameter_values(parameters)
+        signals = self._evaluate_tree(self._model._model_tree, parameter_values)
+        return np.broadcast_to(signals, (parameters.shape[0], self._model.get_nmr_observations())).copy()
+
+    def _get_parameter_values(self, parameters):
+        """Get the values of all model parameters, including the fixed and dependent parameters.
+
+        Args:
+            parameters (ndarray): the (n, p) matrix with the free parameters
+
+        Returns:
+            dict: per parameter (in dot format) the values as (n, 1) arrays or scalars
+        """
+        values = {}
+        for ind, name in enumerate(self._estimable_parameters):
+            values[name] = parameters[:, ind:ind + 1].astype(np.float64)
+
+        for m, p in self._functions_info.get_value_fixed_parameters_list():
+            name = '{}.{}'.format(m.name, p.name)
+            values[name] = self._to_voxel_column(self._functions_info.get_parameter_value(name))
+
+        for m, p in self._functions_info.get_dependency_fixed_parameters_list():
+            name = '{}.{}'.format(m.name, p.name)
+            values[name] = _evaluate_assignment(self._functions_info.get_parameter_value(name).assignment_code,
+                                                values)
+        return values
+
+    def _to_voxel_column(self, value):
+        """Convert a scalar or per voxel value to a scalar or a (n, 1) column."""
+        if np.isscalar(value) or np.asarray(value).size == 1:
+            return float(np.asarray(value).ravel()[0])
+        return np.reshape(np.asarray(value, dtype=np.float64), (-1, 1))
+
+    def _prepare_protocol_value(self, name, value):
+        """Convert a protocol value to a (1, m), (n, m) or for gradient vectors a (1, m, 3) or (n, m, 3) array."""
+        value = np.asarray(value, dtype=np.float64)
+        nmr_observations = self._model.get_nmr_observations()
+        if name == 'g':
+            return np.reshape(value, (-1, nmr_observations, 3))
+        if value.size == 1:
+            return np.reshape(value, (1, 1))
+        return np.reshape(value, (-1, nmr_observations))
+
+    def _evaluate_tree(self, node, parameter_values):
+        """Evaluate the compartment model tree from the given node."""
+        if not node.children:
+            compartment = node.data
+            kwargs = {}
+            for p in compartment.get_parameters():
+                if isinstance(p, ProtocolParameter):
+                    kwargs[p.name] = self._protocol_values[p.name]
+                elif isinstance(p, FreeParameter):
+                    kwargs[p.name] = parameter_values['{}.{}'.format(compartment.name, p.name)]
+            return _compartment_functions[compartment.get_cl_function_name()](**kwargs)
+
+        results = [self._evaluate_tree(child, parameter_values) for child in node.children]
+        combined = results[0]
+        for result in results[1:]:
+            if node.data == '*':
+                combined = combined * result
+            elif node.data == '/':
+                combined = combined / result
+            elif node.data == '+':
+                combined = combined + result
+            else:
+                combined = combined - result
+        return combined
+
+
+def get_numpy_backend_problems(model):
+    """Get the reasons why the given model can not be evaluated using the NumPy backend.
+
+    Args:
+        model (mdt.models.composite.DMRICompositeModel): the model to check, with its input data set
+
+    Returns:
+        list of str: the problems preventing the use of the NumPy backend, empty if the model is supported.
+    """
+    problems = []
+
+    for compartment in model._model_functions_info.get_compartment_models():
+        if not has_compartment_function(compartment.get_cl_function_name()):
+            problems.append('The compartment "{}" has no NumPy implementation.'.format(
+                compartment.get_cl_function_name()))
+
+    if model._signal_noise_model is not None:
+        problems.append('Signal noise models are not supported.')
+
+    if model._get_protocol_update_callbacks():
+        problems.append('Protocol update callbacks, like the gradient deviations, are not supported.')
+
+    for m, p in model._model_functions_info.get_dependency_fixed_parameters_list():
+        if model._model_functions_info.get_parameter_value('{}.{}'.format(m.name, p.name)).pre_transform_code:
+            problems.append('The dependency of the parameter "{}.{}" is not supported.'.format(m.name, p.name))
+
+    return problems
+
+
+def _evaluate_assignment(assignment_code, parameter_values):
+    """Evaluate the (CL) assignment code of a parameter dependency using NumPy.
+
+    This supports the simple dependencies used in most models, consisting of arithmetic, type casts and common
+    math functions.
+
+    Args:
+        assignment_code (str): the CL code of the assignment
+        parameter_values (dict): the values of the parameters referenced in the assignment, in dot format
+
+    Returns:
+        ndarray or float: the value of the dependent parameter
+
+    Raises:
+        ValueError: if the assignment code could not be evaluated
+    """
+    expression = re.sub(r'\((double|float|mot_float_type|int|uint)\)', '', assignment_code.strip().rstrip(';'))
+
+    variables = {}
+    for ind, name in enumerate(sorted(parameter_values, key=len, reverse=True)):
+        if name in expression:
+            variables['_param{}'.format(ind)] = parameter_values[name]
+            expression = expression.replace(name, '_param{}'.format(ind))
+
+    namespace = {'max': np.maximum, 'fmax': np.maximum, 'min': np.minimum, 'fmin': np.minimum,
+                 'exp': np.exp, 'log': np.log, 'sqrt': np.sqrt, 'pow': np.power, 'pown': np.power,
+                 'fabs': np.abs, 'abs': np.abs, 'sin': np.sin, 'cos': np.cos, 'M_PI': np.pi,
+                 '__builtins__': {}}
+    namespace.update(variables)
+
+    try:
+        return eval(expression, namespace)
+    except Exception as exc:
+        raise ValueError('Could not evaluate the parameter dependency "{}" using NumPy: {}'.format(
+            assignment_code, exc))
+
+
+def compare_backends(model, protocol, parameters, nmr_repeats=3):
+    """Compare the signal simulation of the OpenCL and NumPy backends, in run time and in results.
+
+    Args:
+        model (str or model): the model or the name of the model to simulate
+        protocol (mdt.protocols.Protocol): the protocol to simulate
+        parameters (ndarray): the (n, p) matrix with the free parameters for each of the n voxels
+        nmr_repeats (int): the number of times we repeat the simulation, after the first run
+
+    Returns:
+        dict: with the keys ``opencl_first_run`` (the run time including the kernel compilation),
+            ``opencl`` and ``numpy`` (the average run time of the repeats) and ``max_relative_difference``
+            (the maximum difference between the simulated signals, relative to the largest signal of each voxel).
+    """
+    from mdt.simulations import simulate_signals
+
+    def time_simulation(backend):
+        start = timeit.default_timer()
+        signals = simulate_signals(model, protocol, parameters, backend=backend)
+        return timeit.default_timer() - start, signals
+
+    opencl_first_run, opencl_signals = time_simulation('opencl')
+    opencl_times = [time_simulation('opencl')[0] for _ in range(nmr_repeats)]
+
+    numpy_times = []
+    numpy_signals = None
+    for _ in range(nmr_repeats):
+        run_time, numpy_signals = time_simulation('numpy')
+        numpy_times.append(run_time)
+
+    signal_scale = np.maximum(np.max(np.abs(opencl_signals), axis=1, keepdims=True), np.finfo(float).tiny)
+    difference = np.abs(opencl_signals - numpy_signals) / signal_scale
+    return {'opencl_first_run': opencl_first_run,
+            'opencl': float(np.mean(opencl_times)),
+            'numpy': float(np.mean(numpy_times)),
+            'max_relative_difference': float(np.max(difference))}
@@ -4,21 +4,25 @@ import logging
 import os
 import timeit
 import time
+import weakref
 import numpy as np
+import pyopencl as cl
 from numpy.lib.format import open_memmap
-from mdt.configuration import gzip_sampling_results, get_processing_strategy
+from mdt.configuration import gzip_sampling_results, get_processing_strategy, get_nifti_writer_options
 from mdt.lib.deferred_mappings import DeferredActionDict
 from mdt.lib.nifti import write_all_as_nifti
 from mdt.model_building.utils import ParameterDecodingWrapper
 from mdt.utils import load_samples, per_model_logging_context, get_intermediate_results_path, create_roi, \
-    restore_volumes, is_scalar, split_array_to_dict
-from mdt.lib.input_data import ROIMRIInputData
+    restore_volumes, is_scalar, split_array_to_dict, estimate_intermediate_results_size
 from mdt.lib.processing.processing_strategies import SimpleModelProcessor
 from mdt.lib.exceptions import InsufficientProtocolError
+from mdt.lib.profiling import profile_stage
 from mot import minimize
 from mot.configuration import CLRuntimeInfo
+from mot.lib.cl_environments import CLEnvironment
 from mot.lib.cl_function import SimpleCLFunction
-from mot.lib.kernel_data import Array, Zeros
+from mot.lib.kernel_data import Array, Zeros, KernelData
+from mot.library_functions import Rand123
 
 __author__ = 'Robbert Harms'
 __date__ = "2015-05-01"
@@ -77,6 +81,12 @@ def compute_bootstrap(model, input_data, optimization_results, output_folder, bo
 
     bootstrap_options = bootstrap_options or {}
 
+    processing_strategy = get_processing_strategy('sampling')
+
+    estimated_size = None
+    if processing_strategy.supports_local_tmp_storage():
+        estimated_size = estimate_intermediate_results_size(model, input_data.nmr_voxels)
+
     with per_model_logging_context(output_folder, overwrite=recalculate):
         with _log_info(logger, model.name):
             if bootstrap_method == 'residual':
@@ -90,13 +100,12 @@ def compute_bootstrap(model, input_data, optimization_results, output_folder, bo
                 optimization_results,
                 nmr_samples,
                 model, input_data.mask, input_data.nifti_header, output_folder,
-                get_intermediate_results_path(output_folder, tmp_dir), recalculate,
+                get_intermediate_results_path(output_folder, tmp_dir, estimated_size=estimated_size), recalculate,
                 keep_samples=keep_samples,
                 optimizer_options=optimizer_options,
                 **bootstrap_options
             )
 
-            processing_strategy = get_processing_strategy('sampling')
             return processing_strategy.process(worker)
 
 
@@ -123,19 +132,30 @@ class BootstrappingProcessor(SimpleModelProcessor):
     def __init__(self, optimization_method, input_data,
                  optimization_results, nmr_samples, model, mask, nifti_header,
                  output_dir, tmp_storage_dir, recalculate, keep_samples=True,
-                 optimizer_options=None):
+                 optimizer_options=None, nmr_replicates_per_batch=None, use_device_rng=False, seed=None):
         """The processing worker for model sample.
 
+        The bootstrap replicates are not optimized one by one. Instead, a batch of replicates of all the voxels
+        is stacked into one set of independent problem instances, each with their own observations, which are
+        solved in a single optimization run.
+
         Args:
             optimization_method: the optimization routine to use
             optimization_results (dict): the starting point for the bootstrapping method
             nmr_samples (int): the number of samples we would like to return.
+            nmr_replicates_per_batch (int): the number of bootstrap replicates optimized together in one run.
+                If not set, we take as many replicates as fit within about 100000 problem instances per run.
+            use_device_rng (boolean): if set, we generate the observations of the replicates on the compute device,
+                directly in the buffer read by the optimizer, instead of drawing them in Python. Only the signal
+                estimates, the residuals, the voxel indices and the seed are transferred to the device.
+            seed (int): the seed of the random number generator on the device. Every sample of every voxel gets
+                its own random stream derived from this seed, making the results independent of the chunk and
+                batch sizes. If not set, we draw a seed using the NumPy random state.
         """
         super().__init__(mask, nifti_header, output_dir, tmp_storage_dir, recalculate)
         self._logger = logging.getLogger(__name__)
         self._optimization_method = optimization_method
         self._input_data = input_data.get_subset(volumes_to_keep=model.get_used_volumes(input_data))
-        self._roi_input_data = ROIMRIInputData.from_input_data(self._input_data)
         self._optimization_results = optimization_results
         self._nmr_samples = nmr_samples
         self._model = model
@@ -144,6 +164,9 @@ class BootstrappingProcessor(SimpleModelProcessor):
         self._logger = logging.getLogger(__name__)
         self._optimizer_options = optimizer_options
         self._sample_storage = None
+        self._nmr_replicates_per_batch = nmr_replicates_per_batch
+        self._use_device_rng = use_device_rng
+        self._seed = int(seed) if seed is not None else int(np.random.randint(np.iinfo(np.int32).max))
 
         self._model.set_input_data(input_data)
 
@@ -158,36 +181,137 @@ class BootstrappingProcessor(SimpleModelProcessor):
         self._objective_func = self._wrapper.wrap_objective_function(self._model.get_objective_function())
         self._constraints_func = self._wrapper.wrap_constraints_function(self._model.get_constraints_function())
 
+    def get_memory_per_voxel(self):
+        """Estimate the memory per voxel from the number of observations, parameters and bootstrap samples."""
+        nmr_params = self._model.get_nmr_parameters()
+        return 8 * (3 * self._model.get_nmr_observations() + nmr_params * (self._nmr_samples + nmr_params + 10))
+
     def _process(self, roi_indices, next_indices=None):
         """Apply the bootstrapping procedure on the given voxels.
 
+        This generates the bootstrap replicates in batches, using :meth:`_get_bootstrap_observations` or
+        :meth:`_get_device_bootstrap_observations`, and stores the optimization results of every batch as the
+        next samples.
+        """
+        y = self._get_signal_estimates(roi_indices)
+        errors = self._input_data.get_observations_subset(roi_indices) - y
+        x0 = self._codec.encode(self._x_opt_array[roi_indices],
+                                self._model.get_kernel_data().get_subset(roi_indices))
+
+        nmr_replicates_per_batch = self._get_nmr_replicates_per_batch(len(roi_indices))
+
+        for batch_start in range(0, self._nmr_samples, nmr_replicates_per_batch):
+            batch_end = min(batch_start + nmr_replicates_per_batch, self._nmr_samples)
+            self._logger.info('Processed samples {} from {}'.format(batch_start, self._nmr_samples))
+
+            if self._use_device_rng:
+                observations = self._get_device_bootstrap_observations(y, errors, roi_indices, batch_start, batch_end)
+            else:
+                with profile_stage('resample', nmr_voxels=len(roi_indices), nmr_replicates=batch_end - batch_start):
+                    observations = self._get_bootstrap_observations(y, errors, batch_end - batch_start)
+                observations = observations.reshape((-1, errors.shape[1]))
+            x_star = self._optimize_replicates(observations, x0, roi_indices, batch_end - batch_start)
+            with profile_stage('samples_write', nmr_voxels=len(roi_indices), nmr_replicates=batch_end - batch_start):
+                self._store_samples(x_star, roi_indices, batch_start, batch_end)
+
+    def _get_bootstrap_observations(self, signal_estimates, errors, nmr_replicates):
+        """Generate the observations of a batch of bootstrap replicates.
+
         This method needs to be defined per bootstrapping scheme.
+
+        Args:
+            signal_estimates (ndarray): the (n, m) matrix with the model signal at the optimized parameters
+            errors (ndarray): the (n, m) matrix with the residuals of the observations
+            nmr_replicates (int): the number of replicates to generate
+
+        Returns:
+            ndarray: a (nmr_replicates, n, m) matrix with the observations of every replicate
+        """
+        raise NotImplementedError()
+
+    def _get_device_bootstrap_observations(self, signal_estimates, errors, roi_indices, sample_start, sample_end):
+        """Get the kernel data generating the observations of a batch of bootstrap replicates on the device.
+
+        Args:
+            signal_estimates (ndarray): the (n, m) matrix with the model signal at the optimized parameters
+            errors (ndarray): the (n, m) matrix with the residuals of the observations
+            roi_indices (ndarray): the n voxels we are processing
+            sample_start (int): the index of the first sample of this batch
+            sample_end (int): the index after the last sample of this batch
+
+        Returns:
+            mot.lib.kernel_data.KernelData: the observations of the (sample_end - sample_start) * n problem
+                instances, with all the voxels of the first replicate first.
         """
-        return NotImplementedError()
+        return _DeviceBootstrapObservations(
+            signal_estimates, errors, roi_indices, sample_start, sample_end - sample_start, self._seed,
+            self._get_device_resampling_cl_code(errors.shape[1]))
 
-    def _single_optimization_run(self, y_star, x0, roi_indices):
-        """Generate one new sample using a single run of the optimization routine."""
-        self._roi_input_data.observations[roi_indices] = y_star
-        self._model.set_input_data(self._roi_input_data, suppress_warnings=True)
+    def _get_device_resampling_cl_code(self, nmr_observations):
+        """Get the CL code generating the observations of one bootstrap replicate of one voxel.
 
-        kernel_data_subset = self._model.get_kernel_data().get_subset(roi_indices)
+        This method needs to be defined per bootstrapping scheme to support generating the observations on the device.
 
-        results = minimize(self._objective_func, x0,
-                           method=self._optimization_method,
-                           nmr_observations=self._model.get_nmr_observations(),
-                           cl_runtime_info=self._cl_runtime_info,
-                           data=self._wrapper.wrap_input_data(kernel_data_subset),
-                           lower_bounds=self._get_bounds(self._lower_bounds, roi_indices),
-                           upper_bounds=self._get_bounds(self._upper_bounds, roi_indices),
-                           constraints_func=self._constraints_func,
-                           options=self._optimizer_options)
+        Args:
+            nmr_observations (int): the number of observations per voxel
+
+        Returns:
+            str: CL code which fills the array ``replicate`` using the arrays ``estimates`` and ``errors`` of the
+                voxel and the random number generator ``rng_data``.
+        """
+        raise NotImplementedError()
+
+    def _get_nmr_replicates_per_batch(self, nmr_voxels):
+        """Get the number of replicates we optimize together in one optimization run."""
+        if self._nmr_replicates_per_batch:
+            return min(self._nmr_replicates_per_batch, self._nmr_samples)
+        return int(min(max(100000 // max(nmr_voxels, 1), 1), self._nmr_samples))
+
+    def _optimize_replicates(self, observations, x0, roi_indices, nmr_replicates):
+        """Optimize a batch of bootstrap replicates in a single optimization run.
+
+        All the replicates of all the voxels are stacked as independent problem instances, each with their own
+        observations and all sharing the protocol and the starting point of their voxel.
+
+        Args:
+            observations (ndarray or mot.lib.kernel_data.KernelData): the (B * n, m) observations of every
+                replicate of every voxel, with all the voxels of the first replicate first
+            x0 (ndarray): the (n, p) matrix with the (encoded) starting points of every voxel
+            roi_indices (ndarray): the n voxels we are processing
+            nmr_replicates (int): the number of replicates B
+
+        Returns:
+            dict: per result map a matrix with on the first axis the voxels and on the second the B replicates
+        """
+        problem_indices = np.tile(roi_indices, nmr_replicates)
+
+        with profile_stage('input_subset', nmr_problems=len(problem_indices)):
+            kernel_data = self._model.get_kernel_data(observations=observations).get_subset(problem_indices)
+
+        with profile_stage('minimize', nmr_problems=len(problem_indices), method=self._optimization_method):
+            results = minimize(self._objective_func, np.tile(x0, (nmr_replicates, 1)),
+                               method=self._optimization_method,
+                               nmr_observations=self._model.get_nmr_observations(),
+                               cl_runtime_info=self._cl_runtime_info,
+                               data=self._wrapper.wrap_input_data(kernel_data),
+                               lower_bounds=self._get_bounds(self._lower_bounds, problem_indices),
+                               upper_bounds=self._get_bounds(self._upper_bounds, problem_indices),
+                               constraints_func=self._constraints_func,
+                               options=self._optimizer_options)
 
-        x_final_array = self._codec.decode(results['x'], kernel_data_subset)
+        with profile_stage('decode', nmr_problems=len(problem_indices)):
+            x_final_array = self._codec.decode(results['x'], kernel_data)
 
         x_dict = split_array_to_dict(x_final_array, self._model.get_free_param_names())
-        x_dict.update(self._model.get_post_optimization_output(x_final_array, roi_indices=roi_indices,
-                                                               parameters_dict=x_dict))
-        return x_dict
+        with profile_stage('post_processing', nmr_problems=len(problem_indices)):
+            x_dict.update(self._model.get_post_optimization_output(x_final_array, roi_indices=problem_indices,
+                                                                   parameters_dict=x_dict, kernel_data=kernel_data))
+
+        replicate_results = {}
+        for key, value in x_dict.items():
+            value = np.asarray(value).reshape((nmr_replicates, len(roi_indices)) + np.shape(value)[1:])
+            replicate_results[key] = np.swapaxes(value, 0, 1)
+        return replicate_results
 
     def _get_signal_estimates(self, roi_indices):
         self._model.set_input_data(self._input_data, suppress_warnings=True)
@@ -218,8 +342,16 @@ class BootstrappingProcessor(SimpleModelProcessor):
                 return_values.append(el[roi_indices])
         return tuple(return_values)
 
-    def _store_sample(self, optimization_results, roi_indices, sample_ind):
-        """Store the optimization results as a next sample."""
+    def _store_samples(self, optimization_results, roi_indices, sample_start, sample_end):
+        """Store the optimization results of a batch of replicates as the samples in the given range.
+
+        Args:
+            optimization_results (dict): per result map a matrix with the voxels on the first axis and the
+                replicates on the second.
+            roi_indices (ndarray): the voxels we processed
+            sample_start (int): the index of the first sample of this batch
+            sample_end (int): the index after the last sample of this batch
+        """
         if not os.path.exists(self._output_dir):
             os.makedirs(self._output_dir)
 
@@ -237,12 +369,16 @@ class BootstrappingProcessor(SimpleModelProcessor):
                     del current_results  # closes the memmap
 
                 shape = [self._total_nmr_voxels, self._nmr_samples]
-                if value.ndim > 1:
-                    shape.extend(value.shape[1:])
+                if value.ndim > 2:
+                    shape.extend(value.shape[2:])
                 self._sample_storage[key] = open_memmap(samples_path, mode=mode, dtype=value.dtype, shape=tuple(shape))
 
         for key, value in optimization_results.items():
-            self._sample_storage[key][roi_indices, sample_ind] = value
+            self._sample_storage[key][roi_indices, sample_start:sample_end] = value
+
+    def set_tmp_storage_shard(self, shard_dir=None):
+        raise NotImplementedError('The bootstrap samples are written directly to the output folder, '
+                                  'writing to shards is not supported.')
 
     def combine(self):
         super().combine()
@@ -254,10 +390,12 @@ class BootstrappingProcessor(SimpleModelProcessor):
             statistic_maps[name] = np.mean(samples, axis=1)
             statistic_maps[name + '.std'] = np.std(samples, axis=1)
 
-        write_all_as_nifti(restore_volumes(statistic_maps, self._mask),
-                           os.path.join(self._output_dir, 'univariate_normal'),
-                           nifti_header=self._nifti_header,
-                           gzip=self._write_volumes_gzipped)
+        with profile_stage('nifti_combine', maps_subdir='univariate_normal', nmr_maps=len(statistic_maps),
+                           gzip=self._write_volumes_gzipped):
+            write_all_as_nifti(restore_volumes(statistic_maps, self._mask_index),
+                               os.path.join(self._output_dir, 'univariate_normal'),
+                               nifti_header=self._nifti_header,
+                               gzip=self._write_volumes_gzipped, **get_nifti_writer_options())
 
         write_all_as_nifti({'UsedMask': self._mask}, self._output_dir, nifti_header=self._nifti_header,
                            gzip=self._write_volumes_gzipped)
@@ -275,22 +413,21 @@ class ResidualBootstrappingProcessor(BootstrappingProcessor):
         """Compute bootstrap samples using residual bootstrapping. """
         super().__init__(*args, **kwargs)
 
-    def _process(self, roi_indices, next_indices=None):
-        y = self._get_signal_estimates(roi_indices)
-        errors = self._input_data.observations[roi_indices] - y
-        x0 = self._codec.encode(self._x_opt_array[roi_indices],
-                                self._model.get_kernel_data().get_subset(roi_indices))
+    def _get_bootstrap_observations(self, signal_estimates, errors, nmr_replicates):
+        """Resample, per voxel and with replacement, the residuals of that voxel over all its observations."""
+        nmr_voxels, nmr_observations = errors.shape
+        voxel_indices = np.arange(nmr_voxels)[None, :, None]
+        observation_indices = np.random.randint(0, nmr_observations,
+                                                size=(nmr_replicates, nmr_voxels, nmr_observations))
+        return signal_estimates[None] + errors[voxel_indices, observation_indices]
 
-        for sample_ind in range(self._nmr_samples):
-            if sample_ind % (self._nmr_samples * 0.1) == 0:
-                self._logger.info('Processed samples {} from {}'.format(sample_ind, self._nmr_samples))
-
-            errors_resampled = errors[range(errors.shape[1]),
-                                      np.random.randint(0, errors.shape[1], size=errors.shape)]
-
-            y_star = y + errors_resampled
-            x_star = self._single_optimization_run(y_star, x0, roi_indices)
-            self._store_sample(x_star, roi_indices, sample_ind)
+    def _get_device_resampling_cl_code(self, nmr_observations):
+        return '''
+            for(uint i = 0; i < ''' + str(nmr_observations) + '''; i++){
+                replicate[i] = estimates[i] + errors[min((uint)(frand(rng_data) * ''' + str(nmr_observations) + '''),
+                                                     (uint)''' + str(nmr_observations - 1) + ''')];
+            }
+        '''
 
 
 class WildBootstrappingProcessor(BootstrappingProcessor):
@@ -308,8 +445,15 @@ class WildBootstrappingProcessor(BootstrappingProcessor):
                 - normal for the standard normal distribution
                 - mammen for the distribution proposed by Mammen 1993
                 - simple for a distribution of v = -1 with p=0.5 and +1 for p=0.5
+
+                When generating the observations on the device, only the methods given by name are supported.
         """
         super().__init__(*args, **kwargs)
+        self._random_variable_name = random_variable_method or 'normal'
+        if self._use_device_rng and not isinstance(self._random_variable_name, str):
+            raise ValueError('Generating the bootstrap observations on the device requires '
+                             'the random variable method to be given by name.')
+
         self._random_variable_method = random_variable_method or (lambda v: np.random.randn(*v))
 
         if self._random_variable_method == 'normal':
@@ -330,16 +474,195 @@ class WildBootstrappingProcessor(BootstrappingProcessor):
                 return r
             self._random_variable_method = distr
 
-    def _process(self, roi_indices, next_indices=None):
-        y = self._get_signal_estimates(roi_indices)
-        errors = self._input_data.observations[roi_indices] - y
-        x0 = self._codec.encode(self._x_opt_array[roi_indices],
-                                self._model.get_kernel_data().get_subset(roi_indices))
+    def _get_bootstrap_observations(self, signal_estimates, errors, nmr_replicates):
+        return signal_estimates[None] + errors[None] * self._random_variable_method((nmr_replicates,) + errors.shape)
+
+    def _get_device_resampling_cl_code(self, nmr_observations):
+        if self._random_variable_name == 'mannen':
+            random_variable = '(frand(rng_data) < {} ? {} : {})'.format(
+                (np.sqrt(5) + 1) / (2 * np.sqrt(5)), -(np.sqrt(5) - 1) / 2, (np.sqrt(5) + 1) / 2)
+        elif self._random_variable_name == 'simple':
+            random_variable = '(frand(rng_data) < 0.5 ? -1 : 1)'
+        else:
+            random_variable = 'frandn(rng_data)'
+
+        return '''
+            for(uint i = 0; i < ''' + str(nmr_observations) + '''; i++){
+                replicate[i] = estimates[i] + errors[i] * ''' + random_variable + ''';
+            }
+        '''
+
+
+class _DeviceBootstrapObservations(KernelData):
+
+    _kernels = weakref.WeakKeyDictionary()  # the generating kernels per context, per resampling code
+
+    def __init__(self, signal_estimates, errors, roi_indices, sample_start, nmr_replicates, seed,
+                 resampling_cl_code, problem_range=None):
+        """Kernel data for the observations of a batch of bootstrap replicates, generated on the compute device.
+
+        The observations are generated by a kernel directly in a device buffer, which is then used as the
+        observations of the optimizer. The random number generator of every problem instance is initialized
+        with the seed, the sample index and the voxel index, such that the generated observations do not depend
+        on how the voxels and samples are divided over the chunks, batches and devices.
+
+        Like the observations given per problem instance to the model kernel data, the problem indices given to
+        ``get_subset`` are ignored, only the batch ranges are applied.
+
+        Args:
+            signal_estimates (ndarray): the (n, m) matrix with the model signal at the optimized parameters
+            errors (ndarray): the (n, m) matrix with the residuals of the observations
+            roi_indices (ndarray): the n voxels we are processing
+            sample_start (int): the index of the first sample of this batch
+            nmr_replicates (int): the number of replicates in this batch
+            seed (int): the seed of the random number generator
+            resampling_cl_code (str): the CL code generating the observations of one replicate of one voxel,
+                see :meth:`BootstrappingProcessor._get_device_resampling_cl_code`
+            problem_range (tuple): the range of the problem instances of this kernel data, defaults to all
+                the nmr_replicates * n problem instances.
+        """
+        self._signal_estimates = np.ascontiguousarray(signal_estimates, dtype=np.float32)
+        self._errors = np.ascontiguousarray(errors, dtype=np.float32)
+        self._roi_indices = np.ascontiguousarray(roi_indices, dtype=np.uint32)
+        self._sample_start = sample_start
+        self._nmr_replicates = nmr_replicates
+        self._seed = seed
+        self._resampling_cl_code = resampling_cl_code
+        self._problem_range = problem_range or (0, nmr_replicates * self._errors.shape[0])
+        self._buffer_cache = {}  # the generated observations and the queue generating them, per context
+
+        # the layout of the observations of one problem instance, used for the kernel declarations
+        self._layout = Array(np.zeros((1, self._errors.shape[1]), dtype=np.float32), mode='r')
+
+    @property
+    def ctype(self):
+        return 'float'
+
+    def get_subset(self, problem_indices=None, batch_range=None):
+        if batch_range is None:
+            return self
+        return _DeviceBootstrapObservations(
+            self._signal_estimates, self._errors, self._roi_indices, self._sample_start, self._nmr_replicates,
+            self._seed, self._resampling_cl_code,
+            problem_range=(self._problem_range[0] + batch_range[0], self._problem_range[0] + batch_range[1]))
+
+    def set_mot_float_dtype(self, mot_float_dtype):
+        pass
 
-        for sample_ind in range(self._nmr_samples):
-            if sample_ind % (self._nmr_samples * 0.1) == 0:
-                self._logger.info('Processed samples {} from {}'.format(sample_ind, self._nmr_samples))
+    def get_data(self):
+        if not self._buffer_cache:
+            self.get_kernel_inputs(CLRuntimeInfo().cl_environments[0], 1)
+        buffer, queue = next(iter(self._buffer_cache.values()))
 
-            y_star = y + errors * self._random_variable_method(errors.shape)
-            x_star = self._single_optimization_run(y_star, x0, roi_indices)
-            self._store_sample(x_star, roi_indices, sample_ind)
+        observations = np.empty((self._problem_range[1] - self._problem_range[0], self._errors.shape[1]),
+                                dtype=np.float32)
+        cl.enqueue_copy(queue, observations, buffer, is_blocking=True)
+        return observations
+
+    def get_children(self):
+        return []
+
+    def get_scalar_arg_dtypes(self):
+        return [None]
+
+    def get_type_definitions(self):
+        return ''
+
+    def initialize_variable(self, variable_name, kernel_param_name, problem_id_substitute, address_space):
+        return self._layout.initialize_variable(variable_name, kernel_param_name, problem_id_substitute,
+                                                address_space)
+
+    def get_function_call_input(self, variable_name, kernel_param_name, problem_id_substitute, address_space):
+        return self._layout.get_function_call_input(variable_name, kernel_param_name, problem_id_substitute,
+                                                    address_space)
+
+    def post_function_callback(self, variable_name, kernel_param_name, problem_id_substitute, address_space):
+        return ''
+
+    def get_struct_declaration(self, name):
+        return self._layout.get_struct_declaration(name)
+
+    def get_struct_initialization(self, variable_name, kernel_param_name, problem_id_substitute):
+        return self._layout.get_struct_initialization(variable_name, kernel_param_name, problem_id_substitute)
+
+    def get_kernel_parameters(self, kernel_param_name):
+        return self._layout.get_kernel_parameters(kernel_param_name)
+
+    def enqueue_host_access(self, cl_environments, is_blocking=True, wait_for=None):
+        return {}
+
+    def enqueue_device_access(self, cl_environments, is_blocking=True, wait_for=None):
+        if isinstance(cl_environments, CLEnvironment):
+            cl_environments = [cl_environments]
+
+        for env in cl_environments:
+            self.get_kernel_inputs(env, 1)
+
+        if is_blocking:
+            for env in cl_environments:
+                env.queue.finish()
+        return {}
+
+    def get_kernel_inputs(self, cl_environment, workgroup_size):
+        cl_context = cl_environment.context
+        if cl_context not in self._buffer_cache:
+            self._buffer_cache[cl_context] = (self._generate_observations(cl_environment), cl_environment.queue)
+        return [self._buffer_cache[cl_context][0]]
+
+    def get_nmr_kernel_inputs(self):
+        return 1
+
+    def _generate_observations(self, cl_environment):
+        """Enqueue the generation of the observations in a new device buffer.
+
+        Since the queue executes in order, the generated observations are ready for the kernels enqueued after this.
+
+        Returns:
+            pyopencl.Buffer: the buffer which will hold the generated observations
+        """
+        nmr_problems = self._problem_range[1] - self._problem_range[0]
+        context = cl_environment.context
+
+        observations = cl.Buffer(context, cl.mem_flags.READ_WRITE,
+                                 size=max(nmr_problems, 1) * self._errors.shape[1] * np.dtype(np.float32).itemsize)
+        if not nmr_problems:
+            return observations
+
+        inputs = [cl.Buffer(context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=data)
+                  for data in [self._signal_estimates, self._errors, self._roi_indices]]
+
+        self._get_kernel(context)(
+            cl_environment.queue, (nmr_problems,), None, *inputs, observations,
+            np.uint32(self._errors.shape[0]), np.uint32(self._problem_range[0]), np.uint32(self._sample_start),
+            np.uint32(self._seed & 0xFFFFFFFF), np.uint32((self._seed >> 32) & 0xFFFFFFFF))
+        return observations
+
+    def _get_kernel(self, context):
+        kernels = self._kernels.setdefault(context, {})
+        key = (self._errors.shape[1], self._resampling_cl_code)
+        if key not in kernels:
+            program = cl.Program(context, Rand123().get_cl_code() + '''
+                kernel void generate_bootstrap_observations(
+                        global const float* all_estimates, global const float* all_errors,
+                        global const uint* roi_indices, global float* observations,
+                        uint nmr_voxels, uint problem_offset, uint sample_start, uint seed_low, uint seed_high){
+
+                    uint problem_ind = problem_offset + get_global_id(0);
+                    uint voxel_ind = problem_ind % nmr_voxels;
+
+                    // only the first counter is incremented per draw, the others identify the sample and the voxel
+                    philox4x32_ctr_t counter = {{0, 0, sample_start + problem_ind / nmr_voxels,
+                                                 roi_indices[voxel_ind]}};
+                    philox4x32_key_t key = {{seed_low, seed_high}};
+                    rand123_data rand123_rng_data = {counter, key};
+                    void* rng_data = (void*)&rand123_rng_data;
+
+                    global const float* estimates = all_estimates + voxel_ind * ''' + str(self._errors.shape[1]) + ''';
+                    global const float* errors = all_errors + voxel_ind * ''' + str(self._errors.shape[1]) + ''';
+                    global float* replicate = observations + get_global_id(0) * ''' + str(self._errors.shape[1]) + ''';
+
+                    ''' + self._resampling_cl_code + '''
+                }
+            ''').build()
+            kernels[key] = cl.Kernel(program, 'generate_bootstrap_observations')
+        return kernels[key]
@@ -3,21 +3,31 @@ import numpy as np
 import numpy.ma as ma
 import glob
 import logging
+import multiprocessing
 import os
+import pickle
 import shutil
 import time
 import timeit
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 import mot
 from mdt.__version__ import __version__
+from mdt.lib.deferred_mappings import DeferredActionDict
 from mdt.lib.nifti import get_all_nifti_data
 from mdt.lib.components import get_model
-from mdt.configuration import get_processing_strategy, gzip_optimization_results
+from mdt.configuration import get_processing_strategy, gzip_optimization_results, get_optimizer_for_model
 from mdt.model_building.utils import ParameterDecodingWrapper
 from mdt.utils import create_roi, model_output_exists, \
-    per_model_logging_context, get_intermediate_results_path, is_scalar, split_array_to_dict, restore_volumes
-from mdt.lib.processing.processing_strategies import SimpleModelProcessor
+    per_model_logging_context, get_intermediate_results_path, is_scalar, split_array_to_dict, restore_volumes, \
+    estimate_intermediate_results_size, get_mask_index
+from mdt.lib.processing.processing_strategies import SimpleModelProcessor, get_worker_process_settings, \
+    apply_worker_process_settings
 from mdt.lib.exceptions import InsufficientProtocolError
+from mdt.lib.profiling import profile_stage
+from mdt.lib.results_manifest import get_fitting_manifest, get_changed_items, write_manifest, remove_manifest, \
+    load_manifest, get_voxel_checksums, write_voxel_checksums, get_reusable_voxels, get_changed_fitting_routine_items
+from mdt.lib.results_container import CONTAINER_FILENAME, find_results_container
 import mot.configuration
 from mot import minimize
 from mot.configuration import CLRuntimeInfo
@@ -29,7 +39,7 @@ __email__ = "robbert@xkls.nl"
 
 
 def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=None,
-                           method=None, optimizer_options=None, double_precision=False):
+                           method=None, optimizer_options=None, double_precision=False, results_cache=None):
     """Get better optimization starting points for the given model.
 
     Since initialization can make quite a difference in optimization results, this function can generate
@@ -54,7 +64,7 @@ def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=
         input_data (:class:`~mdt.lib.input_data.MRIInputData`): the input data object containing all
             the info needed for model fitting of intermediate models.
         output_folder (string): The path to the folder where to place the output, we will make a subdir with the
-            model name in it.
+            model name in it. If None, the intermediate models are fitted in memory.
         cl_device_ind (int or list): the index of the CL device to use. The index is from the list from the function
             utils.get_cl_devices(). This can also be a list of device indices.
         method (str): The optimization method to use, one of:
@@ -66,6 +76,8 @@ def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=
             If not given, defaults to 'Powell'.
         optimizer_options (dict): extra options passed to the optimization routines.
         double_precision (boolean): if we would like to do the calculations in double precision
+        results_cache (CascadeResultsCache): optional in-memory cache with the results of intermediate models.
+            If given, intermediate models are only fitted if their results are not yet in this cache.
 
     Returns:
         dict: a dictionary with initialization points for the selected model
@@ -76,6 +88,10 @@ def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=
         return {key: value for key, value in fit_results.items() if key in param_names}
 
     def get_model_fit(model_name):
+        if results_cache is not None and results_cache.has_results(model_name):
+            logger.info('Using the cached results of {} for generating initialization point.'.format(model_name))
+            return results_cache.get_results(model_name, input_data.mask)
+
         logger.info('Starting intermediate optimization for generating initialization point.')
 
         inits = get_init_data(model_name)
@@ -83,7 +99,8 @@ def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=
         from mdt import fit_model
         results = fit_model(model_name, input_data, output_folder, recalculate=False, use_cascaded_inits=False,
                             method=method, optimizer_options=optimizer_options, double_precision=double_precision,
-                            cl_device_ind=cl_device_ind, initialization_data={'inits': inits})
+                            cl_device_ind=cl_device_ind, initialization_data={'inits': inits},
+                            results_cache=results_cache)
 
         logger.info('Finished intermediate optimization for generating initialization point.')
         return results
@@ -94,92 +111,269 @@ def get_optimization_inits(model_name, input_data, output_folder, cl_device_ind=
 
         if 'S0.s0' in free_parameters and input_data.has_input_data('b'):
             if input_data.get_input_data('b').shape[0] == input_data.nmr_voxels:
-                masked_observations = ma.masked_array(input_data.observations, input_data.get_input_data('b') < 250e6)
-                inits['S0.s0'] = restore_volumes(np.mean(masked_observations, axis=1), input_data.mask)
+                inits['S0.s0'] = restore_volumes(
+                    _get_mean_observations(input_data, observations_mask=input_data.get_input_data('b') < 250e6),
+                    input_data.mask)
             else:
                 unweighted_locations = np.where(input_data.get_input_data('b') < 250e6)[0]
                 inits['S0.s0'] = np.mean(input_data.signal4d[..., unweighted_locations], axis=-1)
 
-        if model_name.startswith('BallStick_r2'):
-            inits.update(get_subset(free_parameters, get_model_fit('BallStick_r1')))
-            inits['w_stick1.w'] = np.minimum(inits['w_stick0.w'], 0.05)
-        elif model_name.startswith('BallStick_r3'):
-            inits.update(get_subset(free_parameters, get_model_fit('BallStick_r2')))
-            inits['w_stick2.w'] = np.minimum(inits['w_stick1.w'], 0.05)
-        elif model_name.startswith('Tensor'):
-            fit_results = get_model_fit('BallStick_r1')
-            inits.update(get_subset(free_parameters, fit_results))
-            inits['Tensor.theta'] = fit_results['Stick0.theta']
-            inits['Tensor.phi'] = fit_results['Stick0.phi']
-        elif model_name.startswith('NODDI'):
-            fit_results = get_model_fit('BallStick_r1')
-            inits.update(get_subset(free_parameters, fit_results))
-            inits['w_ic.w'] = fit_results['w_stick0.w'] / 2.0
-            inits['w_ec.w'] = fit_results['w_stick0.w'] / 2.0
-            inits['w_csf.w'] = fit_results['w_ball.w']
-            inits['NODDI_IC.theta'] = fit_results['Stick0.theta']
-            inits['NODDI_IC.phi'] = fit_results['Stick0.phi']
-        elif model_name.startswith('BinghamNODDI_r1'):
-            noddi_results = get_model_fit('NODDI')
-            inits.update(get_subset(free_parameters, noddi_results))
-            inits['w_in0.w'] = noddi_results['w_ic.w']
-            inits['w_en0.w'] = noddi_results['w_ec.w']
-            inits['w_csf.w'] = noddi_results['w_csf.w']
-            inits['BinghamNODDI_IN0.theta'] = noddi_results['NODDI_IC.theta']
-            inits['BinghamNODDI_IN0.phi'] = noddi_results['NODDI_IC.phi']
-            inits['BinghamNODDI_IN0.k1'] = noddi_results['NODDI_IC.kappa']
-        elif model_name.startswith('BinghamNODDI_r2'):
-            bs2_results = get_model_fit('BallStick_r2')
-            inits.update(get_subset(free_parameters, bs2_results))
-            inits.update(get_subset(free_parameters, get_model_fit('BinghamNODDI_r1')))
-            inits['BinghamNODDI_IN1.theta'] = bs2_results['Stick1.theta']
-            inits['BinghamNODDI_IN1.phi'] = bs2_results['Stick1.phi']
-        elif model_name.startswith('Kurtosis'):
-            fit_results = get_model_fit('Tensor')
-            inits.update(get_subset(free_parameters, fit_results))
-            inits.update({'KurtosisTensor.' + key: fit_results['Tensor.' + key]
-                          for key in ['theta', 'phi', 'psi', 'd', 'dperp0', 'dperp1']})
-        elif model_name.startswith('CHARMED_r'):
-            nmr_dir = model_name[len('CHARMED_r'):len('CHARMED_r')+1]
-            fit_results = get_model_fit('BallStick_r' + nmr_dir)
-            inits.update(get_subset(free_parameters, fit_results))
-            inits['Tensor.theta'] = fit_results['Stick0.theta']
-            inits['Tensor.phi'] = fit_results['Stick0.phi']
-            for dir_ind in range(int(nmr_dir)):
-                inits['w_res{}.w'.format(dir_ind)] = fit_results['w_stick{}.w'.format(dir_ind)]
-                inits['CHARMEDRestricted{}.theta'.format(dir_ind)] = fit_results['Stick{}.theta'.format(dir_ind)]
-                inits['CHARMEDRestricted{}.phi'.format(dir_ind)] = fit_results['Stick{}.phi'.format(dir_ind)]
-        elif model_name.startswith('BallRacket_r'):
-            nmr_dir = model_name[len('BallRacket_r'):len('BallRacket_r')+1]
-            fit_results = get_model_fit('BallStick_r' + nmr_dir)
-            inits.update(get_subset(free_parameters, fit_results))
-            for dir_ind in range(int(nmr_dir)):
-                inits['w_res{}.w'.format(dir_ind)] = fit_results['w_stick{}.w'.format(dir_ind)]
-                inits['Racket{}.theta'.format(dir_ind)] = fit_results['Stick{}.theta'.format(dir_ind)]
-                inits['Racket{}.phi'.format(dir_ind)] = fit_results['Stick{}.phi'.format(dir_ind)]
-        elif model_name.startswith('AxCaliber'):
-            fit_results = get_model_fit('BallStick_r1')
-            inits.update(get_subset(free_parameters, fit_results))
-            inits['GDRCylinders.theta'] = fit_results['Stick0.theta']
-            inits['GDRCylinders.phi'] = fit_results['Stick0.phi']
-        elif model_name.startswith('ActiveAx'):
-            fit_results = get_model_fit('BallStick_r1')
-            inits.update(get_subset(free_parameters, fit_results))
-            inits['w_ic.w'] = fit_results['w_stick0.w'] / 2.0
-            inits['w_ec.w'] = fit_results['w_stick0.w'] / 2.0
-            inits['w_csf.w'] = fit_results['w_ball.w']
-            inits['CylinderGPD.theta'] = fit_results['Stick0.theta']
-            inits['CylinderGPD.phi'] = fit_results['Stick0.phi']
-        elif model_name.startswith('QMT_ReducedRamani'):
-            inits['S0.s0'] = np.mean(input_data.signal4d, axis=-1)
+        dependencies, get_cascade_inits = _get_cascade_initialization(model_name)
+        fit_results = []
+        for dependency in dependencies:
+            fit_results.append(get_model_fit(dependency))
+            inits.update(get_subset(free_parameters, fit_results[-1]))
+        if get_cascade_inits is not None:
+            inits.update(get_cascade_inits(model_name, input_data, fit_results))
 
         return inits
     return get_init_data(model_name)
 
 
+def get_cascade_dependencies(model_name):
+    """Get the names of the intermediate models used by :func:`get_optimization_inits` for the given model.
+
+    Args:
+        model_name (str): the name of the model for which we want the dependencies
+
+    Returns:
+        list of str: the names of the models of which the fit results are used to initialize the given model.
+    """
+    return _get_cascade_initialization(model_name)[0]
+
+
+def _get_cascade_initialization(model_name):
+    """Get the intermediate models of the given model and the function computing its initializations from their fits.
+
+    Args:
+        model_name (str): the name of the model
+
+    Returns:
+        tuple: the list with the names of the intermediate models and a function computing the initialization values
+            from the model name, the input data and the list with the fit results of the intermediate models.
+            This function is None if the model has no cascaded initializations.
+    """
+    for prefix, get_dependencies, get_inits in _cascade_initializations:
+        if model_name.startswith(prefix):
+            return get_dependencies(model_name), get_inits
+    return [], None
+
+
+def _get_nmr_directions(model_name, prefix):
+    return int(model_name[len(prefix):len(prefix) + 1])
+
+
+def _ballstick_r2_inits(model_name, input_data, fit_results):
+    return {'w_stick1.w': np.minimum(fit_results[0]['w_stick0.w'], 0.05)}
+
+
+def _ballstick_r3_inits(model_name, input_data, fit_results):
+    return {'w_stick2.w': np.minimum(fit_results[0]['w_stick1.w'], 0.05)}
+
+
+def _tensor_inits(model_name, input_data, fit_results):
+    return {'Tensor.theta': fit_results[0]['Stick0.theta'],
+            'Tensor.phi': fit_results[0]['Stick0.phi']}
+
+
+def _noddi_inits(model_name, input_data, fit_results):
+    return {'w_ic.w': fit_results[0]['w_stick0.w'] / 2.0,
+            'w_ec.w': fit_results[0]['w_stick0.w'] / 2.0,
+            'w_csf.w': fit_results[0]['w_ball.w'],
+            'NODDI_IC.theta': fit_results[0]['Stick0.theta'],
+            'NODDI_IC.phi': fit_results[0]['Stick0.phi']}
+
+
+def _bingham_noddi_r1_inits(model_name, input_data, fit_results):
+    return {'w_in0.w': fit_results[0]['w_ic.w'],
+            'w_en0.w': fit_results[0]['w_ec.w'],
+            'w_csf.w': fit_results[0]['w_csf.w'],
+            'BinghamNODDI_IN0.theta': fit_results[0]['NODDI_IC.theta'],
+            'BinghamNODDI_IN0.phi': fit_results[0]['NODDI_IC.phi'],
+            'BinghamNODDI_IN0.k1': fit_results[0]['NODDI_IC.kappa']}
+
+
+def _bingham_noddi_r2_inits(model_name, input_data, fit_results):
+    return {'BinghamNODDI_IN1.theta': fit_results[0]['Stick1.theta'],
+            'BinghamNODDI_IN1.phi': fit_results[0]['Stick1.phi']}
+
+
+def _kurtosis_inits(model_name, input_data, fit_results):
+    return {'KurtosisTensor.' + key: fit_results[0]['Tensor.' + key]
+            for key in ['theta', 'phi', 'psi', 'd', 'dperp0', 'dperp1']}
+
+
+def _charmed_inits(model_name, input_data, fit_results):
+    inits = {'Tensor.theta': fit_results[0]['Stick0.theta'],
+             'Tensor.phi': fit_results[0]['Stick0.phi']}
+    for dir_ind in range(_get_nmr_directions(model_name, 'CHARMED_r')):
+        inits['w_res{}.w'.format(dir_ind)] = fit_results[0]['w_stick{}.w'.format(dir_ind)]
+        inits['CHARMEDRestricted{}.theta'.format(dir_ind)] = fit_results[0]['Stick{}.theta'.format(dir_ind)]
+        inits['CHARMEDRestricted{}.phi'.format(dir_ind)] = fit_results[0]['Stick{}.phi'.format(dir_ind)]
+    return inits
+
+
+def _ball_racket_inits(model_name, input_data, fit_results):
+    inits = {}
+    for dir_ind in range(_get_nmr_directions(model_name, 'BallRacket_r')):
+        inits['w_res{}.w'.format(dir_ind)] = fit_results[0]['w_stick{}.w'.format(dir_ind)]
+        inits['Racket{}.theta'.format(dir_ind)] = fit_results[0]['Stick{}.theta'.format(dir_ind)]
+        inits['Racket{}.phi'.format(dir_ind)] = fit_results[0]['Stick{}.phi'.format(dir_ind)]
+    return inits
+
+
+def _axcaliber_inits(model_name, input_data, fit_results):
+    return {'GDRCylinders.theta': fit_results[0]['Stick0.theta'],
+            'GDRCylinders.phi': fit_results[0]['Stick0.phi']}
+
+
+def _activeax_inits(model_name, input_data, fit_results):
+    return {'w_ic.w': fit_results[0]['w_stick0.w'] / 2.0,
+            'w_ec.w': fit_results[0]['w_stick0.w'] / 2.0,
+            'w_csf.w': fit_results[0]['w_ball.w'],
+            'CylinderGPD.theta': fit_results[0]['Stick0.theta'],
+            'CylinderGPD.phi': fit_results[0]['Stick0.phi']}
+
+
+def _qmt_reduced_ramani_inits(model_name, input_data, fit_results):
+    return {'S0.s0': restore_volumes(_get_mean_observations(input_data), input_data.mask)}
+
+
+def _get_mean_observations(input_data, observations_mask=None, batch_size=10000):
+    """Get per voxel the mean of the observations.
+
+    This reads the observations in batches of voxels, using ``get_observations_subset``, such that we never
+    load the observations of all voxels at once.
+
+    Args:
+        input_data (mdt.lib.input_data.MRIInputData): the input data with the observations
+        observations_mask (ndarray): if given, a mask per voxel of the observations to exclude from the mean
+        batch_size (int): the number of voxels to read at once
+
+    Returns:
+        ndarray: per voxel in the ROI the mean of the observations
+    """
+    means = np.zeros(input_data.nmr_voxels)
+    for start in range(0, input_data.nmr_voxels, batch_size):
+        roi_indices = np.arange(start, min(start + batch_size, input_data.nmr_voxels))
+        observations = input_data.get_observations_subset(roi_indices)
+        if observations_mask is not None:
+            observations = ma.masked_array(observations, observations_mask[roi_indices])
+        means[roi_indices] = np.mean(observations, axis=1)
+    return means
+
+
+# The cascaded initializations, as (model name prefix, intermediate models, initialization function) tuples.
+# The first matching prefix is used. The free parameters shared with the intermediate models are initialized with their
+# fit results, in the order of the intermediate models, before applying the initialization function.
+_cascade_initializations = [
+    ('BallStick_r2', lambda model_name: ['BallStick_r1'], _ballstick_r2_inits),
+    ('BallStick_r3', lambda model_name: ['BallStick_r2'], _ballstick_r3_inits),
+    ('Tensor', lambda model_name: ['BallStick_r1'], _tensor_inits),
+    ('NODDI', lambda model_name: ['BallStick_r1'], _noddi_inits),
+    ('BinghamNODDI_r1', lambda model_name: ['NODDI'], _bingham_noddi_r1_inits),
+    ('BinghamNODDI_r2', lambda model_name: ['BallStick_r2', 'BinghamNODDI_r1'], _bingham_noddi_r2_inits),
+    ('Kurtosis', lambda model_name: ['Tensor'], _kurtosis_inits),
+    ('CHARMED_r', lambda model_name: ['BallStick_r{}'.format(_get_nmr_directions(model_name, 'CHARMED_r'))],
+     _charmed_inits),
+    ('BallRacket_r', lambda model_name: ['BallStick_r{}'.format(_get_nmr_directions(model_name, 'BallRacket_r'))],
+     _ball_racket_inits),
+    ('AxCaliber', lambda model_name: ['BallStick_r1'], _axcaliber_inits),
+    ('ActiveAx', lambda model_name: ['BallStick_r1'], _activeax_inits),
+    ('QMT_ReducedRamani', lambda model_name: [], _qmt_reduced_ramani_inits),
+]
+
+
+def get_cascade_fitting_order(model_names):
+    """Get the order in which to fit the given models and all their intermediate models.
+
+    This sorts the dependency graph (model -> intermediate models, see :func:`get_cascade_dependencies`)
+    topologically, such that every intermediate model is listed once and before all the models that depend on it.
+
+    Args:
+        model_names (list of str): the names of the models we want to fit
+
+    Returns:
+        list of str: the names of all the models to fit, in topological order
+    """
+    fitting_order = []
+
+    def visit(model_name, path):
+        if model_name in fitting_order:
+            return
+        if model_name in path:
+            raise ValueError('Cyclic cascade dependency found for the model {}.'.format(model_name))
+        for dependency in get_cascade_dependencies(model_name):
+            visit(dependency, path + [model_name])
+        fitting_order.append(model_name)
+
+    for model_name in model_names:
+        visit(model_name, [])
+    return fitting_order
+
+
+class CascadeResultsCache:
+
+    def __init__(self):
+        """In-memory cache for the results of the models fitted on a single input data set.
+
+        This is used to compute the results of the intermediate models in a cascade (see
+        :func:`get_optimization_inits`) only once, when fitting multiple models on the same data.
+        The results are kept as ROI arrays, one cache should only be used for a single input data object.
+        """
+        self._results = {}
+
+    def has_results(self, model_name):
+        """Check if we have results for the given model.
+
+        Args:
+            model_name (str): the name of the model
+
+        Returns:
+            boolean: if results are cached for this model
+        """
+        return model_name in self._results
+
+    def get_results(self, model_name, mask):
+        """Get the cached results of the given model, as volumes.
+
+        Args:
+            model_name (str): the name of the model
+            mask (ndarray): the mask used to create the ROI arrays
+
+        Returns:
+            dict: the results maps as 3d/4d volumes, restored from the cached ROI arrays when requested
+        """
+        return DeferredActionDict(lambda _, value: restore_volumes(value, mask), self._results[model_name])
+
+    def get_roi_results(self, model_name):
+        """Get the cached results of the given model, as ROI arrays.
+
+        Args:
+            model_name (str): the name of the model
+
+        Returns:
+            dict: the results maps as ROI arrays
+        """
+        return self._results[model_name]
+
+    def set_results(self, model_name, roi_results):
+        """Store the results of the given model in this cache.
+
+        Args:
+            model_name (str): the name of the model
+            roi_results (dict): the results of the model, as ROI arrays. These are loaded into memory.
+        """
+        self._results[model_name] = {key: np.array(value) for key, value in roi_results.items()}
+
+    def clear(self):
+        """Remove all the results from this cache."""
+        self._results = {}
+
+
 def get_batch_fitting_function(total_nmr_subjects, models_to_fit, output_folder,
                                recalculate=False, cl_device_ind=None, double_precision=False,
-                               tmp_results_dir=True, use_gradient_deviations=False):
+                               tmp_results_dir=True, use_gradient_deviations=False, profile=False):
     """Get the batch fitting function that can fit all desired models on a subject.
 
     Args:
@@ -193,6 +387,8 @@ def get_batch_fitting_function(total_nmr_subjects, models_to_fit, output_folder,
         tmp_results_dir (str, True or None): The temporary dir for the calculations. Set to a string to use
             that path directly, set to True to use the config value, set to None to disable.
         use_gradient_deviations (boolean): if you want to use the gradient deviations if present
+        profile (boolean): if set, we write a profile of the processing stages to the output folder of every model,
+            see :mod:`mdt.lib.profiling`.
     """
     logger = logging.getLogger(__name__)
 
@@ -208,7 +404,14 @@ def get_batch_fitting_function(total_nmr_subjects, models_to_fit, output_folder,
         def __init__(self):
             self._index_counter = 0
 
-        def __call__(self, subject_info):
+        def __call__(self, subject_info, input_data=None):
+            """Fit all the models on the given subject.
+
+            Args:
+                subject_info (mdt.lib.batch_utils.SubjectInfo): the subject to fit
+                input_data (mdt.lib.input_data.MRIInputData): the input data of this subject, if already loaded
+                    (see :meth:`load_input_data`). If not given, we load the input data here.
+            """
             from mdt import fit_model
 
             logger.info('Going to process subject {}, ({} of {}, we are at {:.2%})'.format(
@@ -218,29 +421,36 @@ def get_batch_fitting_function(total_nmr_subjects, models_to_fit, output_folder,
 
             output_dir = os.path.join(output_folder, subject_info.subject_id)
 
-            if all(model_output_exists(model, output_dir) for model in models_to_fit) and not recalculate:
+            if self.output_exists(subject_info):
                 logger.info('Skipping subject {0}, output exists'.format(subject_info.subject_id))
                 return
 
-            logger.info('Loading the data (DWI, mask and protocol) of subject {0}'.format(subject_info.subject_id))
-            input_data = subject_info.get_input_data(use_gradient_deviations)
+            if input_data is None:
+                input_data = self.load_input_data(subject_info)
+            results_cache = CascadeResultsCache()
 
             with timer(subject_info.subject_id):
-                for model in models_to_fit:
+                for model in self._get_fitting_order():
                     if isinstance(model, str):
                         model_name = model
                     else:
                         model_name = model.name
 
-                    logger.info('Going to fit model {0} on subject {1}'.format(model_name, subject_info.subject_id))
+                    # intermediate models are, as in the cascaded initializations, never recalculated
+                    is_intermediate = model not in models_to_fit
+
+                    logger.info('Going to fit {0} {1} on subject {2}'.format(
+                        'intermediate model' if is_intermediate else 'model', model_name, subject_info.subject_id))
 
                     try:
                         fit_model(model, input_data, output_dir,
-                                  recalculate=recalculate,
+                                  recalculate=recalculate and not is_intermediate,
                                   cl_device_ind=cl_device_ind,
                                   double_precision=double_precision,
                                   tmp_results_dir=tmp_results_dir,
-                                  use_cascaded_inits=True)
+                                  use_cascaded_inits=True,
+                                  results_cache=results_cache,
+                                  profile=profile)
 
                     except InsufficientProtocolError as ex:
                         logger.info('Could not fit model {0} on subject {1} '
@@ -248,9 +458,158 @@ def get_batch_fitting_function(total_nmr_subjects, models_to_fit, output_folder,
                     else:
                         logger.info('Done fitting model {0} on subject {1}'.format(model_name, subject_info.subject_id))
 
+        def output_exists(self, subject_info):
+            """Check if we can skip the given subject, that is, if all output exists and we do not recalculate.
+
+            For output with a manifest (see :mod:`mdt.lib.results_manifest`) we only compare the inputs which can
+            be checked without loading the input data, that is, the optimization routine and the MDT version. Changes
+            to the data or the model of a subject are not detected here, use recalculate to refit such subjects.
+            """
+            if recalculate:
+                return False
+
+            output_dir = os.path.join(output_folder, subject_info.subject_id)
+            for model in models_to_fit:
+                model_name = model if isinstance(model, str) else model.name
+                if not model_output_exists(model, output_dir):
+                    return False
+
+                method, optimizer_options = get_optimizer_for_model(model_name)
+                if get_changed_fitting_routine_items(os.path.join(output_dir, model_name), method,
+                                                     optimizer_options=optimizer_options,
+                                                     double_precision=double_precision):
+                    return False
+            return True
+
+        def load_input_data(self, subject_info):
+            """Load the input data of the given subject.
+
+            This can be used to load the data of a next subject while the current subject is being fitted.
+
+            Returns:
+                mdt.lib.input_data.MRIInputData: the input data, or None if this subject will be skipped.
+            """
+            if self.output_exists(subject_info):
+                return None
+            logger.info('Loading the data (DWI, mask and protocol) of subject {0}'.format(subject_info.subject_id))
+            return subject_info.get_input_data(use_gradient_deviations)
+
+        def _get_fitting_order(self):
+            """Get the models to fit, including the intermediate models, such that each model is fitted only once.
+
+            The intermediate models are sorted before the models that depend on them, model objects are fitted in
+            the order given.
+            """
+            model_names = [model if isinstance(model, str) else model.name for model in models_to_fit]
+            fitting_order = []
+            for model_name in get_cascade_fitting_order(model_names):
+                if model_name in model_names:
+                    fitting_order.append(models_to_fit[model_names.index(model_name)])
+                else:
+                    fitting_order.append(model_name)
+            return fitting_order
+
     return FitFunc()
 
 
+def run_batch_fitting(subjects, models_to_fit, output_folder, nmr_concurrent_subjects=1, prefetch=True,
+                      cl_device_ind=None, **kwargs):
+    """Fit the given models on all the given subjects.
+
+    By default the subjects are processed one after the other, while the data of the next subject is loaded in the
+    background. If ``nmr_concurrent_subjects`` is larger than one, the subjects are distributed over a pool of
+    worker processes instead. The CL devices are then distributed in a round-robin fashion over the workers.
+
+    Args:
+        subjects (list of mdt.lib.batch_utils.SubjectInfo): the subjects to fit
+        models_to_fit (list of str): A list of models to fit to the data.
+        output_folder (str): the folder in which to place the output
+        nmr_concurrent_subjects (int): the number of subjects to process concurrently, each in its own process
+        prefetch (boolean): if we load the data of the next subject while fitting the current one. Only used when
+            processing one subject at the time.
+        cl_device_ind (int or list of int): the index of the CL device(s) to use.
+        **kwargs: other keyword arguments for :func:`get_batch_fitting_function`
+
+    Returns:
+        dict: per subject id the output of the fitting function
+    """
+    logger = logging.getLogger(__name__)
+
+    if nmr_concurrent_subjects > 1 and len(subjects) > 1:
+        try:
+            pickle.dumps((subjects, models_to_fit))
+        except (pickle.PicklingError, TypeError, AttributeError) as exc:
+            logger.warning('Could not send the subjects to the worker processes ({}), '
+                           'processing the subjects one after the other.'.format(exc))
+        else:
+            return _run_batch_fitting_in_processes(subjects, models_to_fit, output_folder, nmr_concurrent_subjects,
+                                                   cl_device_ind, kwargs)
+
+    fit_func = get_batch_fitting_function(len(subjects), models_to_fit, output_folder,
+                                          cl_device_ind=cl_device_ind, **kwargs)
+    results = {}
+    if not prefetch:
+        for subject in subjects:
+            results[subject.subject_id] = fit_func(subject)
+        return results
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_input_data = None
+        for ind, subject in enumerate(subjects):
+            input_data = next_input_data.result() if next_input_data else fit_func.load_input_data(subject)
+            next_input_data = None
+            if ind + 1 < len(subjects):
+                next_input_data = executor.submit(fit_func.load_input_data, subjects[ind + 1])
+            results[subject.subject_id] = fit_func(subject, input_data=input_data)
+    return results
+
+
+def _run_batch_fitting_in_processes(subjects, models_to_fit, output_folder, nmr_processes, cl_device_ind, kwargs):
+    """Fit the subjects using a pool of worker processes, see :func:`run_batch_fitting`."""
+    from mdt.utils import get_cl_devices
+    logger = logging.getLogger(__name__)
+    logger.info('Fitting {} subjects concurrently.'.format(min(nmr_processes, len(subjects))))
+
+    settings = get_worker_process_settings()
+    if cl_device_ind is not None:
+        all_devices = get_cl_devices()
+        devices = get_cl_devices(cl_device_ind)
+        settings['cl_device_ind'] = [all_devices.index(env) for env in devices]
+
+    mp_context = multiprocessing.get_context('spawn')
+    with mp_context.Pool(min(nmr_processes, len(subjects)), initializer=_init_batch_fitting_worker,
+                         initargs=(settings, mp_context.Value('i', 0), len(subjects), models_to_fit,
+                                   output_folder, kwargs)) as pool:
+        results = {}
+        for ind, (subject_id, output) in enumerate(pool.imap_unordered(_fit_subject_in_worker_process, subjects)):
+            results[subject_id] = output
+            logger.info('Finished subject {} ({} of {} subjects).'.format(subject_id, ind + 1, len(subjects)))
+    return results
+
+
+_worker_fit_func = None
+"""The batch fitting function of the current worker process, see :func:`_init_batch_fitting_worker`."""
+
+
+def _init_batch_fitting_worker(settings, worker_counter, total_nmr_subjects, models_to_fit, output_folder, kwargs):
+    """Initialize a worker process for the concurrent batch fitting.
+
+    This applies the settings of the main process and constructs the batch fitting function.
+    """
+    global _worker_fit_func
+    apply_worker_process_settings(settings, worker_counter)
+    _worker_fit_func = get_batch_fitting_function(total_nmr_subjects, models_to_fit, output_folder, **kwargs)
+
+
+def _fit_subject_in_worker_process(subject_info):
+    """Fit a single subject using the batch fitting function of this worker process.
+
+    Returns:
+        tuple: the subject id and the output of the batch fitting function
+    """
+    return subject_info.subject_id, _worker_fit_func(subject_info)
+
+
 def fit_composite_model(model, input_data, output_folder, method, tmp_results_dir,
                         recalculate=False, optimizer_options=None):
     """Fits the composite model and returns the results as ROI lists per map.
@@ -261,11 +620,21 @@ def fit_composite_model(model, input_data, output_folder, method, tmp_results_di
         input_data (:class:`~mdt.lib.input_data.MRIInputData`): The input data object for the model.
         output_folder (string): The path to the folder where to place the output.
             The resulting maps are placed in a subdirectory (named after the model name) in this output folder.
+            If None, the model is fitted in memory, without writing any files,
+            see :func:`fit_composite_model_in_memory`.
         method (str): The optimization routine to use.
         tmp_results_dir (str): the main directory to use for the temporary results
         recalculate (boolean): If we want to recalculate the results if they are already present.
         optimizer_options (dict): the additional optimization options
+
+    If results are present which were computed with different inputs, we normally recalculate all voxels. If only the
+    voxel specific inputs changed, for example the mask, the results of the voxels of which the inputs did not change
+    are copied from the existing results and only the other voxels are fitted. See
+    :func:`~mdt.lib.results_manifest.get_reusable_voxels` for the details.
     """
+    if output_folder is None:
+        return fit_composite_model_in_memory(model, input_data, method, optimizer_options=optimizer_options)
+
     logger = logging.getLogger(__name__)
     output_path = os.path.join(output_folder, model.name)
 
@@ -274,10 +643,33 @@ def fit_composite_model(model, input_data, output_folder, method, tmp_results_di
             'The given protocol is insufficient for this model. '
             'The reported errors where: {}'.format(model.get_input_data_problems(input_data)))
 
-    if not recalculate and model_output_exists(model, output_folder):
-        maps = get_all_nifti_data(output_path)
+    model.set_input_data(input_data, suppress_warnings=True)
+
+    output_exists = not recalculate and model_output_exists(model, output_folder)
+
+    # results without a manifest are reused as is, this avoids reading all the observations to compute the manifest
+    if output_exists and load_manifest(output_path) is None:
         logger.info('Not recalculating {} model'.format(model.name))
-        return create_roi(maps, input_data.mask)
+        return create_roi(get_all_nifti_data(output_path), input_data.mask)
+
+    manifest = get_fitting_manifest(model, input_data, method, optimizer_options=optimizer_options,
+                                    double_precision=CLRuntimeInfo().double_precision)
+
+    reusable_voxels = None
+    voxel_checksums = None
+    if output_exists:
+        changed_items = get_changed_items(output_path, manifest)
+        if changed_items:
+            voxel_checksums = get_voxel_checksums(model, input_data)
+            reusable_voxels = get_reusable_voxels(output_path, manifest, input_data.mask, voxel_checksums)
+            if reusable_voxels is None:
+                logger.info('The inputs of the {} model changed since the last fit ({}), recalculating.'.format(
+                    model.name, ', '.join(changed_items)))
+                recalculate = True
+        else:
+            maps = get_all_nifti_data(output_path)
+            logger.info('Not recalculating {} model'.format(model.name))
+            return create_roi(maps, input_data.mask)
 
     with per_model_logging_context(output_path):
         logger.info('Using MDT version {}'.format(__version__))
@@ -286,24 +678,130 @@ def fit_composite_model(model, input_data, output_folder, method, tmp_results_di
         model.set_input_data(input_data)
 
         if recalculate:
-            if os.path.exists(output_path):
-                list(map(os.remove, glob.glob(os.path.join(output_path, '*.nii*'))))
-                if os.path.exists(os.path.join(output_path + 'covariances')):
-                    shutil.rmtree(os.path.join(output_path + 'covariances'))
+            _remove_results(output_path)
 
         if not os.path.exists(output_path):
             os.makedirs(output_path)
 
         with _model_fit_logging(logger, model.name, model.get_free_param_names()):
-            tmp_dir = get_intermediate_results_path(output_path, tmp_results_dir)
+            processing_strategy = get_processing_strategy('optimization')
+
+            estimated_size = None
+            if processing_strategy.supports_local_tmp_storage():
+                estimated_size = estimate_intermediate_results_size(model, input_data.nmr_voxels)
+
+            tmp_dir = get_intermediate_results_path(output_path, tmp_results_dir, estimated_size=estimated_size)
             logger.info('Saving temporary results in {}.'.format(tmp_dir))
 
+            if get_changed_items(tmp_dir, manifest):
+                logger.info('Discarding the temporary results, these were computed using different inputs.')
+                recalculate = True
+
             worker = FittingProcessor(method, model, input_data.mask,
                                       input_data.nifti_header, output_path,
                                       tmp_dir, recalculate, optimizer_options=optimizer_options)
 
-            processing_strategy = get_processing_strategy('optimization')
-            return processing_strategy.process(worker)
+            if reusable_voxels is not None:
+                previous_mask, previous_roi_indices, roi_indices = reusable_voxels
+                logger.info('The voxel inputs of the {} model changed since the last fit, reusing the results of '
+                            '{} of the {} voxels.'.format(model.name, len(roi_indices), input_data.nmr_voxels))
+                worker.add_precomputed_results(
+                    _load_previous_results(output_path, previous_mask, previous_roi_indices), roi_indices)
+                _remove_results(output_path)
+
+            write_manifest(tmp_dir, manifest)
+
+            results = processing_strategy.process(worker)
+            if results is None:
+                # with distributed processing, only the process which combined the results writes the checksums
+                return create_roi(get_all_nifti_data(output_path), input_data.mask)
+
+            if voxel_checksums is None:
+                voxel_checksums = get_voxel_checksums(model, input_data)
+            write_voxel_checksums(output_path, input_data.mask, voxel_checksums)
+            write_manifest(output_path, manifest)
+            return results
+
+
+def _remove_results(output_path):
+    """Remove the results, and their manifest, in the given output directory of a model."""
+    if not os.path.exists(output_path):
+        return
+
+    remove_manifest(output_path)
+    list(map(os.remove, glob.glob(os.path.join(output_path, '*.nii*'))))
+    if os.path.isfile(os.path.join(output_path, CONTAINER_FILENAME)):
+        os.remove(os.path.join(output_path, CONTAINER_FILENAME))
+    if os.path.exists(os.path.join(output_path, 'covariances')):
+        shutil.rmtree(os.path.join(output_path, 'covariances'))
+
+
+def _load_previous_results(output_path, mask, roi_indices):
+    """Load the results of the given voxels from the results in the given output directory.
+
+    Args:
+        output_path (str): the directory with the results of a model
+        mask (ndarray): the mask with which these results were computed
+        roi_indices (ndarray): the ROI indices, in that mask, of the voxels we want to load
+
+    Returns:
+        dict: per subdirectory of the results ('' for the top level maps) a dictionary with the values of the given
+            voxels per map. The maps are only loaded when accessed.
+    """
+    mask_index = get_mask_index(mask)
+
+    subdirs = {''}
+    for dirpath, dirnames, filenames in os.walk(output_path):
+        if any(fname.endswith(('.nii', '.nii.gz')) for fname in filenames):
+            subdir = os.path.relpath(dirpath, output_path)
+            subdirs.add('' if subdir == '.' else subdir)
+
+    container, prefix = find_results_container(output_path)
+    if container is not None:
+        if prefix == '':
+            subdirs.update(container_prefix[:-1] for container_prefix in container.get_prefixes())
+        container.close()
+
+    return {subdir: DeferredActionDict(lambda _, volume: mask_index.create_roi(volume)[roi_indices],
+                                       get_all_nifti_data(os.path.join(output_path, subdir)), cache=False)
+            for subdir in subdirs}
+
+
+def fit_composite_model_in_memory(model, input_data, method, optimizer_options=None):
+    """Fits the composite model in memory and returns the results as ROI lists per map.
+
+    This uses the same processing as :func:`fit_composite_model`, but keeps the results of every batch in memory
+    instead of in the temporary storage, and does not write any output files or logs to disk. This is meant for
+    small datasets, for example a single slice or a region of interest, where the file handling would dominate
+    the runtime. Since nothing is written to disk, an interrupted fit can not be continued.
+
+    Args:
+        model (:class:`~mdt.models.base.EstimableModel`): An implementation of an composite model
+            that contains the model we want to optimize.
+        input_data (:class:`~mdt.lib.input_data.MRIInputData`): The input data object for the model.
+        method (str): The optimization routine to use.
+        optimizer_options (dict): the additional optimization options
+
+    Returns:
+        dict: the results of the top level maps as ROI arrays, of shape (nmr_voxels, ...)
+    """
+    logger = logging.getLogger(__name__)
+
+    if not model.is_input_data_sufficient(input_data):
+        raise InsufficientProtocolError(
+            'The given protocol is insufficient for this model. '
+            'The reported errors where: {}'.format(model.get_input_data_problems(input_data)))
+
+    logger.info('Preparing for model {0}'.format(model.name))
+    model.set_input_data(input_data)
+
+    with _model_fit_logging(logger, model.name, model.get_free_param_names()):
+        logger.info('Keeping the results in memory.')
+        worker = FittingProcessor(method, model, input_data.mask, input_data.nifti_header, None, None, False,
+                                  optimizer_options=optimizer_options)
+
+        processing_strategy = get_processing_strategy('optimization')
+        return processing_strategy.process(worker)
 
 
 @contextmanager
@@ -339,7 +837,6 @@ class FittingProcessor(SimpleModelProcessor):
         self._method = method
         self._optimizer_options = optimizer_options
         self._write_volumes_gzipped = gzip_optimization_results()
-        self._subdirs = set()
         self._logger=logging.getLogger(__name__)
 
         self._cl_runtime_info = CLRuntimeInfo()
@@ -352,6 +849,28 @@ class FittingProcessor(SimpleModelProcessor):
         self._objective_func = self._wrapper.wrap_objective_function(self._model.get_objective_function())
         self._constraints_func = self._wrapper.wrap_constraints_function(self._model.get_constraints_function())
 
+    def __reduce__(self):
+        """Pickle this processor by its constructor arguments, such that it can be used in subprocesses.
+
+        The unpickled processor never recalculates, that is, it continues using the current temporary storage.
+        Processors keeping their results in memory can not be pickled, since the results would end up in the
+        subprocesses.
+        """
+        if self._in_memory_results is not None:
+            raise pickle.PicklingError('The processor {} keeps its results in memory, '
+                                       'it can not be pickled.'.format(type(self).__name__))
+        return FittingProcessor, (self._method, self._model, self._mask, self._nifti_header, self._output_dir,
+                                  self._tmp_storage_dir, False, self._optimizer_options)
+
+    def get_memory_per_voxel(self):
+        """Estimate the memory per voxel from the number of observations and parameters.
+
+        This accounts for the input data, the parameters and the quadratic (in the number of parameters) memory of
+        the optimizers and the covariance matrices, all in double precision.
+        """
+        nmr_params = self._model.get_nmr_parameters()
+        return 8 * (3 * self._model.get_nmr_observations() + nmr_params * (nmr_params + 10))
+
     def _process(self, roi_indices, next_indices=None):
         self._logger.info('Starting optimization')
         self._logger.info('Using MOT version {}'.format(mot.__version__))
@@ -367,32 +886,45 @@ class FittingProcessor(SimpleModelProcessor):
         else:
             self._logger.info('We will use the optimizer {} with default settings.'.format(self._method))
 
-        kernel_data_subset = self._kernel_data.get_subset(roi_indices)
-        x0 = self._codec.encode(self._initial_params[roi_indices], kernel_data_subset)
+        kernel_data_subset, x0, lower_bounds, upper_bounds = self._get_prepared(roi_indices)
 
-        results = minimize(self._objective_func, x0, method=self._method,
-                           nmr_observations=self._model.get_nmr_observations(),
-                           cl_runtime_info=self._cl_runtime_info,
-                           data=self._wrapper.wrap_input_data(kernel_data_subset),
-                           lower_bounds=self._get_bounds(self._lower_bounds, roi_indices),
-                           upper_bounds=self._get_bounds(self._upper_bounds, roi_indices),
-                           constraints_func=self._constraints_func,
-                           options=self._optimizer_options)
+        with profile_stage('minimize', nmr_voxels=len(roi_indices), method=self._method):
+            results = minimize(self._objective_func, x0, method=self._method,
+                               nmr_observations=self._model.get_nmr_observations(),
+                               cl_runtime_info=self._cl_runtime_info,
+                               data=self._wrapper.wrap_input_data(kernel_data_subset),
+                               lower_bounds=lower_bounds,
+                               upper_bounds=upper_bounds,
+                               constraints_func=self._constraints_func,
+                               options=self._optimizer_options)
 
         self._logger.info('Finished optimization')
         self._logger.info('Starting post-processing')
 
-        x_final_array = self._codec.decode(results['x'], kernel_data_subset)
+        with profile_stage('decode', nmr_voxels=len(roi_indices)):
+            x_final_array = self._codec.decode(results['x'], kernel_data_subset)
 
         x_dict = split_array_to_dict(x_final_array, self._model.get_free_param_names())
         x_dict.update({'ReturnCodes': results['status']})
-        x_dict.update(self._model.get_post_optimization_output(x_final_array, roi_indices=roi_indices,
-                                                               parameters_dict=x_dict))
+        with profile_stage('post_processing', nmr_voxels=len(roi_indices)):
+            x_dict.update(self._model.get_post_optimization_output(x_final_array, roi_indices=roi_indices,
+                                                                   parameters_dict=x_dict,
+                                                                   kernel_data=kernel_data_subset))
         x_dict.update({self._used_mask_name: np.ones(roi_indices.shape[0], dtype=np.bool)})
 
         self._logger.info('Finished post-processing')
         self._write_output_recursive(x_dict, roi_indices)
 
+    def _prepare(self, roi_indices):
+        """Get the kernel data subset, the encoded starting point and the bounds for the given voxels."""
+        with profile_stage('input_subset', nmr_voxels=len(roi_indices)):
+            kernel_data_subset = self._kernel_data.get_subset(roi_indices)
+        with profile_stage('encode', nmr_voxels=len(roi_indices)):
+            x0 = self._codec.encode(self._initial_params[roi_indices], kernel_data_subset)
+        return (kernel_data_subset, x0,
+                self._get_bounds(self._lower_bounds, roi_indices),
+                self._get_bounds(self._upper_bounds, roi_indices))
+
     def _get_bounds(self, bounds, roi_indices):
         return_values = []
         for el in bounds:
@@ -412,12 +944,27 @@ class FittingProcessor(SimpleModelProcessor):
             else:
                 current_output[key] = value
 
-        self._write_volumes(current_output, roi_indices, os.path.join(self._tmp_storage_dir, sub_dir))
-        self._subdirs.add(sub_dir)
+        self._write_volumes(current_output, roi_indices, self._get_tmp_storage_path(sub_dir))
+
+    def add_precomputed_results(self, results, roi_indices):
+        """Add results which were computed before, for example in a previous fit with a different mask.
+
+        The given voxels are marked as processed, such that they are not fitted again.
+
+        Args:
+            results (dict): per subdirectory ('' for the top level maps) a dictionary with the results per map
+            roi_indices (ndarray): the ROI indices of the voxels of the given results
+        """
+        for sub_dir, maps in results.items():
+            self._write_volumes(maps, roi_indices, self._get_tmp_storage_path(sub_dir))
+        self._mark_as_processed(roi_indices)
 
     def combine(self):
         super().combine()
-        for subdir in self._subdirs:
+        if self._in_memory_results is not None:
+            return dict(self._in_memory_results.get('', {}))
+
+        for subdir in self._get_tmp_subdirs():
             self._combine_volumes(self._output_dir, self._tmp_storage_dir,
                                   self._nifti_header, maps_subdir=subdir)
-        return create_roi(get_all_nifti_data(self._output_dir), self._mask)
+        return create_roi(get_all_nifti_data(self._output_dir), self._mask_index)
@@ -1,19 +1,29 @@
 import collections
+import glob
 import shutil
 from contextlib import contextmanager
 import logging
 import os
+import pickle
 import timeit
 import time
 import numpy as np
 from numpy.lib.format import open_memmap
-from mdt.configuration import gzip_sampling_results, get_processing_strategy
+from mdt.configuration import gzip_sampling_results, get_processing_strategy, get_nifti_writer_options
 from mdt.lib.fsl_sampling_routine import FSLSamplingRoutine
-from mdt.utils import load_samples, per_model_logging_context, get_intermediate_results_path
+from mdt.lib.results_container import ResultsContainerWriter, CONTAINER_FILENAME
+from mdt.utils import load_samples, per_model_logging_context, get_intermediate_results_path, \
+    estimate_intermediate_results_size
 from mdt.lib.processing.processing_strategies import SimpleModelProcessor
 from mdt.lib.exceptions import InsufficientProtocolError
+from mdt.lib.profiling import profile_stage
+from mdt.lib.results_manifest import get_sampling_manifest, get_changed_items, write_manifest, load_manifest
+import mot
 from mot.sample import AdaptiveMetropolisWithinGibbs, SingleComponentAdaptiveMetropolis, MetropolisWithinGibbs
 from mot.sample.t_walk import ThoughtfulWalk
+from mot.lib.utils import split_in_batches
+from mot.sample.base import SimpleSampleOutput
+from mot.configuration import CLRuntimeInfo
 
 __author__ = 'Robbert Harms'
 __date__ = "2015-05-01"
@@ -23,7 +33,8 @@ __email__ = "robbert@xkls.nl"
 
 def sample_composite_model(model, input_data, output_folder, nmr_samples, thinning, burnin, tmp_dir,
                            method=None, recalculate=False, store_samples=True, sample_items_to_save=None,
-                           post_sampling_cb=None, sampler_options=None):
+                           post_sampling_cb=None, sampler_options=None, streaming_block_size=None,
+                           checkpoint_interval=None):
     """Sample a composite model.
 
     Args:
@@ -61,6 +72,12 @@ def sample_composite_model(model, input_data, output_folder, nmr_samples, thinni
                 dictionary with as keys dir-/file-names and as values maps to be stored in the results directory.
         sampler_options (dict): specific options for the MCMC routine. These will be provided to the sampling routine
             as additional keyword arguments to the constructor.
+        streaming_block_size (int): if set, we sample in streaming mode. The chains are then generated in blocks of
+            this many samples and the post-sampling statistics are updated after every block. Only the samples
+            selected for storage are kept, such that the memory use is independent of the length of the chain.
+        checkpoint_interval (int): if set, we store the state of the sampler every this many samples. If the
+            sampling is interrupted, a next call with ``recalculate=False`` continues the chains from the last
+            checkpoint instead of restarting the interrupted batch of voxels.
     """
     from mdt.__version__ import __version__
     logger = logging.getLogger(__name__)
@@ -86,31 +103,67 @@ def sample_composite_model(model, input_data, output_folder, nmr_samples, thinni
     if not os.path.isdir(output_folder):
         os.makedirs(output_folder)
 
+    model.set_input_data(input_data)
+
+    output_exists = not recalculate and (os.path.exists(os.path.join(output_folder, 'UsedMask.nii.gz'))
+                                         or os.path.exists(os.path.join(output_folder, 'UsedMask.nii')))
+
+    # results without a manifest are reused as is, this avoids reading all the observations to compute the manifest
+    if output_exists and load_manifest(output_folder) is None:
+        logger.info('Not recalculating {} model'.format(model.name))
+        return load_samples(output_folder)
+
+    manifest = get_sampling_manifest(
+        model, input_data, method or 'AMWG',
+        {'nmr_samples': nmr_samples, 'thinning': thinning, 'burnin': burnin, 'store_samples': store_samples,
+         'sample_items_to_save': sample_items_to_save, 'post_sampling_cb': post_sampling_cb,
+         'sampler_options': sampler_options, 'streaming_block_size': streaming_block_size},
+        double_precision=CLRuntimeInfo().double_precision)
+
+    if not recalculate:
+        changed_items = get_changed_items(output_folder, manifest)
+        if changed_items:
+            logger.info('The inputs of the {} model changed since the last sampling ({}), recalculating.'.format(
+                model.name, ', '.join(changed_items)))
+            recalculate = True
+
     if recalculate:
         shutil.rmtree(output_folder)
-    else:
-        if os.path.exists(os.path.join(output_folder, 'UsedMask.nii.gz')) \
-                or os.path.exists(os.path.join(output_folder, 'UsedMask.nii')):
-            logger.info('Not recalculating {} model'.format(model.name))
-            return load_samples(output_folder)
+    elif output_exists:
+        logger.info('Not recalculating {} model'.format(model.name))
+        return load_samples(output_folder)
 
     if not os.path.isdir(output_folder):
         os.makedirs(output_folder)
 
-    model.set_input_data(input_data)
+    processing_strategy = get_processing_strategy('sampling')
+
+    # the checkpoints are meant to survive a crash, as such, these are never placed in RAM
+    estimated_size = None
+    if checkpoint_interval is None and processing_strategy.supports_local_tmp_storage():
+        estimated_size = estimate_intermediate_results_size(model, input_data.nmr_voxels)
+
+    tmp_results_path = get_intermediate_results_path(output_folder, tmp_dir, estimated_size=estimated_size)
+    if get_changed_items(tmp_results_path, manifest):
+        logger.info('Discarding the temporary results, these were computed using different inputs.')
+        recalculate = True
 
     with per_model_logging_context(output_folder, overwrite=recalculate):
         with _log_info(logger, model.name):
             worker = SamplingProcessor(
                 nmr_samples, thinning, burnin, method or 'AMWG',
                 model, input_data.mask, input_data.nifti_header, output_folder,
-                get_intermediate_results_path(output_folder, tmp_dir), recalculate,
+                tmp_results_path, recalculate,
                 samples_storage_strategy=samples_storage_strategy,
                 post_sampling_cb=post_sampling_cb,
-                sampler_options=sampler_options)
+                sampler_options=sampler_options,
+                streaming_block_size=streaming_block_size,
+                checkpoint_interval=checkpoint_interval)
+            write_manifest(tmp_results_path, manifest)
 
-            processing_strategy = get_processing_strategy('sampling')
-            return processing_strategy.process(worker)
+            results = processing_strategy.process(worker)
+            write_manifest(output_folder, manifest)
+            return results
 
 
 @contextmanager
@@ -134,7 +187,8 @@ class SamplingProcessor(SimpleModelProcessor):
         pass
 
     def __init__(self, nmr_samples, thinning, burnin, method, model, mask, nifti_header, output_dir, tmp_storage_dir,
-                 recalculate, samples_storage_strategy=None, post_sampling_cb=None, sampler_options=None):
+                 recalculate, samples_storage_strategy=None, post_sampling_cb=None, sampler_options=None,
+                 streaming_block_size=None, checkpoint_interval=None):
         """The processing worker for model sample.
 
         Args:
@@ -155,7 +209,17 @@ class SamplingProcessor(SimpleModelProcessor):
                     dictionary with as keys dir-/file-names and as values maps to be stored in the results directory.
             sampler_options (dict): specific options for the MCMC routine. These will be provided to the sampling routine
                 as additional keyword arguments to the constructor.
+            streaming_block_size (int): if set, we generate the chains in blocks of this many samples and update the
+                post-sampling statistics after every block, instead of keeping the full chains in memory.
+            checkpoint_interval (int): if set, we write a checkpoint of the sampler state every this many samples,
+                from which we can resume the current batch of voxels after an interruption.
+
+        Raises:
+            ValueError: if a post-sampling callback is used in streaming mode, since that requires the full chains.
         """
+        if streaming_block_size and post_sampling_cb:
+            raise ValueError('The post-sampling callback can not be used in streaming sampling mode.')
+
         super().__init__(mask, nifti_header, output_dir, tmp_storage_dir, recalculate)
         self._nmr_samples = nmr_samples
         self._thinning = thinning
@@ -169,19 +233,58 @@ class SamplingProcessor(SimpleModelProcessor):
         self._samples_output_stored = []
         self._post_sampling_cb = post_sampling_cb
         self._sampler_options = sampler_options or {}
+        self._streaming_block_size = streaming_block_size
+        self._checkpoint_interval = checkpoint_interval
+        self._checkpoint_path = os.path.join(self._processing_tmp_dir, 'sampling_checkpoint.npz')
+        self._checkpoint_chain_dir = os.path.join(self._processing_tmp_dir, 'sampling_chain')
 
         self._kernel_data = self._model.get_kernel_data()
         self._initial_params = self._model.get_initial_parameters()
         self._ll_func = self._model.get_log_likelihood_function()
         self._prior_func = self._model.get_log_prior_function()
 
+    def get_memory_per_voxel(self):
+        """Estimate the memory per voxel from the number of observations, parameters and samples.
+
+        This accounts for the input data and for the samples, log-likelihoods and log-priors of the chain, all in
+        double precision. In streaming mode, only one block of the chain is in memory at a time, next to the
+        statistics and the batch means used for the ESS.
+        """
+        nmr_params = self._model.get_nmr_parameters()
+        nmr_samples_in_memory = self._nmr_samples
+        if self._streaming_block_size:
+            nmr_samples_in_memory = (min(self._streaming_block_size, self._nmr_samples)
+                                     + int(np.sqrt(self._nmr_samples)) + nmr_params + 10)
+        return 8 * (3 * self._model.get_nmr_observations() + (nmr_params + 2) * nmr_samples_in_memory
+                    + 10 * nmr_params)
+
+    def _prepare(self, roi_indices):
+        """Get the kernel data subset, the starting points and the proposal standard deviations of the given voxels."""
+        proposal_stds = None
+        if self._method in ['AMWG', 'SCAM', 'MWG', 'FSL']:
+            proposal_stds = self._model.get_rwm_proposal_stds()[roi_indices]
+        return self._kernel_data.get_subset(roi_indices), self._initial_params[roi_indices], proposal_stds
+
     def _process(self, roi_indices, next_indices=None):
+        sampler = self._get_sampler(roi_indices)
+        if self._streaming_block_size:
+            self._process_streaming(sampler, roi_indices)
+        else:
+            self._process_full_chain(sampler, roi_indices)
+
+        if self._checkpoint_interval:
+            self._write_in_background(self._remove_checkpoint)
+
+    def _get_sampler(self, roi_indices):
+        """Construct the sampler for the given voxels."""
+        kernel_data_subset, initial_params, proposal_stds = self._get_prepared(roi_indices)
+
         method = None
-        method_args = [self._ll_func, self._prior_func, self._initial_params[roi_indices]]
-        method_kwargs = {'data': self._kernel_data.get_subset(roi_indices)}
+        method_args = [self._ll_func, self._prior_func, initial_params]
+        method_kwargs = {'data': kernel_data_subset}
 
         if self._method in ['AMWG', 'SCAM', 'MWG', 'FSL']:
-            method_args.append(self._model.get_rwm_proposal_stds()[roi_indices])
+            method_args.append(proposal_stds)
 
         if self._method in ['AMWG', 'SCAM', 'MWG', 'FSL', 't-walk']:
             method_kwargs.update(finalize_proposal_func=self._model.get_finalize_proposal_function())
@@ -204,12 +307,20 @@ class SamplingProcessor(SimpleModelProcessor):
         if method is None:
             raise ValueError('Could not find the sampler with name {}.'.format(self._method))
 
-        sampler = method(*method_args, **method_kwargs)
-        sampling_output = sampler.sample(self._nmr_samples, burnin=self._burnin, thinning=self._thinning)
+        return method(*method_args, **method_kwargs)
+
+    def _process_full_chain(self, sampler, roi_indices):
+        """Sample the full chain and compute the post-sampling maps from all the samples."""
+        if self._checkpoint_interval:
+            sampling_output = self._sample_chain_with_checkpoints(sampler, roi_indices)
+        else:
+            with profile_stage('sample', nmr_voxels=len(roi_indices), nmr_samples=self._nmr_samples):
+                sampling_output = sampler.sample(self._nmr_samples, burnin=self._burnin, thinning=self._thinning)
         samples = sampling_output.get_samples()
 
         self._logger.info('Starting post-processing')
-        maps_to_save = self._model.get_post_sampling_maps(sampling_output, roi_indices=roi_indices)
+        with profile_stage('post_processing', nmr_voxels=len(roi_indices)):
+            maps_to_save = self._model.get_post_sampling_maps(sampling_output, roi_indices=roi_indices)
         maps_to_save.update({self._used_mask_name: np.ones(samples.shape[0], dtype=np.bool)})
 
         if self._post_sampling_cb:
@@ -218,6 +329,160 @@ class SamplingProcessor(SimpleModelProcessor):
                 maps_to_save.update(out)
 
         self._write_output_recursive(maps_to_save, roi_indices)
+        self._write_sample_results(self._get_samples_to_save(sampling_output), roi_indices)
+
+        self._logger.info('Finished post-processing')
+
+    def _process_streaming(self, sampler, roi_indices):
+        """Sample the chain in blocks, updating the post-sampling statistics and storing the samples per block."""
+        def process_block(block_start, sampling_output, statistics):
+            self._model.update_sampling_statistics(statistics, sampling_output, roi_indices=roi_indices)
+            self._write_sample_results(self._get_samples_to_save(sampling_output), roi_indices,
+                                       block_start=block_start)
+
+        block_size = self._streaming_block_size
+        if self._checkpoint_interval:
+            block_size = min(block_size, self._checkpoint_interval)
+
+        statistics = self._sample_in_blocks(
+            sampler, roi_indices, block_size, process_block,
+            self._model.get_sampling_statistics(len(roi_indices), self._nmr_samples))
+
+        self._logger.info('Starting post-processing')
+        with profile_stage('post_processing', nmr_voxels=len(roi_indices)):
+            maps_to_save = self._model.get_post_sampling_maps_from_statistics(statistics, roi_indices=roi_indices)
+        maps_to_save.update({self._used_mask_name: np.ones(len(roi_indices), dtype=bool)})
+        self._write_output_recursive(maps_to_save, roi_indices)
+        self._logger.info('Finished post-processing')
+
+    def _sample_chain_with_checkpoints(self, sampler, roi_indices):
+        """Sample the full chain in blocks, storing the chain on disk such that we can resume from a checkpoint.
+
+        Returns:
+            mot.sample.base.SamplingOutput: the output of the sampler over the full chain
+        """
+        chain_names = ['samples', 'log_likelihoods', 'log_priors']
+
+        def process_block(block_start, sampling_output, state):
+            outputs = [sampling_output.get_samples(), sampling_output.get_log_likelihoods(),
+                       sampling_output.get_log_priors()]
+
+            os.makedirs(self._checkpoint_chain_dir, exist_ok=True)
+            for name, output in zip(chain_names, outputs):
+                path = os.path.join(self._checkpoint_chain_dir, name + '.npy')
+                if block_start == 0:
+                    chain = open_memmap(path, mode='w+', dtype=output.dtype,
+                                        shape=output.shape[:-1] + (self._nmr_samples,))
+                else:
+                    chain = open_memmap(path, mode='r+')
+                chain[..., block_start:block_start + output.shape[-1]] = output
+                chain.flush()
+                del chain
+
+        self._sample_in_blocks(sampler, roi_indices, self._checkpoint_interval, process_block)
+        return SimpleSampleOutput(*[np.load(os.path.join(self._checkpoint_chain_dir, name + '.npy'))
+                                    for name in chain_names])
+
+    def _sample_in_blocks(self, sampler, roi_indices, block_size, process_block, state=None):
+        """Sample the chain in blocks, resuming from and writing checkpoints if enabled.
+
+        Args:
+            sampler (mot.sample.base.AbstractSampler): the sampler for the current voxels
+            roi_indices (ndarray): the ROI indices of the current voxels
+            block_size (int): the maximum number of samples per block
+            process_block (Callable[[int, SamplingOutput, object], None]): called after every block, with the
+                position of the block in the chain, the sampling output of the block and the state object.
+            state (object): the (picklable) state of the block processing, this is stored in the checkpoints.
+
+        Returns:
+            object: the state after processing all the blocks, this may be a state restored from a checkpoint.
+        """
+        samples_done = 0
+        checkpoint = self._load_checkpoint(roi_indices)
+        if checkpoint is not None:
+            samples_done, sampler_state, state = checkpoint
+            _set_sampler_state(sampler, sampler_state)
+            self._logger.info('Resuming the sampling from sample {} using the checkpoint.'.format(samples_done))
+
+        last_checkpoint = samples_done
+        for batch_start, batch_end in split_in_batches(self._nmr_samples - samples_done, max_batch_size=block_size):
+            block_start = samples_done + batch_start
+            block_end = samples_done + batch_end
+
+            with profile_stage('sample', nmr_voxels=len(roi_indices), nmr_samples=block_end - block_start):
+                sampling_output = sampler.sample(block_end - block_start,
+                                                 burnin=(self._burnin if block_start == 0 else 0),
+                                                 thinning=self._thinning)
+            process_block(block_start, sampling_output, state)
+
+            if self._checkpoint_interval and block_end < self._nmr_samples \
+                    and block_end - last_checkpoint >= self._checkpoint_interval:
+                self._write_in_background(self._write_checkpoint, roi_indices, block_end,
+                                          _get_sampler_state(sampler), pickle.dumps(state))
+                last_checkpoint = block_end
+        return state
+
+    def _write_checkpoint(self, roi_indices, samples_done, sampler_state, pickled_state):
+        """Write a checkpoint, this replaces the previous checkpoint atomically."""
+        os.makedirs(self._processing_tmp_dir, exist_ok=True)
+
+        settings = np.array([samples_done, self._nmr_samples, self._burnin or 0, self._thinning or 0],
+                            dtype=np.int64)
+        sampler_items = {'sampler.' + key: value for key, value in sampler_state.items()}
+
+        tmp_path = self._checkpoint_path + '.tmp.npz'
+        np.savez(tmp_path, roi_indices=roi_indices, settings=settings, method=np.array(self._method),
+                 mot_version=np.array(mot.__version__), state=np.frombuffer(pickled_state, dtype=np.uint8),
+                 **sampler_items)
+        os.replace(tmp_path, self._checkpoint_path)
+
+    def _load_checkpoint(self, roi_indices):
+        """Load the checkpoint of the given voxels, if present.
+
+        Since the sampler state depends on the internals of the MOT samplers, see :func:`_get_sampler_state`,
+        checkpoints written by another version of MOT are not used.
+
+        Returns:
+            tuple or None: the number of samples done, the sampler state and the state of the block processing.
+                None if there is no usable checkpoint for these voxels.
+        """
+        if not self._checkpoint_interval or not os.path.isfile(self._checkpoint_path):
+            return None
+
+        with np.load(self._checkpoint_path) as checkpoint:
+            mot_version = str(checkpoint['mot_version']) if 'mot_version' in checkpoint.files else 'unknown'
+            if mot_version != mot.__version__:
+                self._logger.info('Ignoring the sampling checkpoint since it was written using MOT version {}, '
+                                  'we are using version {}.'.format(mot_version, mot.__version__))
+                return None
+
+            settings = checkpoint['settings']
+            if not np.array_equal(checkpoint['roi_indices'], roi_indices) \
+                    or str(checkpoint['method']) != self._method \
+                    or list(settings[1:]) != [self._nmr_samples, self._burnin or 0, self._thinning or 0]:
+                self._logger.info('Ignoring the sampling checkpoint since it does not match the current batch.')
+                return None
+
+            sampler_state = {key[len('sampler.'):]: checkpoint[key] for key in checkpoint.files
+                             if key.startswith('sampler.')}
+            return int(settings[0]), sampler_state, pickle.loads(checkpoint['state'].tobytes())
+
+    def _remove_checkpoint(self):
+        if os.path.isfile(self._checkpoint_path):
+            os.remove(self._checkpoint_path)
+        if os.path.isdir(self._checkpoint_chain_dir):
+            shutil.rmtree(self._checkpoint_chain_dir)
+
+    def _get_samples_to_save(self, sampling_output):
+        """Get the chains of the output items we want to store.
+
+        Args:
+            sampling_output (mot.sample.base.SamplingOutput): the output of the sampler
+
+        Returns:
+            dict: per output name the (d, n) matrix with the chain of that item
+        """
+        samples = sampling_output.get_samples()
 
         def get_output(output_name):
             if output_name in self._model.get_free_param_names():
@@ -230,11 +495,14 @@ class SamplingProcessor(SimpleModelProcessor):
         items_to_save = {}
         for ind, name in enumerate(list(self._model.get_free_param_names()) + ['LogLikelihood', 'LogPrior']):
             if self._samples_to_save_method.store_samples(name):
-                self._samples_output_stored.append(name)
+                if name not in self._samples_output_stored:
+                    self._samples_output_stored.append(name)
                 items_to_save.update({name: get_output(name)})
-        self._write_sample_results(items_to_save, roi_indices)
+        return items_to_save
 
-        self._logger.info('Finished post-processing')
+    def set_tmp_storage_shard(self, shard_dir=None):
+        raise NotImplementedError('The sample chains are written directly to the output folder, '
+                                  'writing to shards is not supported.')
 
     def combine(self):
         super().combine()
@@ -243,11 +511,30 @@ class SamplingProcessor(SimpleModelProcessor):
             self._combine_volumes(self._output_dir, self._tmp_storage_dir,
                                   self._nifti_header, maps_subdir=subdir)
 
+        if self._write_results_container:
+            self._move_samples_to_container()
+
         if self._samples_output_stored:
             return load_samples(self._output_dir)
 
         return SamplingProcessor.SampleChainNotStored()
 
+    def _move_samples_to_container(self):
+        """Move the sample files from the output directory into the results container."""
+        sample_files = sorted(glob.glob(os.path.join(self._output_dir, '*.samples.npy')))
+        if not sample_files:
+            return
+
+        with ResultsContainerWriter(os.path.join(self._output_dir, CONTAINER_FILENAME), self._mask_index,
+                                    nifti_header=self._nifti_header,
+                                    compression_level=get_nifti_writer_options()['compression_level']) as writer:
+            for fname in sample_files:
+                writer.write_roi(os.path.basename(fname)[0:-len('.samples.npy')], open_memmap(fname, mode='r'),
+                                 group='samples')
+
+        for fname in sample_files:
+            os.remove(fname)
+
     def _write_output_recursive(self, results, roi_indices, sub_dir=''):
         current_output = {}
         sub_dir = sub_dir
@@ -261,42 +548,96 @@ class SamplingProcessor(SimpleModelProcessor):
         self._write_volumes(current_output, roi_indices, os.path.join(self._tmp_storage_dir, sub_dir))
         self._subdirs.add(sub_dir)
 
-    def _write_sample_results(self, results, roi_indices):
+    def _write_sample_results(self, results, roi_indices, block_start=0):
         """Write the sample results to a .npy file.
 
         If the given sample files do not exists or if the existing file is not large enough it will create one
         with enough storage to hold all the samples for the given total_nmr_voxels.
         On storing it should also be given a list of voxel indices with the indices of the voxels that are being stored.
 
+        If a write executor is set, the writing is done in the background.
+
+        When sampling in streaming mode, the results only contain a block of the chain. We then only store the
+        samples of that block which are selected for storage.
+
         Args:
             results (dict): the samples to write
             roi_indices (ndarray): the roi indices of the voxels we computed
+            block_start (int): the position in the chain of the first sample in the results
         """
-        if not os.path.exists(self._output_dir):
-            os.makedirs(self._output_dir)
-
-        for fname in os.listdir(self._output_dir):
-            if fname.endswith('.samples.npy'):
-                chain_name = fname[0:-len('.samples.npy')]
-                if chain_name not in results:
-                    os.remove(os.path.join(self._output_dir, fname))
-
-        for output_name, samples in results.items():
-            save_indices = self._samples_to_save_method.indices_to_store(output_name, samples.shape[1])
-            samples_path = os.path.join(self._output_dir, output_name + '.samples.npy')
-            mode = 'w+'
-
-            if os.path.isfile(samples_path):
-                mode = 'r+'
-                current_results = open_memmap(samples_path, mode='r')
-                if current_results.shape[1] != len(save_indices):
-                    mode = 'w+'
-                del current_results  # closes the memmap
-
-            saved = open_memmap(samples_path, mode=mode, dtype=samples.dtype,
-                                shape=(self._total_nmr_voxels, len(save_indices)))
-            saved[roi_indices, :] = samples[:, save_indices]
-            del saved
+        self._write_in_background(self._write_sample_results_to_disk, results, roi_indices, block_start)
+
+    def _write_sample_results_to_disk(self, results, roi_indices, block_start=0):
+        """The synchronous part of :meth:`_write_sample_results`."""
+        with profile_stage('samples_write', nmr_voxels=len(roi_indices)):
+            if not os.path.exists(self._output_dir):
+                os.makedirs(self._output_dir)
+
+            for fname in os.listdir(self._output_dir):
+                if fname.endswith('.samples.npy'):
+                    chain_name = fname[0:-len('.samples.npy')]
+                    if chain_name not in results:
+                        os.remove(os.path.join(self._output_dir, fname))
+
+            for output_name, samples in results.items():
+                save_indices = np.asarray(self._samples_to_save_method.indices_to_store(
+                    output_name, self._nmr_samples), dtype=np.int64)
+                samples_path = os.path.join(self._output_dir, output_name + '.samples.npy')
+                mode = 'w+'
+
+                if os.path.isfile(samples_path):
+                    mode = 'r+'
+                    current_results = open_memmap(samples_path, mode='r')
+                    if current_results.shape[1] != len(save_indices):
+                        mode = 'w+'
+                    del current_results  # closes the memmap
+
+                saved = open_memmap(samples_path, mode=mode, dtype=samples.dtype,
+                                    shape=(self._total_nmr_voxels, len(save_indices)))
+
+                in_block = (save_indices >= block_start) & (save_indices < block_start + samples.shape[1])
+                if np.all(in_block):
+                    saved[roi_indices, :] = samples[:, save_indices - block_start]
+                elif np.any(in_block):
+                    saved[np.asarray(roi_indices)[:, None], np.where(in_block)[0][None, :]] = \
+                        samples[:, save_indices[in_block] - block_start]
+                del saved
+
+
+def _get_sampler_state(sampler):
+    """Get a copy of the state of a MOT sampler.
+
+    The state of the samplers is held in their array attributes, like the current position and log-likelihood,
+    the random number generator state and the adaptive proposal state (like the proposal standard deviations and the
+    acceptance counters), together with the current iteration index.
+
+    This relies on the private attributes of the MOT samplers, as in MOT 0.11. The checkpoints therefore record the
+    MOT version and are only used with the same version.
+
+    Args:
+        sampler (mot.sample.base.AbstractSampler): the sampler
+
+    Returns:
+        dict: the copied state of the sampler
+    """
+    state = {key: np.copy(value) for key, value in vars(sampler).items()
+             if isinstance(value, np.ndarray) and key != '_x0'}
+    state['_sampling_index'] = np.array(sampler._sampling_index)
+    return state
+
+
+def _set_sampler_state(sampler, state):
+    """Restore the state of a MOT sampler, as returned by :func:`_get_sampler_state`.
+
+    Args:
+        sampler (mot.sample.base.AbstractSampler): the sampler to update
+        state (dict): the sampler state
+    """
+    for key, value in state.items():
+        if key == '_sampling_index':
+            sampler._sampling_index = int(value)
+        elif isinstance(getattr(sampler, key, None), np.ndarray):
+            setattr(sampler, key, np.require(np.copy(value), requirements='C'))
 
 
 class SamplesStorageStrategy:
@@ -8,17 +8,30 @@ encapsulates how to process the processors. For example, a strategy may be to sp
 those while saving intermediate results.
 """
 import glob
+import io
 import logging
+import multiprocessing
 import os
+import pickle
 import shutil
+import socket
+import tempfile
+import threading
 import timeit
+import uuid
 from contextlib import contextmanager
 import numpy as np
 import time
 import gc
+from concurrent.futures import ThreadPoolExecutor
+import mot.configuration
 from numpy.lib.format import open_memmap
+from mdt.configuration import get_config_dict, get_nifti_writer_options, use_results_container
 from mdt.lib.nifti import write_all_as_nifti
-from mdt.utils import create_roi
+from mdt.lib.profiling import profile_stage
+from mdt.lib.results_container import ResultsContainerWriter, CONTAINER_FILENAME
+from mdt.lib.deferred_mappings import DeferredActionDict
+from mdt.utils import get_mask_index, restore_volumes
 
 __author__ = 'Robbert Harms'
 __date__ = "2016-07-29"
@@ -43,6 +56,14 @@ class ModelProcessingStrategy:
         """
         raise NotImplementedError()
 
+    def supports_local_tmp_storage(self):
+        """Check if the temporary results may be placed on storage local to this process, like a RAM filesystem.
+
+        Returns:
+            boolean: False if the temporary results must be accessible by other processes or machines
+        """
+        return True
+
 
 class ModelProcessor:
 
@@ -59,6 +80,30 @@ class ModelProcessor:
         """
         raise NotImplementedError()
 
+    def set_background_executors(self, prepare_executor=None, write_executor=None):
+        """Set the executors this processor may use to do work in the background.
+
+        Processing strategies can use this to overlap the host side work of a processor, like preparing the data of
+        the next batch and writing the results of the previous batch, with the computations of the current batch.
+        Processors that do not support background work may ignore this.
+
+        Args:
+            prepare_executor (concurrent.futures.Executor): the executor to use for preparing the next batch.
+                Set to None to prepare each batch in the calling thread.
+            write_executor (concurrent.futures.Executor): the executor to use for writing the results.
+                Set to None to write the results in the calling thread.
+        """
+
+    def get_memory_per_voxel(self):
+        """Get an estimate of the memory needed to process a single voxel.
+
+        This is used by processing strategies which adapt the number of voxels per batch to a memory budget.
+
+        Returns:
+            int or None: the estimated number of bytes needed per voxel, or None if unknown.
+        """
+        return None
+
     def get_voxels_to_compute(self):
         """Get the ROI indices of the voxels we need to compute.
 
@@ -80,6 +125,40 @@ class ModelProcessor:
         """
         raise NotImplementedError()
 
+    def get_processing_tmp_dir(self):
+        """Get the directory for the bookkeeping of the processing.
+
+        Processing strategies may use this directory to store their own state. It is shared by all processes
+        working on the same temporary storage.
+
+        Returns:
+            str or None: the path to the processing directory, None if the processor keeps its results in memory
+        """
+        raise NotImplementedError()
+
+    def set_tmp_storage_shard(self, shard_dir=None):
+        """Write the temporary results of the next batches to the given shard directory.
+
+        This is used when multiple independent processes work on the same temporary storage. Instead of writing to
+        the shared temporary results, every process writes its results to its own shards, which are merged using
+        :meth:`merge_tmp_storage_shards` before combining.
+
+        Args:
+            shard_dir (str): the directory to write the temporary results to, set to None to write to the
+                temporary storage again.
+        """
+        raise NotImplementedError('The processor {} does not support writing its results '
+                                  'to shards.'.format(type(self).__name__))
+
+    def merge_tmp_storage_shards(self, shard_dirs):
+        """Merge the results written to the given shard directories into the temporary storage.
+
+        Args:
+            shard_dirs (list of str): the shard directories to merge, these are removed afterwards.
+        """
+        raise NotImplementedError('The processor {} does not support writing its results '
+                                  'to shards.'.format(type(self).__name__))
+
     def combine(self):
         """Combine all the calculated parts.
 
@@ -136,23 +215,21 @@ class ChunksProcessingStrategy(ModelProcessingStrategy):
             start_nmr_processed = (total_nmr_voxels - len(total_roi_indices))
 
             mot_logging_enabled = True
-            for chunk_ind, chunk in enumerate(chunks):
+            for chunk, next_chunk in self._iterate_chunks(processor, chunks):
                 self._logger.info(self._get_batch_start_message(
                         total_nmr_voxels, chunk, total_roi_indices, voxels_processed, start_time, start_nmr_processed))
 
-                next_chunk = None
-                if chunk_ind < len(chunks) - 1:
-                    next_chunk = chunks[chunk_ind + 1]
-
                 def process():
                     processor.process(chunk, next_indices=next_chunk)
 
+                chunk_start_time = timeit.default_timer()
                 if mot_logging_enabled:
                     process()
                     mot_logging_enabled = False
                 else:
                     with self._with_logging_to_debug():
                         process()
+                self._chunk_processed(chunk, timeit.default_timer() - chunk_start_time)
 
                 gc.collect()
 
@@ -162,6 +239,31 @@ class ChunksProcessingStrategy(ModelProcessingStrategy):
 
         return batches
 
+    def _iterate_chunks(self, processor, chunks):
+        """Iterate over the chunks to process, together with the chunk processed after each chunk.
+
+        Args:
+            processor (ModelProcessor): the processor we use
+            chunks (list of ndarray): the chunks from :meth:`_get_chunks`
+
+        Returns:
+            Iterator[tuple]: per chunk the ROI indices of that chunk and of the next chunk, the latter is None
+                for the last chunk.
+        """
+        for chunk_ind, chunk in enumerate(chunks):
+            next_chunk = None
+            if chunk_ind < len(chunks) - 1:
+                next_chunk = chunks[chunk_ind + 1]
+            yield chunk, next_chunk
+
+    def _chunk_processed(self, chunk, run_time):
+        """Called after each processed chunk, this allows adapting the chunks to the processing speed.
+
+        Args:
+            chunk (ndarray): the ROI indices of the processed chunk
+            run_time (float): the time it took to process the chunk, in seconds
+        """
+
     @contextmanager
     def _with_logging_to_debug(self):
         package_handlers = [logging.getLogger(package).handlers for package in ['mdt', 'mot']]
@@ -225,6 +327,573 @@ class VoxelRange(ChunksProcessingStrategy):
         return chunks
 
 
+class AdaptiveVoxelRange(ChunksProcessingStrategy):
+
+    def __init__(self, max_nmr_voxels=100000, min_nmr_voxels=100, memory_budget=None, target_batch_time=60,
+                 **kwargs):
+        """Optimize a given dataset in batches of which the size adapts to the memory use and the processing speed.
+
+        The size of the first batch is determined by the memory budget and the estimated memory use per voxel of the
+        processor. After each batch we measure the number of voxels processed per second and resize the next batch such
+        that it takes approximately ``target_batch_time`` seconds, without exceeding the memory budget.
+
+        Args:
+            max_nmr_voxels (int): the maximum number of voxels per batch
+            min_nmr_voxels (int): the minimum number of voxels per batch
+            memory_budget (float): the memory budget in MB. Defaults to a quarter of the physical memory, limited
+                by the global memory of the smallest compute device.
+            target_batch_time (float): the desired processing time per batch, in seconds
+        """
+        super().__init__(**kwargs)
+        self.max_nmr_voxels = max_nmr_voxels
+        self.min_nmr_voxels = min_nmr_voxels
+        self.memory_budget = memory_budget
+        self.target_batch_time = target_batch_time
+        self._max_batch_size = max_nmr_voxels
+        self._batch_size = max_nmr_voxels
+
+    def _get_chunks(self, total_roi_indices):
+        return [total_roi_indices]
+
+    def _iterate_chunks(self, processor, chunks):
+        """Split the voxels in batches, of which the size is adapted to the processing speed of the previous batches.
+
+        Since the next batch is handed to the processor before the current batch is processed, for prefetching, the
+        size of the next batch is based on the speed measured up to the previous batch.
+        """
+        self._max_batch_size = self._get_max_batch_size(processor)
+        self._batch_size = self._max_batch_size
+
+        for roi_indices in chunks:
+            batch_start = 0
+            batch = roi_indices[:self._batch_size]
+            while len(batch):
+                next_start = batch_start + len(batch)
+                next_batch = roi_indices[next_start:next_start + self._batch_size]
+                yield batch, (next_batch if len(next_batch) else None)
+                batch_start, batch = next_start, next_batch
+
+    def _chunk_processed(self, chunk, run_time):
+        if run_time > 0:
+            voxels_per_second = len(chunk) / run_time
+            self._batch_size = int(np.clip(voxels_per_second * self.target_batch_time,
+                                           min(self.min_nmr_voxels, self._max_batch_size), self._max_batch_size))
+            self._logger.debug('Processed {:.1f} voxels per second, '
+                               'using {} voxels for the batch after the next.'.format(voxels_per_second,
+                                                                                      self._batch_size))
+
+    def _get_max_batch_size(self, processor):
+        """Get the maximum number of voxels per batch, given the memory budget.
+
+        Args:
+            processor (ModelProcessor): the processor, used for the estimate of the memory per voxel
+
+        Returns:
+            int: the maximum number of voxels per batch
+        """
+        memory_per_voxel = processor.get_memory_per_voxel()
+        if not memory_per_voxel:
+            return self.max_nmr_voxels
+
+        memory_budget = self._get_memory_budget()
+        nmr_voxels = int(np.clip(memory_budget // memory_per_voxel, self.min_nmr_voxels, self.max_nmr_voxels))
+        self._logger.info('Using at most {} voxels per batch, with a memory budget of {:.0f} MB '
+                          'and an estimated {:.2f} kB per voxel.'.format(nmr_voxels, memory_budget / 1024 ** 2,
+                                                                         memory_per_voxel / 1024))
+        return nmr_voxels
+
+    def _get_memory_budget(self):
+        """Get the memory budget in bytes.
+
+        Returns:
+            int: the configured memory budget, or, if not set, a quarter of the physical memory limited by the
+                global memory of the smallest compute device.
+        """
+        if self.memory_budget:
+            return int(self.memory_budget * 1024 ** 2)
+
+        try:
+            memory_budget = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 4
+        except (ValueError, OSError, AttributeError):
+            memory_budget = 1024 ** 3
+
+        device_memory = [env.device.global_mem_size for env in mot.configuration.get_cl_environments()]
+        if device_memory:
+            memory_budget = min(memory_budget, min(device_memory) // 2)
+        return memory_budget
+
+
+class PipelinedVoxelRange(VoxelRange):
+
+    def __init__(self, max_nmr_voxels=10000, **kwargs):
+        """Optimize a given dataset in batches of the given number of voxels, overlapping the work between batches.
+
+        This processes the voxels in the same batches as :class:`VoxelRange`, but while a batch is being computed
+        the data of the next batch is prepared, and the results of the previous batch are written, in background
+        threads. This hides most of the host side work (data subsets, initial parameters and the writing of the
+        intermediate results) behind the computations on the compute device.
+
+        Args:
+            max_nmr_voxels (int): the number of voxels per batch
+        """
+        super().__init__(max_nmr_voxels=max_nmr_voxels, **kwargs)
+
+    def _process_chunk(self, processor, chunks):
+        with ThreadPoolExecutor(max_workers=1) as prepare_executor, \
+                ThreadPoolExecutor(max_workers=1) as write_executor:
+            processor.set_background_executors(prepare_executor=prepare_executor, write_executor=write_executor)
+            try:
+                return super()._process_chunk(processor, chunks)
+            finally:
+                processor.set_background_executors()
+
+
+class ProcessPoolProcessingStrategy(ChunksProcessingStrategy):
+
+    def __init__(self, max_nmr_voxels=10000, nmr_processes=None, **kwargs):
+        """Optimize a given dataset by sharding the voxels over multiple worker processes.
+
+        The voxels are divided in batches, as in :class:`VoxelRange`, which are then distributed over a pool of worker
+        processes. Each worker rebuilds the model and the processor from a pickled copy and writes its results directly
+        to the shared temporary storage. Combining the results is done in the main process afterwards.
+
+        This is useful on machines with many CPU cores, where a single OpenCL context does not use all cores
+        efficiently. The OpenCL devices of the main process are distributed in a round-robin fashion over the workers.
+
+        Not all processors can be pickled and send to a subprocess, if not, this falls back to processing the
+        batches one after the other in the main process. Large arrays held by the processor, like the volumes of the
+        input data, are not send to the workers but written once to the temporary storage, from which the workers
+        memory map them.
+
+        Args:
+            max_nmr_voxels (int): the maximum number of voxels per batch
+            nmr_processes (int): the number of worker processes, defaults to the number of CPU cores
+        """
+        super().__init__(**kwargs)
+        self.nmr_voxels = max_nmr_voxels
+        self.nmr_processes = nmr_processes or os.cpu_count() or 1
+
+    def _get_chunks(self, total_roi_indices):
+        nmr_voxels = min(self.nmr_voxels, int(np.ceil(len(total_roi_indices) / self.nmr_processes)))
+        nmr_voxels = max(nmr_voxels, 1)
+
+        chunks = []
+        for ind_start in range(0, len(total_roi_indices), nmr_voxels):
+            ind_end = min(len(total_roi_indices), ind_start + nmr_voxels)
+            chunks.append(total_roi_indices[ind_start:ind_end])
+        return chunks
+
+    def _process_chunk(self, processor, chunks):
+        worker_data_dir = tempfile.mkdtemp(prefix='worker_data_', dir=processor.get_processing_tmp_dir())
+        try:
+            try:
+                pickled_processor = _dump_with_file_references(processor, worker_data_dir)
+            except (pickle.PicklingError, TypeError, AttributeError) as exc:
+                self._logger.warning('Could not send the processor to the worker processes ({}), '
+                                     'processing all voxels in the main process.'.format(exc))
+                return super()._process_chunk(processor, chunks)
+            return self._process_chunk_in_workers(processor, chunks, pickled_processor)
+        finally:
+            shutil.rmtree(worker_data_dir, ignore_errors=True)
+
+    def _process_chunk_in_workers(self, processor, chunks, pickled_processor):
+        total_roi_indices = processor.get_voxels_to_compute()
+        total_nmr_voxels = processor.get_total_nmr_voxels()
+
+        if not len(total_roi_indices):
+            return []
+
+        nmr_processes = min(self.nmr_processes, len(chunks))
+        self._logger.info('Processing {} batches using {} worker processes.'.format(len(chunks), nmr_processes))
+
+        mp_context = multiprocessing.get_context('spawn')
+        worker_counter = mp_context.Value('i', 0)
+
+        start_time = timeit.default_timer()
+        start_nmr_processed = (total_nmr_voxels - len(total_roi_indices))
+        voxels_processed = 0
+
+        with mp_context.Pool(nmr_processes, initializer=_init_worker_process,
+                             initargs=(pickled_processor, get_worker_process_settings(), worker_counter)) as pool:
+            for roi_indices in pool.imap_unordered(_process_in_worker_process, chunks):
+                self._logger.info(self._get_batch_start_message(
+                    total_nmr_voxels, roi_indices, total_roi_indices, voxels_processed,
+                    start_time, start_nmr_processed))
+                voxels_processed += len(roi_indices)
+
+        self._logger.info('Computations are at 100%')
+        return []
+
+
+class DistributedVoxelRange(VoxelRange):
+
+    def __init__(self, max_nmr_voxels=10000, lease_time=600, poll_interval=10, **kwargs):
+        """Process a dataset cooperatively with other, independent, processes working on the same temporary storage.
+
+        This allows multiple invocations of the model fitting, for example on different nodes of a cluster, to
+        divide the voxels of a single dataset. All invocations must use the same output folder and the same
+        temporary results directory, on a shared file system, and must not recalculate.
+
+        The voxels are divided in batches of a fixed size. Each process claims batches using lock files, processes
+        them and writes the results to a separate shard per batch. While processing, the lock file is touched
+        regularly, if it is not touched for longer than the lease time the batch is considered abandoned and can
+        be claimed by another process. When all batches are finished, one of the processes merges the shards and
+        combines the results, the others wait until the results are written. Only the process which combined the
+        results returns them, the others return None.
+
+        This only works for processors writing all their temporary results using shards, like the model fitting.
+
+        Args:
+            max_nmr_voxels (int): the number of voxels per batch
+            lease_time (float): the time in seconds after which an untouched claim is considered abandoned.
+                This should be well above any clock difference between the nodes and the file server.
+            poll_interval (float): the time in seconds between checks for finished or abandoned batches
+        """
+        super().__init__(max_nmr_voxels=max_nmr_voxels, **kwargs)
+        self.lease_time = lease_time
+        self.poll_interval = poll_interval
+
+    def supports_local_tmp_storage(self):
+        return False
+
+    def process(self, processor):
+        if processor.get_processing_tmp_dir() is None:
+            raise ValueError('The distributed processing requires a processor which '
+                             'writes its temporary results to a shared file system.')
+        processor.set_tmp_storage_shard(None)
+
+        work_dir = os.path.join(processor.get_processing_tmp_dir(), 'distributed')
+        shards_dir = os.path.join(work_dir, 'shards')
+        os.makedirs(shards_dir, exist_ok=True)
+
+        chunks = self._get_chunks(np.arange(processor.get_total_nmr_voxels()))
+        voxels_to_compute = processor.get_voxels_to_compute()
+
+        self._logger.info('Processing {} batches in cooperation with other processes, '
+                          'using the work directory {}.'.format(len(chunks), work_dir))
+
+        def chunk_path(chunk_ind, extension):
+            return os.path.join(work_dir, 'chunk_{:06d}.{}'.format(chunk_ind, extension))
+
+        mot_logging_enabled = True
+        while True:
+            remaining = [ind for ind in range(len(chunks)) if not os.path.exists(chunk_path(ind, 'done'))]
+            if not remaining or not os.path.exists(work_dir):  # the work dir is removed after combining
+                break
+
+            processed_any = False
+            for chunk_ind in remaining:
+                lease = _FileLease(chunk_path(chunk_ind, 'lock'), self.lease_time)
+                if not lease.acquire():
+                    continue
+
+                try:
+                    if os.path.exists(chunk_path(chunk_ind, 'done')):
+                        continue
+
+                    self._logger.info('Computations are at {0:.2%}, processing batch {1} of {2}.'.format(
+                        1 - len(remaining) / len(chunks), chunk_ind + 1, len(chunks)))
+
+                    roi_indices = np.intersect1d(chunks[chunk_ind], voxels_to_compute)
+                    shard_dir = os.path.join(shards_dir, 'chunk_{:06d}'.format(chunk_ind))
+
+                    if mot_logging_enabled:
+                        self._process_shard(processor, roi_indices, shard_dir, lease)
+                        mot_logging_enabled = False
+                    else:
+                        with self._with_logging_to_debug():
+                            self._process_shard(processor, roi_indices, shard_dir, lease)
+
+                    with open(chunk_path(chunk_ind, 'done'), 'w'):
+                        pass
+                    processed_any = True
+                finally:
+                    lease.release()
+                gc.collect()
+
+            if not processed_any:
+                time.sleep(self.poll_interval)
+
+        self._logger.info('Computations are at 100%')
+
+        while os.path.exists(work_dir):
+            lease = _FileLease(os.path.join(work_dir, 'combine.lock'), self.lease_time)
+            if lease.acquire():
+                try:
+                    self._logger.info('Computed all voxels, now creating nifti\'s')
+                    processor.merge_tmp_storage_shards(sorted(glob.glob(os.path.join(shards_dir, 'chunk_??????'))))
+                    return_data = processor.combine()
+                    processor.finalize()
+                    return return_data
+                finally:
+                    lease.release()
+
+            self._logger.info('Waiting for another process to combine the results.')
+            time.sleep(self.poll_interval)
+        return None
+
+    def _process_shard(self, processor, roi_indices, shard_dir, lease):
+        """Process the given voxels and write the results to the given shard.
+
+        The results are first written to a directory specific to this lease, which is renamed to the shard directory
+        when complete. As such, partial results of abandoned batches are never merged.
+
+        Args:
+            processor (ModelProcessor): the processor to use
+            roi_indices (ndarray): the voxels to process
+            shard_dir (str): the directory for the results of this batch
+            lease (_FileLease): the lease of this batch
+        """
+        tmp_shard_dir = '{}.{}'.format(shard_dir, lease.owner)
+        if len(roi_indices):
+            processor.set_tmp_storage_shard(tmp_shard_dir)
+            try:
+                processor.process(roi_indices)
+            finally:
+                processor.set_tmp_storage_shard(None)
+        else:
+            os.makedirs(tmp_shard_dir, exist_ok=True)
+
+        try:
+            os.rename(tmp_shard_dir, shard_dir)
+        except OSError:
+            self._logger.warning('The batch in {} was already completed by another process.'.format(shard_dir))
+            shutil.rmtree(tmp_shard_dir)
+
+
+class _FileLease:
+
+    def __init__(self, path, lease_time):
+        """An exclusive claim on a unit of work, using a lock file on a, possibly shared, file system.
+
+        The lock file is created atomically and touched regularly by a background thread while the lease is held.
+        A lock file which was not touched for longer than the lease time is considered abandoned, and is taken over.
+
+        Args:
+            path (str): the path of the lock file
+            lease_time (float): the time in seconds after which an untouched lock file is considered abandoned
+        """
+        self.path = path
+        self.lease_time = lease_time
+        self.owner = '{}-{}-{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self._stop_event = None
+
+    def acquire(self):
+        """Try to acquire this lease.
+
+        Returns:
+            boolean: if we now hold this lease
+        """
+        if not self._create_lock_file():
+            if not self._take_over_abandoned():
+                return False
+            if not self._create_lock_file():
+                return False
+
+        self._stop_event = threading.Event()
+        threading.Thread(target=self._keep_alive, args=(self._stop_event,), daemon=True).start()
+        return True
+
+    def release(self):
+        """Release this lease, if held."""
+        if self._stop_event is None:
+            return
+        self._stop_event.set()
+        self._stop_event = None
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _create_lock_file(self):
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except (FileExistsError, FileNotFoundError):
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.owner)
+        return True
+
+    def _take_over_abandoned(self):
+        """Remove the lock file if it is abandoned.
+
+        We read the owner before checking the age of the lock file, such that a lock file created after the age check
+        can not be mistaken for the abandoned one. The lock file is then moved to a name unique to this lease, after
+        which we check that we moved the lock file we found abandoned and that it is still expired. If another process
+        claimed the lease or touched the lock file in the meantime, we move the lock file back.
+
+        Returns:
+            boolean: if we removed an abandoned lock file
+        """
+        expired_path = '{}.{}'.format(self.path, self.owner)
+        try:
+            with open(self.path, 'r') as f:
+                abandoned_owner = f.read()
+            if not self._is_expired(self.path):
+                return False
+            os.rename(self.path, expired_path)
+        except OSError:
+            return False
+
+        with open(expired_path, 'r') as f:
+            moved_owner = f.read()
+        if moved_owner != abandoned_owner or not self._is_expired(expired_path):
+            os.rename(expired_path, self.path)
+            return False
+        os.remove(expired_path)
+        return True
+
+    def _is_expired(self, path):
+        return time.time() - os.stat(path).st_mtime >= self.lease_time
+
+    def _keep_alive(self, stop_event):
+        while not stop_event.wait(self.lease_time / 4):
+            try:
+                os.utime(self.path)
+            except OSError:
+                return
+
+
+def get_worker_process_settings():
+    """Get the current MDT configuration and MOT runtime settings in a form that can be send to a subprocess.
+
+    Returns:
+        dict: with the MDT configuration, the indices of the current CL devices (in the list of
+            :func:`mdt.utils.get_cl_devices`), the compile flags and if we use double precision.
+    """
+    from mdt.utils import get_cl_devices
+    all_devices = get_cl_devices()
+    device_indices = [all_devices.index(env) for env in mot.configuration.get_cl_environments() if env in all_devices]
+    return {'config': get_config_dict(),
+            'cl_device_ind': device_indices or None,
+            'compile_flags': mot.configuration.get_compile_flags(),
+            'double_precision': mot.configuration.use_double_precision()}
+
+
+def apply_worker_process_settings(settings, worker_counter):
+    """Apply the settings of the main process in a worker process.
+
+    This sets the MDT configuration and the MOT runtime settings of the main process, with one CL device per worker.
+    The devices are distributed in a round-robin fashion over the workers.
+
+    Args:
+        settings (dict): the settings of the main process, see :func:`get_worker_process_settings`
+        worker_counter (multiprocessing.Value): shared counter used to give each worker its own index
+    """
+    from mdt.configuration import SetConfigDict
+    from mdt.utils import get_cl_devices
+
+    with worker_counter.get_lock():
+        worker_ind = worker_counter.value
+        worker_counter.value += 1
+
+    SetConfigDict(settings['config']).apply()
+
+    devices = get_cl_devices(settings['cl_device_ind'])
+    mot.configuration.set_cl_environments([devices[worker_ind % len(devices)]])
+    mot.configuration.set_compile_flags(settings['compile_flags'])
+    mot.configuration.set_use_double_precision(settings['double_precision'])
+
+
+_worker_processor = None
+"""The processor used by the current worker process, see :func:`_init_worker_process`."""
+
+
+def _init_worker_process(pickled_processor, settings, worker_counter):
+    """Initialize a worker process of the :class:`ProcessPoolProcessingStrategy`.
+
+    Args:
+        pickled_processor (bytes): the pickled processor
+        settings (dict): the settings of the main process, see :func:`get_worker_process_settings`
+        worker_counter (multiprocessing.Value): shared counter used to give each worker its own index
+    """
+    global _worker_processor
+    apply_worker_process_settings(settings, worker_counter)
+
+    for package in ['mdt', 'mot']:
+        for handler in logging.getLogger(package).handlers:
+            handler.setLevel(logging.WARNING)
+
+    _worker_processor = _load_with_file_references(pickled_processor)
+
+
+def _process_in_worker_process(roi_indices):
+    """Process the given voxels with the processor of this worker process.
+
+    Args:
+        roi_indices (ndarray): the ROI indices to process
+
+    Returns:
+        ndarray: the processed ROI indices
+    """
+    _worker_processor.process(roi_indices)
+    return roi_indices
+
+
+def _dump_with_file_references(obj, directory, min_nbytes=1024 ** 2):
+    """Pickle the given object, while storing the large arrays it references as separate files.
+
+    Only the paths to these files are pickled, on unpickling using :func:`_load_with_file_references` the arrays are
+    memory mapped. This way, the worker processes share the arrays using the page cache of the operating system,
+    instead of each receiving (and holding) a copy of for example the 4d volume of the input data.
+
+    Args:
+        obj (object): the object to pickle
+        directory (str): the directory in which to store the arrays, this should exist until all workers unpickled
+            the object and finished their work.
+        min_nbytes (int): the minimum size, in bytes, of the arrays we store as separate files
+
+    Returns:
+        bytes: the pickled object
+    """
+    buffer = io.BytesIO()
+    _FileReferencePickler(buffer, directory, min_nbytes).dump(obj)
+    return buffer.getvalue()
+
+
+def _load_with_file_references(data):
+    """Unpickle an object pickled using :func:`_dump_with_file_references`.
+
+    Args:
+        data (bytes): the pickled object
+
+    Returns:
+        object: the unpickled object, with the large arrays memory mapped copy-on-write from their files.
+    """
+    return _FileReferenceUnpickler(io.BytesIO(data)).load()
+
+
+class _FileReferencePickler(pickle.Pickler):
+
+    def __init__(self, file, directory, min_nbytes):
+        """Pickler storing the large arrays as separate files, see :func:`_dump_with_file_references`."""
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._directory = directory
+        self._min_nbytes = min_nbytes
+        self._references = {}
+
+    def persistent_id(self, obj):
+        if type(obj) not in (np.ndarray, np.memmap) or obj.dtype.hasobject or obj.nbytes < self._min_nbytes:
+            return None
+
+        if id(obj) not in self._references:
+            path = os.path.join(self._directory, '{}.npy'.format(len(self._references)))
+            np.save(path, obj)
+
+            # we keep a reference to the array such that its id is not reused during pickling
+            self._references[id(obj)] = (obj, path)
+        return 'ndarray', self._references[id(obj)][1]
+
+
+class _FileReferenceUnpickler(pickle.Unpickler):
+
+    def persistent_load(self, pid):
+        reference_type, path = pid
+        if reference_type != 'ndarray':
+            raise pickle.UnpicklingError('Unsupported persistent reference type "{}".'.format(reference_type))
+        return np.load(path, mmap_mode='c')
+
+
 class SimpleModelProcessor(ModelProcessor):
 
     def __init__(self, mask, nifti_header, output_dir, tmp_storage_dir, recalculate):
@@ -238,24 +907,100 @@ class SimpleModelProcessor(ModelProcessor):
             mask (ndarray): the mask to use during processing
             nifti_header (nibabel nifti header): the nifti header to use for writing the output nifti files
             output_dir (str): the location for the final output files
-            tmp_storage_dir (str): the location for the temporary output files
+            tmp_storage_dir (str): the location for the temporary output files. If None, the results are kept in
+                memory instead, no files are written to the temporary storage. This requires a processor which
+                supports this, like the model fitting.
             recalculate (boolean): if we want to recalculate existing results if present
         """
         super().__init__()
         self._write_volumes_gzipped = True
+        self._write_results_container = use_results_container()
         self._used_mask_name = 'UsedMask'
         self._mask = mask
+        self._mask_index = get_mask_index(mask)
         self._nifti_header = nifti_header
         self._output_dir = output_dir
         self._tmp_storage_dir = tmp_storage_dir
-        self._prepare_tmp_storage(self._tmp_storage_dir, recalculate)
-        self._processing_tmp_dir = os.path.join(self._tmp_storage_dir, 'processing_tmp')
-        self._roi_lookup_path = os.path.join(self._processing_tmp_dir, 'roi_voxel_lookup_table.npy')
-        self._volume_indices = self._create_roi_to_volume_index_lookup_table()
-        self._total_nmr_voxels = np.count_nonzero(self._mask)
+        self._in_memory_results = None
+        self._processing_tmp_dir = None
+        self._total_nmr_voxels = self._mask_index.nmr_voxels
+        if self._tmp_storage_dir is None:
+            self._in_memory_results = {}
+        else:
+            self._processing_tmp_dir = os.path.join(self._tmp_storage_dir, 'processing_tmp')
+            self._prepare_tmp_storage(self._tmp_storage_dir, recalculate)
+        self._prepare_executor = None
+        self._write_executor = None
+        self._prepared_batches = {}
+        self._pending_writes = []
+        self._shard_dir = None
+
+    def __getstate__(self):
+        raise pickle.PicklingError('The processor {} can not be pickled.'.format(type(self).__name__))
 
     def combine(self):
-        pass
+        self._wait_for_pending_writes()
+
+    def get_processing_tmp_dir(self):
+        return self._processing_tmp_dir
+
+    def set_tmp_storage_shard(self, shard_dir=None):
+        if shard_dir is not None and self._in_memory_results is not None:
+            raise ValueError('Can not write shards if the results are kept in memory.')
+        self._wait_for_pending_writes()
+        self._shard_dir = shard_dir
+
+    def merge_tmp_storage_shards(self, shard_dirs):
+        self.set_tmp_storage_shard(None)
+        for shard_dir in shard_dirs:
+            with open(os.path.join(shard_dir, 'roi_indices.index'), 'rb') as f:
+                roi_indices = np.load(f)
+
+            for dirpath, dirnames, filenames in os.walk(shard_dir):
+                results = {fname[:-len('.npy')]: np.load(os.path.join(dirpath, fname), mmap_mode='r')
+                           for fname in filenames if fname.endswith('.npy')}
+                if results:
+                    self._write_volumes_to_disk(
+                        results, roi_indices, os.path.join(self._tmp_storage_dir, os.path.relpath(dirpath, shard_dir)))
+            shutil.rmtree(shard_dir)
+
+    def set_background_executors(self, prepare_executor=None, write_executor=None):
+        self._wait_for_pending_writes()
+        self._prepared_batches = {}
+        self._prepare_executor = prepare_executor
+        self._write_executor = write_executor
+
+    def _prepare(self, roi_indices):
+        """Prepare the processing of the given voxels.
+
+        This is meant for the host side work needed before processing a batch, like taking the subset of the input data
+        and computing the starting points. This may be called from a background thread while another batch is
+        being processed, so implementations should not change the state of this processor.
+
+        Args:
+            roi_indices (ndarray): the list of ROI indices we want to prepare
+
+        Returns:
+            the preparation results, these are made available to :meth:`_process` using :meth:`_get_prepared`.
+        """
+        return None
+
+    def _get_prepared(self, roi_indices):
+        """Get the results of :meth:`_prepare` for the given voxels.
+
+        If the preparation of these voxels was already started in the background we wait for those results, else we
+        prepare the voxels directly.
+
+        Args:
+            roi_indices (ndarray): the list of ROI indices of the current batch
+
+        Returns:
+            the results of :meth:`_prepare`
+        """
+        future = self._prepared_batches.pop(roi_indices.tobytes(), None)
+        if future is not None:
+            return future.result()
+        return self._prepare(roi_indices)
 
     def _process(self, roi_indices, next_indices=None):
         """This is the function the user needs to implement to process the dataset.
@@ -270,23 +1015,31 @@ class SimpleModelProcessor(ModelProcessor):
     def process(self, roi_indices, next_indices=None):
         """By default this will store some information about already processed voxels.
 
-        This will call the user implementable function :meth:`_process` to do the processing.
+        This will call the user implementable function :meth:`_process` to do the processing. If a prepare executor
+        is set, we start preparing the next batch before processing the current one.
         """
-        self._process(roi_indices, next_indices=next_indices)
-        self._write_volumes({'processed_voxels': np.ones(roi_indices.shape[0], dtype=np.bool)},
-                            roi_indices, self._processing_tmp_dir)
+        if next_indices is not None and self._prepare_executor is not None:
+            self._prepared_batches[next_indices.tobytes()] = self._prepare_executor.submit(self._prepare, next_indices)
+
+        with profile_stage('chunk', nmr_voxels=len(roi_indices)):
+            self._process(roi_indices, next_indices=next_indices)
+
+        self._mark_as_processed(roi_indices)
 
     def get_voxels_to_compute(self):
         """By default this will return the indices of all the voxels we have not yet computed.
 
         In the case that recalculate is set to False and we have some intermediate results lying about, this
-        function will only return the indices of the voxels we have not yet processed.
+        function will only return the indices of the voxels we have not yet processed. If the results are kept
+        in memory, we always compute all voxels.
         """
         roi_list = np.arange(0, self._total_nmr_voxels)
+        if self._processing_tmp_dir is None:
+            return roi_list
+
         processed_voxels_path = os.path.join(self._processing_tmp_dir, 'processed_voxels.npy')
         if os.path.exists(processed_voxels_path):
-            return roi_list[np.logical_not(np.squeeze(create_roi(np.load(processed_voxels_path, mmap_mode='r'),
-                                                                 self._mask)[roi_list]))]
+            return roi_list[np.logical_not(np.load(processed_voxels_path, mmap_mode='r')[:, 0])]
         return roi_list
 
     def get_total_nmr_voxels(self):
@@ -295,42 +1048,196 @@ class SimpleModelProcessor(ModelProcessor):
 
     def finalize(self):
         """Cleans the temporary storage directory."""
-        del self._volume_indices
-        shutil.rmtree(self._tmp_storage_dir)
+        self._wait_for_pending_writes()
+        if self._tmp_storage_dir is not None:
+            shutil.rmtree(self._tmp_storage_dir)
+
+    def _mark_as_processed(self, roi_indices):
+        """Mark the given voxels as processed, such that they are skipped by :meth:`get_voxels_to_compute`.
+
+        Args:
+            roi_indices (ndarray): the ROI indices of the processed voxels
+        """
+        if self._in_memory_results is None:
+            self._write_volumes({'processed_voxels': np.ones(roi_indices.shape[0], dtype=np.bool)},
+                                roi_indices, self._processing_tmp_dir)
 
     def _prepare_tmp_storage(self, tmp_storage_dir, recalculate):
-        if recalculate:
-            if os.path.exists(tmp_storage_dir):
-                shutil.rmtree(tmp_storage_dir)
+        """Prepare the temporary storage directory, removing the existing results if we recalculate.
+
+        Since the temporary results are stored in the order of the voxels in the mask, they can only be reused with
+        the same mask. For this reason we store the mask in the temporary storage, and remove the existing results
+        if they were computed using a different mask.
+
+        Args:
+            tmp_storage_dir (str): the temporary storage directory
+            recalculate (boolean): if we want to remove the existing temporary results
+        """
+        mask_path = os.path.join(self._processing_tmp_dir, 'mask.npy')
+
+        if os.path.exists(tmp_storage_dir) and (recalculate or not self._tmp_storage_is_compatible(mask_path)):
+            shutil.rmtree(tmp_storage_dir)
 
-        if not os.path.exists(tmp_storage_dir):
-            os.makedirs(tmp_storage_dir)
+        os.makedirs(self._processing_tmp_dir, exist_ok=True)
+        if not os.path.isfile(mask_path):
+            creation_path = '{}.{}.tmp.npy'.format(mask_path[:-len('.npy')], os.getpid())
+            np.save(creation_path, self._mask_index.mask)
+            os.replace(creation_path, mask_path)
+
+    def _tmp_storage_is_compatible(self, mask_path):
+        """Check if the existing temporary results can be reused with the current mask.
+
+        Args:
+            mask_path (str): the path to the mask stored with the temporary results
+
+        Returns:
+            boolean: False if the temporary results were computed with a different mask, or if they are stored as
+                volumes instead of in the ROI form.
+        """
+        if os.path.isfile(mask_path) and not np.array_equal(np.load(mask_path), self._mask_index.mask):
+            return False
+
+        processed_voxels_path = os.path.join(self._processing_tmp_dir, 'processed_voxels.npy')
+        if os.path.isfile(processed_voxels_path):
+            processed_voxels = np.load(processed_voxels_path, mmap_mode='r')
+            return processed_voxels.shape == (self._total_nmr_voxels, 1)
+        return True
+
+    def _write_in_background(self, write_func, *args, **kwargs):
+        """Run the given write function using the write executor, or directly if no write executor is set.
+
+        All writes are submitted to the same executor, such that they are executed in the order of submission
+        if the executor uses a single worker.
+
+        Args:
+            write_func (Callable): the function doing the writing
+            *args: the positional arguments for the write function
+            **kwargs: the keyword arguments for the write function
+        """
+        if self._write_executor is None:
+            write_func(*args, **kwargs)
+        else:
+            for future in [f for f in self._pending_writes if f.done()]:
+                self._pending_writes.remove(future)
+                future.result()
+            self._pending_writes.append(self._write_executor.submit(write_func, *args, **kwargs))
+
+    def _wait_for_pending_writes(self):
+        """Wait until all the writes submitted to the write executor are finished.
+
+        This re-raises the first exception raised by any of the writes.
+        """
+        pending_writes = self._pending_writes
+        self._pending_writes = []
+        for future in pending_writes:
+            future.result()
 
     def _write_volumes(self, results, roi_indices, tmp_dir):
         """Write the result arrays to the temporary storage
 
+        If a write executor is set, the writing is done in the background.
+
         Args:
             results (dict): the dictionary with the results to save
             roi_indices (ndarray): the indices of the voxels we computed
             tmp_dir (str): the directory to save the intermediate results to
         """
-        if not os.path.exists(tmp_dir):
-            os.makedirs(tmp_dir)
+        self._write_in_background(self._write_volumes_to_disk, results, roi_indices, tmp_dir)
+
+    def _write_volumes_to_disk(self, results, roi_indices, tmp_dir):
+        """Write the result arrays to the temporary storage, this is the synchronous part of :meth:`_write_volumes`.
+
+        Args:
+            results (dict): the dictionary with the results to save
+            roi_indices (ndarray): the indices of the voxels we computed
+            tmp_dir (str): the directory to save the intermediate results to
+        """
+        if self._in_memory_results is not None:
+            self._write_volumes_to_memory(results, roi_indices, tmp_dir)
+            return
+
+        with profile_stage('memmap_write', nmr_voxels=len(roi_indices), nmr_maps=len(results)):
+            if self._shard_dir is not None:
+                self._write_volumes_to_shard(results, roi_indices, tmp_dir)
+                return
+
+            os.makedirs(tmp_dir, exist_ok=True)
+
+            roi_slice = _get_contiguous_slice(roi_indices)
+            for param_name, result_array in results.items():
+                filename = os.path.join(tmp_dir, param_name + '.npy')
+                self._write_volume(result_array, roi_indices if roi_slice is None else roi_slice, filename)
+
+    def _write_volumes_to_memory(self, results, roi_indices, tmp_dir):
+        """Store the result arrays in memory, this replaces the temporary storage if no storage dir is given.
+
+        As with the temporary files, the results are stored in their ROI form, with one array per map, of shape
+        (nmr_voxels, ...). The arrays are allocated when the first results of a map come in.
+
+        Args:
+            results (dict): the dictionary with the results to save
+            roi_indices (ndarray): the indices of the voxels we computed
+            tmp_dir (str): the subdirectory of the results, see :meth:`_get_tmp_storage_path`
+        """
+        with profile_stage('memory_write', nmr_voxels=len(roi_indices), nmr_maps=len(results)):
+            maps = self._in_memory_results.setdefault(tmp_dir, {})
+            for param_name, result_array in results.items():
+                result_array = np.asarray(result_array)
+                if len(result_array.shape) < 2:
+                    result_array = np.reshape(result_array, (-1, 1))
 
-        volume_indices = self._volume_indices[roi_indices, :]
+                if param_name not in maps:
+                    maps[param_name] = np.zeros((self._total_nmr_voxels,) + result_array.shape[1:],
+                                                dtype=result_array.dtype)
+                maps[param_name][roi_indices] = result_array
+
+    def _get_tmp_storage_path(self, sub_dir=''):
+        """Get the path to the given subdirectory of the temporary storage.
+
+        If the results are kept in memory, this returns the subdirectory itself, which is then used as the key of the
+        results in memory.
+
+        Args:
+            sub_dir (str): the subdirectory, relative to the temporary storage directory
+
+        Returns:
+            str: the path to use for writing the results of that subdirectory
+        """
+        if self._tmp_storage_dir is None:
+            return sub_dir
+        return os.path.join(self._tmp_storage_dir, sub_dir)
+
+    def _write_volumes_to_shard(self, results, roi_indices, tmp_dir):
+        """Write the result arrays of one batch to the current shard, see :meth:`set_tmp_storage_shard`.
+
+        The results are stored as they are, in the order of the ROI indices, which are stored alongside. The directory
+        structure relative to the temporary storage directory is replicated in the shard directory.
+
+        Args:
+            results (dict): the dictionary with the results to save
+            roi_indices (ndarray): the indices of the voxels we computed
+            tmp_dir (str): the directory in the temporary storage the results are meant for
+        """
+        shard_subdir = os.path.join(self._shard_dir, os.path.relpath(tmp_dir, self._tmp_storage_dir))
+        os.makedirs(shard_subdir, exist_ok=True)
+
+        with open(os.path.join(self._shard_dir, 'roi_indices.index'), 'wb') as f:
+            np.save(f, roi_indices)
 
         for param_name, result_array in results.items():
-            filename = os.path.join(tmp_dir, param_name + '.npy')
-            self._write_volume(result_array, volume_indices, filename)
+            np.save(os.path.join(shard_subdir, param_name + '.npy'), result_array)
 
-    def _write_volume(self, data, volume_indices, filename):
+    def _write_volume(self, data, roi_indices, filename):
         """Write the result of one map to the specified file.
 
-        This is meant to save map data to a temporary .npy file.
+        This is meant to save map data to a temporary .npy file. The temporary files hold the maps in their ROI form,
+        that is, as arrays of shape (nmr_voxels, ...) with the voxels in the order of the mask. These are only
+        restored to volumes when combining the results.
 
         Args:
             data (ndarray): the voxel data to store
-            volume_indices (ndarray): the volume indices of the computed data points
+            roi_indices (ndarray or slice): the ROI indices of the computed data points, or the slice of the ROI
+                if the voxels are contiguous.
             filename (str): the file to write the results to. This by default will append to the file if it exists.
         """
         extra_dims = (1,)
@@ -341,13 +1248,51 @@ class SimpleModelProcessor(ModelProcessor):
         else:
             data = np.reshape(data, (-1, 1))
 
-        mode = 'w+'
-        if os.path.isfile(filename):
-            mode = 'r+'
+        if not os.path.isfile(filename):
+            self._create_volume_file(filename, data.dtype, (self._total_nmr_voxels,) + extra_dims)
+
+        tmp_matrix = open_memmap(filename, mode='r+')
+        tmp_matrix[roi_indices] = data
+
+    def _create_volume_file(self, filename, dtype, shape):
+        """Create a new zero filled .npy file, if it does not exist yet.
 
-        tmp_matrix = open_memmap(filename, mode=mode, dtype=data.dtype,
-                                 shape=self._mask.shape[0:3] + extra_dims)
-        tmp_matrix[volume_indices[:, 0], volume_indices[:, 1], volume_indices[:, 2]] = data
+        The file is first created under a temporary name and then linked to the final filename. This makes the creation
+        safe if multiple processes write their results to the same file.
+
+        Args:
+            filename (str): the file to create
+            dtype (np.dtype): the data type of the new file
+            shape (tuple): the shape of the new file
+        """
+        creation_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        new_file = open_memmap(creation_filename, mode='w+', dtype=dtype, shape=shape)
+        del new_file  # closes the memmap
+        try:
+            os.link(creation_filename, filename)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(creation_filename)
+
+    def _get_tmp_subdirs(self):
+        """Get the subdirectories of the temporary storage directory which contain result maps.
+
+        This searches the temporary storage directory, such that we also find the results of subprocesses or of
+        earlier, interrupted, runs.
+
+        Returns:
+            list of str: the subdirectories, relative to the temporary storage directory, with temporary results maps.
+        """
+        subdirs = []
+        for dirpath, dirnames, filenames in os.walk(self._tmp_storage_dir):
+            if os.path.abspath(dirpath) == os.path.abspath(self._processing_tmp_dir):
+                dirnames[:] = []
+                continue
+            if any(fname.endswith('.npy') for fname in filenames):
+                subdir = os.path.relpath(dirpath, self._tmp_storage_dir)
+                subdirs.append('' if subdir == '.' else subdir)
+        return subdirs
 
     def _combine_volumes(self, output_dir, tmp_storage_dir, nifti_header, maps_subdir=''):
         """Combine volumes found in subdirectories to a final volume.
@@ -359,9 +1304,16 @@ class SimpleModelProcessor(ModelProcessor):
                 If this is set we will load the results from a subdirectory (with this name) from the tmp_storage_dir
                 and write the results to a subdirectory (with this name) in the output dir.
 
+        If results containers are enabled, the volumes are written to the results container in the output dir
+        instead of to separate nifti files.
+
         Returns:
             dict: the dictionary with the ROIs for every volume, by parameter name
         """
+        if self._write_results_container:
+            self._combine_volumes_in_container(output_dir, tmp_storage_dir, nifti_header, maps_subdir=maps_subdir)
+            return
+
         full_output_dir = os.path.join(output_dir, maps_subdir)
         if not os.path.exists(full_output_dir):
             os.makedirs(full_output_dir)
@@ -374,34 +1326,52 @@ class SimpleModelProcessor(ModelProcessor):
                              glob.glob(os.path.join(tmp_storage_dir, maps_subdir, '*.npy'))))
 
         chunks_dir = os.path.join(tmp_storage_dir, maps_subdir)
-        for map_name in map_names:
-            data = np.load(os.path.join(chunks_dir, map_name + '.npy'), mmap_mode='r')
-            write_all_as_nifti({map_name: data}, full_output_dir, nifti_header=nifti_header,
-                               gzip=self._write_volumes_gzipped)
-
-    def _create_roi_to_volume_index_lookup_table(self):
-        """Creates and returns a lookup table for roi index -> volume index.
+        volumes = DeferredActionDict(
+            lambda _, roi: restore_volumes(roi, self._mask_index),
+            {map_name: np.load(os.path.join(chunks_dir, map_name + '.npy'), mmap_mode='r') for map_name in map_names},
+            cache=False)
+        with profile_stage('nifti_combine', maps_subdir=maps_subdir, nmr_maps=len(volumes),
+                           gzip=self._write_volumes_gzipped):
+            write_all_as_nifti(volumes, full_output_dir, nifti_header=nifti_header,
+                               gzip=self._write_volumes_gzipped, **get_nifti_writer_options())
 
-        This will create from the given mask a memory mapped lookup table mapping the ROI indices (single integer)
-        to the correct voxel location in 3d. To find a voxel index using the ROI index, just index this lookup
-        table using the ROI index as index.
+    def _combine_volumes_in_container(self, output_dir, tmp_storage_dir, nifti_header, maps_subdir=''):
+        """Combine volumes found in subdirectories in the results container of the output directory.
 
-        For example, suppose we have the lookup table:
+        The maps are written chunk by chunk, using the maps subdirectory as prefix of the map names.
 
-            0: (0, 0, 0)
-            1: (0, 0, 1)
-            2: (0, 1, 0)
-            ...
-
-        We can get the position of a voxel in the 3d space by indexing this array as: ``lookup_table[roi_index]``
-        to get the correct 3d location.
-
-        Returns:
-            memmap ndarray: the memory mapped array which
-        """
-        if not os.path.exists(os.path.dirname(self._roi_lookup_path)):
-            os.mkdir(os.path.dirname(self._roi_lookup_path))
-        if os.path.isfile(self._roi_lookup_path):
-            os.remove(self._roi_lookup_path)
-        np.save(self._roi_lookup_path, np.argwhere(self._mask))
-        return np.load(self._roi_lookup_path, mmap_mode='r')
+        Args:
+            output_dir (str): the location for the output files
+            tmp_storage_dir (str): the directory with the temporary results
+            nifti_header: the nifti header to store in the container
+            maps_subdir (str): the subdirectory of the maps, in the tmp storage dir and in the container
+        """
+        chunks_dir = os.path.join(tmp_storage_dir, maps_subdir)
+        prefix = '/'.join(os.path.normpath(maps_subdir).split(os.sep)) + '/' if maps_subdir else ''
+
+        with profile_stage('container_combine', maps_subdir=maps_subdir), \
+                ResultsContainerWriter(os.path.join(output_dir, CONTAINER_FILENAME), self._mask_index,
+                                       nifti_header=nifti_header,
+                                       compression_level=get_nifti_writer_options()['compression_level']) as writer:
+            for path in sorted(glob.glob(os.path.join(chunks_dir, '*.npy'))):
+                map_name = os.path.splitext(os.path.basename(path))[0]
+                writer.write_roi(prefix + map_name, np.load(path, mmap_mode='r'))
+
+
+def _get_contiguous_slice(roi_indices):
+    """Get the slice equivalent to the given ROI indices, if they are a contiguous increasing range.
+
+    Writing a slice of a memory mapped array is a sequential write, while writing using an index array is not.
+
+    Args:
+        roi_indices (ndarray): the ROI indices
+
+    Returns:
+        slice or None: the slice if the indices are contiguous, else None
+    """
+    roi_indices = np.asarray(roi_indices)
+    if not len(roi_indices) or roi_indices[-1] - roi_indices[0] != len(roi_indices) - 1:
+        return None
+    if len(roi_indices) > 1 and np.any(np.diff(roi_indices) != 1):
+        return None
+    return slice(int(roi_indices[0]), int(roi_indices[-1]) + 1)
@@ -0,0 +1,232 @@
+"""Opt-in profiling of the stages of the model fitting, sampling and bootstrapping.
+
+The processing code marks its stages using :func:`profile_stage`. This is a no-op unless a profiler is activated using
+:func:`profiling_context`, in which case the wall time and the peak traced memory of every stage are recorded. When the
+context ends, the profiler writes a JSON summary with the totals per stage and a trace file, in the Chrome trace event
+format, with every individual stage. The trace can be opened in ``chrome://tracing`` or in Perfetto.
+
+The peak memory is measured using :mod:`tracemalloc`, which traces the allocations made by Python and by NumPy, but
+not the memory allocated by the OpenCL drivers. Measuring the peak per stage requires resetting the traced peak, which
+is only possible from Python 3.9 onwards. On older versions the stages are recorded without their peak memory.
+
+Only the stages processed in the profiled process are recorded. Stages processed in the worker processes of the
+process pool strategy, or in the worker processes of :func:`mdt.batch_fit`, are not part of the profile.
+"""
+import json
+import logging
+import os
+import threading
+import timeit
+import tracemalloc
+from contextlib import contextmanager
+
+__author__ = 'Robbert Harms'
+__date__ = '2020-05-20'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert@xkls.nl'
+__licence__ = 'LGPL v3'
+
+
+SUMMARY_FILENAME = 'profile_summary.json'
+TRACE_FILENAME = 'profile_trace.json'
+
+_active_profiler = None
+"""The profiler activated by :func:`profiling_context`, None if profiling is disabled."""
+
+
+@contextmanager
+def profiling_context(output_dir, enabled=True):
+    """Record the stages processed within this context and write the profile to the given directory.
+
+    If a profiler is already active, this context records its stages with that profiler instead, such that nested
+    calls (for example the cascaded initializations of a model fit) end up in the same profile.
+
+    Args:
+        output_dir (str): the directory to write the summary and the trace to. If None, the summary is logged instead.
+        enabled (boolean): if False, this context does nothing. This allows callers to make the profiling optional.
+    """
+    global _active_profiler
+    if not enabled or _active_profiler is not None:
+        yield _active_profiler
+        return
+
+    profiler = StageProfiler()
+    _active_profiler = profiler
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        _active_profiler = None
+        if output_dir is None:
+            profiler.log_summary()
+        else:
+            profiler.write(output_dir)
+
+
+@contextmanager
+def profile_stage(name, **kwargs):
+    """Record the processing time and peak memory of the code within this context as the given stage.
+
+    Args:
+        name (str): the name of the stage
+        **kwargs: additional information to store with this stage, like the number of voxels
+    """
+    if _active_profiler is None:
+        yield
+    else:
+        with _active_profiler.stage(name, **kwargs):
+            yield
+
+
+def is_profiling():
+    """Check if a profiler is active.
+
+    Returns:
+        boolean: if the stages are currently being recorded
+    """
+    return _active_profiler is not None
+
+
+class StageProfiler:
+
+    def __init__(self):
+        """Records the wall time and peak memory of (nested) processing stages.
+
+        Stages can be recorded from multiple threads, every thread has its own stack of nested stages. Memory peaks
+        are traced for the whole process, such that stages running concurrently in different threads share their
+        peaks. If the traced peak can not be reset (before Python 3.9), the peak memory of the stages is None.
+        """
+        self._events = []
+        self._lock = threading.Lock()
+        self._thread_stacks = threading.local()
+        self._start_time = None
+        self._started_tracemalloc = False
+        self._trace_peaks = hasattr(tracemalloc, 'reset_peak')
+
+    def start(self):
+        """Start the profiling."""
+        self._start_time = timeit.default_timer()
+        if self._trace_peaks and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+
+    def stop(self):
+        """Stop the profiling."""
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    @contextmanager
+    def stage(self, name, **kwargs):
+        """Record the code within this context as a stage.
+
+        Args:
+            name (str): the name of the stage
+            **kwargs: additional information to store with this stage
+        """
+        stack = self._get_stack()
+        if self._trace_peaks:
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'], self._get_traced_peak())
+            self._reset_traced_peak()
+
+        frame = {'peak': 0 if self._trace_peaks else None}
+        stack.append(frame)
+        start_time = timeit.default_timer()
+        try:
+            yield
+        finally:
+            duration = timeit.default_timer() - start_time
+            stack.pop()
+            if self._trace_peaks:
+                frame['peak'] = max(frame['peak'], self._get_traced_peak())
+                self._reset_traced_peak()
+                if stack:
+                    stack[-1]['peak'] = max(stack[-1]['peak'], frame['peak'])
+
+            with self._lock:
+                self._events.append({'name': name,
+                                     'start': start_time - self._start_time,
+                                     'duration': duration,
+                                     'peak_memory': frame['peak'],
+                                     'depth': len(stack),
+                                     'thread': threading.get_ident(),
+                                     'args': kwargs})
+
+    def get_summary(self):
+        """Get the totals per stage.
+
+        Returns:
+            dict: per stage name the number of calls, the total and maximum wall time in seconds and the maximum
+                peak memory in MB (None if the peak memory is not traced)
+        """
+        summary = {}
+        for event in self._events:
+            stage = summary.setdefault(event['name'], {'calls': 0, 'total_time': 0, 'max_time': 0,
+                                                       'peak_memory_mb': None})
+            stage['calls'] += 1
+            stage['total_time'] += event['duration']
+            stage['max_time'] = max(stage['max_time'], event['duration'])
+            if event['peak_memory'] is not None:
+                stage['peak_memory_mb'] = max(stage['peak_memory_mb'] or 0, event['peak_memory'] / 1024 ** 2)
+        return summary
+
+    def get_trace_events(self):
+        """Get all the recorded stages as Chrome trace events.
+
+        Returns:
+            list of dict: the complete (``X``) events, with the times in microseconds
+        """
+        return [{'name': event['name'],
+                 'ph': 'X',
+                 'ts': event['start'] * 1e6,
+                 'dur': event['duration'] * 1e6,
+                 'pid': os.getpid(),
+                 'tid': event['thread'],
+                 'args': self._get_trace_args(event)}
+                for event in self._events]
+
+    def write(self, output_dir):
+        """Write the summary and the trace to the given directory.
+
+        Args:
+            output_dir (str): the directory to write the profile files to
+        """
+        os.makedirs(output_dir, exist_ok=True)
+
+        with open(os.path.join(output_dir, SUMMARY_FILENAME), 'w') as f:
+            json.dump(self._get_summary_document(), f, indent=4, sort_keys=True, default=str)
+
+        with open(os.path.join(output_dir, TRACE_FILENAME), 'w') as f:
+            json.dump({'traceEvents': self.get_trace_events(), 'displayTimeUnit': 'ms'}, f, default=str)
+
+        logging.getLogger(__name__).info('Wrote the profile to {}.'.format(output_dir))
+
+    def log_summary(self):
+        """Log the summary, for when there is no directory to write the profile to."""
+        logging.getLogger(__name__).info('Profile summary: {}'.format(
+            json.dumps(self._get_summary_document(), indent=4, sort_keys=True, default=str)))
+
+    def _get_summary_document(self):
+        return {'total_time': timeit.default_timer() - self._start_time, 'stages': self.get_summary()}
+
+    def _get_trace_args(self, event):
+        args = dict(event['args'])
+        if event['peak_memory'] is not None:
+            args['peak_memory_mb'] = event['peak_memory'] / 1024 ** 2
+        return args
+
+    def _get_stack(self):
+        if not hasattr(self._thread_stacks, 'stack'):
+            self._thread_stacks.stack = []
+        return self._thread_stacks.stack
+
+    def _get_traced_peak(self):
+        if not tracemalloc.is_tracing():
+            return 0
+        return tracemalloc.get_traced_memory()[1]
+
+    def _reset_traced_peak(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
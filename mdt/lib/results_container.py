@@ -0,0 +1,355 @@
+"""Single file container for storing the results of model fitting and sampling.
+
+By default, every result map is written as a separate nifti file. For models with many output maps (like the
+covariances) this results in many files, which can be slow on (parallel) network filesystems. As an alternative,
+the results can be stored in a single results container.
+
+The container is a zip file in which every map is stored in its ROI form (one row per voxel in the mask), split in
+chunks of voxels which are compressed independently. This allows reading a map, or a few voxels of a map, without
+decompressing the whole container. Next to the maps, the container stores the mask and the nifti header needed
+to restore the maps to volumes.
+
+The maps are stored in groups, ``maps`` for the result maps and ``samples`` for the sampling results.
+Map names can contain a forward slash to indicate a subdirectory, like ``covariances/S0.s0_to_S0.s0``.
+"""
+import io
+import json
+import os
+import sys
+import zipfile
+import nibabel as nib
+import numpy as np
+from mdt.lib.nifti import nifti_info_decorate_array, NiftiInfo
+from mdt.utils import get_mask_index
+
+__author__ = 'Robbert Harms'
+__date__ = '2020-02-14'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert@xkls.nl'
+__licence__ = 'LGPL v3'
+
+
+CONTAINER_FILENAME = 'results.zip'
+_FORMAT_VERSION = 1
+
+
+class ResultsContainer:
+
+    def __init__(self, filename):
+        """Read the maps stored in a results container.
+
+        Args:
+            filename (str): the filename of the results container
+        """
+        self._filename = filename
+        self._zipfile = zipfile.ZipFile(filename, 'r')
+        self._info = json.loads(self._zipfile.read('container.json').decode('utf8'))
+        self._mask = np.load(io.BytesIO(self._zipfile.read('mask.npy')))
+        self._array_infos = {}
+
+        for member in self._zipfile.namelist():
+            if member.endswith('/info.json'):
+                group, name = member[:-len('/info.json')].split('/', 1)
+                self._array_infos[(group, name)] = json.loads(self._zipfile.read(member).decode('utf8'))
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def mask(self):
+        return self._mask
+
+    @property
+    def nifti_header(self):
+        """Get the nifti header stored in this container.
+
+        Returns:
+            nibabel header: the nifti header, or None if no header was stored.
+        """
+        header_type = self._info.get('header_type')
+        if header_type is None:
+            return None
+        header_class = nib.Nifti2Header if header_type == 'Nifti2Header' else nib.Nifti1Header
+        return header_class(binaryblock=self._zipfile.read('header.bin'))
+
+    def get_names(self, group='maps', prefix=''):
+        """Get the names of the maps in the given group, directly under the given prefix.
+
+        Args:
+            group (str): the group of maps, one of ``maps`` or ``samples``
+            prefix (str): the subdirectory of the maps, for example ``covariances/``
+
+        Returns:
+            list of str: the names of the maps, without the prefix
+        """
+        names = []
+        for map_group, name in self._array_infos:
+            if map_group == group and name.startswith(prefix) and '/' not in name[len(prefix):]:
+                names.append(name[len(prefix):])
+        return sorted(names)
+
+    def get_prefixes(self, group='maps'):
+        """Get the prefixes (subdirectories) of the maps in the given group.
+
+        Args:
+            group (str): the group of maps, one of ``maps`` or ``samples``
+
+        Returns:
+            list of str: the prefixes, for example ``['covariances/']``. Maps without prefix are not represented.
+        """
+        return sorted({name[:name.rindex('/') + 1] for map_group, name in self._array_infos
+                       if map_group == group and '/' in name})
+
+    def has_map(self, name, group='maps'):
+        return (group, name) in self._array_infos
+
+    def get_roi(self, name, roi_indices=None, group='maps'):
+        """Read the ROI (a list of voxels) of a map.
+
+        This only decompresses the chunks which contain the requested voxels.
+
+        Args:
+            name (str): the name of the map
+            roi_indices (ndarray): if given, the indices of the voxels (in the ROI) we want to read
+            group (str): the group of the map, one of ``maps`` or ``samples``
+
+        Returns:
+            ndarray: the ROI data of the requested voxels
+        """
+        if not self.has_map(name, group=group):
+            raise ValueError('The map "{}" could not be found in the results container.'.format(name))
+
+        info = self._array_infos[(group, name)]
+        chunk_size = info['chunk_size']
+
+        if roi_indices is None:
+            chunks = [self._read_chunk(group, name, ind) for ind in range(info['nmr_chunks'])]
+            if not chunks:
+                return np.zeros(info['shape'], dtype=info['dtype'])
+            return np.concatenate(chunks)
+
+        roi_indices = np.asarray(roi_indices)
+        result = np.zeros((len(roi_indices),) + tuple(info['shape'][1:]), dtype=info['dtype'])
+        chunk_indices = roi_indices // chunk_size
+        for chunk_ind in np.unique(chunk_indices):
+            positions = np.where(chunk_indices == chunk_ind)[0]
+            result[positions] = self._read_chunk(group, name, chunk_ind)[roi_indices[positions] % chunk_size]
+        return result
+
+    def get_volume(self, name, group='maps'):
+        """Read a map and restore it to a volume.
+
+        Args:
+            name (str): the name of the map
+            group (str): the group of the map, one of ``maps`` or ``samples``
+
+        Returns:
+            ndarray: the map as a volume, decorated with the nifti header of this container
+        """
+        roi = self.get_roi(name, group=group)
+        volume = get_mask_index(self._mask).restore_volume(roi, with_volume_dim=False)
+        return nifti_info_decorate_array(volume, NiftiInfo(header=self.nifti_header, filepath=self._filename))
+
+    def get_volume_proxies(self, prefix='', map_names=None):
+        """Get a deferred loading object for each of the maps under the given prefix.
+
+        Args:
+            prefix (str): the subdirectory of the maps, for example ``covariances/``
+            map_names (list of str): if given, we only return these maps
+
+        Returns:
+            dict: per map name an object with a ``get_data()`` method returning the map as a volume
+        """
+        return {name: _ContainerVolumeProxy(self, prefix + name) for name in self.get_names(prefix=prefix)
+                if not map_names or name in map_names}
+
+    def close(self):
+        self._zipfile.close()
+
+    def _read_chunk(self, group, name, chunk_ind):
+        return np.load(io.BytesIO(self._zipfile.read('{}/{}/{}.npy'.format(group, name, chunk_ind))))
+
+
+class ResultsContainerWriter:
+
+    def __init__(self, filename, mask, nifti_header=None, chunk_size=10000, compression_level=1):
+        """Write maps to a results container.
+
+        If the container already exists, we add the maps to the existing container. Maps which already exist
+        are overwritten. Since maps can not be removed from a zip file, the maps are then written to a new container
+        which replaces the existing container when closing this writer, after copying the maps which were not
+        overwritten.
+
+        Args:
+            filename (str): the filename of the results container
+            mask (ndarray or mdt.utils.MaskIndex): the 3d mask of the voxels we store, or its mask index
+            nifti_header (nibabel header): the nifti header used when restoring the maps to volumes
+            chunk_size (int): the number of voxels per chunk
+            compression_level (int): the compression level of the chunks, from 1 (fastest) to 9 (smallest).
+                The compression level is only supported from Python 3.7, older versions use the default level.
+
+        Raises:
+            ValueError: if the container exists and was created for a different mask
+        """
+        self._filename = filename
+        mask_index = get_mask_index(mask)
+        self._mask = mask_index.mask
+        self._voxel_coordinates = mask_index.volume_indices
+        self._chunk_size = chunk_size
+        self._compression_level = compression_level
+        self._written_maps = set()
+        self._tmp_filename = None
+
+        if os.path.isfile(filename):
+            with zipfile.ZipFile(filename, 'r') as f:
+                existing_mask = np.load(io.BytesIO(f.read('mask.npy')))
+            if not np.array_equal(existing_mask, self._mask):
+                raise ValueError('The results container "{}" was created for a different mask.'.format(filename))
+            self._tmp_filename = filename + '.tmp'
+            self._zipfile = self._open(self._tmp_filename)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+            self._zipfile = self._open(filename)
+            self._write_header(nifti_header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None and self._tmp_filename is not None:
+            self._zipfile.close()
+            self._zipfile = None
+            os.remove(self._tmp_filename)
+        else:
+            self.close()
+
+    def write_volume(self, name, volume, group='maps'):
+        """Write a map given as a volume, only the voxels in the mask are stored.
+
+        The volume is read per chunk of voxels, as such, the volume can be a memory mapped array.
+
+        Args:
+            name (str): the name of the map
+            volume (ndarray): the volume, the first three dimensions should match the mask
+            group (str): the group of the map, one of ``maps`` or ``samples``
+        """
+        self._write_chunks(name, group, volume.dtype, (len(self._voxel_coordinates),) + volume.shape[3:],
+                           lambda start, end: volume[tuple(self._voxel_coordinates[start:end].T)])
+
+    def write_roi(self, name, roi, group='maps'):
+        """Write a map given in its ROI form (one row per voxel in the mask).
+
+        The ROI is read per chunk of voxels, as such, it can be a memory mapped array.
+
+        Args:
+            name (str): the name of the map
+            roi (ndarray): the ROI of the map, the first dimension should match the number of voxels in the mask
+            group (str): the group of the map, one of ``maps`` or ``samples``
+        """
+        if roi.shape[0] != len(self._voxel_coordinates):
+            raise ValueError('The number of voxels in the map "{}" ({}) does not match the mask ({}).'.format(
+                name, roi.shape[0], len(self._voxel_coordinates)))
+        self._write_chunks(name, group, roi.dtype, roi.shape, lambda start, end: roi[start:end])
+
+    def close(self):
+        """Close the container, if we were adding to an existing container this replaces the existing container."""
+        if self._zipfile is None:
+            return
+
+        if self._tmp_filename is not None:
+            self._copy_existing_items()
+        self._zipfile.close()
+        self._zipfile = None
+
+        if self._tmp_filename is not None:
+            os.replace(self._tmp_filename, self._filename)
+
+    def _write_chunks(self, name, group, dtype, shape, get_chunk):
+        """Write the chunks of a map and the map information.
+
+        Args:
+            name (str): the name of the map
+            group (str): the group of the map
+            dtype (np.dtype): the data type of the map
+            shape (tuple): the shape of the ROI of the map
+            get_chunk (Callable[[int, int], ndarray]): function returning the data of the voxels in the given range
+        """
+        self._written_maps.add('{}/{}'.format(group, name))
+
+        nmr_chunks = int(np.ceil(shape[0] / self._chunk_size))
+        for chunk_ind in range(nmr_chunks):
+            start = chunk_ind * self._chunk_size
+            end = min(start + self._chunk_size, shape[0])
+
+            buffer = io.BytesIO()
+            np.save(buffer, np.ascontiguousarray(get_chunk(start, end), dtype=dtype))
+            self._zipfile.writestr('{}/{}/{}.npy'.format(group, name, chunk_ind), buffer.getvalue())
+
+        info = {'dtype': np.dtype(dtype).str, 'shape': list(shape), 'chunk_size': self._chunk_size,
+                'nmr_chunks': nmr_chunks}
+        self._zipfile.writestr('{}/{}/info.json'.format(group, name), json.dumps(info))
+
+    def _copy_existing_items(self):
+        """Copy the items of the existing container which were not overwritten to the new container."""
+        with zipfile.ZipFile(self._filename, 'r') as source:
+            for item in source.infolist():
+                if item.filename.rsplit('/', 1)[0] not in self._written_maps:
+                    self._zipfile.writestr(item, source.read(item.filename))
+
+    def _write_header(self, nifti_header):
+        info = {'format_version': _FORMAT_VERSION, 'header_type': None}
+        if nifti_header is not None:
+            info['header_type'] = type(nifti_header).__name__
+            self._zipfile.writestr('header.bin', nifti_header.binaryblock)
+
+        buffer = io.BytesIO()
+        np.save(buffer, self._mask)
+        self._zipfile.writestr('mask.npy', buffer.getvalue())
+        self._zipfile.writestr('container.json', json.dumps(info))
+
+    def _open(self, filename):
+        kwargs = {}
+        if sys.version_info >= (3, 7):
+            kwargs['compresslevel'] = self._compression_level
+        return zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED, **kwargs)
+
+
+class _ContainerVolumeProxy:
+
+    def __init__(self, container, name):
+        """Loads a map from a results container as a volume when requested, similar to a nibabel image."""
+        self._container = container
+        self._name = name
+
+    def get_data(self):
+        return self._container.get_volume(self._name)
+
+
+def find_results_container(directory):
+    """Find the results container holding the maps of the given output directory.
+
+    The results of a directory can be stored in a container in that directory, or, for subdirectories like
+    ``covariances``, in a container in the parent directory.
+
+    Args:
+        directory (str): the output directory
+
+    Returns:
+        tuple: the opened :class:`ResultsContainer` and the prefix of the maps of the given directory in the
+            container. Returns (None, None) if no container was found.
+    """
+    directory = os.path.abspath(directory)
+
+    if os.path.isfile(os.path.join(directory, CONTAINER_FILENAME)):
+        return ResultsContainer(os.path.join(directory, CONTAINER_FILENAME)), ''
+
+    parent_container = os.path.join(os.path.dirname(directory), CONTAINER_FILENAME)
+    if os.path.isfile(parent_container):
+        container = ResultsContainer(parent_container)
+        prefix = os.path.basename(directory) + '/'
+        if container.get_names(prefix=prefix) or container.get_names(group='samples', prefix=prefix):
+            return container, prefix
+        container.close()
+
+    return None, None
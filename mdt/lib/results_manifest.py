@@ -0,0 +1,461 @@
+"""Manifests recording the inputs with which the results of a model were computed.
+
+When a model is fitted or sampled, a manifest is written next to the results. This manifest holds a hash of every
+input that determines the results: the masked observations, the protocol, the extra protocol, the noise standard
+deviation, the model definition (its CL code, initialization, bounds, fixations and post-processing), the routine
+with its options and the MDT version. When the processing is run again, the manifest of the existing results is
+compared to the manifest of the current inputs. If they are identical the existing results are reused, if not,
+the results are recomputed.
+
+Results without a manifest, for example those computed with an older version of MDT, are reused as before.
+
+Next to the manifest we store a checksum per voxel of all the inputs which are specific to a voxel, like the
+observations and the initialization. If only these inputs changed, for example because the mask was edited, the
+results of the voxels of which the checksum did not change can be reused, see :func:`get_reusable_voxels`.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import os
+import collections.abc
+import numpy as np
+from mdt.__version__ import __version__
+
+__author__ = 'Robbert Harms'
+__date__ = '2020-06-08'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert@xkls.nl'
+__licence__ = 'LGPL v3'
+
+
+MANIFEST_FILENAME = 'manifest.json'
+VOXEL_CHECKSUMS_FILENAME = 'manifest_voxels.npz'
+
+_VOXEL_ITEMS = ('mask', 'observations', 'extra_protocol', 'noise_std', 'gradient_deviations', 'volume_weights',
+                'model_parameters')
+"""The items of the manifest which (may) differ per voxel, these are covered by the voxel checksums."""
+
+_FNV_OFFSET = np.uint64(14695981039346656037)
+_FNV_PRIME = np.uint64(1099511628211)
+
+
+def get_fitting_manifest(model, input_data, method, optimizer_options=None, double_precision=False):
+    """Get the manifest for fitting the given model on the given input data.
+
+    Args:
+        model (:class:`~mdt.models.composite.DMRICompositeModel`): the model we fit, with the input data set
+        input_data (:class:`~mdt.lib.input_data.MRIInputData`): the input data
+        method (str): the optimization routine
+        optimizer_options (dict): the options for the optimization routine
+        double_precision (boolean): if the computations are done in double precision
+
+    Returns:
+        dict: the manifest, with the combined hash as ``key`` and the hash per input in ``items``
+    """
+    items = _get_input_data_hashes(input_data)
+    items.update(_get_model_hashes(model, 'optimization'))
+    items['routine'] = _get_fitting_routine_hash(method, optimizer_options, double_precision)
+    return _create_manifest('optimization', items)
+
+
+def get_changed_fitting_routine_items(directory, method, optimizer_options=None, double_precision=False):
+    """Compare the inputs of the stored fitting manifest which can be checked without the input data.
+
+    These are the optimization routine and the MDT version. This allows deciding if existing results can be reused
+    before loading the input data, for example when skipping subjects in batch fitting.
+
+    Args:
+        directory (str): the directory with the stored manifest
+        method (str): the optimization routine
+        optimizer_options (dict): the options for the optimization routine
+        double_precision (boolean): if the computations are done in double precision
+
+    Returns:
+        list of str or None: the names of the inputs which changed, an empty list if these are identical.
+            Returns None if there is no stored manifest.
+    """
+    stored = load_manifest(directory)
+    if stored is None:
+        return None
+
+    items = {'routine': _get_fitting_routine_hash(method, optimizer_options, double_precision),
+             'mdt_version': _hash(__version__)}
+    stored_items = stored.get('items', {})
+    return sorted(name for name, value in items.items() if stored_items.get(name) != value)
+
+
+def get_sampling_manifest(model, input_data, method, routine_options, double_precision=False):
+    """Get the manifest for sampling the given model on the given input data.
+
+    Args:
+        model (:class:`~mdt.models.composite.DMRICompositeModel`): the model we sample, with the input data set
+        input_data (:class:`~mdt.lib.input_data.MRIInputData`): the input data
+        method (str): the sampling routine
+        routine_options (dict): all the settings of the sampling routine, like the number of samples, the burnin and
+            the sampler options. Callables are represented by their names.
+        double_precision (boolean): if the computations are done in double precision
+
+    Returns:
+        dict: the manifest, with the combined hash as ``key`` and the hash per input in ``items``
+    """
+    items = _get_input_data_hashes(input_data)
+    items.update(_get_model_hashes(model, 'sampling'))
+    items['routine'] = _hash({'method': method, 'options': routine_options, 'double_precision': double_precision})
+    return _create_manifest('sampling', items)
+
+
+def load_manifest(directory):
+    """Load the manifest stored in the given directory.
+
+    Args:
+        directory (str): the directory with the results
+
+    Returns:
+        dict or None: the manifest, or None if there is no (readable) manifest in the directory
+    """
+    path = os.path.join(directory, MANIFEST_FILENAME)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        logging.getLogger(__name__).warning('Could not read the manifest {}, ignoring it.'.format(path))
+        return None
+
+
+def write_manifest(directory, manifest):
+    """Write the given manifest to the given directory.
+
+    The manifest is first written to a temporary file and then moved in place, such that an interrupted write never
+    leaves a partial manifest.
+
+    Args:
+        directory (str): the directory with the results
+        manifest (dict): the manifest to write
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, MANIFEST_FILENAME)
+    creation_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(creation_path, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(creation_path, path)
+
+
+def remove_manifest(directory):
+    """Remove the manifest and the voxel checksums from the given directory, if present.
+
+    Args:
+        directory (str): the directory with the results
+    """
+    for filename in [MANIFEST_FILENAME, VOXEL_CHECKSUMS_FILENAME]:
+        path = os.path.join(directory, filename)
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def get_voxel_checksums(model, input_data):
+    """Get a checksum per voxel of all the inputs which can differ per voxel.
+
+    This covers the observations, the noise std, the extra protocol, the gradient deviations, the volume weights and the
+    initialization, bounds and fixations of the model. Values which are not specific to a voxel, like a scalar noise
+    std, are hashed as a whole and mixed into the checksum of every voxel.
+
+    The checksums are meant to detect changes, not to be cryptographically secure.
+
+    Args:
+        model (:class:`~mdt.models.composite.DMRICompositeModel`): the model, with the input data set
+        input_data (:class:`~mdt.lib.input_data.MRIInputData`): the input data
+
+    Returns:
+        ndarray: a (n,) array of type uint64 with a checksum per voxel
+    """
+    nmr_voxels = input_data.nmr_voxels
+    values = _flatten({'extra_protocol': input_data.extra_protocol,
+                       'noise_std': input_data.noise_std,
+                       'gradient_deviations': input_data.gradient_deviations,
+                       'volume_weights': input_data.volume_weights,
+                       'model_parameters': _get_model_parameters(model)})
+
+    checksums = np.full(nmr_voxels, _FNV_OFFSET, dtype=np.uint64)
+    for name in sorted(list(values) + ['observations']):
+        checksums = _mix(checksums, _hash_to_uint64(name))
+
+        if name == 'observations':
+            for start, block in _iterate_observations(input_data):
+                checksums[start:start + len(block)] = _mix_rows(checksums[start:start + len(block)], block)
+            continue
+
+        array = None if values[name] is None else np.asarray(values[name])
+        if array is not None and array.ndim > 0 and array.shape[0] == nmr_voxels and array.dtype != object:
+            checksums = _mix_rows(checksums, array)
+        else:
+            checksums = _mix(checksums, _hash_to_uint64(values[name]))
+    return checksums
+
+
+def write_voxel_checksums(directory, mask, checksums):
+    """Write the voxel checksums, and the mask they belong to, to the given directory.
+
+    Args:
+        directory (str): the directory with the results
+        mask (ndarray): the mask of the results
+        checksums (ndarray): the checksum per voxel in the mask, see :func:`get_voxel_checksums`
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, VOXEL_CHECKSUMS_FILENAME)
+    creation_path = '{}.{}.tmp.npz'.format(path[:-len('.npz')], os.getpid())
+    np.savez(creation_path, mask=np.asarray(mask, dtype=bool), checksums=checksums)
+    os.replace(creation_path, path)
+
+
+def load_voxel_checksums(directory):
+    """Load the voxel checksums stored in the given directory.
+
+    Args:
+        directory (str): the directory with the results
+
+    Returns:
+        tuple or None: the mask and the checksum per voxel in that mask, or None if not available
+    """
+    path = os.path.join(directory, VOXEL_CHECKSUMS_FILENAME)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with np.load(path) as data:
+            return data['mask'], data['checksums']
+    except (OSError, ValueError, KeyError):
+        logging.getLogger(__name__).warning('Could not read the voxel checksums {}, ignoring them.'.format(path))
+        return None
+
+
+def get_reusable_voxels(directory, manifest, mask, voxel_checksums):
+    """Get the voxels of which the results in the given directory can be reused for the current inputs.
+
+    The results of a voxel can be reused if it is in the mask of both the stored results and the current inputs,
+    if its voxel checksum did not change and if all the other, not voxel specific, inputs are identical.
+
+    Args:
+        directory (str): the directory with the stored manifest and voxel checksums
+        manifest (dict): the manifest of the current inputs
+        mask (ndarray): the current mask
+        voxel_checksums (ndarray): the voxel checksums of the current inputs
+
+    Returns:
+        tuple or None: the mask of the stored results, the ROI indices of the reusable voxels in that mask and the ROI
+            indices of these voxels in the current mask. Returns None if no results can be reused.
+    """
+    stored_manifest = load_manifest(directory)
+    stored_checksums = load_voxel_checksums(directory)
+    if stored_manifest is None or stored_checksums is None \
+            or stored_manifest.get('incremental_key') != manifest['incremental_key']:
+        return None
+
+    stored_mask, stored_checksums = stored_checksums
+    mask = np.asarray(mask, dtype=bool)
+    if stored_mask.shape != mask.shape or len(stored_checksums) != np.count_nonzero(stored_mask):
+        return None
+
+    stored_roi_lookup = np.cumsum(stored_mask.ravel()) - 1
+    flat_indices = np.flatnonzero(mask)
+
+    roi_indices = np.flatnonzero(stored_mask.ravel()[flat_indices])
+    stored_roi_indices = stored_roi_lookup[flat_indices[roi_indices]]
+
+    unchanged = stored_checksums[stored_roi_indices] == voxel_checksums[roi_indices]
+    if not np.any(unchanged):
+        return None
+    return stored_mask, stored_roi_indices[unchanged], roi_indices[unchanged]
+
+
+def get_changed_items(directory, manifest):
+    """Compare the manifest stored in the given directory with the given manifest.
+
+    Args:
+        directory (str): the directory with the stored manifest
+        manifest (dict): the manifest of the current inputs
+
+    Returns:
+        list of str or None: the names of the inputs which changed, an empty list if the manifests are identical.
+            Returns None if there is no stored manifest.
+    """
+    stored = load_manifest(directory)
+    if stored is None:
+        return None
+    if stored.get('key') == manifest['key']:
+        return []
+
+    stored_items = stored.get('items', {})
+    changed = sorted(name for name in set(stored_items) | set(manifest['items'])
+                     if stored_items.get(name) != manifest['items'].get(name))
+    return changed or ['key']
+
+
+def _get_fitting_routine_hash(method, optimizer_options, double_precision):
+    """Get the hash of the optimization routine, with its options and precision."""
+    return _hash({'method': method, 'options': optimizer_options, 'double_precision': double_precision})
+
+
+def _create_manifest(processing_type, items):
+    """Create the manifest from the hashes of the inputs.
+
+    Next to the key, this stores an incremental key, the hash of all inputs which are the same for every voxel.
+    """
+    return {'key': _hash(items),
+            'incremental_key': _hash({name: value for name, value in items.items() if name not in _VOXEL_ITEMS}),
+            'processing_type': processing_type,
+            'mdt_version': __version__,
+            'created': datetime.datetime.now().isoformat(),
+            'items': items}
+
+
+def _get_input_data_hashes(input_data):
+    """Get the hashes of all the inputs in the given input data object."""
+    protocol = input_data.protocol
+    return {'mask': _hash(input_data.mask),
+            'observations': _hash_observations(input_data),
+            'protocol': _hash({name: protocol.get_column(name) for name in protocol.column_names}),
+            'extra_protocol': _hash(input_data.extra_protocol),
+            'noise_std': _hash(input_data.noise_std),
+            'gradient_deviations': _hash(input_data.gradient_deviations),
+            'volume_weights': _hash(input_data.volume_weights),
+            'mdt_version': _hash(__version__)}
+
+
+def _hash_observations(input_data):
+    """Get the hash of the observations of the given input data, see :func:`_iterate_observations`."""
+    hash_func = hashlib.sha256()
+    hash_func.update('observations:{}:{}'.format(input_data.nmr_voxels, input_data.nmr_observations).encode('utf-8'))
+    for _, block in _iterate_observations(input_data):
+        _update_hash(hash_func, block)
+    return hash_func.hexdigest()
+
+
+def _iterate_observations(input_data, voxels_per_block=10000):
+    """Iterate over the observations of the given input data in blocks of voxels.
+
+    The blocks are loaded using ``get_observations_subset``, such that observations which are read on demand, like those
+    of a memory mapped volume, are never loaded all at once.
+
+    Yields:
+        tuple: the index of the first voxel in the block and the (n, d) matrix with the observations of the block
+    """
+    nmr_voxels = input_data.nmr_voxels
+    for start in range(0, nmr_voxels, voxels_per_block):
+        yield start, np.asarray(input_data.get_observations_subset(
+            np.arange(start, min(start + voxels_per_block, nmr_voxels))))
+
+
+def _get_model_hashes(model, processing_type):
+    """Get the hashes of the definition of the given model.
+
+    The CL code covers the model functions and their composition. The initialization, bounds and fixations are passed
+    to the kernels as data, as such these are hashed separately.
+    """
+    objective_function = model.get_objective_function()
+    constraints_function = model.get_constraints_function()
+
+    return {'model_code': _hash({'name': model.name,
+                                 'objective': objective_function.get_cl_code(),
+                                 'constraints': (None if constraints_function is None
+                                                 else constraints_function.get_cl_code())}),
+            'model_parameters': _hash(_get_model_parameters(model)),
+            'post_processing': _hash(model.get_active_post_processing().get(processing_type))}
+
+
+def _get_model_parameters(model):
+    """Get the initialization, bounds and fixations of the free parameters of the given model."""
+    return {'free': model.get_free_param_names(),
+            'initial': model.get_initial_parameters(),
+            'lower_bounds': model.get_lower_bounds(),
+            'upper_bounds': model.get_upper_bounds(),
+            'fixed': model._get_fixed_parameter_maps()}
+
+
+def _hash(value):
+    """Get the hexadecimal SHA-256 hash of the given (nested) value."""
+    hash_func = hashlib.sha256()
+    _update_hash(hash_func, value)
+    return hash_func.hexdigest()
+
+
+def _update_hash(hash_func, value, rows_per_update=10000):
+    """Update the given hash function with the given value.
+
+    Mappings and sequences are hashed recursively, with the mappings in order of their keys. Arrays are hashed using
+    their data type, shape and contents, in blocks of rows such that large (memory mapped) arrays are not copied
+    entirely.
+    """
+    if value is None or isinstance(value, (str, bool)):
+        hash_func.update('{}:{}'.format(type(value).__name__, value).encode('utf-8'))
+    elif isinstance(value, collections.abc.Mapping):
+        hash_func.update('dict:{}'.format(len(value)).encode('utf-8'))
+        for key in sorted(value, key=str):
+            _update_hash(hash_func, str(key))
+            _update_hash(hash_func, value[key])
+    elif isinstance(value, (list, tuple)):
+        hash_func.update('list:{}'.format(len(value)).encode('utf-8'))
+        for element in value:
+            _update_hash(hash_func, element)
+    elif callable(value):
+        _update_hash(hash_func, '{}.{}'.format(getattr(value, '__module__', ''),
+                                               getattr(value, '__qualname__', type(value).__name__)))
+    else:
+        array = np.asarray(value)
+        if array.dtype == object:
+            _update_hash(hash_func, repr(value))
+            return
+
+        hash_func.update('array:{}:{}'.format(array.dtype.str, array.shape).encode('utf-8'))
+        if array.ndim == 0:
+            hash_func.update(array.tobytes())
+        else:
+            for ind in range(0, array.shape[0], rows_per_update):
+                hash_func.update(np.ascontiguousarray(array[ind:ind + rows_per_update]).tobytes())
+
+
+def _flatten(values, prefix=''):
+    """Flatten the given nested dictionary to a dictionary with paths as keys."""
+    flattened = {}
+    for key, value in values.items():
+        if isinstance(value, collections.abc.Mapping):
+            flattened.update(_flatten(value, prefix='{}{}/'.format(prefix, key)))
+        elif isinstance(value, (list, tuple)) and not all(isinstance(el, str) for el in value):
+            flattened.update(_flatten(dict(enumerate(value)), prefix='{}{}/'.format(prefix, key)))
+        else:
+            flattened[prefix + str(key)] = value
+    return flattened
+
+
+def _hash_to_uint64(value):
+    """Get the first 64 bits of the hash of the given value."""
+    return np.uint64(int(_hash(value)[:16], 16))
+
+
+def _mix(checksums, values):
+    """Mix the given values into the given checksums, using a step of the 64 bits FNV-1a hash."""
+    return (checksums ^ values) * _FNV_PRIME
+
+
+def _mix_rows(checksums, array, rows_per_update=10000):
+    """Mix the contents of every row of the given array into the checksum of the corresponding voxel.
+
+    The bytes of every row are padded to a multiple of eight and mixed in as 64 bits words.
+    """
+    checksums = _mix(checksums, _hash_to_uint64('array:{}:{}'.format(array.dtype.str, array.shape[1:])))
+
+    for start in range(0, array.shape[0], rows_per_update):
+        block = np.ascontiguousarray(array[start:start + rows_per_update])
+        row_bytes = block.reshape(block.shape[0], -1).view(np.uint8).reshape(block.shape[0], -1)
+
+        padding = (-row_bytes.shape[1]) % 8
+        if padding:
+            row_bytes = np.hstack([row_bytes, np.zeros((row_bytes.shape[0], padding), dtype=np.uint8)])
+        words = np.ascontiguousarray(row_bytes).view(np.uint64)
+
+        block_checksums = checksums[start:start + rows_per_update]
+        for column in range(words.shape[1]):
+            block_checksums = _mix(block_checksums, words[:, column])
+        checksums[start:start + rows_per_update] = block_checksums
+    return checksums
@@ -0,0 +1,257 @@
+"""Streaming (online) summary statistics of MCMC chains.
+
+By default, the full chain of every voxel is kept in memory until sampling has finished, after which the point
+estimates and the other summary statistics are computed. For long chains this limits the number of voxels that can
+be sampled at once.
+
+The statistics in this module are instead updated block by block, while the sampler generates the chain. The memory
+needed is then independent of the length of the chain. The statistics are computed with the same estimators as the
+regular post-processing, that is, the univariate normal fits, the univariate and multivariate ESS using batch means
+with a batch size of the square root of the chain length, the average acceptance rate and the MLE and MAP estimates.
+"""
+import numpy as np
+
+__author__ = 'Robbert Harms'
+__date__ = '2020-03-09'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert@xkls.nl'
+__licence__ = 'LGPL v3'
+
+
+class StreamingSampleStatistics:
+
+    def __init__(self, nmr_problems, nmr_params, nmr_samples, compute_covariance=True):
+        """Running summary statistics of the sampled chains of a set of problems.
+
+        Args:
+            nmr_problems (int): the number of problems (voxels) we are sampling
+            nmr_params (int): the number of parameters per problem
+            nmr_samples (int): the total length of the chains, used to determine the batch size of the batch means
+            compute_covariance (boolean): if we keep track of the covariance of the parameters. This is needed for
+                the multivariate ESS and costs memory quadratic in the number of parameters.
+        """
+        self._nmr_problems = nmr_problems
+        self._nmr_params = nmr_params
+        self._count = 0
+
+        self._mean = np.zeros((nmr_problems, nmr_params))
+        self._sum_squares = np.zeros((nmr_problems, nmr_params))
+        self._comoments = None
+        if compute_covariance:
+            self._comoments = np.zeros((nmr_problems, nmr_params, nmr_params))
+
+        self._batch_size = max(int(np.floor(np.sqrt(nmr_samples))), 1)
+        self._batch_means = np.zeros((nmr_problems, nmr_params, max(nmr_samples // self._batch_size, 1)))
+        self._nmr_batches = 0
+        self._partial_batch_sum = np.zeros((nmr_problems, nmr_params))
+        self._partial_batch_count = 0
+
+        self._nmr_changes = np.zeros((nmr_problems, nmr_params), dtype=np.int64)
+        self._last_sample = None
+
+        self._mle_values = np.full(nmr_problems, -np.inf)
+        self._mle_samples = np.zeros((nmr_problems, nmr_params))
+        self._mle_indices = np.zeros(nmr_problems, dtype=np.uint64)
+        self._map_values = np.full(nmr_problems, -np.inf)
+        self._map_log_likelihoods = np.zeros(nmr_problems)
+        self._map_samples = np.zeros((nmr_problems, nmr_params))
+        self._map_indices = np.zeros(nmr_problems, dtype=np.uint64)
+
+        self._derived_maps = {}
+
+    @property
+    def nmr_samples(self):
+        """The number of samples processed so far."""
+        return self._count
+
+    @property
+    def mean(self):
+        """The (d, p) matrix with the mean of every parameter."""
+        return self._mean
+
+    @property
+    def std(self):
+        """The (d, p) matrix with the (population) standard deviation of every parameter."""
+        return np.sqrt(self._sum_squares / max(self._count, 1))
+
+    def get_covariances(self):
+        """Get the sample covariance matrix of the parameters (normalized by n - 1).
+
+        Returns:
+            ndarray: a (d, p, p) matrix with the covariance matrix of every problem
+        """
+        if self._comoments is None:
+            raise ValueError('The covariances were not computed, please set "compute_covariance" to True.')
+        return self._comoments / max(self._count - 1, 1)
+
+    def get_univariate_ess(self):
+        """Get the univariate Effective Sample Size of every parameter, using the batch means estimator.
+
+        Returns:
+            ndarray: a (d, p) matrix with the ESS of every parameter
+        """
+        batch_means = self._batch_means[..., :self._nmr_batches]
+        batch_variance = self._batch_size * np.sum((batch_means - self._mean[..., None]) ** 2, axis=2) \
+            / (self._nmr_batches - 1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self._count * (self._sum_squares / self._count) / batch_variance
+
+    def get_multivariate_ess(self):
+        """Get the multivariate Effective Sample Size, using the batch means estimator.
+
+        Returns:
+            ndarray: the multivariate ESS of every problem
+        """
+        z = self._batch_means[..., :self._nmr_batches] - self._mean[..., None]
+        sigma = self._batch_size * np.einsum('dpk,dqk->dpq', z, z) / (self._nmr_batches - 1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self._count * (np.linalg.det(self.get_covariances()) ** (1.0 / self._nmr_params)
+                                  / np.linalg.det(sigma) ** (1.0 / self._nmr_params))
+
+    def get_acceptance_rates(self):
+        """Get the fraction of samples that differ from their predecessor, per parameter.
+
+        Returns:
+            ndarray: a (d, p) matrix with the average acceptance rate of every parameter
+        """
+        return self._nmr_changes / max(self._count, 1)
+
+    def get_maximum_likelihood(self):
+        """Get the samples with the highest log-likelihood.
+
+        Returns:
+            tuple: the (d, p) matrix with the samples, the (d,) log-likelihoods and the (d,) positions in the chain
+        """
+        return self._mle_samples, self._mle_values, self._mle_indices
+
+    def get_maximum_a_posteriori(self):
+        """Get the samples with the highest posterior.
+
+        Returns:
+            tuple: the (d, p) matrix with the samples, the (d,) log-posteriors, the (d,) log-likelihoods and
+                the (d,) positions in the chain.
+        """
+        return self._map_samples, self._map_values, self._map_log_likelihoods, self._map_indices
+
+    def get_derived_maps(self):
+        """Get the combined derived maps.
+
+        Returns:
+            dict: per map name the value over all the samples, see :meth:`update_derived_maps`
+        """
+        results = {}
+        for name, (count, mean, sum_squares) in self._derived_maps.items():
+            results[name] = mean
+            if sum_squares is not None:
+                results[name + '.std'] = np.sqrt(sum_squares / count)
+        return results
+
+    def update(self, samples, log_likelihoods, log_priors):
+        """Add the next block of the chains to the statistics.
+
+        Args:
+            samples (ndarray): a (d, p, n) matrix with the next n samples of every problem
+            log_likelihoods (ndarray): a (d, n) matrix with the log-likelihoods of the samples
+            log_priors (ndarray): a (d, n) matrix with the log-priors of the samples
+        """
+        nmr_new = samples.shape[2]
+        if not nmr_new:
+            return
+
+        samples = samples.astype(np.float64)
+        block_mean = np.mean(samples, axis=2)
+        deviations = samples - block_mean[..., None]
+
+        self._update_comoments(nmr_new, block_mean, deviations)
+        self._update_batch_means(samples)
+        self._update_acceptance(samples)
+        self._update_maxima(samples, log_likelihoods, log_priors)
+        self._count += nmr_new
+
+    def update_derived_maps(self, maps, nmr_samples):
+        """Add the derived maps computed on the next block of the chains.
+
+        Maps ``x`` with an accompanying ``x.std`` map are treated as a mean and a standard deviation and are combined
+        into the mean and standard deviation over all the blocks. Any other map is averaged over the blocks, weighted
+        by the number of samples in each block.
+
+        Args:
+            maps (dict): the maps computed on the samples of the current block
+            nmr_samples (int): the number of samples in the current block
+        """
+        for name, value in maps.items():
+            if name.endswith('.std') and name[:-len('.std')] in maps:
+                continue
+
+            value = np.asarray(value, dtype=np.float64)
+            block_sum_squares = None
+            if name + '.std' in maps:
+                block_sum_squares = np.asarray(maps[name + '.std'], dtype=np.float64) ** 2 * nmr_samples
+
+            if name not in self._derived_maps:
+                self._derived_maps[name] = (nmr_samples, value, block_sum_squares)
+                continue
+
+            count, mean, sum_squares = self._derived_maps[name]
+            total = count + nmr_samples
+            delta = value - mean
+            mean = mean + delta * nmr_samples / total
+            if sum_squares is not None:
+                sum_squares = sum_squares + block_sum_squares + delta ** 2 * count * nmr_samples / total
+            self._derived_maps[name] = (total, mean, sum_squares)
+
+    def _update_comoments(self, nmr_new, block_mean, deviations):
+        """Merge the mean and the (co)moments of a new block using the parallel algorithm of Chan et al."""
+        total = self._count + nmr_new
+        delta = block_mean - self._mean
+
+        self._sum_squares += np.sum(deviations ** 2, axis=2) + delta ** 2 * self._count * nmr_new / total
+        if self._comoments is not None:
+            self._comoments += (np.einsum('dpn,dqn->dpq', deviations, deviations)
+                                + delta[:, :, None] * delta[:, None, :] * self._count * nmr_new / total)
+        self._mean += delta * nmr_new / total
+
+    def _update_batch_means(self, samples):
+        """Add the samples to the batches used in the ESS estimates, samples beyond the last full batch are ignored."""
+        position = 0
+        nmr_new = samples.shape[2]
+        max_batches = self._batch_means.shape[2]
+
+        while position < nmr_new and self._nmr_batches < max_batches:
+            nmr_used = min(self._batch_size - self._partial_batch_count, nmr_new - position)
+            self._partial_batch_sum += np.sum(samples[..., position:position + nmr_used], axis=2)
+            self._partial_batch_count += nmr_used
+            position += nmr_used
+
+            if self._partial_batch_count == self._batch_size:
+                self._batch_means[..., self._nmr_batches] = self._partial_batch_sum / self._batch_size
+                self._nmr_batches += 1
+                self._partial_batch_sum[:] = 0
+                self._partial_batch_count = 0
+
+    def _update_acceptance(self, samples):
+        self._nmr_changes += np.count_nonzero(samples[..., 1:] - samples[..., :-1], axis=2)
+        if self._last_sample is not None:
+            self._nmr_changes += (samples[..., 0] != self._last_sample)
+        self._last_sample = samples[..., -1].copy()
+
+    def _update_maxima(self, samples, log_likelihoods, log_priors):
+        problems = np.arange(self._nmr_problems)
+        posteriors = log_likelihoods + log_priors
+
+        mle_indices = np.argmax(log_likelihoods, axis=1)
+        mle_values = log_likelihoods[problems, mle_indices]
+        improved = (mle_values > self._mle_values) | (self._count == 0)
+        self._mle_values[improved] = mle_values[improved]
+        self._mle_samples[improved] = samples[problems, :, mle_indices][improved]
+        self._mle_indices[improved] = mle_indices[improved] + self._count
+
+        map_indices = np.argmax(posteriors, axis=1)
+        map_values = posteriors[problems, map_indices]
+        improved = (map_values > self._map_values) | (self._count == 0)
+        self._map_values[improved] = map_values[improved]
+        self._map_log_likelihoods[improved] = log_likelihoods[problems, map_indices][improved]
+        self._map_samples[improved] = samples[problems, :, map_indices][improved]
+        self._map_indices[improved] = map_indices[improved] + self._count
@@ -0,0 +1,227 @@
+"""Placement of the temporary results in a RAM filesystem.
+
+During processing, the intermediate results are written batch by batch to memory mapped files in the temporary
+results directory. If this directory is on a slow or network file system, flushing these memory maps can take a
+considerable part of the processing time. If enabled, using the ``ram_tmp_storage`` section of the MDT configuration,
+the temporary results are placed in a RAM filesystem (like ``/dev/shm``) instead, as long as their estimated size fits
+the memory budget. If not, we spill to the regular temporary results directory.
+
+Since the contents of a RAM filesystem do not survive a reboot, and are not cleaned when a process crashes, the
+temporary results in RAM are owned by the process that created them. They are removed when that process exits and
+the results of processes which are no longer running are removed the next time the RAM storage is used. As such,
+an interrupted computation using the RAM storage can only be continued from within the same Python session.
+
+The owner of a temporary results directory is recorded in a token file next to that directory, holding the hostname,
+the process id and the start time of the owning process. The start time guards against removing the results of a
+running process which happens to reuse the process id of the original owner.
+"""
+import atexit
+import hashlib
+import json
+import logging
+import os
+import shutil
+import socket
+from mdt.configuration import get_ram_tmp_storage_settings
+
+__author__ = 'Robbert Harms'
+__date__ = '2020-06-02'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert@xkls.nl'
+__licence__ = 'LGPL v3'
+
+
+_owned_dirs = set()
+"""The temporary results directories created by this process in the RAM filesystem."""
+
+_OWNER_TOKEN_EXTENSION = '.owner'
+
+
+def get_ram_tmp_results_path(output_dir, estimated_size):
+    """Get the path for the temporary results in the RAM filesystem, if enabled and if the results fit.
+
+    The results fit if their estimated size, together with the size of the temporary results already in the RAM
+    filesystem, is within the memory budget and if the RAM filesystem has enough free space.
+
+    Args:
+        output_dir (str): the output directory of the results, used to create a unique path
+        estimated_size (int): the estimated size in bytes of the temporary results
+
+    Returns:
+        str or None: the path for the temporary results, or None if the results should be stored on disk
+    """
+    settings = get_ram_tmp_storage_settings()
+    if not settings['enabled']:
+        return None
+
+    logger = logging.getLogger(__name__)
+    ram_dir = settings['path']
+
+    if not output_dir.endswith('/'):
+        output_dir += '/'
+    path = os.path.join(ram_dir, '{}_{}'.format(os.getpid(), hashlib.md5(output_dir.encode('utf-8')).hexdigest()))
+
+    if os.path.isdir(path):
+        _take_ownership(path)
+        return path
+
+    try:
+        os.makedirs(ram_dir, exist_ok=True)
+        remove_stale_ram_tmp_results(ram_dir)
+        disk_usage = shutil.disk_usage(ram_dir)
+        in_use = _get_size_on_disk(ram_dir)
+    except OSError as exc:
+        logger.warning('Could not use the RAM filesystem {} for the temporary results ({}).'.format(ram_dir, exc))
+        return None
+
+    if settings['memory_budget'] is None:
+        memory_budget = disk_usage.total / 2.
+    else:
+        memory_budget = settings['memory_budget'] * 1024 ** 2
+
+    if estimated_size + in_use > memory_budget or estimated_size > disk_usage.free:
+        logger.info('The temporary results (estimated {:.1f} MB) do not fit in the RAM filesystem, '
+                    'storing them on disk.'.format(estimated_size / 1024 ** 2))
+        return None
+
+    _take_ownership(path)
+    return path
+
+
+def remove_stale_ram_tmp_results(ram_dir):
+    """Remove the temporary results of processes which are no longer running.
+
+    This only removes the directories with an owner token of a process on this host which is no longer running.
+    Directories without an owner token, or owned by another host, are left alone. This only works on POSIX systems,
+    on other systems this does nothing.
+
+    Args:
+        ram_dir (str): the directory in the RAM filesystem holding the temporary results
+    """
+    if os.name != 'posix' or not os.path.isdir(ram_dir):
+        return
+
+    for filename in os.listdir(ram_dir):
+        if not filename.endswith(_OWNER_TOKEN_EXTENSION):
+            continue
+
+        token_path = os.path.join(ram_dir, filename)
+        owner = _read_owner_token(token_path)
+        if owner is not None and _is_stale_owner(owner):
+            shutil.rmtree(token_path[:-len(_OWNER_TOKEN_EXTENSION)], ignore_errors=True)
+            try:
+                os.remove(token_path)
+            except OSError:
+                pass
+
+
+def _take_ownership(path):
+    """Mark the given path as owned by this process, such that it is removed when this process exits.
+
+    This writes the owner token of this process next to the given path, see :func:`_get_owner_token`.
+    """
+    if not _owned_dirs:
+        atexit.register(_remove_owned_dirs)
+    _owned_dirs.add(path)
+
+    with open(path + _OWNER_TOKEN_EXTENSION, 'w') as f:
+        json.dump(_get_owner_token(os.getpid()), f)
+
+
+def _remove_owned_dirs():
+    """Remove all the temporary results directories owned by this process."""
+    for path in _owned_dirs:
+        shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.remove(path + _OWNER_TOKEN_EXTENSION)
+        except OSError:
+            pass
+    _owned_dirs.clear()
+
+
+def _get_owner_token(pid):
+    """Get the information identifying the given process on this host.
+
+    Args:
+        pid (int): the process id
+
+    Returns:
+        dict: the hostname, the process id and the start time of the process (None if unknown)
+    """
+    return {'hostname': socket.gethostname(), 'pid': pid, 'start_time': _get_process_start_time(pid)}
+
+
+def _read_owner_token(token_path):
+    """Read an owner token, returns None if the token could not be read."""
+    try:
+        with open(token_path, 'r') as f:
+            owner = json.load(f)
+        int(owner['pid'])
+        return owner
+    except (OSError, ValueError, TypeError, KeyError):
+        return None
+
+
+def _is_stale_owner(owner):
+    """Check if the process in the given owner token is no longer running on this host.
+
+    Args:
+        owner (dict): the owner token, see :func:`_get_owner_token`
+
+    Returns:
+        boolean: True if the owner ran on this host and is no longer running, False otherwise
+    """
+    if owner['hostname'] != socket.gethostname():
+        return False
+
+    pid = int(owner['pid'])
+    if not _process_exists(pid):
+        return True
+
+    start_time = _get_process_start_time(pid)
+    return owner.get('start_time') is not None and start_time is not None and start_time != owner['start_time']
+
+
+def _get_process_start_time(pid):
+    """Get the start time of the given process, in clock ticks after the system boot.
+
+    This reads the start time from the ``/proc`` filesystem, on systems without it this returns None.
+
+    Args:
+        pid (int): the process id
+
+    Returns:
+        int or None: the start time of the process, or None if not available
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid), 'r') as f:
+            stat = f.read()
+        return int(stat[stat.rindex(')') + 2:].split()[19])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _process_exists(pid):
+    """Check if a process with the given process id is running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _get_size_on_disk(directory):
+    """Get the number of bytes used by all the files in the given directory.
+
+    This uses the allocated blocks instead of the file sizes, since the memory mapped files are sparse until written.
+    """
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            try:
+                size += os.stat(os.path.join(dirpath, filename)).st_blocks * 512
+            except (OSError, AttributeError):
+                pass
+    return size
@@ -85,11 +85,16 @@ class EstimableModel:
         """
         raise NotImplementedError()
 
-    def get_kernel_data(self):
+    def get_kernel_data(self, observations=None):
         """Get the kernel data this model needs for evaluation in OpenCL.
 
         This is needed for evaluating the priors, likelihoods and other functions.
 
+        Args:
+            observations (ndarray): if given, use these observations instead of the observations of the input data.
+                These are not subsetted when taking a subset of the kernel data, they should already match the
+                problems the kernel data is used for.
+
         Returns:
             mot.lib.kernel_data.KernelData: the kernel data used by this model
         """
@@ -145,7 +150,8 @@ class EstimableModel:
         """
         raise NotImplementedError()
 
-    def get_post_optimization_output(self, optimized_parameters, roi_indices=None, parameters_dict=None):
+    def get_post_optimization_output(self, optimized_parameters, roi_indices=None, parameters_dict=None,
+                                     kernel_data=None):
         """Get the output after optimization.
 
         This is called by the processing strategy to finalize the optimization of a batch of voxels.
@@ -155,6 +161,8 @@ class EstimableModel:
             roi_indices (Iterable or None): if set, the problem instances optimized in this batch
             parameters_dict (dict): same data as ``optimized_parameters``, only then represented as a dict.
                 Only needed if available, to speed up this function.
+            kernel_data (mot.lib.kernel_data.KernelData): the kernel data of the optimized problems, if not given
+                we use the subset of the model's kernel data given by ``roi_indices``.
 
         Returns:
             dict: dictionary with results maps, can be nested which should translate to sub-directories.
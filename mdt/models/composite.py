@@ -2,11 +2,14 @@ import logging
 from collections import Mapping
 from textwrap import dedent
 import copy
+import pickle
 import collections
 import numpy as np
 from mdt.configuration import get_active_post_processing
 from mdt.lib.deferred_mappings import DeferredFunctionDict
 from mdt.lib.exceptions import DoubleModelNameException
+from mdt.lib.profiling import profile_stage
+from mdt.lib.sampling_statistics import StreamingSampleStatistics
 from mdt.model_building.model_functions import WeightType
 from mdt.model_building.parameter_functions.dependencies import SimpleAssignment, AbstractParameterDependency
 from mdt.model_building.utils import ParameterCodec
@@ -18,7 +21,7 @@ from mdt.model_building.parameters import ProtocolParameter, FreeParameter, Curr
     AzimuthAngleParameter, RotationalAngleParameter, AllObservationsParam, ObservationIndexParam, NmrObservationsParam
 from mot.configuration import CLRuntimeInfo
 from mot.lib.utils import all_elements_equal, get_single_value
-from mot.lib.kernel_data import Array, Zeros, Scalar, LocalMemory, Struct, CompositeArray, PrivateMemory
+from mot.lib.kernel_data import Array, Zeros, Scalar, LocalMemory, Struct, CompositeArray, PrivateMemory, KernelData
 
 from mdt.models.base import MissingProtocolInput
 from mdt.models.base import EstimableModel
@@ -80,6 +83,7 @@ class DMRICompositeModel(EstimableModel):
         self.volume_selection = volume_selection
 
         self._enforce_weights_sum_to_one = enforce_weights_sum_to_one
+        self._recorded_calls = collections.OrderedDict()
 
         self._model_functions_info = ModelFunctionsInformation(model_tree, likelihood_function, signal_noise_model,
                                                                enable_prior_parameters=True)
@@ -126,6 +130,42 @@ class DMRICompositeModel(EstimableModel):
     def name(self):
         return self._name
 
+    def __reduce__(self):
+        """Pickle this model by its name and the modifications made to it.
+
+        The model tree and the CL functions of a composite model can not be pickled directly. Instead, we store the name
+        of this model together with the calls made to modifier methods like :meth:`fix`, :meth:`init` and
+        :meth:`set_input_data`. On unpickling, we load the model with the same name from the components and replay
+        those calls. This only works for models available in the component library, such that we can for example
+        send models to subprocesses.
+
+        Per parameter, only the last fixation (:meth:`fix` or :meth:`unfix`), initialization and bounds are
+        recorded, see :meth:`_record_call`.
+        """
+        from mdt.lib.components import has_component
+        if not has_component('composite_models', self.name):
+            raise pickle.PicklingError('The model "{}" can not be pickled since it is not '
+                                       'available in the components.'.format(self.name))
+        return _rebuild_composite_model, (self.name, self.volume_selection, list(self._recorded_calls.values()),
+                                          self._post_processing)
+
+    def _record_call(self, key, method_name, args, move_to_end=False):
+        """Record a call to a modifier method, to be replayed when this model is unpickled.
+
+        Since a later call with the same key supersedes an earlier call, we only keep the last call per key.
+        By default, the replacing call takes the position of the call it replaces, such that the calls are replayed in
+        the order in which their keys first occurred.
+
+        Args:
+            key (tuple): the key of the call, for example ``('init', 'Ball.d')``
+            method_name (str): the name of the method to call on replay
+            args (tuple): the arguments of the call
+            move_to_end (boolean): if set, the call is replayed after all other recorded calls
+        """
+        if move_to_end:
+            self._recorded_calls.pop(key, None)
+        self._recorded_calls[key] = (method_name, args)
+
     def get_composite_model_function(self):
         """Get the composite model function for the current model tree.
 
@@ -140,11 +180,17 @@ class DMRICompositeModel(EstimableModel):
         """
         return CompositeModelFunction(self._model_tree, signal_noise_model=self._signal_noise_model)
 
-    def get_kernel_data(self):
+    def get_kernel_data(self, observations=None):
         """Get the kernel data this model needs for evaluation in OpenCL.
 
         This is needed for evaluating the priors, likelihoods and other functions.
 
+        Args:
+            observations (ndarray or mot.lib.kernel_data.KernelData): if given, use these observations instead of
+                the observations of the input data. These are not subsetted when taking a subset of the kernel data,
+                they should already match the problems the kernel data is used for. Kernel data is used as is,
+                without transforming the observations.
+
         Returns:
             mot.lib.kernel_data.KernelData: the kernel data used by this model
         """
@@ -155,7 +201,13 @@ class DMRICompositeModel(EstimableModel):
             'protocol_update_cbs': self._get_protocol_update_callbacks_kernel_inputs(),
             'cache': self._get_cache_struct()
         }
-        data_items.update(self._get_observations_data())
+        if observations is None:
+            data_items.update(self._get_observations_data())
+        elif isinstance(observations, KernelData):
+            data_items['observations'] = observations
+        else:
+            data_items['observations'] = _FixedObservationsArray(
+                np.ascontiguousarray(self._transform_observations(observations), dtype=np.float32))
         data_items.update(self._get_fixed_parameters_as_var_data())
 
         if self._input_data.volume_weights is not None:
@@ -227,7 +279,8 @@ class DMRICompositeModel(EstimableModel):
         return np.concatenate([np.transpose(np.array([s]))
                                if len(s.shape) < 2 else s for s in starting_points], axis=1)
 
-    def get_post_optimization_output(self, optimized_parameters, roi_indices=None, parameters_dict=None):
+    def get_post_optimization_output(self, optimized_parameters, roi_indices=None, parameters_dict=None,
+                                     kernel_data=None):
         """Get the output after optimization.
 
         This is called by the processing strategy to finalize the optimization of a batch of voxels.
@@ -238,7 +291,8 @@ class DMRICompositeModel(EstimableModel):
         if not parameters_dict:
             parameters_dict = split_array_to_dict(optimized_parameters, self.get_free_param_names())
         parameters_dict = self._post_process_optimization_maps(optimized_parameters, roi_indices,
-                                                               parameters_dict=parameters_dict)
+                                                               parameters_dict=parameters_dict,
+                                                               kernel_data=kernel_data)
         return parameters_dict
 
     def get_rwm_proposal_stds(self):
@@ -291,7 +345,7 @@ class DMRICompositeModel(EstimableModel):
         return results
 
     def _post_process_optimization_maps(self, parameters_array, roi_indices, parameters_dict=None,
-                                        log_likelihoods=None):
+                                        log_likelihoods=None, kernel_data=None):
         """Create post processing optimization maps.
 
         The current steps in this function:
@@ -310,6 +364,8 @@ class DMRICompositeModel(EstimableModel):
             log_likelihoods (ndarray): for every set of parameters the corresponding log likelihoods.
                 If not provided they will be calculated from the parameters.
             roi_indices (Iterable): if set, the problem instances optimized in this batch
+            kernel_data (mot.lib.kernel_data.KernelData): the kernel data of the optimized problems, defaults to
+                the subset of the kernel data of this model given by the ROI indices.
 
         Returns:
             dict: The results dictionary.
@@ -319,28 +375,37 @@ class DMRICompositeModel(EstimableModel):
             parameters_dict = split_array_to_dict(parameters_array, self.get_free_param_names())
         results_dict.update(parameters_dict)
 
-        results_dict.update(self._get_dependent_map_calculator()(self, results_dict, roi_indices=roi_indices))
-        results_dict.update(self._get_fixed_parameter_maps(roi_indices))
+        with profile_stage('dependent_maps'):
+            results_dict.update(self._get_dependent_map_calculator()(self, results_dict, roi_indices=roi_indices))
+            results_dict.update(self._get_fixed_parameter_maps(roi_indices))
 
         if self._post_processing['optimization']['ll_and_ic']:
-            results_dict.update(self._get_post_optimization_information_criterion_maps(
-                parameters_array, roi_indices, log_likelihoods=log_likelihoods))
+            with profile_stage('ll_and_ic'):
+                results_dict.update(self._get_post_optimization_information_criterion_maps(
+                    parameters_array, roi_indices, log_likelihoods=log_likelihoods, kernel_data=kernel_data))
 
+        packed_covariances = None
         if self._post_processing['optimization']['uncertainties']:
-            fim = self._compute_fisher_information_matrix(parameters_array, roi_indices)
+            with profile_stage('uncertainties', method=self._post_processing['optimization']['uncertainties_method']):
+                fim = self._compute_fisher_information_matrix(parameters_array, roi_indices, kernel_data=kernel_data)
             results_dict.update(fim['stds'])
             results_dict['covariances'] = fim['covariances']
+            packed_covariances = fim['packed']
 
         routine_input = ExtraOptimizationMapsInfo(self, results_dict, self._input_data, roi_indices)
         for routine in self._extra_optimization_maps_funcs:
             try:
-                results_dict.update(routine(routine_input))
+                with profile_stage('extra_optimization_maps', function=getattr(routine, '__name__', str(routine))):
+                    results_dict.update(routine(routine_input))
             except KeyError as exc:
                 if not exc.args[0].endswith('.std'):
                     raise exc
 
         if not self._post_processing['optimization']['store_covariances']:
             del results_dict['covariances']
+        elif packed_covariances is not None \
+                and self._post_processing['optimization']['covariances_storage'] == 'packed':
+            results_dict['covariances'] = {'UpperTriangular': packed_covariances.astype(np.float32)}
 
         return results_dict
 
@@ -412,7 +477,7 @@ class DMRICompositeModel(EstimableModel):
         if self._post_processing['sampling']['average_acceptance_rate']:
             items.update({'average_acceptance_rate': lambda: self._get_average_acceptance_rate(samples)})
         if self._post_processing['sampling']['maximum_likelihood'] \
-            or self._post_processing['sampling']['maximum_a_posteriori']:
+                or self._post_processing['sampling']['maximum_a_posteriori']:
             mle_maps_cb, map_maps_cb = self._get_mle_map_statistics(sampling_output, roi_indices=roi_indices)
             if self._post_processing['sampling']['maximum_likelihood']:
                 items.update({'maximum_likelihood': mle_maps_cb})
@@ -421,6 +486,93 @@ class DMRICompositeModel(EstimableModel):
 
         return DeferredFunctionDict(items, cache=False)
 
+    def get_sampling_statistics(self, nmr_problems, nmr_samples):
+        """Get an object for computing the post-sampling statistics while sampling.
+
+        This is used when sampling in streaming mode, in which the chain is generated and processed in blocks. Update
+        the statistics using :meth:`update_sampling_statistics` and get the maps using
+        :meth:`get_post_sampling_maps_from_statistics`.
+
+        Args:
+            nmr_problems (int): the number of problems we are sampling
+            nmr_samples (int): the total length of the chains
+
+        Returns:
+            mdt.lib.sampling_statistics.StreamingSampleStatistics: the streaming statistics
+        """
+        return StreamingSampleStatistics(nmr_problems, self.get_nmr_parameters(), nmr_samples,
+                                         compute_covariance=self._post_processing['sampling']['multivariate_ess'])
+
+    def update_sampling_statistics(self, statistics, sampling_output, roi_indices=None):
+        """Add the next block of a chain to the streaming sampling statistics.
+
+        Args:
+            statistics (mdt.lib.sampling_statistics.StreamingSampleStatistics): the statistics to update
+            sampling_output (mot.sample.base.SamplingOutput): the output of the sampler for the next block
+            roi_indices (Iterable or None): if set, the problem instances sampled in this batch
+        """
+        samples = sampling_output.get_samples()
+        if self._post_processing['sampling']['model_defined_maps']:
+            statistics.update_derived_maps(self._post_sampling_extra_model_defined_maps(samples, roi_indices),
+                                           samples.shape[2])
+        statistics.update(samples, sampling_output.get_log_likelihoods(), sampling_output.get_log_priors())
+
+    def get_post_sampling_maps_from_statistics(self, statistics, roi_indices=None):
+        """Get the post sample volume maps from the streaming sampling statistics.
+
+        This is the streaming counterpart of :meth:`get_post_sampling_maps`.
+
+        Args:
+            statistics (mdt.lib.sampling_statistics.StreamingSampleStatistics): the statistics over all the samples
+            roi_indices (Iterable or None): if set, the problem instances sampled in this batch
+
+        Returns:
+            dict: a dictionary with for every subdirectory the maps to save
+        """
+        param_names = self.get_free_param_names()
+
+        def univariate_normal():
+            results = {}
+            for ind, param_name in enumerate(param_names):
+                results[param_name] = statistics.mean[:, ind]
+                results['{}.std'.format(param_name)] = statistics.std[:, ind]
+            return results
+
+        def univariate_ess():
+            ess = statistics.get_univariate_ess()
+            ess[np.isinf(ess)] = 0
+            return split_array_to_dict(np.nan_to_num(ess), [a + '.UnivariateESS' for a in param_names])
+
+        def multivariate_ess():
+            ess = statistics.get_multivariate_ess()
+            ess[np.isinf(ess)] = 0
+            return {'MultivariateESS': np.nan_to_num(ess)}
+
+        def average_acceptance_rate():
+            return split_array_to_dict(statistics.get_acceptance_rates(), param_names)
+
+        items = {}
+        if self._post_processing['sampling']['model_defined_maps']:
+            items.update({'model_defined_maps': statistics.get_derived_maps})
+        if self._post_processing['sampling']['univariate_normal']:
+            items.update({'univariate_normal': univariate_normal})
+        if self._post_processing['sampling']['univariate_ess']:
+            items.update({'univariate_ess': univariate_ess})
+        if self._post_processing['sampling']['multivariate_ess']:
+            items.update({'multivariate_ess': multivariate_ess})
+        if self._post_processing['sampling']['average_acceptance_rate']:
+            items.update({'average_acceptance_rate': average_acceptance_rate})
+        if self._post_processing['sampling']['maximum_likelihood'] \
+                or self._post_processing['sampling']['maximum_a_posteriori']:
+            mle_maps_cb, map_maps_cb = self._get_mle_map_callbacks(
+                statistics.get_maximum_likelihood(), statistics.get_maximum_a_posteriori(), roi_indices)
+            if self._post_processing['sampling']['maximum_likelihood']:
+                items.update({'maximum_likelihood': mle_maps_cb})
+            if self._post_processing['sampling']['maximum_a_posteriori']:
+                items.update({'maximum_a_posteriori': map_maps_cb})
+
+        return DeferredFunctionDict(items, cache=False)
+
     def get_model_eval_function(self):
         return self._get_model_eval_function(include_cache_init_func=True)
 
@@ -554,6 +706,7 @@ class DMRICompositeModel(EstimableModel):
         if isinstance(value, str):
             value = SimpleAssignment(value)
         self._model_functions_info.fix_parameter(model_param_name, value)
+        self._record_call(('fixation', model_param_name), 'fix', (model_param_name, value))
         return self
 
     def unfix(self, model_param_name):
@@ -566,6 +719,7 @@ class DMRICompositeModel(EstimableModel):
             Returns self for chainability
         """
         self._model_functions_info.unfix(model_param_name)
+        self._record_call(('fixation', model_param_name), 'unfix', (model_param_name,))
         return self
 
     def init(self, model_param_name, value):
@@ -580,6 +734,7 @@ class DMRICompositeModel(EstimableModel):
         """
         if not self._model_functions_info.is_fixed(model_param_name):
             self._model_functions_info.set_parameter_value(model_param_name, value)
+            self._record_call(('init', model_param_name), 'init', (model_param_name, value))
         return self
 
     def set_initial_parameters(self, initial_params):
@@ -611,6 +766,7 @@ class DMRICompositeModel(EstimableModel):
             Returns self for chainability
         """
         self._lower_bounds[model_param_name] = value
+        self._record_call(('set_lower_bound', model_param_name), 'set_lower_bound', (model_param_name, value))
         return self
 
     def set_lower_bounds(self, lower_bounds):
@@ -638,6 +794,7 @@ class DMRICompositeModel(EstimableModel):
             Returns self for chainability
         """
         self._upper_bounds[model_param_name] = value
+        self._record_call(('set_upper_bound', model_param_name), 'set_upper_bound', (model_param_name, value))
         return self
 
     def set_upper_bounds(self, upper_bounds):
@@ -687,6 +844,7 @@ class DMRICompositeModel(EstimableModel):
                 self._logger.info('Using the gradient deviations in the model optimization.')
 
         self._input_data = input_data
+        self._record_call(('set_input_data',), 'set_input_data', (self._original_input_data, True), move_to_end=True)
         if self._input_data.noise_std is not None:
             std_param = self._model_functions_info.get_noise_std_param()
             self._model_functions_info.set_parameter_value(
@@ -826,19 +984,97 @@ class DMRICompositeModel(EstimableModel):
         mle_samples = samples[range(samples.shape[0]), :, mle_indices]
         map_samples = samples[range(samples.shape[0]), :, map_indices]
 
+        return self._get_mle_map_callbacks((mle_samples, mle_values, mle_indices),
+                                           (map_samples, map_values, map_lls, map_indices), roi_indices)
+
+    def _get_mle_map_callbacks(self, mle_statistics, map_statistics, roi_indices):
+        """Get the functions generating the maps of the MLE and the MAP estimators.
+
+        For voxels in which the MLE and MAP are the same sample, for example when using uninformative priors, the
+        post-processing maps of the MLE are reused for the MAP. As such, the post-processing is only applied to the
+        voxels in which the two estimators differ.
+
+        Args:
+            mle_statistics (tuple): the samples, log-likelihoods and chain positions of the MLE
+            map_statistics (tuple): the samples, log-posteriors, log-likelihoods and chain positions of the MAP
+            roi_indices (Iterable): if set, the problem instances sampled in this batch
+
+        Returns:
+            tuple(Func, Func): the function that generates the maps for the MLE and for the MAP estimators.
+        """
+        mle_samples, mle_values, mle_indices = mle_statistics
+        map_samples, map_values, map_lls, map_indices = map_statistics
+        mle_optimization_maps = []
+
+        def get_mle_optimization_maps():
+            if not mle_optimization_maps:
+                mle_optimization_maps.append(self._post_process_optimization_maps(
+                    mle_samples, roi_indices, log_likelihoods=mle_values))
+            return mle_optimization_maps[0]
+
         def mle_maps():
-            maps = self._post_process_optimization_maps(mle_samples, roi_indices, log_likelihoods=mle_values)
-            maps.update({'MaximumLikelihoodEstimator.indices': mle_indices})
-            return maps
+            return self._get_mle_maps(mle_samples, mle_values, mle_indices, roi_indices,
+                                      optimization_maps=get_mle_optimization_maps())
 
         def map_maps():
-            maps = self._post_process_optimization_maps(map_samples, roi_indices, log_likelihoods=map_lls)
-            maps.update({'MaximumAPosteriori': map_values,
-                         'MaximumAPosteriori.indices': map_indices})
-            return maps
+            differing = np.nonzero(mle_indices != map_indices)[0]
+            if len(differing) == len(map_indices):
+                return self._get_map_maps(map_samples, map_values, map_lls, map_indices, roi_indices)
+
+            optimization_maps = get_mle_optimization_maps()
+            if len(differing):
+                voxel_indices = differing if roi_indices is None else np.asarray(roi_indices)[differing]
+                optimization_maps = _replace_voxels(
+                    optimization_maps, differing,
+                    self._post_process_optimization_maps(map_samples[differing], voxel_indices,
+                                                         log_likelihoods=map_lls[differing]))
+            return self._get_map_maps(map_samples, map_values, map_lls, map_indices, roi_indices,
+                                      optimization_maps=optimization_maps)
 
         return mle_maps, map_maps
 
+    def _get_mle_maps(self, mle_samples, mle_values, mle_indices, roi_indices, optimization_maps=None):
+        """Get the maps of the Maximum Likelihood Estimator.
+
+        Args:
+            mle_samples (ndarray): the (d, p) matrix with the samples with the highest log-likelihood
+            mle_values (ndarray): the log-likelihoods of these samples
+            mle_indices (ndarray): the positions of these samples in the chain
+            roi_indices (Iterable): if set, the problem instances sampled in this batch
+            optimization_maps (dict): the post-processing maps of these samples, if already computed
+
+        Returns:
+            dict: the maps of the MLE
+        """
+        if optimization_maps is None:
+            optimization_maps = self._post_process_optimization_maps(mle_samples, roi_indices,
+                                                                     log_likelihoods=mle_values)
+        maps = dict(optimization_maps)
+        maps.update({'MaximumLikelihoodEstimator.indices': mle_indices})
+        return maps
+
+    def _get_map_maps(self, map_samples, map_values, map_lls, map_indices, roi_indices, optimization_maps=None):
+        """Get the maps of the Maximum A Posteriori estimator.
+
+        Args:
+            map_samples (ndarray): the (d, p) matrix with the samples with the highest posterior
+            map_values (ndarray): the log-posteriors of these samples
+            map_lls (ndarray): the log-likelihoods of these samples
+            map_indices (ndarray): the positions of these samples in the chain
+            roi_indices (Iterable): if set, the problem instances sampled in this batch
+            optimization_maps (dict): the post-processing maps of these samples, if already computed
+
+        Returns:
+            dict: the maps of the MAP
+        """
+        if optimization_maps is None:
+            optimization_maps = self._post_process_optimization_maps(map_samples, roi_indices,
+                                                                     log_likelihoods=map_lls)
+        maps = dict(optimization_maps)
+        maps.update({'MaximumAPosteriori': map_values,
+                     'MaximumAPosteriori.indices': map_indices})
+        return maps
+
     def _get_univariate_normal(self, samples):
         """Fit a univariate normal distribution to the parameters, i.e. calculate the mean and std. of each parameter.
 
@@ -900,7 +1136,7 @@ class DMRICompositeModel(EstimableModel):
                                                / samples.shape[2]
         return results
 
-    def _compute_fisher_information_matrix(self, results_array, roi_indices):
+    def _compute_fisher_information_matrix(self, results_array, roi_indices, kernel_data=None):
         """Calculate the covariance and correlation matrix by taking the inverse of the Hessian.
 
         This first calculates/approximates the Hessian at each of the points using numerical differentiation.
@@ -909,8 +1145,14 @@ class DMRICompositeModel(EstimableModel):
         Args:
             results_array (ndarray): the list with the optimized points for each parameter
             roi_indices (Iterable or None): if set, the problem instances optimized in this batch
+            kernel_data (mot.lib.kernel_data.KernelData): the kernel data of the optimized problems, defaults to
+                the subset of the kernel data of this model given by the ROI indices.
+
+        Returns:
+            dict: with the standard deviations (``stds``), the covariance maps (``covariances``) and the
+                upper triangular covariance matrix elements as one matrix (``packed``).
         """
-        covars = self._compute_covariance_matrix(results_array, roi_indices)
+        covars = self._compute_covariance_matrix(results_array, roi_indices, kernel_data=kernel_data)
         names = self.get_covariance_output_names()
 
         stds = {}
@@ -921,9 +1163,9 @@ class DMRICompositeModel(EstimableModel):
             else:
                 covariances[name] = covars[..., ind]
 
-        return {'stds': stds, 'covariances': covariances}
+        return {'stds': stds, 'covariances': covariances, 'packed': covars}
 
-    def _compute_covariance_matrix(self, results_array, roi_indices=None):
+    def _compute_covariance_matrix(self, results_array, roi_indices=None, kernel_data=None):
         """Calculate the covariance and correlation matrix by taking the inverse of the Hessian.
 
         This first calculates/approximates the Hessian at each of the points using numerical differentiation.
@@ -934,10 +1176,18 @@ class DMRICompositeModel(EstimableModel):
         Args:
             results_array (ndarray): the list with the optimized points for each parameter
             roi_indices (Iterable or None): if set, the problem instances optimized in this batch
+            kernel_data (mot.lib.kernel_data.KernelData): the kernel data of the optimized problems, defaults to
+                the subset of the kernel data of this model given by the ROI indices.
 
         Returns:
             ndarray: for each voxel (first dimension ) a covariance matrix (second dimension)
         """
+        if self._post_processing['optimization']['uncertainties_method'] == 'jacobian':
+            if self._supports_jacobian_fisher_information():
+                return self._compute_jacobian_covariance_matrix(results_array, roi_indices, kernel_data=kernel_data)
+            self._logger.warning('The Jacobian uncertainties require a Gaussian or OffsetGaussian likelihood '
+                                 'with a fixed noise std, using the Hessian instead.')
+
         nmr_params = self.get_nmr_parameters()
         scales = self._get_numdiff_scaling_factors()
 
@@ -962,8 +1212,11 @@ class DMRICompositeModel(EstimableModel):
             }
         ''', dependencies=[self.get_objective_function(), self._get_spherical_transformation_func()])
 
+        if kernel_data is None:
+            kernel_data = self.get_kernel_data().get_subset(roi_indices)
+
         wrapped_input_data = Struct({
-            'data': self.get_kernel_data().get_subset(roi_indices),
+            'data': kernel_data,
             'x_tmp': LocalMemory('mot_float_type', nmr_items=nmr_params)
         }, 'hessian_function_wrapper_data')
 
@@ -989,26 +1242,169 @@ class DMRICompositeModel(EstimableModel):
             lower_bounds=lower_bounds,
             upper_bounds=upper_bounds,
             step_ratio=2,
-            nmr_steps=5,
+            nmr_steps=self._post_processing['optimization']['uncertainties_nmr_steps'],
             max_step_sizes=self._get_numdiff_max_step_sizes(),
             data=wrapped_input_data,
             cl_runtime_info=CLRuntimeInfo(double_precision=True)
         )
 
-        hessian = np.nan_to_num(hessian)
+        return self._invert_fisher_information_matrix(hessian)
+
+    def _invert_fisher_information_matrix(self, fim):
+        """Invert the Fisher Information Matrices of the scaled parameters to the covariances of the parameters.
+
+        Args:
+            fim (ndarray): per voxel the upper triangular elements of the FIM with respect to the scaled parameters
+
+        Returns:
+            ndarray: per voxel the upper triangular elements of the covariance matrix
+        """
+        nmr_params = self.get_nmr_parameters()
+        scales = self._get_numdiff_scaling_factors()
 
-        data = Array(hessian, ctype='double', mode='rw')
+        data = Array(np.nan_to_num(fim), ctype='double', mode='rw')
         pseudo_inverse_real_symmetric_matrix_upper_triangular().evaluate((
             Scalar(nmr_params, ctype='uint'),
             data,
             PrivateMemory(2 * nmr_params + 2 * nmr_params ** 2, 'double')
-        ), nmr_instances=hessian.shape[0], use_local_reduction=False)
+        ), nmr_instances=fim.shape[0], use_local_reduction=False)
 
         covars = data.get_data()
         covars /= np.outer(scales, scales)[np.triu_indices(nmr_params)]
         return covars
 
-    def _get_post_optimization_information_criterion_maps(self, results_array, roi_indices, log_likelihoods=None):
+    def _supports_jacobian_fisher_information(self):
+        """Check if we can compute the Fisher Information Matrix from the Jacobian of the model signal.
+
+        This requires a Gaussian or Offset Gaussian likelihood function with a fixed noise standard deviation.
+        """
+        std_param = self._model_functions_info.get_noise_std_param()
+        return self._likelihood_function.name in ('Gaussian', 'OffsetGaussian') and \
+            self._model_functions_info.is_fixed_to_value('{}.{}'.format(self._likelihood_function.name,
+                                                                        std_param.name))
+
+    def _compute_jacobian_covariance_matrix(self, results_array, roi_indices=None, kernel_data=None):
+        """Calculate the covariance matrix from the Fisher Information Matrix computed using the model Jacobian.
+
+        For a Gaussian likelihood the FIM is given by :math:`J^{T}J / \\sigma^{2}`, with :math:`J` the Jacobian of the
+        model signal with respect to the parameters. For the Offset Gaussian likelihood we use the Jacobian of the
+        offset signal :math:`\\sqrt{S^{2} + \\sigma^{2}}` instead. The Jacobian is approximated using central
+        differences, this needs two model evaluations per parameter per observation, instead of the many evaluations
+        of the objective function needed for the Hessian.
+
+        Args:
+            results_array (ndarray): the list with the optimized points for each parameter
+            roi_indices (Iterable or None): if set, the problem instances optimized in this batch
+            kernel_data (mot.lib.kernel_data.KernelData): the kernel data of the optimized problems, defaults to
+                the subset of the kernel data of this model given by the ROI indices.
+
+        Returns:
+            ndarray: for each voxel (first dimension ) a covariance matrix (second dimension)
+        """
+        nmr_params = self.get_nmr_parameters()
+        nmr_problems = results_array.shape[0]
+        scales = self._get_numdiff_scaling_factors()
+        steps = [max_step * 1e-3 / scale for max_step, scale in zip(self._get_numdiff_max_step_sizes(), scales)]
+
+        def get_bounds(bounds, use_bounds, infinity):
+            columns = []
+            for ind, bound in enumerate(bounds):
+                if not self._get_numdiff_use_bounds()[ind] or not use_bounds[ind]:
+                    bound = infinity
+                elif not is_scalar(bound) and roi_indices is not None:
+                    bound = bound[roi_indices]
+                columns.append(np.broadcast_to(np.squeeze(np.asarray(bound, dtype=np.float64)), (nmr_problems,)))
+            return np.stack(columns, axis=1)
+
+        lower_bounds = get_bounds(self.get_lower_bounds(), self._get_numdiff_use_lower_bounds(), -np.inf)
+        upper_bounds = get_bounds(self.get_upper_bounds(), self._get_numdiff_use_upper_bounds(), np.inf)
+
+        std_param = self._model_functions_info.get_noise_std_param()
+        sigma_name = '{}.{}'.format(self._likelihood_function.name, std_param.name).replace('.', '_')
+        eval_function_info = self.get_model_eval_function()
+        eval_function_name = eval_function_info.get_cl_function_name()
+
+        weight = '1.0 / (' + sigma_name + ' * ' + sigma_name + ')'
+        if self._input_data.volume_weights is not None:
+            weight += ' * model_data->volume_weights[i]'
+        if self._likelihood_function.name == 'OffsetGaussian':
+            weight += ' * pown(signal / hypot(signal, (double)' + sigma_name + '), 2)'
+
+        transformations = '{' + '\n'.join(self._get_spherical_transformations()) + '\n' + \
+            '\n'.join(self._get_rotational_transformations()) + '\n' + \
+            (self._get_weight_sum_to_one_transformation() if self._enforce_weights_sum_to_one else '') + '}'
+
+        fim_function = SimpleCLFunction.from_string('''
+            void _mdt_jacobian_fim(global mot_float_type* parameters, global double* lower_bounds,
+                                   global double* upper_bounds, global double* fim,
+                                   void* data, local mot_float_type* x){
+
+                _mdt_model_data* model_data = (_mdt_model_data*)data;
+                const double steps[] = {''' + ', '.join(map(repr, steps)) + '''};
+                const double scales[] = {''' + ', '.join(map(repr, scales)) + '''};
+                double gradient[''' + str(nmr_params) + '''];
+                double signal, lower, upper, f_upper, f_lower;
+                uint k;
+
+                for(k = 0; k < ''' + str(nmr_params) + '''; k++){
+                    x[k] = parameters[k];
+                }
+                ''' + self._get_param_listing_for_param(self._likelihood_function, std_param) + '''
+
+                for(k = 0; k < ''' + str(nmr_params * (nmr_params + 1) // 2) + '''; k++){
+                    fim[k] = 0;
+                }
+
+                for(uint i = 0; i < ''' + str(self.get_nmr_observations()) + '''; i++){
+                    for(uint j = 0; j < ''' + str(nmr_params) + '''; j++){
+                        upper = min(parameters[j] + steps[j], upper_bounds[j]);
+                        lower = max(parameters[j] - steps[j], lower_bounds[j]);
+
+                        x[j] = upper;
+                        ''' + transformations + '''
+                        f_upper = ''' + eval_function_name + '''(data, x, i);
+
+                        for(k = 0; k < ''' + str(nmr_params) + '''; k++){
+                            x[k] = parameters[k];
+                        }
+                        x[j] = lower;
+                        ''' + transformations + '''
+                        f_lower = ''' + eval_function_name + '''(data, x, i);
+
+                        for(k = 0; k < ''' + str(nmr_params) + '''; k++){
+                            x[k] = parameters[k];
+                        }
+
+                        gradient[j] = (upper > lower) ? (f_upper - f_lower) / ((upper - lower) * scales[j]) : 0;
+                    }
+                    signal = ''' + eval_function_name + '''(data, x, i);
+
+                    k = 0;
+                    for(uint a = 0; a < ''' + str(nmr_params) + '''; a++){
+                        for(uint b = a; b < ''' + str(nmr_params) + '''; b++){
+                            fim[k++] += ''' + weight + ''' * gradient[a] * gradient[b];
+                        }
+                    }
+                }
+            }
+        ''', dependencies=[eval_function_info, self._get_spherical_transformation_func()])
+
+        if kernel_data is None:
+            kernel_data = self.get_kernel_data().get_subset(roi_indices)
+
+        fim = Zeros((nmr_problems, nmr_params * (nmr_params + 1) // 2), 'double')
+        fim_function.evaluate({'parameters': Array(results_array, ctype='mot_float_type'),
+                               'lower_bounds': Array(lower_bounds, ctype='double'),
+                               'upper_bounds': Array(upper_bounds, ctype='double'),
+                               'fim': fim,
+                               'data': kernel_data,
+                               'x': LocalMemory('mot_float_type', nmr_items=nmr_params)},
+                              nmr_problems, cl_runtime_info=CLRuntimeInfo(double_precision=True))
+
+        return self._invert_fisher_information_matrix(fim.get_data())
+
+    def _get_post_optimization_information_criterion_maps(self, results_array, roi_indices, log_likelihoods=None,
+                                                          kernel_data=None):
         """Add some final results maps to the results dictionary.
 
         This called by the function post_process_optimization_maps() as last call to add more maps.
@@ -1018,13 +1414,17 @@ class DMRICompositeModel(EstimableModel):
             roi_indices (ndarray): limit the analysis to these voxels.
             log_likelihoods (ndarray): for every set of parameters the corresponding log likelihoods.
                 If not provided they will be calculated from the parameters.
+            kernel_data (mot.lib.kernel_data.KernelData): the kernel data of the optimized problems, defaults to
+                the subset of the kernel data of this model given by the ROI indices.
 
         Returns:
             dict: the calculated information criterion maps
         """
         if log_likelihoods is None:
+            if kernel_data is None:
+                kernel_data = self.get_kernel_data().get_subset(roi_indices)
             log_likelihoods = compute_log_likelihood(self.get_log_likelihood_function(),
-                                                     results_array, data=self.get_kernel_data().get_subset(roi_indices))
+                                                     results_array, data=kernel_data)
             log_likelihoods[np.isinf(log_likelihoods)] = 0
             log_likelihoods = np.nan_to_num(log_likelihoods)
 
@@ -1434,12 +1834,14 @@ class DMRICompositeModel(EstimableModel):
 
         Can return None if there are no observations.
         """
-        observations = self._input_data.observations
-        if observations is not None:
-            observations = self._transform_observations(observations).astype(np.float32)
-            return {'observations': Array(observations)}
+        if self._has_observations():
+            return {'observations': _ObservationsArray(self._input_data, self._transform_observations)}
         return {}
 
+    def _has_observations(self):
+        """Check if the input data has observations, without loading the observations themselves."""
+        return self._input_data.nmr_voxels > 0 or self._input_data.observations is not None
+
     def _convert_parameters_dot_to_bar(self, string):
         """Convert a string containing parameters with . to parameter names with _"""
         for m, p in self._model_functions_info.get_model_parameter_list():
@@ -1935,22 +2337,22 @@ class DMRICompositeModel(EstimableModel):
                 if isinstance(param, ProtocolParameter):
                     param_list.append(param.name)
                 elif isinstance(param, CurrentObservationParam):
-                    if self._input_data.observations is not None:
+                    if self._has_observations():
                         param_list.append('model_data->observations[observation_index]')
                     else:
                         param_list.append('0.0')
                 elif isinstance(param, AllObservationsParam):
-                    if self._input_data.observations is not None:
+                    if self._has_observations():
                         param_list.append('model_data->observations')
                     else:
                         param_list.append('null')
                 elif isinstance(param, ObservationIndexParam):
-                    if self._input_data.observations is not None:
+                    if self._has_observations():
                         param_list.append('observation_index')
                     else:
                         param_list.append('0')
                 elif isinstance(param, NmrObservationsParam):
-                    if self._input_data.observations is not None:
+                    if self._has_observations():
                         param_list.append(str(self.get_nmr_observations()))
                     else:
                         param_list.append('0')
@@ -2176,6 +2578,157 @@ class DMRICompositeModel(EstimableModel):
         return None
 
 
+def _rebuild_composite_model(model_name, volume_selection, recorded_calls, post_processing):
+    """Rebuild a pickled composite model, see :meth:`DMRICompositeModel.__reduce__`.
+
+    Args:
+        model_name (str): the name of the composite model to load from the components
+        volume_selection (boolean): the volume selection setting of the pickled model
+        recorded_calls (list): the (method name, arguments) tuples of the modifier calls to replay
+        post_processing (dict): the active post processing of the pickled model
+
+    Returns:
+        DMRICompositeModel: the rebuilt composite model
+    """
+    from mdt.lib.components import get_model
+    model = get_model(model_name)(volume_selection=volume_selection)
+    for method_name, args in recorded_calls:
+        getattr(model, method_name)(*args)
+    for processing_type, settings in post_processing.items():
+        model.update_active_post_processing(processing_type, settings)
+    return model
+
+
+class _ObservationsArray(KernelData):
+
+    def __init__(self, input_data, transform_observations):
+        """Kernel data for the observations, which only loads the observations of the requested voxel subsets.
+
+        Models are typically evaluated on subsets of the voxels, using ``get_subset``. This class loads and transforms
+        only the observations of the voxels in such a subset, allowing the input data to read the observations on
+        demand. The subsets are regular :class:`~mot.lib.kernel_data.Array` objects. If this object is used directly,
+        all observations are loaded at once and all other methods are delegated to an array with these observations.
+
+        Args:
+            input_data (mdt.lib.input_data.MRIInputData): the input data with the observations
+            transform_observations (Callable): the function used to transform the observations before fitting
+        """
+        self._input_data = input_data
+        self._transform_observations = transform_observations
+        self._mot_float_dtype = None
+        self._array = None
+
+    @property
+    def ctype(self):
+        return 'float'
+
+    def get_subset(self, problem_indices=None, batch_range=None):
+        if problem_indices is None and batch_range is None:
+            return self
+        if problem_indices is None:
+            problem_indices = np.arange(batch_range[0], batch_range[1])
+        return Array(self._load_observations(self._input_data.get_observations_subset(problem_indices)))
+
+    def set_mot_float_dtype(self, mot_float_dtype):
+        self._mot_float_dtype = mot_float_dtype
+        if self._array is not None:
+            self._array.set_mot_float_dtype(mot_float_dtype)
+
+    def get_data(self):
+        return self._get_array().get_data()
+
+    def get_children(self):
+        return []
+
+    def get_scalar_arg_dtypes(self):
+        return self._get_array().get_scalar_arg_dtypes()
+
+    def get_type_definitions(self):
+        return self._get_array().get_type_definitions()
+
+    def initialize_variable(self, variable_name, kernel_param_name, problem_id_substitute, address_space):
+        return self._get_array().initialize_variable(variable_name, kernel_param_name, problem_id_substitute,
+                                                     address_space)
+
+    def get_function_call_input(self, variable_name, kernel_param_name, problem_id_substitute, address_space):
+        return self._get_array().get_function_call_input(variable_name, kernel_param_name, problem_id_substitute,
+                                                         address_space)
+
+    def post_function_callback(self, variable_name, kernel_param_name, problem_id_substitute, address_space):
+        return self._get_array().post_function_callback(variable_name, kernel_param_name, problem_id_substitute,
+                                                        address_space)
+
+    def get_struct_declaration(self, name):
+        return self._get_array().get_struct_declaration(name)
+
+    def get_struct_initialization(self, variable_name, kernel_param_name, problem_id_substitute):
+        return self._get_array().get_struct_initialization(variable_name, kernel_param_name, problem_id_substitute)
+
+    def get_kernel_parameters(self, kernel_param_name):
+        return self._get_array().get_kernel_parameters(kernel_param_name)
+
+    def enqueue_host_access(self, cl_environments, is_blocking=True, wait_for=None):
+        return self._get_array().enqueue_host_access(cl_environments, is_blocking=is_blocking, wait_for=wait_for)
+
+    def enqueue_device_access(self, cl_environments, is_blocking=True, wait_for=None):
+        return self._get_array().enqueue_device_access(cl_environments, is_blocking=is_blocking, wait_for=wait_for)
+
+    def get_kernel_inputs(self, cl_environment, workgroup_size):
+        return self._get_array().get_kernel_inputs(cl_environment, workgroup_size)
+
+    def get_nmr_kernel_inputs(self):
+        return self._get_array().get_nmr_kernel_inputs()
+
+    def _get_array(self):
+        """Get the array with the observations of all voxels, this loads all the observations in memory."""
+        if self._array is None:
+            self._array = Array(self._load_observations(self._input_data.observations))
+            if self._mot_float_dtype is not None:
+                self._array.set_mot_float_dtype(self._mot_float_dtype)
+        return self._array
+
+    def _load_observations(self, observations):
+        # the volume selection can give non C-contiguous observations, which MOT would read in the wrong order
+        return np.ascontiguousarray(self._transform_observations(observations), dtype=np.float32)
+
+
+def _replace_voxels(maps, voxel_indices, replacement_maps):
+    """Get a copy of the given (nested) dictionary of maps with the values of some voxels replaced.
+
+    Args:
+        maps (dict): the (nested) dictionary with per map the values of all voxels
+        voxel_indices (ndarray): the positions of the voxels to replace
+        replacement_maps (dict): the maps with the new values of only the voxels to replace
+
+    Returns:
+        dict: a new dictionary with the replaced voxel values, the original maps are not changed
+    """
+    results = {}
+    for key, value in maps.items():
+        if isinstance(value, Mapping):
+            results[key] = _replace_voxels(value, voxel_indices, replacement_maps[key])
+        elif np.ndim(value) == 0:
+            results[key] = value
+        else:
+            results[key] = np.array(value)
+            results[key][voxel_indices] = replacement_maps[key]
+    return results
+
+
+class _FixedObservationsArray(Array):
+    """Kernel data for observations given directly per problem instance.
+
+    These observations already match the problem instances they are used for, as such they are not subsetted
+    by the voxel indices given to ``get_subset``. Batch ranges, as used when dividing the work over multiple
+    devices, are still applied.
+    """
+
+    def get_subset(self, problem_indices=None, batch_range=None):
+        if batch_range is None:
+            return self
+        return Array(self._data[batch_range[0]:batch_range[1]], mode=self._mode, use_host_ptr=self._use_host_ptr)
+
+
 class SamplingPostProcessingData(collections.Mapping):
 
     def __init__(self, samples, param_names, fixed_parameters):
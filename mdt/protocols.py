@@ -2,6 +2,7 @@ import collections
 import glob
 import numbers
 import os
+from functools import partial
 from warnings import warn
 
 import numpy as np
@@ -41,9 +42,9 @@ class Protocol(collections.Mapping):
         self._preferred_column_order = ('gx', 'gy', 'gz', 'G', 'Delta', 'delta', 'TE', 'T1', 'b', 'q', 'maxG')
         self._virtual_columns = [VirtualColumnB(),
                                  VirtualColumn_g_spherical(),
-                                 SimpleVirtualColumn('Delta', lambda protocol: get_sequence_timings(protocol)['Delta']),
-                                 SimpleVirtualColumn('delta', lambda protocol: get_sequence_timings(protocol)['delta']),
-                                 SimpleVirtualColumn('G', lambda protocol: get_sequence_timings(protocol)['G'])]
+                                 SimpleVirtualColumn('Delta', partial(_get_sequence_timing, 'Delta')),
+                                 SimpleVirtualColumn('delta', partial(_get_sequence_timing, 'delta')),
+                                 SimpleVirtualColumn('G', partial(_get_sequence_timing, 'G'))]
 
         if columns:
             if 'g' in columns:
@@ -605,6 +606,11 @@ class VirtualColumn_g_spherical(VirtualColumn):
         return np.array([thetas, phis]).T
 
 
+def _get_sequence_timing(column_name, protocol):
+    """Get one of the sequence timings of the given protocol, see :func:`get_sequence_timings`."""
+    return get_sequence_timings(protocol)[column_name]
+
+
 def get_sequence_timings(protocol):
     """Return G, Delta and delta, estimate them if necessary.
 
@@ -2,8 +2,9 @@ import numpy as np
 import collections
 from mdt.lib.components import get_model
 from mdt.lib.nifti import get_all_nifti_data
-from mdt.utils import create_roi, restore_volumes
-from mdt.lib.input_data import MockMRIInputData
+from mdt.utils import create_roi, restore_volumes, split_array_to_dict
+from mdt.lib.input_data import MockMRIInputData, ROIMRIInputData, SimpleMRIInputData
+from mdt.lib.numpy_backend import NumpyModelEvaluator
 from mot.lib.cl_function import SimpleCLFunction
 from mot.lib.kernel_data import Array, Zeros
 
@@ -52,7 +53,7 @@ def create_signal_estimates(model, input_data, parameters):
     return restore_volumes(results, input_data.mask)
 
 
-def simulate_signals(model, protocol, parameters):
+def simulate_signals(model, protocol, parameters, backend='opencl'):
     """Estimate the signals of a given model for the given combination of protocol and parameters.
 
     In contrast to the function :func:`create_signal_estimates`, this function does not incorporate the gradient
@@ -64,10 +65,16 @@ def simulate_signals(model, protocol, parameters):
         protocol (mdt.protocols.Protocol): the protocol we will use for the signal simulation
         parameters (dict or ndarray): the parameters for which to simulate the signal. It can either be a matrix with
             for every row every model parameter, or a dictionary with for every parameter a 1d array.
+        backend (str): the backend used to evaluate the model, either ``opencl`` or ``numpy``. The NumPy backend
+            avoids the OpenCL compilation, which can be faster for small simulations. It only supports the models
+            listed in :mod:`mdt.lib.numpy_backend`.
 
     Returns:
         ndarray: a 2d array with for every parameter combination the simulated model signal
     """
+    if backend not in ('opencl', 'numpy'):
+        raise ValueError('The backend "{}" is not supported, use "opencl" or "numpy".'.format(backend))
+
     if isinstance(model, str):
         model = get_model(model)()
 
@@ -76,6 +83,9 @@ def simulate_signals(model, protocol, parameters):
     if isinstance(parameters, collections.Mapping):
         parameters = model.param_dict_to_array(parameters)
 
+    if backend == 'numpy':
+        return NumpyModelEvaluator(model).get_signals(np.asarray(parameters))
+
     nmr_problems = parameters.shape[0]
 
     kernel_data = {'data': model.get_kernel_data(),
@@ -105,7 +115,63 @@ def add_rician_noise(signals, noise_level, seed=None):
     random_state = np.random.RandomState(seed)
     x = noise_level * random_state.normal(size=signals.shape) + signals
     y = noise_level * random_state.normal(size=signals.shape)
-    return np.sqrt(x**2, y**2).astype(signals.dtype)
+    return np.sqrt(x**2 + y**2).astype(signals.dtype)
+
+
+def create_phantom(model, protocol, nmr_voxels, snr=30, seed=None, backend='opencl'):
+    """Create a synthetic dataset with the given number of voxels, simulated from the given model.
+
+    The ground truth parameters are drawn per voxel from a normal distribution around the initial parameters of the
+    model, using twice the random walk proposal standard deviations as spread, after which they are clamped to the
+    parameter bounds. The signals are then simulated using :func:`simulate_signals` and made Rician distributed
+    using :func:`add_rician_noise`, with the noise level set to the mean unweighted signal divided by the SNR.
+
+    The signals are simulated for all the volumes in the protocol, also for models which normally only use a subset
+    of the volumes. The voxels are placed in the first ``nmr_voxels`` positions of an approximately cubic volume, such
+    that the datasets can be scaled to an arbitrary number of voxels. This is meant for benchmarks and simulation
+    studies.
+
+    Args:
+        model (str or model): the model or the name of the model to simulate
+        protocol (mdt.protocols.Protocol): the protocol to simulate the signals for
+        nmr_voxels (int): the number of voxels in the phantom
+        snr (float): the signal to noise ratio of the unweighted volumes
+        seed (int): if given, the seed for the random number generation
+        backend (str): the backend used to simulate the signals, see :func:`simulate_signals`
+
+    Returns:
+        tuple: the input data (:class:`~mdt.lib.input_data.SimpleMRIInputData`) with the noisy signals, the mask and
+            the noise std, and a dictionary with per free parameter the ground truth values of the voxels in the mask.
+    """
+    if isinstance(model, str):
+        model = get_model(model)()
+    model.volume_selection = False
+
+    random_state = np.random.RandomState(seed)
+
+    side = int(np.ceil(nmr_voxels ** (1 / 3.)))
+    shape = (side, side, int(np.ceil(nmr_voxels / side ** 2)))
+    mask = np.zeros(int(np.prod(shape)), dtype=bool)
+    mask[:nmr_voxels] = True
+    mask = mask.reshape(shape)
+
+    model.set_input_data(ROIMRIInputData(protocol, np.zeros((nmr_voxels, protocol.length), dtype=np.float32),
+                                         mask, None, noise_std=1), suppress_warnings=True)
+    parameters = random_state.normal(model.get_initial_parameters(), 2 * model.get_rwm_proposal_stds())
+    parameters = model.get_mle_codec().encode_decode(parameters, kernel_data=model.get_kernel_data())
+
+    signals = simulate_signals(model, protocol, parameters, backend=backend)
+
+    unweighted_indices = protocol.get_unweighted_indices()
+    if len(unweighted_indices):
+        noise_level = np.mean(signals[:, unweighted_indices]) / snr
+    else:
+        noise_level = np.mean(signals) / snr
+
+    signals = add_rician_noise(signals, noise_level, seed=random_state.randint(np.iinfo(np.int32).max))
+
+    input_data = SimpleMRIInputData(protocol, restore_volumes(signals, mask), mask, None, noise_std=noise_level)
+    return input_data, split_array_to_dict(parameters, model.get_free_param_names())
 
 
 def _get_simulate_function(model):
@@ -412,6 +412,137 @@ def get_slice_in_dimension(volume, dimension, index):
     return volume[tuple(ind_pos)]
 
 
+class MaskIndex:
+
+    def __init__(self, mask):
+        """The indices of the voxels in a brain mask, to convert between volumes and ROIs.
+
+        The ROI of a mask lists the voxels in the mask in C (row-major) order. This class holds, for one mask, the flat
+        (raveled) volume index and the 3d volume index of every ROI voxel, as well as the inverse lookup from volume
+        position to ROI index. These are computed on first use and then reused, such that converting many maps with
+        the same mask only computes the indices once.
+
+        Please obtain instances using :func:`get_mask_index`, which caches the mask index per mask.
+
+        Args:
+            mask (ndarray): the 3d boolean mask
+        """
+        self.mask = np.array(mask, dtype=bool)
+        self.mask.flags.writeable = False
+        self.shape = self.mask.shape
+        self._flat_indices = None
+        self._volume_indices = None
+        self._index_matrix = None
+
+    @property
+    def nmr_voxels(self):
+        """The number of voxels in the mask."""
+        return self.flat_indices.shape[0]
+
+    @property
+    def flat_indices(self):
+        """The read-only (n,) array with for every ROI voxel the index in the raveled (C order) volume."""
+        if self._flat_indices is None:
+            flat_indices = np.flatnonzero(self.mask)
+            flat_indices.flags.writeable = False
+            self._flat_indices = flat_indices
+        return self._flat_indices
+
+    @property
+    def volume_indices(self):
+        """The read-only (n, 3) array with for every ROI voxel the 3d index in the volume."""
+        if self._volume_indices is None:
+            volume_indices = np.column_stack(np.unravel_index(self.flat_indices, self.shape))
+            volume_indices.flags.writeable = False
+            self._volume_indices = volume_indices
+        return self._volume_indices
+
+    @property
+    def index_matrix(self):
+        """A read-only volume with in every voxel in the mask the index of that voxel in the ROI, zero elsewhere."""
+        if self._index_matrix is None:
+            index_matrix = np.zeros(self.mask.size, dtype=np.int64)
+            index_matrix[self.flat_indices] = np.arange(self.nmr_voxels)
+            index_matrix = index_matrix.reshape(self.shape)
+            index_matrix.flags.writeable = False
+            self._index_matrix = index_matrix
+        return self._index_matrix
+
+    def create_roi(self, volume):
+        """Get the voxels in the mask of the given volume.
+
+        Args:
+            volume (ndarray): a volume with at least the three spatial dimensions of the mask
+
+        Returns:
+            ndarray: the voxels in the mask, with at least two dimensions, (voxels, ...)
+        """
+        if isinstance(volume, np.ndarray) and volume.flags.c_contiguous and volume.shape[:3] == self.shape:
+            roi = volume.reshape((-1,) + volume.shape[3:])[self.flat_indices]
+        else:
+            roi = volume[self.mask]
+
+        if len(roi.shape) == 1:
+            roi = np.expand_dims(roi, axis=1)
+        return roi
+
+    def restore_volume(self, voxel_list, with_volume_dim=True):
+        """Place the given ROI voxels back in a volume, see :func:`restore_volumes`.
+
+        Args:
+            voxel_list (ndarray): the ROI voxels, with the voxels on the first axis
+            with_volume_dim (boolean): if we always return at least 4 dimensions
+
+        Returns:
+            ndarray: the volume with the voxel values in the mask and zeros elsewhere
+        """
+        s = voxel_list.shape
+
+        return_volume = np.zeros((self.mask.size,) + s[1:], dtype=voxel_list.dtype, order='C')
+        return_volume[self.flat_indices] = voxel_list
+        vol = np.reshape(return_volume, self.shape + s[1:])
+
+        if with_volume_dim and len(s) < 2:
+            return np.expand_dims(vol, axis=3)
+        return vol
+
+
+_mask_index_cache = collections.OrderedDict()
+"""Cache of the most recently used mask indices, by hash of the mask. See :func:`get_mask_index`."""
+
+_mask_index_cache_size = 8
+
+
+def get_mask_index(brain_mask):
+    """Get the (cached) :class:`MaskIndex` of the given brain mask.
+
+    The mask indices are cached on the contents of the mask, such that masks loaded or copied multiple times share the
+    same indices. Hashing the mask is much faster than computing the indices, nevertheless, code converting
+    many maps should obtain the mask index once and pass it to the conversion functions instead of the mask.
+
+    Args:
+        brain_mask (ndarray, str or MaskIndex): the mask, or the string to the brain mask to use. If a mask index
+            is given it is returned as is.
+
+    Returns:
+        MaskIndex: the mask index of the given mask
+    """
+    if isinstance(brain_mask, MaskIndex):
+        return brain_mask
+
+    mask = load_brain_mask(brain_mask)
+    key = (mask.shape, hashlib.md5(np.packbits(mask)).hexdigest())
+
+    mask_index = _mask_index_cache.pop(key, None)
+    if mask_index is None:
+        mask_index = MaskIndex(mask)
+    _mask_index_cache[key] = mask_index
+
+    while len(_mask_index_cache) > _mask_index_cache_size:
+        _mask_index_cache.popitem(last=False)
+    return mask_index
+
+
 def create_roi(data, brain_mask):
     """Create and return masked data of the given brain volume and mask
 
@@ -419,31 +550,25 @@ def create_roi(data, brain_mask):
         data (string, ndarray or dict): a brain volume with four dimensions (x, y, z, w)
             where w is the length of the protocol, or a list, tuple or dictionary with volumes or a string
             with a filename of a dataset to use or a directory with the containing maps to load.
-        brain_mask (ndarray or str): the mask indicating the region of interest with dimensions: (x, y, z) or the string
-            to the brain mask to use
+        brain_mask (ndarray, str or MaskIndex): the mask indicating the region of interest with
+            dimensions: (x, y, z), the string to the brain mask to use or the mask index of the mask.
 
     Returns:
         ndarray, tuple, dict: If a single ndarray is given we will return the ROI for that array. If
             an iterable is given we will return a tuple. If a dict is given we return a dict.
             For each result the axis are: (voxels, protocol)
     """
-    brain_mask = load_brain_mask(brain_mask)
-
-    def creator(v):
-        return_val = v[brain_mask]
-        if len(return_val.shape) == 1:
-            return_val = np.expand_dims(return_val, axis=1)
-        return return_val
+    mask_index = get_mask_index(brain_mask)
 
     if isinstance(data, (dict, collections.Mapping)):
-        return DeferredActionDict(lambda _, item: create_roi(item, brain_mask), data)
+        return DeferredActionDict(lambda _, item: create_roi(item, mask_index), data)
     elif isinstance(data, str):
         if os.path.isdir(data):
-            return create_roi(load_volume_maps(data), brain_mask)
-        return creator(load_nifti(data).get_data())
+            return create_roi(load_volume_maps(data), mask_index)
+        return mask_index.create_roi(load_nifti(data).get_data())
     elif isinstance(data, (list, tuple, collections.Sequence)):
-        return DeferredActionTuple(lambda _, item: create_roi(item, brain_mask), data)
-    return creator(data)
+        return DeferredActionTuple(lambda _, item: create_roi(item, mask_index), data)
+    return mask_index.create_roi(data)
 
 
 def restore_volumes(data, brain_mask, with_volume_dim=True):
@@ -453,7 +578,8 @@ def restore_volumes(data, brain_mask, with_volume_dim=True):
 
     Args:
         data (ndarray): the data as a x dimensional list of voxels, or, a list, tuple, or dict of those voxel lists
-        brain_mask (ndarray): the brain_mask which was used to generate the data list
+        brain_mask (ndarray, str or MaskIndex): the brain_mask which was used to generate the data list, or its
+            mask index
         with_volume_dim (boolean): If true we always return values with at least 4 dimensions.
             The extra dimension is for the volume index. If false we return at least 3 dimensions.
 
@@ -462,21 +588,10 @@ def restore_volumes(data, brain_mask, with_volume_dim=True):
         If with_volume_ind_dim is set we return values with 4 dimensions. (x, y, z, 1). If not set we return only
         three dimensions.
     """
-    brain_mask = load_brain_mask(brain_mask)
-
-    shape3d = brain_mask.shape[:3]
-    indices = np.ravel_multi_index(np.nonzero(brain_mask)[:3], shape3d, order='C')
+    mask_index = get_mask_index(brain_mask)
 
     def restorer(voxel_list):
-        s = voxel_list.shape
-
-        return_volume = np.zeros((brain_mask.size,) + s[1:], dtype=voxel_list.dtype, order='C')
-        return_volume[indices] = voxel_list
-        vol = np.reshape(return_volume, shape3d + s[1:])
-
-        if with_volume_dim and len(s) < 2:
-            return np.expand_dims(vol, axis=3)
-        return vol
+        return mask_index.restore_volume(voxel_list, with_volume_dim=with_volume_dim)
 
     if isinstance(data, collections.Mapping):
         return {key: restorer(value) for key, value in data.items()}
@@ -943,8 +1058,15 @@ def model_output_exists(model, output_folder, append_model_name_to_path=True):
     if not os.path.exists(output_path):
         return False
 
+    from mdt.lib.results_container import find_results_container
+    container, prefix = find_results_container(output_path)
+    container_maps = []
+    if container is not None:
+        container_maps = container.get_names(prefix=prefix)
+        container.close()
+
     for parameter_name in parameter_names:
-        if not glob.glob(os.path.join(output_path, parameter_name + '*')):
+        if parameter_name not in container_maps and not glob.glob(os.path.join(output_path, parameter_name + '*')):
             return False
 
     return True
@@ -1055,14 +1177,27 @@ def load_samples(data_folder, mode='r'):
         data_folder (str): the folder from which to use the samples
         mode (str): the mode in which to open the memory mapped sample files (see numpy mode parameter)
 
+    If there are no sample files but the samples are stored in a results container
+    (see :mod:`mdt.lib.results_container`), we return a deferred loading dictionary which reads the samples from the
+    container when requested.
+
     Returns:
         dict: the memory loaded samples per sampled parameter.
     """
+    from mdt.lib.results_container import find_results_container
+
     data_dict = {}
     for fname in glob.glob(os.path.join(data_folder, '*.samples.npy')):
         samples = open_memmap(fname, mode=mode)
         map_name = os.path.basename(fname)[0:-len('.samples.npy')]
         data_dict.update({map_name: samples})
+
+    if not data_dict:
+        container, prefix = find_results_container(data_folder)
+        if container is not None:
+            return DeferredActionDict(lambda name, _: container.get_roi(prefix + name, group='samples'),
+                                      {name: None for name in container.get_names(group='samples', prefix=prefix)})
+
     return data_dict
 
 
@@ -1176,13 +1311,12 @@ def roi_index_to_volume_index(roi_indices, brain_mask):
 
     Args:
         roi_indices (int or ndarray): the index in the ROI created by that brain mask
-        brain_mask (str or 3d array): the brain mask you would like to use
+        brain_mask (str, 3d array or MaskIndex): the brain mask you would like to use
 
     Returns:
         ndarray: the 3d voxel location(s) of the indicated voxel(s)
     """
-    mask = load_brain_mask(brain_mask)
-    return np.argwhere(mask)[roi_indices, :]
+    return np.array(get_mask_index(brain_mask).volume_indices[roi_indices, :])
 
 
 def volume_index_to_roi_index(volume_index, brain_mask):
@@ -1194,14 +1328,15 @@ def volume_index_to_roi_index(volume_index, brain_mask):
 
     Args:
         volume_index (tuple): the volume index, a tuple or list of length 3
-        brain_mask (str or 3d array): the brain mask you would like to use
+        brain_mask (str, 3d array or MaskIndex): the brain mask you would like to use
 
     Returns:
         int: the index of the given voxel in the ROI created by the given mask
     """
+    index_matrix = get_mask_index(brain_mask).index_matrix
     if isinstance(volume_index, np.ndarray) and len(volume_index.shape) >= 2:
-        return create_index_matrix(brain_mask)[volume_index[:, 0], volume_index[:, 1], volume_index[:, 2]]
-    return create_index_matrix(brain_mask)[volume_index[0], volume_index[1], volume_index[2]]
+        return index_matrix[volume_index[:, 0], volume_index[:, 1], volume_index[:, 2]]
+    return index_matrix[volume_index[0], volume_index[1], volume_index[2]]
 
 
 def create_index_matrix(brain_mask):
@@ -1210,15 +1345,13 @@ def create_index_matrix(brain_mask):
     This function is useful if you want to locate a voxel in the ROI given the position in the volume.
 
     Args:
-        brain_mask (str or 3d array): the brain mask you would like to use
+        brain_mask (str, 3d array or MaskIndex): the brain mask you would like to use
 
     Returns:
         3d ndarray: a 3d volume of the same size as the given mask and with as every non-zero element the position
             of that voxel in the linear ROI list.
     """
-    mask = load_brain_mask(brain_mask)
-    roi = np.arange(0, np.count_nonzero(mask))
-    return restore_volumes(roi, mask, with_volume_dim=False)
+    return np.copy(get_mask_index(brain_mask).index_matrix)
 
 
 def get_temporary_results_dir(user_value):
@@ -1645,23 +1778,50 @@ def create_covariance_matrix(nmr_voxels, results, names, result_covars=None):
     return covars
 
 
-def get_intermediate_results_path(output_dir, tmp_dir):
+def get_intermediate_results_path(output_dir, tmp_dir, estimated_size=None):
     """Get a temporary results path for processing.
 
+    If the estimated size of the temporary results is given, and if the RAM storage is enabled in the configuration,
+    the temporary results are placed in a RAM filesystem if they fit, see :mod:`mdt.lib.tmp_storage`. Existing
+    temporary results on disk take precedence, such that interrupted computations can be continued.
+
     Args:
         output_dir (str): the output directory of the results
         tmp_dir (str): a preferred tmp dir. If not given we create a temporary directory in the output_dir.
+        estimated_size (int): the estimated size of the temporary results in bytes. If not given, the
+            results are not placed in the RAM filesystem.
 
     Returns:
         str: a path for saving intermediate computation results
     """
     if tmp_dir is None:
-        return os.path.join(output_dir, DEFAULT_INTERMEDIATE_RESULTS_SUBDIR_NAME)
+        disk_path = os.path.join(output_dir, DEFAULT_INTERMEDIATE_RESULTS_SUBDIR_NAME)
+    else:
+        output_dir_key = output_dir if output_dir.endswith('/') else output_dir + '/'
+        disk_path = os.path.join(tmp_dir, hashlib.md5(output_dir_key.encode('utf-8')).hexdigest())
 
-    if not output_dir.endswith('/'):
-        output_dir += '/'
+    if estimated_size is None or os.path.exists(disk_path):
+        return disk_path
 
-    return os.path.join(tmp_dir, hashlib.md5(output_dir.encode('utf-8')).hexdigest())
+    from mdt.lib.tmp_storage import get_ram_tmp_results_path
+    return get_ram_tmp_results_path(output_dir, estimated_size) or disk_path
+
+
+def estimate_intermediate_results_size(model, nmr_voxels):
+    """Estimate the size of the temporary results of processing the given model.
+
+    This counts, in double precision, the parameters, their standard deviations and covariances and some room for
+    the additional output maps of the model.
+
+    Args:
+        model (:class:`~mdt.models.base.EstimableModel`): the model we will process
+        nmr_voxels (int): the number of voxels we will process
+
+    Returns:
+        int: the estimated number of bytes of the temporary results
+    """
+    nmr_params = model.get_nmr_parameters()
+    return 8 * nmr_voxels * (nmr_params * (nmr_params + 2) + 32)
 
 
 def compute_noddi_dti(model, input_data, results, noddi_d=1.7e-9):
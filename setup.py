@@ -64,7 +64,7 @@ info_dict = dict(
     maintainer='Robbert Harms',
     maintainer_email='robbert@xkls.nl',
     url='https://github.com/robbert-harms/MDT',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     include_package_data=True,
     install_requires=requirements,
     license="LGPL v3",
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_input_data
+----------------------------------
+
+Tests for the memory mapped input volumes and the on demand loading of the observations.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import nibabel as nib
+import numpy as np
+from mot.lib.kernel_data import Array
+from mdt.lib.input_data import MemoryMappedVolume, SimpleMRIInputData
+from mdt.models.composite import _ObservationsArray
+from mdt.protocols import Protocol
+
+
+class MemoryMappedVolumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_input_data_test')
+        self._data = np.random.rand(4, 5, 6, 7).astype(np.float32)
+        self._fname = os.path.join(self._tmp_dir, 'volume.nii')
+        nib.save(nib.Nifti1Image(self._data, np.eye(4)), self._fname)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_get_voxels(self):
+        volume = MemoryMappedVolume(self._fname)
+        coordinates = np.array([[0, 0, 0], [3, 4, 5], [1, 2, 3]])
+
+        np.testing.assert_array_equal(volume.get_voxels(coordinates), self._data[tuple(coordinates.T)])
+
+    def test_volume_selection(self):
+        volume = MemoryMappedVolume(self._fname)[..., [5, 1, 2]]
+        coordinates = np.array([[0, 0, 0], [3, 4, 5], [1, 2, 3]])
+
+        self.assertIsInstance(volume, MemoryMappedVolume)
+        self.assertEqual(volume.shape, (4, 5, 6, 3))
+        np.testing.assert_array_equal(volume.get_voxels(coordinates), self._data[tuple(coordinates.T)][:, [5, 1, 2]])
+        np.testing.assert_array_equal(np.asarray(volume[..., [2, 0]]), self._data[..., [2, 5]])
+
+    def test_mask_indexing(self):
+        mask = np.random.rand(4, 5, 6) > 0.5
+        np.testing.assert_array_equal(MemoryMappedVolume(self._fname)[mask], self._data[mask])
+
+
+class ObservationsArrayTest(unittest.TestCase):
+
+    def setUp(self):
+        self._signal4d = np.random.rand(4, 5, 6, 7)
+        self._mask = np.random.rand(4, 5, 6) > 0.5
+        self._input_data = SimpleMRIInputData(Protocol(), self._signal4d, self._mask, None)
+
+    def test_subsets(self):
+        observations = _ObservationsArray(self._input_data, lambda observations: observations * 2)
+
+        subset = observations.get_subset(np.array([3, 1]))
+        self.assertIsInstance(subset, Array)
+        np.testing.assert_allclose(subset.get_data(), self._signal4d[self._mask][[3, 1]] * 2, rtol=1e-6)
+
+        subset = observations.get_subset(batch_range=(2, 4))
+        np.testing.assert_allclose(subset.get_data(), self._signal4d[self._mask][2:4] * 2, rtol=1e-6)
+
+    def test_full_array(self):
+        observations = _ObservationsArray(self._input_data, lambda observations: observations)
+
+        self.assertIs(observations.get_subset(), observations)
+        self.assertEqual(observations.ctype, 'float')
+        np.testing.assert_allclose(observations.get_data(), self._signal4d[self._mask], rtol=1e-6)
+        self.assertEqual(observations.get_data().dtype, np.float32)
+
+
+if __name__ == '__main__':
+    unittest.main()
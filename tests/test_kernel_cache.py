@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_kernel_cache
+----------------------------------
+
+Tests for the on-disk cache of the compiled OpenCL kernels, :mod:`mdt.lib.kernel_cache`.
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import pyopencl as cl
+from mdt.lib.kernel_cache import KernelCache
+
+_kernel_source = '''
+    __kernel void double_values(__global float* values){
+        values[get_global_id(0)] *= 2;
+    }
+'''
+
+
+def _get_context():
+    for platform in cl.get_platforms():
+        devices = platform.get_devices()
+        if devices:
+            return cl.Context(devices[:1])
+    return None
+
+
+class KernelCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._cache_dir = tempfile.mkdtemp('mdt_kernel_cache_test')
+        self._kernel_cache = KernelCache(self._cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self._cache_dir)
+
+    def _get_context(self):
+        try:
+            context = _get_context()
+        except cl.Error:
+            context = None
+        if context is None:
+            self.skipTest('No OpenCL device available.')
+        return context
+
+    def test_key(self):
+        context = self._get_context()
+        key = self._kernel_cache.get_key(context, _kernel_source, '-cl-fast-relaxed-math')
+
+        self.assertEqual(key, self._kernel_cache.get_key(context, _kernel_source, '-cl-fast-relaxed-math'))
+        self.assertNotEqual(key, self._kernel_cache.get_key(context, _kernel_source, ''))
+        self.assertNotEqual(key, self._kernel_cache.get_key(context, _kernel_source + ' ', '-cl-fast-relaxed-math'))
+
+    def test_store_and_load(self):
+        context = self._get_context()
+        self._kernel_cache.get_program(context, _kernel_source)
+
+        cache_file = self._get_cache_file(context)
+        self.assertTrue(os.path.isfile(cache_file))
+
+        program = self._kernel_cache.get_program(context, _kernel_source)
+        self.assertEqual(program.get_info(cl.program_info.KERNEL_NAMES), 'double_values')
+
+    def test_corrupt_binary(self):
+        context = self._get_context()
+        cache_file = self._get_cache_file(context)
+
+        os.makedirs(self._cache_dir, exist_ok=True)
+        with open(cache_file, 'wb') as f:
+            f.write(b'not a program binary')
+
+        program = self._kernel_cache.get_program(context, _kernel_source)
+        self.assertEqual(program.get_info(cl.program_info.KERNEL_NAMES), 'double_values')
+
+        with open(cache_file, 'rb') as f:
+            self.assertNotEqual(f.read(), b'not a program binary')
+
+    def test_eviction(self):
+        kernel_cache = KernelCache(self._cache_dir, max_size=1)
+
+        now = time.time()
+        for ind in range(3):
+            fname = os.path.join(self._cache_dir, 'kernel_{}.bin'.format(ind))
+            with open(fname, 'wb') as f:
+                f.write(b'0' * 400 * 1024)
+            os.utime(fname, (now - 100 + ind, now - 100 + ind))
+
+        kernel_cache._evict()
+
+        self.assertEqual(sorted(os.listdir(self._cache_dir)), ['kernel_1.bin', 'kernel_2.bin'])
+
+    def test_clear(self):
+        with open(os.path.join(self._cache_dir, 'kernel.bin'), 'wb') as f:
+            f.write(b'0')
+        self._kernel_cache.clear()
+        self.assertEqual(os.listdir(self._cache_dir), [])
+
+    def _get_cache_file(self, context):
+        return os.path.join(self._cache_dir, self._kernel_cache.get_key(context, _kernel_source) + '.bin')
+
+
+if __name__ == '__main__':
+    unittest.main()
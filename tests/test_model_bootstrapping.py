@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_model_bootstrapping
+----------------------------------
+
+Tests for the generation of the bootstrap replicates, :mod:`mdt.lib.processing.model_bootstrapping`.
+"""
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from pkg_resources import resource_filename
+import mdt
+from mdt.lib.processing.model_bootstrapping import ResidualBootstrappingProcessor, WildBootstrappingProcessor
+from mdt.simulations import create_phantom
+
+
+class ResidualBootstrapTest(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self._processor = ResidualBootstrappingProcessor.__new__(ResidualBootstrappingProcessor)
+
+    def _get_replicates(self, nmr_voxels, nmr_observations, nmr_replicates):
+        estimates = np.random.rand(nmr_voxels, nmr_observations)
+        errors = (np.arange(nmr_voxels)[:, None] * 1000 + np.arange(nmr_observations)[None, :]).astype(np.float64)
+        y_star = self._processor._get_bootstrap_observations(estimates, errors, nmr_replicates)
+        return estimates, y_star
+
+    def test_residuals_are_resampled_within_each_voxel(self):
+        estimates, y_star = self._get_replicates(5, 20, 50)
+        resampled_errors = np.round(y_star - estimates[None]).astype(int)
+
+        self.assertEqual(y_star.shape, (50, 5, 20))
+        voxel_indices = np.broadcast_to(np.arange(5)[None, :, None], y_star.shape)
+        np.testing.assert_array_equal(resampled_errors // 1000, voxel_indices)
+
+        observation_indices = resampled_errors % 1000
+        self.assertTrue(np.all((observation_indices >= 0) & (observation_indices < 20)))
+        for voxel_ind in range(5):
+            self.assertEqual(len(np.unique(observation_indices[:, voxel_ind])), 20)
+
+    def test_fewer_voxels_than_observations(self):
+        estimates, y_star = self._get_replicates(1, 30, 3)
+        np.testing.assert_array_equal(np.round(y_star - estimates[None]).astype(int) // 1000, 0)
+
+    def test_replicates_differ(self):
+        _, y_star = self._get_replicates(3, 30, 2)
+        self.assertFalse(np.array_equal(y_star[0], y_star[1]))
+
+
+class WildBootstrapTest(unittest.TestCase):
+
+    def test_residuals_are_scaled_per_observation(self):
+        processor = WildBootstrappingProcessor.__new__(WildBootstrappingProcessor)
+        processor._random_variable_method = lambda shape: np.full(shape, -1.)
+
+        estimates = np.random.rand(4, 10)
+        errors = np.random.rand(4, 10)
+        y_star = processor._get_bootstrap_observations(estimates, errors, 3)
+
+        self.assertEqual(y_star.shape, (3, 4, 10))
+        np.testing.assert_allclose(y_star, (estimates - errors)[None].repeat(3, axis=0))
+
+
+class DeviceBootstrapTest(unittest.TestCase):
+
+    def setUp(self):
+        self._estimates = np.random.RandomState(0).rand(5, 20)
+        self._errors = (np.arange(5)[:, None] * 1000 + np.arange(20)[None, :]).astype(np.float64)
+        self._roi_indices = np.arange(10, 15)
+
+    def _get_processor(self, processor_class, seed=0, **kwargs):
+        processor = processor_class.__new__(processor_class)
+        processor._use_device_rng = True
+        processor._seed = seed
+        for key, value in kwargs.items():
+            setattr(processor, key, value)
+        return processor
+
+    def _get_replicates(self, processor, sample_start, sample_end, roi_slice=slice(None)):
+        observations = processor._get_device_bootstrap_observations(
+            self._estimates[roi_slice], self._errors[roi_slice], self._roi_indices[roi_slice], sample_start, sample_end)
+        return observations.get_data().reshape((sample_end - sample_start, -1, 20))
+
+    def test_residuals_are_resampled_within_each_voxel(self):
+        y_star = self._get_replicates(self._get_processor(ResidualBootstrappingProcessor), 0, 50)
+        resampled_errors = np.round(y_star - self._estimates[None]).astype(int)
+
+        self.assertEqual(y_star.shape, (50, 5, 20))
+        np.testing.assert_array_equal(resampled_errors // 1000,
+                                      np.broadcast_to(np.arange(5)[None, :, None], y_star.shape))
+        for voxel_ind in range(5):
+            self.assertEqual(len(np.unique(resampled_errors[:, voxel_ind] % 1000)), 20)
+        self.assertFalse(np.array_equal(y_star[0], y_star[1]))
+
+    def test_wild_random_variables(self):
+        processor = self._get_processor(WildBootstrappingProcessor, _random_variable_name='simple')
+        random_variables = (self._get_replicates(processor, 0, 50) - self._estimates[None])[:, :, 1:] \
+            / self._errors[None, :, 1:]
+        np.testing.assert_allclose(np.abs(random_variables), 1, rtol=1e-5)
+
+        processor = self._get_processor(WildBootstrappingProcessor, _random_variable_name='normal')
+        random_variables = (self._get_replicates(processor, 0, 200) - self._estimates[None])[:, :, 1:] \
+            / self._errors[None, :, 1:]
+        self.assertAlmostEqual(np.mean(random_variables), 0, delta=0.05)
+        self.assertAlmostEqual(np.std(random_variables), 1, delta=0.05)
+
+    def test_reproducible(self):
+        processor = self._get_processor(ResidualBootstrappingProcessor)
+        np.testing.assert_array_equal(self._get_replicates(processor, 0, 10), self._get_replicates(processor, 0, 10))
+        self.assertFalse(np.array_equal(
+            self._get_replicates(processor, 0, 10),
+            self._get_replicates(self._get_processor(ResidualBootstrappingProcessor, seed=1), 0, 10)))
+
+    def test_independent_of_the_batches_and_chunks(self):
+        processor = self._get_processor(ResidualBootstrappingProcessor)
+        y_star = self._get_replicates(processor, 0, 10)
+
+        np.testing.assert_array_equal(self._get_replicates(processor, 4, 10), y_star[4:])
+        np.testing.assert_array_equal(self._get_replicates(processor, 0, 10, slice(2, 4)), y_star[:, 2:4])
+
+        observations = processor._get_device_bootstrap_observations(
+            self._estimates, self._errors, self._roi_indices, 0, 10)
+        np.testing.assert_array_equal(observations.get_subset(batch_range=(7, 23)).get_data(),
+                                      y_star.reshape((-1, 20))[7:23])
+
+
+class DeviceBootstrapOptimizationTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_model_bootstrapping_test')
+        protocol = mdt.load_protocol(resource_filename('mdt', 'data/mdt_example_data/b1k_b2k/b1k_b2k.prtcl'))
+        self._input_data = create_phantom('S0', protocol, 10, seed=0)[0]
+        self._optimization_results = mdt.fit_model('S0', self._input_data, self._tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _bootstrap(self, seed):
+        return mdt.bootstrap_model('S0', self._input_data, self._optimization_results, self._tmp_dir,
+                                   bootstrap_method='residual', nmr_samples=20, optimization_method='Nelder-Mead',
+                                   bootstrap_options={'use_device_rng': True, 'seed': seed},
+                                   recalculate=True, tmp_results_dir=None)['S0.s0']
+
+    def test_replicates_are_optimized(self):
+        samples = np.array(self._bootstrap(0))
+        s0 = np.squeeze(mdt.create_roi(self._optimization_results['S0.s0'], self._input_data.mask))
+
+        self.assertEqual(samples.shape, (10, 20))
+        self.assertTrue(np.all(np.std(samples, axis=1) > 0))
+        np.testing.assert_allclose(np.mean(samples, axis=1), s0, rtol=1e-2)
+
+        np.testing.assert_array_equal(samples, self._bootstrap(0))
+        self.assertFalse(np.array_equal(samples, self._bootstrap(1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
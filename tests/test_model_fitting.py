@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_model_fitting
+----------------------------------
+
+Tests for the fitting of composite models, :mod:`mdt.lib.processing.model_fitting`.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from pkg_resources import resource_filename
+import mdt
+from mdt.lib.processing.model_fitting import get_batch_fitting_function
+from mdt.lib.processing.processing_strategies import VoxelRange
+from mdt.lib.results_manifest import MANIFEST_FILENAME, VOXEL_CHECKSUMS_FILENAME
+from mdt.simulations import create_phantom
+
+
+class _NotCombiningVoxelRange(VoxelRange):
+    """Processes all voxels but returns no results, like a distributed process which left the combining to another."""
+
+    def process(self, processor):
+        super().process(processor)
+        return None
+
+
+class NotCombiningProcessTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_model_fitting_test')
+        protocol = mdt.load_protocol(resource_filename('mdt', 'data/mdt_example_data/b1k_b2k/b1k_b2k.prtcl'))
+        self._input_data = create_phantom('S0', protocol, 10, seed=0)[0]
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_results_are_loaded_from_the_output(self):
+        with mock.patch('mdt.lib.processing.model_fitting.get_processing_strategy',
+                        return_value=_NotCombiningVoxelRange()):
+            results = mdt.fit_model('S0', self._input_data, self._tmp_dir)
+
+        output_path = os.path.join(self._tmp_dir, 'S0')
+        s0 = np.squeeze(mdt.create_roi(results['S0.s0'], self._input_data.mask))
+        s0_nifti = mdt.create_roi(mdt.load_nifti(os.path.join(output_path, 'S0.s0')).get_data(), self._input_data.mask)
+        self.assertEqual(s0.shape, (10,))
+        np.testing.assert_array_equal(s0, np.squeeze(s0_nifti))
+
+        self.assertFalse(os.path.exists(os.path.join(output_path, MANIFEST_FILENAME)))
+        self.assertFalse(os.path.exists(os.path.join(output_path, VOXEL_CHECKSUMS_FILENAME)))
+
+
+class BatchFitOutputExistsTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_model_fitting_test')
+        protocol = mdt.load_protocol(resource_filename('mdt', 'data/mdt_example_data/b1k_b2k/b1k_b2k.prtcl'))
+        mdt.fit_model('S0', create_phantom('S0', protocol, 10, seed=0)[0], os.path.join(self._tmp_dir, 'subject'))
+        self._subject_info = mock.Mock(subject_id='subject')
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_output_with_a_manifest_is_skipped(self):
+        self.assertTrue(os.path.exists(os.path.join(self._tmp_dir, 'subject', 'S0', MANIFEST_FILENAME)))
+
+        fit_func = get_batch_fitting_function(1, ['S0'], self._tmp_dir)
+        self.assertTrue(fit_func.output_exists(self._subject_info))
+        self.assertIsNone(fit_func.load_input_data(self._subject_info))
+        self._subject_info.get_input_data.assert_not_called()
+
+        fit_func = get_batch_fitting_function(1, ['S0'], self._tmp_dir, recalculate=True)
+        self.assertFalse(fit_func.output_exists(self._subject_info))
+
+    def test_output_of_another_routine_is_not_skipped(self):
+        fit_func = get_batch_fitting_function(1, ['S0'], self._tmp_dir)
+        with mock.patch('mdt.lib.processing.model_fitting.get_optimizer_for_model',
+                        return_value=('Nelder-Mead', {'patience': 2})):
+            self.assertFalse(fit_func.output_exists(self._subject_info))
+
+        fit_func = get_batch_fitting_function(1, ['S0'], self._tmp_dir, double_precision=True)
+        self.assertFalse(fit_func.output_exists(self._subject_info))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_model_sampling
+----------------------------------
+
+Tests for the resuming of interrupted sampling runs from a checkpoint, :mod:`mdt.lib.processing.model_sampling`.
+"""
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from pkg_resources import resource_filename
+import mdt
+from mdt.simulations import create_phantom
+from mdt.lib.processing.model_sampling import AdaptiveMetropolisWithinGibbs
+
+
+class _Interrupted(Exception):
+    pass
+
+
+class SamplingCheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_model_sampling_test')
+        protocol = mdt.load_protocol(resource_filename('mdt', 'data/mdt_example_data/b1k_b2k/b1k_b2k.prtcl'))
+        self._input_data = create_phantom('BallStick_r1', protocol, 10, seed=0)[0]
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _sample(self, name, seed, recalculate=True):
+        np.random.seed(seed)
+        mdt.sample_model('BallStick_r1', self._input_data, os.path.join(self._tmp_dir, name),
+                         nmr_samples=40, burnin=5, thinning=1, method='AMWG', recalculate=recalculate,
+                         double_precision=True, checkpoint_interval=10,
+                         tmp_results_dir=os.path.join(self._tmp_dir, name + '_tmp'))
+        return mdt.load_samples(os.path.join(self._tmp_dir, name, 'BallStick_r1', 'samples'))
+
+    def _interrupt_after_two_blocks(self, name):
+        """Sample until the third block of the chain, such that the checkpoint holds the state after 20 samples."""
+        original_sample = AdaptiveMetropolisWithinGibbs.sample
+        nmr_blocks = [0]
+
+        def interrupted_sample(sampler, *args, **kwargs):
+            nmr_blocks[0] += 1
+            if nmr_blocks[0] > 2:
+                raise _Interrupted()
+            return original_sample(sampler, *args, **kwargs)
+
+        with mock.patch.object(AdaptiveMetropolisWithinGibbs, 'sample', interrupted_sample):
+            with self.assertRaises(_Interrupted):
+                self._sample(name, 0)
+
+        checkpoint_paths = glob.glob(os.path.join(self._tmp_dir, name + '_tmp', '*', 'processing_tmp',
+                                                  'sampling_checkpoint.npz'))
+        self.assertEqual(len(checkpoint_paths), 1)
+        with np.load(checkpoint_paths[0]) as checkpoint:
+            self.assertEqual(checkpoint['settings'][0], 20)
+
+    def _resume(self, name):
+        """Continue the sampling, returning the samples and the number of sampled blocks."""
+        with mock.patch.object(AdaptiveMetropolisWithinGibbs, 'sample', autospec=True,
+                               side_effect=AdaptiveMetropolisWithinGibbs.sample) as sample:
+            samples = self._sample(name, 1, recalculate=False)
+        return samples, sample.call_count
+
+    def test_resumed_chain_is_identical(self):
+        uninterrupted = self._sample('uninterrupted', 0)
+
+        self._interrupt_after_two_blocks('resumed')
+        resumed, nmr_blocks = self._resume('resumed')
+
+        self.assertEqual(nmr_blocks, 2)
+        self.assertEqual(sorted(resumed), sorted(uninterrupted))
+        for name in uninterrupted:
+            np.testing.assert_array_equal(resumed[name], uninterrupted[name], err_msg=name)
+
+    def test_other_mot_version_restarts(self):
+        self._interrupt_after_two_blocks('resumed')
+
+        with mock.patch('mot.__version__', '0.0.0'):
+            nmr_blocks = self._resume('resumed')[1]
+        self.assertEqual(nmr_blocks, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
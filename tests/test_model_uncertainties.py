@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_model_uncertainties
+----------------------------------
+
+Tests for the uncertainties computed in the optimization post-processing of the composite models,
+:mod:`mdt.models.composite`.
+"""
+import unittest
+from unittest import mock
+import numpy as np
+from pkg_resources import resource_filename
+import mdt
+from mdt.lib.input_data import ROIMRIInputData
+from mdt.models import composite
+from mdt.simulations import create_phantom, simulate_signals
+
+
+class GaussianBallStick(mdt.get_template('composite_models', 'BallStick_r1')):
+    likelihood_function = 'Gaussian'
+
+
+class JacobianUncertaintiesTest(unittest.TestCase):
+
+    def setUp(self):
+        protocol = mdt.load_protocol(resource_filename('mdt', 'data/mdt_example_data/b1k_b2k/b1k_b2k.prtcl'))
+        self._parameters = create_phantom('BallStick_r1', protocol, 10, seed=0)[1]
+
+        # without noise the residuals are zero and the Hessian equals the Jacobian FIM J^T J / sigma^2
+        signals = simulate_signals('BallStick_r1', protocol, self._parameters)
+        self._input_data = ROIMRIInputData(protocol, signals, np.ones((10, 1, 1), dtype=bool), None, noise_std=100)
+
+    def _get_output(self, method, **settings):
+        model = GaussianBallStick()()
+        settings.update({'uncertainties': True, 'uncertainties_method': method, 'll_and_ic': False})
+        model.update_active_post_processing('optimization', settings)
+        model.set_input_data(self._input_data, suppress_warnings=True)
+
+        parameters = np.column_stack([self._parameters[name] for name in model.get_free_param_names()])
+        return model, model.get_post_optimization_output(parameters, roi_indices=np.arange(10))
+
+    def test_jacobian_equals_hessian(self):
+        model, jacobian_output = self._get_output('jacobian')
+
+        with mock.patch('mdt.models.composite.estimate_hessian', wraps=composite.estimate_hessian) as hessian:
+            hessian_output = self._get_output('hessian', uncertainties_nmr_steps=1)[1]
+        self.assertEqual(hessian.call_args[1]['nmr_steps'], 1)
+
+        for name in model.get_covariance_output_names():
+            if name.endswith('.std'):
+                np.testing.assert_allclose(jacobian_output[name], hessian_output[name], rtol=1e-2, err_msg=name)
+                self.assertTrue(np.all(jacobian_output[name] > 0), msg=name)
+
+    def test_packed_covariances(self):
+        model, maps_output = self._get_output('jacobian', covariances_storage='maps')
+        packed = self._get_output('jacobian', covariances_storage='packed')[1]['covariances']
+
+        self.assertEqual(list(packed), ['UpperTriangular'])
+        packed = packed['UpperTriangular']
+
+        names = model.get_covariance_output_names()
+        self.assertEqual(packed.shape, (10, len(names)))
+        self.assertEqual(packed.dtype, np.float32)
+
+        for ind, name in enumerate(names):
+            if name.endswith('.std'):
+                np.testing.assert_allclose(np.sqrt(packed[:, ind]), maps_output[name], rtol=1e-5, err_msg=name)
+            else:
+                np.testing.assert_allclose(packed[:, ind], maps_output['covariances'][name], rtol=1e-5,
+                                           atol=1e-6 * np.max(np.abs(maps_output['covariances'][name])),
+                                           err_msg=name)
+
+
+if __name__ == '__main__':
+    unittest.main()
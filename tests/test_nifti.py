@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_nifti
+----------------------------------
+
+Tests for writing the nifti volumes, :mod:`mdt.lib.nifti`.
+"""
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from mdt.lib.nifti import write_nifti, load_nifti, _ParallelGzipFile
+
+
+class WriteNiftiTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_nifti_test')
+        self._data = np.random.rand(20, 30, 40, 5).astype(np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_write_gzipped(self):
+        for nmr_threads in [1, 3]:
+            fname = os.path.join(self._tmp_dir, 'volume_{}.nii.gz'.format(nmr_threads))
+            write_nifti(self._data, fname, nmr_compression_threads=nmr_threads)
+            np.testing.assert_array_equal(load_nifti(fname).get_fdata(), self._data)
+
+    def test_write_uncompressed(self):
+        fname = os.path.join(self._tmp_dir, 'volume.nii')
+        write_nifti(self._data, fname)
+        np.testing.assert_array_equal(load_nifti(fname).get_fdata(), self._data)
+
+    def test_same_content_for_all_threads(self):
+        contents = []
+        for nmr_threads in [1, 3]:
+            fname = os.path.join(self._tmp_dir, 'volume_{}.nii.gz'.format(nmr_threads))
+            write_nifti(self._data, fname, nmr_compression_threads=nmr_threads)
+            with gzip.open(fname, 'rb') as f:
+                contents.append(f.read())
+        self.assertEqual(contents[0], contents[1])
+
+
+class ParallelGzipFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_nifti_test')
+        self._fname = os.path.join(self._tmp_dir, 'data.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_blocks(self):
+        writes = [os.urandom(size) for size in [3, 10, 25, 7, 0, 64, 1]]
+
+        with _ParallelGzipFile(self._fname, nmr_threads=2, block_size=8) as f:
+            for data in writes:
+                self.assertEqual(f.write(data), len(data))
+            self.assertEqual(f.tell(), sum(map(len, writes)))
+
+        with gzip.open(self._fname, 'rb') as f:
+            self.assertEqual(f.read(), b''.join(writes))
+
+    def test_empty(self):
+        with _ParallelGzipFile(self._fname, nmr_threads=2):
+            pass
+
+        with gzip.open(self._fname, 'rb') as f:
+            self.assertEqual(f.read(), b'')
+
+    def test_seek(self):
+        with _ParallelGzipFile(self._fname, nmr_threads=2) as f:
+            f.write(b'abc')
+            f.seek(3)
+            self.assertRaises(IOError, f.seek, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
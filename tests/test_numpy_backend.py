@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_numpy_backend
+----------------------------------
+
+Tests the NumPy model evaluation, :mod:`mdt.lib.numpy_backend`, against the OpenCL model evaluation.
+"""
+import unittest
+import numpy as np
+from pkg_resources import resource_filename
+import mot.configuration
+import mdt
+from mdt.lib.input_data import ROIMRIInputData
+from mdt.lib.numpy_backend import get_numpy_backend_problems
+from mdt.simulations import simulate_signals
+
+
+class NumpyModelEvaluatorTest(unittest.TestCase):
+
+    model_names = ['S0', 'BallStick_r1', 'Tensor']
+
+    def setUp(self):
+        self._protocol = mdt.load_protocol(resource_filename('mdt', 'data/mdt_example_data/b1k_b2k/b1k_b2k.prtcl'))
+        self._random_state = np.random.RandomState(0)
+
+    def _get_model(self, model_name, nmr_voxels=20):
+        """Get a model with random observations and random parameters within the bounds of the model."""
+        model = mdt.get_model(model_name)()
+        observations = self._random_state.normal(1000, 100, size=(nmr_voxels, self._protocol.length))
+        model.set_input_data(ROIMRIInputData(self._protocol, observations, np.ones((nmr_voxels, 1, 1), dtype=bool),
+                                             None, noise_std=100), suppress_warnings=True)
+
+        parameters = self._random_state.normal(model.get_initial_parameters(), 2 * model.get_rwm_proposal_stds())
+        parameters = model.get_mle_codec().encode_decode(parameters, kernel_data=model.get_kernel_data())
+        return model, parameters
+
+    def test_supported(self):
+        for model_name in self.model_names:
+            model = self._get_model(model_name)[0]
+            self.assertEqual(get_numpy_backend_problems(model), [])
+
+    def test_signals(self):
+        for model_name in self.model_names:
+            with self.subTest(model_name=model_name):
+                parameters = self._get_model(model_name)[1]
+
+                with _double_precision():
+                    opencl_signals = simulate_signals(model_name, self._protocol, parameters, backend='opencl')
+                numpy_signals = simulate_signals(model_name, self._protocol, parameters, backend='numpy')
+
+                np.testing.assert_allclose(numpy_signals, opencl_signals, rtol=1e-5,
+                                           atol=1e-5 * np.max(np.abs(opencl_signals)))
+
+
+def _double_precision():
+    return mot.configuration.config_context(mot.configuration.RuntimeConfigurationAction(double_precision=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_processing_strategies
+----------------------------------
+
+Tests for the helper functionality of the processing strategies, :mod:`mdt.lib.processing.processing_strategies`.
+"""
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import unittest
+import uuid
+from unittest import mock
+import numpy as np
+from mdt.lib.components import get_model
+from mdt.lib.processing.processing_strategies import _dump_with_file_references, _load_with_file_references, \
+    _get_contiguous_slice, _FileLease, AdaptiveVoxelRange, DistributedVoxelRange, ModelProcessor
+
+
+class _FakeClock:
+
+    def __init__(self):
+        self.time = 0
+
+    def __call__(self):
+        return self.time
+
+
+class _RecordingProcessor(ModelProcessor):
+
+    def __init__(self, nmr_voxels, clock, seconds_per_voxel):
+        self._nmr_voxels = nmr_voxels
+        self._clock = clock
+        self._seconds_per_voxel = seconds_per_voxel
+        self.calls = []
+
+    def process(self, roi_indices, next_indices=None):
+        self.calls.append((roi_indices, next_indices))
+        self._clock.time += len(roi_indices) * self._seconds_per_voxel
+
+    def get_voxels_to_compute(self):
+        return np.arange(self._nmr_voxels)
+
+    def get_total_nmr_voxels(self):
+        return self._nmr_voxels
+
+    def get_memory_per_voxel(self):
+        return None
+
+
+class _ShardProcessor(ModelProcessor):
+
+    def __init__(self, nmr_voxels, tmp_dir, log_dir):
+        """Writes the processed voxels to its shards and records every processed batch and combine in the log dir."""
+        self._nmr_voxels = nmr_voxels
+        self._tmp_dir = tmp_dir
+        self._log_dir = log_dir
+        self._shard_dir = None
+
+    def process(self, roi_indices, next_indices=None):
+        os.makedirs(self._shard_dir)
+        np.save(os.path.join(self._shard_dir, 'voxels.npy'), roi_indices)
+        np.save(os.path.join(self._log_dir, 'processed_{}.npy'.format(uuid.uuid4().hex)), roi_indices)
+        time.sleep(0.01)
+
+    def get_voxels_to_compute(self):
+        return np.arange(self._nmr_voxels)
+
+    def get_total_nmr_voxels(self):
+        return self._nmr_voxels
+
+    def get_processing_tmp_dir(self):
+        return self._tmp_dir
+
+    def set_tmp_storage_shard(self, shard_dir=None):
+        self._shard_dir = shard_dir
+
+    def merge_tmp_storage_shards(self, shard_dirs):
+        voxels = [np.load(os.path.join(shard_dir, 'voxels.npy')) for shard_dir in shard_dirs]
+        np.save(os.path.join(self._log_dir, 'combined_{}.npy'.format(uuid.uuid4().hex)), np.concatenate(voxels))
+
+    def combine(self):
+        return {'nmr_voxels': self._nmr_voxels}
+
+    def finalize(self):
+        shutil.rmtree(self._tmp_dir)
+
+
+def _process_distributed(nmr_voxels, tmp_dir, log_dir, results_queue):
+    strategy = DistributedVoxelRange(max_nmr_voxels=10, lease_time=60, poll_interval=0.01)
+    results_queue.put(strategy.process(_ShardProcessor(nmr_voxels, tmp_dir, log_dir)))
+
+
+class DistributedVoxelRangeTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_processing_strategies_test')
+        self._log_dir = os.path.join(self._tmp_dir, 'log')
+        os.makedirs(self._log_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _get_logged(self, prefix):
+        return [np.load(os.path.join(self._log_dir, name)) for name in sorted(os.listdir(self._log_dir))
+                if name.startswith(prefix)]
+
+    def test_multiple_processes(self):
+        context = multiprocessing.get_context('fork')
+        results_queue = context.Queue()
+        processes = [context.Process(target=_process_distributed,
+                                     args=(200, os.path.join(self._tmp_dir, 'processing'), self._log_dir,
+                                           results_queue))
+                     for _ in range(3)]
+        for process in processes:
+            process.start()
+        results = [results_queue.get(timeout=60) for _ in processes]
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+
+        processed = self._get_logged('processed_')
+        self.assertEqual(len(processed), 20)
+        np.testing.assert_array_equal(np.sort(np.concatenate(processed)), np.arange(200))
+
+        combined = self._get_logged('combined_')
+        self.assertEqual(len(combined), 1)
+        np.testing.assert_array_equal(combined[0], np.arange(200))
+
+        self.assertEqual(results.count(None), 2)
+        self.assertIn({'nmr_voxels': 200}, results)
+        self.assertFalse(os.path.exists(os.path.join(self._tmp_dir, 'processing')))
+
+
+class AdaptiveVoxelRangeTest(unittest.TestCase):
+
+    def test_next_indices_are_the_next_batch(self):
+        clock = _FakeClock()
+        processor = _RecordingProcessor(1000, clock, 0.1)
+        strategy = AdaptiveVoxelRange(max_nmr_voxels=400, min_nmr_voxels=10, target_batch_time=5)
+
+        with mock.patch('timeit.default_timer', clock):
+            strategy._process_chunk(processor, strategy._get_chunks(processor.get_voxels_to_compute()))
+
+        batch_sizes = [len(roi_indices) for roi_indices, _ in processor.calls]
+        self.assertEqual(batch_sizes[:3], [400, 400, 50])
+        np.testing.assert_array_equal(np.concatenate([c[0] for c in processor.calls]), np.arange(1000))
+
+        for (_, next_indices), (roi_indices, _) in zip(processor.calls[:-1], processor.calls[1:]):
+            np.testing.assert_array_equal(next_indices, roi_indices)
+        self.assertIsNone(processor.calls[-1][1])
+
+
+class FileReferencePicklingTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_processing_strategies_test')
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_large_arrays_are_stored_as_files(self):
+        large = np.random.rand(100, 50)
+        small = np.arange(10)
+
+        data = _dump_with_file_references({'large': large, 'small': small, 'again': large}, self._tmp_dir,
+                                          min_nbytes=1000)
+
+        self.assertLess(len(data), large.nbytes)
+        self.assertEqual(os.listdir(self._tmp_dir), ['0.npy'])
+
+        loaded = _load_with_file_references(data)
+        self.assertIsInstance(loaded['large'], np.memmap)
+        np.testing.assert_array_equal(loaded['large'], large)
+        np.testing.assert_array_equal(loaded['again'], large)
+        np.testing.assert_array_equal(loaded['small'], small)
+
+    def test_loaded_arrays_are_writable_copies(self):
+        large = np.zeros((100, 50))
+        loaded = _load_with_file_references(_dump_with_file_references(large, self._tmp_dir, min_nbytes=1000))
+
+        loaded[0, 0] = 1
+        np.testing.assert_array_equal(np.load(os.path.join(self._tmp_dir, '0.npy')), large)
+
+    def test_object_arrays_are_pickled(self):
+        objects = np.array([{'a': 1}] * 1000, dtype=object)
+        loaded = _load_with_file_references(_dump_with_file_references(objects, self._tmp_dir, min_nbytes=10))
+
+        self.assertEqual(os.listdir(self._tmp_dir), [])
+        self.assertEqual(loaded[0], {'a': 1})
+
+
+class CompositeModelPicklingTest(unittest.TestCase):
+
+    def test_replays_the_last_modifications(self):
+        model = get_model('BallStick_r1')()
+        nmr_initial_calls = len(model._recorded_calls)
+
+        for value in range(10):
+            model.init('Stick0.theta', np.full(100, value, dtype=np.float64))
+        model.fix('Ball.d', 1e-9)
+        model.unfix('Ball.d')
+        model.init('Ball.d', 2e-9)
+        model.set_lower_bound('Stick0.d', 1e-10)
+
+        self.assertLessEqual(len(model._recorded_calls), nmr_initial_calls + 4)
+
+        loaded = pickle.loads(pickle.dumps(model))
+        functions_info = loaded._model_functions_info
+
+        np.testing.assert_array_equal(functions_info.get_parameter_value('Stick0.theta'), np.full(100, 9))
+        self.assertFalse(functions_info.is_fixed('Ball.d'))
+        self.assertEqual(functions_info.get_parameter_value('Ball.d'), 2e-9)
+        self.assertEqual(loaded._lower_bounds['Stick0.d'], 1e-10)
+
+
+class FileLeaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_processing_strategies_test')
+        self._path = os.path.join(self._tmp_dir, 'chunk.lock')
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_exclusive(self):
+        lease = _FileLease(self._path, 60)
+        other = _FileLease(self._path, 60)
+
+        self.assertTrue(lease.acquire())
+        self.assertFalse(other.acquire())
+        with open(self._path, 'r') as f:
+            self.assertEqual(f.read(), lease.owner)
+
+        lease.release()
+        self.assertFalse(os.path.exists(self._path))
+        self.assertTrue(other.acquire())
+        other.release()
+
+    def test_take_over_abandoned(self):
+        abandoned = _FileLease(self._path, 60)
+        self.assertTrue(abandoned._create_lock_file())
+        os.utime(self._path, (time.time() - 120, time.time() - 120))
+
+        lease = _FileLease(self._path, 60)
+        self.assertTrue(lease.acquire())
+        with open(self._path, 'r') as f:
+            self.assertEqual(f.read(), lease.owner)
+        lease.release()
+        self.assertEqual(os.listdir(self._tmp_dir), [])
+
+    def test_take_over_between_stat_and_rename(self):
+        abandoned = _FileLease(self._path, 60)
+        self.assertTrue(abandoned._create_lock_file())
+        os.utime(self._path, (time.time() - 120, time.time() - 120))
+
+        other = _FileLease(self._path, 60)
+        stat = os.stat
+        taken_over = []
+
+        def stat_and_take_over(path, *args, **kwargs):
+            """Let the other lease take over the abandoned lock file right after we found it expired."""
+            result = stat(path, *args, **kwargs)
+            if not taken_over:
+                taken_over.append(True)
+                os.remove(self._path)
+                self.assertTrue(other._create_lock_file())
+            return result
+
+        lease = _FileLease(self._path, 60)
+        with mock.patch('os.stat', side_effect=stat_and_take_over):
+            self.assertFalse(lease.acquire())
+
+        with open(self._path, 'r') as f:
+            self.assertEqual(f.read(), other.owner)
+        self.assertEqual(os.listdir(self._tmp_dir), ['chunk.lock'])
+
+    def test_keep_alive(self):
+        lease = _FileLease(self._path, 0.2)
+        self.assertTrue(lease.acquire())
+        os.utime(self._path, (time.time() - 120, time.time() - 120))
+        time.sleep(0.3)
+
+        self.assertFalse(_FileLease(self._path, 0.2).acquire())
+        lease.release()
+
+
+class ContiguousSliceTest(unittest.TestCase):
+
+    def test_slices(self):
+        self.assertEqual(_get_contiguous_slice(np.arange(3, 10)), slice(3, 10))
+        self.assertEqual(_get_contiguous_slice([5]), slice(5, 6))
+        self.assertIsNone(_get_contiguous_slice([]))
+        self.assertIsNone(_get_contiguous_slice([1, 3, 2, 4]))
+        self.assertIsNone(_get_contiguous_slice([4, 3]))
+        self.assertIsNone(_get_contiguous_slice([0, 2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_results_container
+----------------------------------
+
+Tests for the single file results container, :mod:`mdt.lib.results_container`.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import nibabel as nib
+import numpy as np
+from mdt.lib.results_container import ResultsContainer, ResultsContainerWriter, find_results_container, \
+    CONTAINER_FILENAME
+
+
+class ResultsContainerTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_results_container_test')
+        self._filename = os.path.join(self._tmp_dir, CONTAINER_FILENAME)
+        self._mask = np.random.rand(5, 6, 7) > 0.5
+        self._nmr_voxels = int(np.count_nonzero(self._mask))
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_write_and_read(self):
+        roi = np.random.rand(self._nmr_voxels, 3)
+        volume = np.random.rand(5, 6, 7)
+        header = nib.Nifti1Header()
+
+        with ResultsContainerWriter(self._filename, self._mask, nifti_header=header, chunk_size=7) as writer:
+            writer.write_roi('a', roi)
+            writer.write_volume('covariances/b', volume)
+            writer.write_roi('a', roi[:, 0], group='samples')
+
+        container = ResultsContainer(self._filename)
+        try:
+            self.assertEqual(container.get_names(), ['a'])
+            self.assertEqual(container.get_names(prefix='covariances/'), ['b'])
+            self.assertEqual(container.get_prefixes(), ['covariances/'])
+            self.assertIsInstance(container.nifti_header, nib.Nifti1Header)
+
+            np.testing.assert_array_equal(container.get_roi('a'), roi)
+            np.testing.assert_array_equal(container.get_roi('a', roi_indices=[9, 2, 3]), roi[[9, 2, 3]])
+            np.testing.assert_array_equal(container.get_roi('a', group='samples'), roi[:, 0])
+            np.testing.assert_array_equal(container.get_volume('covariances/b'), volume * self._mask)
+        finally:
+            container.close()
+
+    def test_overwrite(self):
+        with ResultsContainerWriter(self._filename, self._mask, chunk_size=7) as writer:
+            writer.write_roi('a', np.zeros(self._nmr_voxels))
+            writer.write_roi('b', np.ones(self._nmr_voxels))
+
+        with ResultsContainerWriter(self._filename, self._mask, chunk_size=3) as writer:
+            writer.write_roi('a', np.full(self._nmr_voxels, 2.))
+            writer.write_roi('c', np.full(self._nmr_voxels, 3.))
+
+        self.assertEqual(os.listdir(self._tmp_dir), [CONTAINER_FILENAME])
+
+        container = ResultsContainer(self._filename)
+        try:
+            self.assertEqual(container.get_names(), ['a', 'b', 'c'])
+            np.testing.assert_array_equal(container.get_roi('a'), 2)
+            np.testing.assert_array_equal(container.get_roi('b'), 1)
+            np.testing.assert_array_equal(container.get_roi('c'), 3)
+        finally:
+            container.close()
+
+    def test_failed_write_keeps_the_container(self):
+        with ResultsContainerWriter(self._filename, self._mask) as writer:
+            writer.write_roi('a', np.zeros(self._nmr_voxels))
+
+        with self.assertRaises(ValueError):
+            with ResultsContainerWriter(self._filename, self._mask) as writer:
+                writer.write_roi('b', np.zeros(self._nmr_voxels + 1))
+
+        self.assertEqual(os.listdir(self._tmp_dir), [CONTAINER_FILENAME])
+        container = ResultsContainer(self._filename)
+        self.assertEqual(container.get_names(), ['a'])
+        container.close()
+
+    def test_different_mask(self):
+        with ResultsContainerWriter(self._filename, self._mask) as writer:
+            writer.write_roi('a', np.zeros(self._nmr_voxels))
+        self.assertRaises(ValueError, ResultsContainerWriter, self._filename, np.logical_not(self._mask))
+
+    def test_find_results_container(self):
+        with ResultsContainerWriter(self._filename, self._mask) as writer:
+            writer.write_roi('a', np.zeros(self._nmr_voxels))
+            writer.write_roi('covariances/b', np.zeros(self._nmr_voxels))
+
+        container, prefix = find_results_container(self._tmp_dir)
+        self.assertEqual(prefix, '')
+        container.close()
+
+        container, prefix = find_results_container(os.path.join(self._tmp_dir, 'covariances'))
+        self.assertEqual(prefix, 'covariances/')
+        container.close()
+
+        self.assertEqual(find_results_container(os.path.join(self._tmp_dir, 'other')), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
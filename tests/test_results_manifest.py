@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_results_manifest
+----------------------------------
+
+Tests for the manifests and the voxel checksums of the results, :mod:`mdt.lib.results_manifest`, and for the reuse of
+the results of unchanged voxels by the model fitting.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import nibabel as nib
+import numpy as np
+from mdt.lib.input_data import MemoryMappedVolume, SimpleMRIInputData
+from mdt.lib.nifti import write_all_as_nifti
+from mdt.lib.processing.model_fitting import _load_previous_results
+from mdt.lib.results_manifest import _create_manifest, _hash_observations, _iterate_observations, _mix_rows, \
+    _FNV_OFFSET, get_changed_items, get_reusable_voxels, load_voxel_checksums, write_manifest, write_voxel_checksums
+from mdt.protocols import Protocol
+from mdt.utils import restore_volumes
+
+
+def _get_manifest(observations='a', protocol='b'):
+    return _create_manifest('optimization', {'observations': observations, 'protocol': protocol})
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_results_manifest_test')
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_changed_items(self):
+        self.assertIsNone(get_changed_items(self._tmp_dir, _get_manifest()))
+
+        write_manifest(self._tmp_dir, _get_manifest())
+        self.assertEqual(get_changed_items(self._tmp_dir, _get_manifest()), [])
+        self.assertEqual(get_changed_items(self._tmp_dir, _get_manifest(observations='c')), ['observations'])
+        self.assertEqual(get_changed_items(self._tmp_dir, _get_manifest(observations='c', protocol='d')),
+                         ['observations', 'protocol'])
+
+    def test_voxel_checksums(self):
+        mask = np.random.rand(4, 5, 6) > 0.5
+        checksums = np.arange(np.count_nonzero(mask), dtype=np.uint64)
+        write_voxel_checksums(self._tmp_dir, mask, checksums)
+
+        loaded_mask, loaded_checksums = load_voxel_checksums(self._tmp_dir)
+        np.testing.assert_array_equal(loaded_mask, mask)
+        np.testing.assert_array_equal(loaded_checksums, checksums)
+        self.assertEqual(os.listdir(self._tmp_dir), ['manifest_voxels.npz'])
+
+
+class ObservationsHashTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_results_manifest_test')
+        self._data = np.random.rand(10, 12, 8, 7).astype(np.float32)
+        self._mask = np.random.rand(10, 12, 8) > 0.3
+        self._fname = os.path.join(self._tmp_dir, 'volume.nii')
+        nib.save(nib.Nifti1Image(self._data, np.eye(4)), self._fname)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_memory_mapped_observations_are_not_loaded(self):
+        memory_mapped = SimpleMRIInputData(Protocol(), MemoryMappedVolume(self._fname), self._mask, None)
+        in_memory = SimpleMRIInputData(Protocol(), self._data, self._mask, None)
+
+        self.assertEqual(_hash_observations(memory_mapped), _hash_observations(in_memory))
+        self.assertIsNone(memory_mapped._observation_list)
+
+    def test_blocks_give_the_voxel_checksums_of_the_whole_array(self):
+        input_data = SimpleMRIInputData(Protocol(), self._data, self._mask, None)
+        whole = _mix_rows(np.full(input_data.nmr_voxels, _FNV_OFFSET, dtype=np.uint64), input_data.observations)
+
+        blocks = np.full(input_data.nmr_voxels, _FNV_OFFSET, dtype=np.uint64)
+        for start, block in _iterate_observations(input_data, voxels_per_block=100):
+            blocks[start:start + len(block)] = _mix_rows(blocks[start:start + len(block)], block)
+
+        np.testing.assert_array_equal(blocks, whole)
+
+
+class ReusableVoxelsTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_results_manifest_test')
+        self._voxel_data = np.arange(1, 6 * 7 * 8 + 1, dtype=np.uint64).reshape((6, 7, 8))
+        self._maps = {'S0': np.random.rand(6, 7, 8), 'w': np.random.rand(6, 7, 8, 2)}
+
+        self._stored_mask = np.zeros((6, 7, 8), dtype=bool)
+        self._stored_mask[1:4, 1:5, 2:6] = True
+        self._store_results(self._stored_mask)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_grown_mask(self):
+        mask = np.zeros_like(self._stored_mask)
+        mask[0:5, 0:6, 1:7] = True
+
+        reused_voxels = self._get_reused_voxels(mask)
+        np.testing.assert_array_equal(reused_voxels, self._stored_mask)
+
+    def test_shrunk_mask(self):
+        mask = np.zeros_like(self._stored_mask)
+        mask[2:4, 1:3, 2:6] = True
+
+        reused_voxels = self._get_reused_voxels(mask)
+        np.testing.assert_array_equal(reused_voxels, mask)
+
+    def test_changed_voxels(self):
+        changed = np.zeros_like(self._stored_mask)
+        changed[2, 2, 3] = changed[3, 4, 5] = True
+        self._voxel_data[changed] += 1000
+
+        reused_voxels = self._get_reused_voxels(self._stored_mask)
+        np.testing.assert_array_equal(reused_voxels, self._stored_mask & ~changed)
+
+    def test_different_incremental_key(self):
+        manifest = _get_manifest()
+        manifest['incremental_key'] = 'other'
+        self.assertIsNone(get_reusable_voxels(self._tmp_dir, manifest, self._stored_mask,
+                                              self._get_checksums(self._stored_mask)))
+
+    def test_no_overlap(self):
+        mask = ~self._stored_mask
+        self.assertIsNone(get_reusable_voxels(self._tmp_dir, _get_manifest(), mask, self._get_checksums(mask)))
+
+    def _store_results(self, mask):
+        write_all_as_nifti(restore_volumes({k: v[mask] for k, v in self._maps.items()}, mask), self._tmp_dir)
+        write_voxel_checksums(self._tmp_dir, mask, self._get_checksums(mask))
+        write_manifest(self._tmp_dir, _get_manifest())
+
+    def _get_checksums(self, mask):
+        return self._voxel_data[mask]
+
+    def _get_reused_voxels(self, mask):
+        """Get the voxels reused for the given mask, after checking that the loaded results are of these voxels."""
+        stored_mask, stored_roi_indices, roi_indices = get_reusable_voxels(
+            self._tmp_dir, _get_manifest(observations='changed'), mask, self._get_checksums(mask))
+        np.testing.assert_array_equal(stored_mask, self._stored_mask)
+
+        previous_results = _load_previous_results(self._tmp_dir, stored_mask, stored_roi_indices)
+        for name, volume in self._maps.items():
+            np.testing.assert_allclose(np.squeeze(previous_results[''][name]),
+                                       volume[mask][roi_indices], rtol=1e-6)
+
+        reused_voxels = np.zeros_like(mask)
+        reused_voxels[tuple(np.argwhere(mask)[roi_indices].T)] = True
+        return reused_voxels
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_sampling_statistics
+----------------------------------
+
+Tests for the streaming summary statistics of MCMC chains, :mod:`mdt.lib.sampling_statistics`.
+"""
+import unittest
+import numpy as np
+from mdt.lib.sampling_statistics import StreamingSampleStatistics
+
+
+class StreamingSampleStatisticsTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self._samples = random_state.randn(5, 3, 400).cumsum(axis=2)
+        self._samples[..., 1::3] = self._samples[..., 0::3][..., :self._samples[..., 1::3].shape[2]]
+        self._log_likelihoods = random_state.randn(5, 400)
+        self._log_priors = random_state.randn(5, 400)
+
+    def _get_statistics(self, block_sizes):
+        statistics = StreamingSampleStatistics(5, 3, self._samples.shape[2])
+        position = 0
+        for block_size in block_sizes:
+            statistics.update(self._samples[..., position:position + block_size],
+                              self._log_likelihoods[:, position:position + block_size],
+                              self._log_priors[:, position:position + block_size])
+            position += block_size
+        return statistics
+
+    def test_moments(self):
+        statistics = self._get_statistics([150, 1, 249])
+
+        self.assertEqual(statistics.nmr_samples, 400)
+        np.testing.assert_allclose(statistics.mean, np.mean(self._samples, axis=2))
+        np.testing.assert_allclose(statistics.std, np.std(self._samples, axis=2))
+        np.testing.assert_allclose(statistics.get_covariances(),
+                                   [np.cov(self._samples[ind]) for ind in range(self._samples.shape[0])])
+
+    def test_independent_of_block_sizes(self):
+        single = self._get_statistics([400])
+        blocks = self._get_statistics([7] * 57 + [1])
+
+        np.testing.assert_allclose(blocks.get_univariate_ess(), single.get_univariate_ess())
+        np.testing.assert_allclose(blocks.get_multivariate_ess(), single.get_multivariate_ess())
+        np.testing.assert_array_equal(blocks.get_acceptance_rates(), single.get_acceptance_rates())
+
+    def test_univariate_ess(self):
+        batch_size = 20
+        batch_means = self._samples.reshape((5, 3, -1, batch_size)).mean(axis=3)
+        batch_variance = batch_size * np.var(batch_means, axis=2, ddof=1)
+        expected = 400 * np.var(self._samples, axis=2) / batch_variance
+
+        np.testing.assert_allclose(self._get_statistics([400]).get_univariate_ess(), expected)
+
+    def test_acceptance_rates(self):
+        changes = np.count_nonzero(np.diff(self._samples, axis=2), axis=2)
+        np.testing.assert_allclose(self._get_statistics([100, 300]).get_acceptance_rates(), changes / 400)
+
+    def test_maxima(self):
+        statistics = self._get_statistics([100, 300])
+        problems = np.arange(5)
+
+        samples, values, indices = statistics.get_maximum_likelihood()
+        np.testing.assert_array_equal(indices, np.argmax(self._log_likelihoods, axis=1))
+        np.testing.assert_array_equal(values, np.max(self._log_likelihoods, axis=1))
+        np.testing.assert_array_equal(samples, self._samples[problems, :, indices.astype(int)])
+
+        posteriors = self._log_likelihoods + self._log_priors
+        samples, values, log_likelihoods, indices = statistics.get_maximum_a_posteriori()
+        np.testing.assert_array_equal(indices, np.argmax(posteriors, axis=1))
+        np.testing.assert_array_equal(values, np.max(posteriors, axis=1))
+        np.testing.assert_array_equal(log_likelihoods, self._log_likelihoods[problems, indices.astype(int)])
+        np.testing.assert_array_equal(samples, self._samples[problems, :, indices.astype(int)])
+
+    def test_derived_maps(self):
+        values = np.random.rand(4, 100)
+        statistics = StreamingSampleStatistics(4, 1, 100)
+        for start, end in [(0, 30), (30, 31), (31, 100)]:
+            block = values[:, start:end]
+            statistics.update_derived_maps({'a': np.mean(block, axis=1), 'a.std': np.std(block, axis=1),
+                                            'b': np.full(4, end - start)}, end - start)
+
+        derived = statistics.get_derived_maps()
+        np.testing.assert_allclose(derived['a'], np.mean(values, axis=1))
+        np.testing.assert_allclose(derived['a.std'], np.std(values, axis=1))
+        np.testing.assert_allclose(derived['b'], np.full(4, (30 ** 2 + 1 + 69 ** 2) / 100.))
+
+
+if __name__ == '__main__':
+    unittest.main()
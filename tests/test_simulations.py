@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_simulations
+----------------------------------
+
+Tests for the simulation of synthetic datasets, :mod:`mdt.simulations`.
+"""
+import unittest
+import numpy as np
+from pkg_resources import resource_filename
+import mdt
+from mdt.simulations import create_phantom, add_rician_noise
+
+
+class CreatePhantomTest(unittest.TestCase):
+
+    def setUp(self):
+        self._protocol = mdt.load_protocol(resource_filename('mdt', 'data/mdt_example_data/b1k_b2k/b1k_b2k.prtcl'))
+
+    def test_all_volumes_are_simulated(self):
+        for model_name in ['BallStick_r1', 'Tensor']:
+            with self.subTest(model_name=model_name):
+                input_data, ground_truth = create_phantom(model_name, self._protocol, 20, seed=0)
+
+                self.assertEqual(input_data.observations.shape, (20, self._protocol.length))
+                self.assertEqual(np.count_nonzero(input_data.mask), 20)
+                self.assertEqual(sorted(ground_truth), sorted(mdt.get_model(model_name)().get_free_param_names()))
+
+    def test_reproducible(self):
+        first = create_phantom('BallStick_r1', self._protocol, 10, seed=1)[0].observations
+        second = create_phantom('BallStick_r1', self._protocol, 10, seed=1)[0].observations
+        np.testing.assert_array_equal(first, second)
+
+
+class AddRicianNoiseTest(unittest.TestCase):
+
+    def test_rayleigh_without_signal(self):
+        noisy = add_rician_noise(np.zeros(100000), 2, seed=0)
+        self.assertAlmostEqual(np.mean(noisy), 2 * np.sqrt(np.pi / 2), delta=0.02)
+        self.assertAlmostEqual(np.mean(noisy ** 2), 2 * 2 ** 2, delta=0.1)
+
+    def test_high_snr(self):
+        noisy = add_rician_noise(np.full(100000, 100.), 2, seed=0)
+        self.assertAlmostEqual(np.mean(noisy ** 2), 100 ** 2 + 2 * 2 ** 2, delta=5)
+        self.assertAlmostEqual(np.std(noisy), 2, delta=0.05)
+
+    def test_dtype_and_seed(self):
+        signals = np.random.rand(10, 5).astype(np.float32)
+        noisy = add_rician_noise(signals, 0.1, seed=1)
+        self.assertEqual(noisy.dtype, np.float32)
+        np.testing.assert_array_equal(noisy, add_rician_noise(signals, 0.1, seed=1))
+
+
+if __name__ == '__main__':
+    unittest.main()
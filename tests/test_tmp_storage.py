@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_tmp_storage
+----------------------------------
+
+Tests for placing the temporary results in a RAM filesystem, :mod:`mdt.lib.tmp_storage`.
+"""
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+from mdt.lib import tmp_storage
+from mdt.lib.tmp_storage import get_ram_tmp_results_path, remove_stale_ram_tmp_results
+
+
+def _get_dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    return process.pid
+
+
+class RamTmpStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self._ram_dir = tempfile.mkdtemp('mdt_tmp_storage_test')
+        self._owned_dirs = set(tmp_storage._owned_dirs)
+
+    def tearDown(self):
+        tmp_storage._owned_dirs.intersection_update(self._owned_dirs)
+        shutil.rmtree(self._ram_dir)
+
+    def _get_path(self, estimated_size, enabled=True, memory_budget=None):
+        settings = {'enabled': enabled, 'path': self._ram_dir, 'memory_budget': memory_budget}
+        with mock.patch('mdt.lib.tmp_storage.get_ram_tmp_storage_settings', return_value=settings):
+            return get_ram_tmp_results_path('/output/BallStick_r1', estimated_size)
+
+    def _create_owned_dir(self, name, **owner):
+        path = os.path.join(self._ram_dir, name)
+        os.makedirs(path)
+        with open(path + '.owner', 'w') as f:
+            json.dump(dict({'hostname': socket.gethostname(), 'pid': os.getpid(), 'start_time': None}, **owner), f)
+        return path
+
+    def test_disabled(self):
+        self.assertIsNone(self._get_path(1024, enabled=False))
+
+    def test_memory_budget(self):
+        self.assertIsNone(self._get_path(2 * 1024 ** 2, memory_budget=1))
+
+        path = self._get_path(1024, memory_budget=1)
+        self.assertEqual(os.path.dirname(path), self._ram_dir)
+        self.assertIn(path, tmp_storage._owned_dirs)
+        self.assertEqual(self._get_path(1024, memory_budget=1), path)
+
+        with open(path + '.owner', 'r') as f:
+            owner = json.load(f)
+        self.assertEqual(owner['pid'], os.getpid())
+        self.assertEqual(owner['hostname'], socket.gethostname())
+
+    def test_remove_owned_dirs(self):
+        path = self._get_path(1024)
+        os.makedirs(path)
+
+        tmp_storage._remove_owned_dirs()
+        self.assertEqual(os.listdir(self._ram_dir), [])
+
+    @unittest.skipIf(os.name != 'posix', 'Stale results are only removed on POSIX systems.')
+    def test_remove_stale(self):
+        dead_pid = _get_dead_pid()
+        start_time = tmp_storage._get_process_start_time(os.getpid())
+
+        running = self._create_owned_dir('running', start_time=start_time)
+        dead = self._create_owned_dir('dead', pid=dead_pid)
+        other_host = self._create_owned_dir('other_host', pid=dead_pid, hostname=socket.gethostname() + '_other')
+        without_token = os.path.join(self._ram_dir, '{}_without_token'.format(dead_pid))
+        os.makedirs(without_token)
+
+        remove_stale_ram_tmp_results(self._ram_dir)
+
+        self.assertTrue(os.path.isdir(running))
+        self.assertFalse(os.path.exists(dead))
+        self.assertFalse(os.path.exists(dead + '.owner'))
+        self.assertTrue(os.path.isdir(other_host))
+        self.assertTrue(os.path.isdir(without_token))
+
+    @unittest.skipIf(tmp_storage._get_process_start_time(os.getpid()) is None, 'The process start time is unknown.')
+    def test_remove_stale_reused_pid(self):
+        start_time = tmp_storage._get_process_start_time(os.getpid())
+        reused = self._create_owned_dir('reused', start_time=start_time - 1)
+
+        remove_stale_ram_tmp_results(self._ram_dir)
+        self.assertFalse(os.path.exists(reused))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_utils
+----------------------------------
+
+Tests for the conversion between volumes and ROIs using the cached mask indices, :class:`mdt.utils.MaskIndex`.
+"""
+import unittest
+import numpy as np
+from mdt.utils import MaskIndex, get_mask_index, create_roi, restore_volumes, roi_index_to_volume_index, \
+    volume_index_to_roi_index, create_index_matrix
+
+
+class MaskIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self._mask = np.random.rand(5, 6, 7) > 0.5
+        self._volume = np.random.rand(5, 6, 7, 3)
+
+    def test_indices(self):
+        mask_index = MaskIndex(self._mask)
+
+        self.assertEqual(mask_index.nmr_voxels, np.count_nonzero(self._mask))
+        np.testing.assert_array_equal(mask_index.flat_indices, np.flatnonzero(self._mask))
+        np.testing.assert_array_equal(mask_index.volume_indices, np.argwhere(self._mask))
+
+        index_matrix = mask_index.index_matrix
+        np.testing.assert_array_equal(index_matrix[self._mask], np.arange(mask_index.nmr_voxels))
+        self.assertTrue(np.all(index_matrix[~self._mask] == 0))
+
+    def test_read_only(self):
+        mask_index = MaskIndex(self._mask)
+        for array in [mask_index.mask, mask_index.flat_indices, mask_index.volume_indices, mask_index.index_matrix]:
+            self.assertFalse(array.flags.writeable)
+
+    def test_roi_conversions(self):
+        mask_index = MaskIndex(self._mask)
+
+        np.testing.assert_array_equal(mask_index.create_roi(self._volume), self._volume[self._mask])
+        np.testing.assert_array_equal(mask_index.create_roi(self._volume[..., 0]),
+                                      self._volume[..., 0][self._mask][:, None])
+        np.testing.assert_array_equal(mask_index.create_roi(np.asfortranarray(self._volume)),
+                                      self._volume[self._mask])
+
+        restored = mask_index.restore_volume(self._volume[self._mask])
+        np.testing.assert_array_equal(restored[self._mask], self._volume[self._mask])
+        self.assertTrue(np.all(restored[~self._mask] == 0))
+
+        self.assertEqual(mask_index.restore_volume(self._volume[..., 0][self._mask]).shape, (5, 6, 7, 1))
+        self.assertEqual(mask_index.restore_volume(self._volume[..., 0][self._mask], with_volume_dim=False).shape,
+                         (5, 6, 7))
+
+    def test_module_functions(self):
+        roi = create_roi(self._volume, self._mask)
+        np.testing.assert_array_equal(roi, self._volume[self._mask])
+        np.testing.assert_array_equal(restore_volumes(roi, self._mask)[self._mask], roi)
+
+        roi_index = np.count_nonzero(self._mask) // 2
+        volume_index = roi_index_to_volume_index(roi_index, self._mask)
+        np.testing.assert_array_equal(volume_index, np.argwhere(self._mask)[roi_index])
+        self.assertEqual(volume_index_to_roi_index(tuple(volume_index), self._mask), roi_index)
+
+        volume_index[0] = -1
+        np.testing.assert_array_equal(get_mask_index(self._mask).volume_indices, np.argwhere(self._mask))
+
+        index_matrix = create_index_matrix(self._mask)
+        index_matrix[0, 0, 0] = -1
+        self.assertNotEqual(get_mask_index(self._mask).index_matrix[0, 0, 0], -1)
+
+    def test_cache(self):
+        mask_index = get_mask_index(self._mask)
+        self.assertIs(get_mask_index(self._mask.copy()), mask_index)
+        self.assertIs(get_mask_index(mask_index), mask_index)
+        self.assertIsNot(get_mask_index(~self._mask), mask_index)
+
+
+if __name__ == '__main__':
+    unittest.main()